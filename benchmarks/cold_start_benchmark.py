@@ -0,0 +1,61 @@
+"""Cold start cost of the layer runtime.
+
+Imports `lambda_runtime.py` in fresh interpreters, the way the bootstrap starts it, and
+reports the import time with boto3 loaded lazily, as a dormant or normal sandbox does,
+against loading boto3 eagerly, as the debug path does:
+
+    python -m benchmarks.cold_start_benchmark
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+RUNTIME_PATH = Path(__file__).parent.parent / "plldb" / "cloudformation" / "layer" / "lambda_runtime.py"
+
+STATEMENTS = {"lazy": "import lambda_runtime", "eager": "import lambda_runtime, boto3"}
+
+
+def run_statement(runtime: Path, statement: str, probe: str) -> str:
+    """Run the statement in a fresh interpreter that can import the runtime, returns what the probe printed."""
+    code = f"import sys, time; sys.path.insert(0, {str(runtime.parent)!r}); start = time.perf_counter(); {statement}; print({probe})"
+    return subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60, check=True).stdout.strip()
+
+
+def measure_import(runtime: Path, statement: str, repeat: int) -> float:
+    """Fastest import time in milliseconds of the statement over fresh interpreters."""
+    runs = [float(run_statement(runtime, statement, "time.perf_counter() - start")) for _ in range(repeat)]
+    return min(runs) * 1000
+
+
+def loads_boto3(runtime: Path, statement: str) -> bool:
+    """Whether boto3 is loaded once the statement ran in a fresh interpreter."""
+    return run_statement(runtime, statement, "'boto3' in sys.modules") == "True"
+
+
+def run_benchmark(runtime: Path, repeat: int) -> Dict[str, float]:
+    return {name: measure_import(runtime, statement, repeat) for name, statement in STATEMENTS.items()}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure the cold start of the PLLDB layer runtime with lazy and eager boto3")
+    parser.add_argument("--repeat", type=int, default=5, help="Interpreters started per measurement, the fastest is reported")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(RUNTIME_PATH, args.repeat)
+
+    print(f"Cold start: lazy boto3 {results['lazy']:.1f} ms, eager boto3 {results['eager']:.1f} ms")
+    if loads_boto3(RUNTIME_PATH, STATEMENTS["lazy"]):
+        print("Importing the runtime loads boto3, the lazy measurement includes it", file=sys.stderr)
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps({"version": 1, "runtime": str(RUNTIME_PATH), "importMs": results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
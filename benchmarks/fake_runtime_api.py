@@ -0,0 +1,172 @@
+"""Local stand-in for the Lambda Runtime API, shared by the layer runtime tests and the runtime benchmark."""
+
+import json
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class _RuntimeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A runtime stopped between posting a result and reading the reply is not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeRuntimeApi:
+    """Serve queued invocations and record what the runtime posts back.
+
+    Invocations are queued with `add_invocation` and handed out by the
+    `/invocation/next` endpoint, which blocks like the real one does. Results
+    posted by the runtime are collected in `responses`, `errors`,
+    `init_errors` and `restore_errors`. Streamed responses are read chunk by chunk
+    as they arrive; their chunks and trailers are kept in `streams`, the joined
+    body in `responses`. `/restore/next` answers at once, as if
+    the snapshot was restored right away. The server speaks HTTP/1.1, so connections are kept alive,
+    and `connections` counts how many were opened. `handed_out` and
+    `completed` hold the `perf_counter` time at which each invocation was
+    handed to the runtime and its result was posted back.
+    """
+
+    def __init__(self, next_timeout: float = 5.0):
+        self.next_timeout = next_timeout
+        self.invocations: "queue.Queue[Tuple[bytes, Dict[str, str]]]" = queue.Queue()
+        self.responses: Dict[str, bytes] = {}
+        self.errors: Dict[str, Dict[str, Any]] = {}
+        self.init_errors: List[Dict[str, Any]] = []
+        self.restore_errors: List[Dict[str, Any]] = []
+        self.streams: Dict[str, Dict[str, Any]] = {}
+        self.requests: List[Tuple[str, str, Dict[str, str]]] = []
+        self.connections = 0
+        self.handed_out: Dict[str, float] = {}
+        self.completed: Dict[str, float] = {}
+        self._results = threading.Condition()
+        self._server = _RuntimeApiServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def add_invocation(self, event: Any, request_id: str, headers: Optional[Dict[str, str]] = None) -> None:
+        """Queue an invocation, the event is sent as is when given as bytes."""
+        body = event if isinstance(event, bytes) else json.dumps(event).encode()
+        self.invocations.put((body, {"Lambda-Runtime-Aws-Request-Id": request_id, **(headers or {})}))
+
+    def wait_for_results(self, count: int, timeout: float = 10.0) -> None:
+        """Wait until the runtime has posted the given number of responses and errors."""
+        with self._results:
+            if not self._results.wait_for(lambda: len(self.responses) + len(self.errors) >= count, timeout):
+                raise TimeoutError(f"Runtime posted {len(self.responses) + len(self.errors)} of {count} results")
+
+    def wait_for_chunks(self, request_id: str, count: int, timeout: float = 10.0) -> None:
+        """Wait until the given number of chunks of a streamed response arrived."""
+        with self._results:
+            if not self._results.wait_for(lambda: len(self.streams.get(request_id, {}).get("chunks", [])) >= count, timeout):
+                raise TimeoutError(f"Runtime streamed fewer than {count} chunks")
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _record(self, request_id: Optional[str], body: bytes, kind: str) -> None:
+        with self._results:
+            if request_id is not None:
+                self.completed[request_id] = time.perf_counter()
+            if kind == "response":
+                self.responses[request_id or ""] = body
+            elif kind == "error":
+                self.errors[request_id or ""] = json.loads(body)
+            elif kind == "restore_error":
+                self.restore_errors.append(json.loads(body))
+            else:
+                self.init_errors.append(json.loads(body))
+            self._results.notify_all()
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                api.connections += 1
+                super().setup()
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                api.requests.append(("GET", self.path, dict(self.headers)))
+                if self.path.endswith("/runtime/restore/next"):
+                    self._reply(200, b"")
+                    return
+                if not self.path.endswith("/runtime/invocation/next"):
+                    self._reply(404, b"")
+                    return
+                try:
+                    body, headers = api.invocations.get(timeout=api.next_timeout)
+                except queue.Empty:
+                    self._reply(500, b'{"errorMessage": "No invocation queued"}')
+                    return
+                api.handed_out[headers["Lambda-Runtime-Aws-Request-Id"]] = time.perf_counter()
+                self._reply(200, body, headers)
+
+            def do_POST(self):
+                api.requests.append(("POST", self.path, dict(self.headers)))
+                parts = self.path.split("/")
+                if self.headers.get("Transfer-Encoding") == "chunked":
+                    self._read_stream(parts[-2])
+                    self._reply(202, b'{"status": "OK"}')
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.endswith("/init/error"):
+                    api._record(None, body, "init_error")
+                elif self.path.endswith("/restore/error"):
+                    api._record(None, body, "restore_error")
+                elif parts[-1] in ("response", "error"):
+                    api._record(parts[-2], body, parts[-1])
+                else:
+                    self._reply(404, b"")
+                    return
+                self._reply(202, b'{"status": "OK"}')
+
+            def _read_stream(self, request_id: str):
+                stream: Dict[str, Any] = {"chunks": [], "trailers": {}, "mode": self.headers.get("Lambda-Runtime-Function-Response-Mode")}
+                with api._results:
+                    api.streams[request_id] = stream
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    if size == 0:
+                        break
+                    chunk = self.rfile.read(size)
+                    self.rfile.readline()
+                    with api._results:
+                        stream["chunks"].append(chunk)
+                        api._results.notify_all()
+                while True:
+                    line = self.rfile.readline().strip()
+                    if not line:
+                        break
+                    name, _, value = line.decode().partition(":")
+                    stream["trailers"][name] = value.strip()
+                api._record(request_id, b"".join(stream["chunks"]), "response")
+
+            def _reply(self, status: int, body: bytes, headers: Optional[Dict[str, str]] = None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
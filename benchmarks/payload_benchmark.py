@@ -0,0 +1,160 @@
+"""Per-hop cost of carrying large payloads through the layer runtime.
+
+Drives one event and one debugger response of a given size through the hops of the
+debug path, with the Runtime API and S3 replaced by in-memory stubs, and reports the CPU
+time and the peak of Python allocations of each hop:
+
+- NextInvocation: reading the event from the Runtime API
+- Routing: evaluating routing rules that select by function only
+- PayloadOffload: serializing the request and uploading it to S3
+- ResponseRead: reading the offloaded response of the debugger from S3
+- RuntimeResponse: posting the response to the Runtime API
+
+Any version of `lambda_runtime.py` can be measured, so a change can be compared with
+the runtime it replaces:
+
+    git show HEAD~1:plldb/cloudformation/layer/lambda_runtime.py > /tmp/before.py
+    python -m benchmarks.payload_benchmark --runtime /tmp/before.py
+    python -m benchmarks.payload_benchmark
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Optional
+
+RUNTIME_PATH = Path(__file__).parent.parent / "plldb" / "cloudformation" / "layer" / "lambda_runtime.py"
+
+DEFAULT_SIZES_MB = (1.0, 4.0)
+
+
+def load_runtime(path: Path) -> ModuleType:
+    spec = importlib.util.spec_from_file_location("lambda_runtime_under_benchmark", path)
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_document(size: int) -> bytes:
+    """JSON document of about the given size, shaped like an API Gateway event with many records."""
+    record = {"id": "0" * 8, "name": "order item", "quantity": 3, "price": 12.5, "tags": ["a", "b", "c"], "attributes": {"color": "red", "size": "M"}}
+    count = max(1, size // len(json.dumps(record)))
+    return json.dumps({"httpMethod": "POST", "path": "/orders", "headers": {"Content-Type": "application/json"}, "records": [record] * count}).encode()
+
+
+class StubRuntimeApiClient:
+    def __init__(self, event: bytes):
+        self.event = event
+        self.posted: Optional[bytes] = None
+
+    def next_invocation(self):
+        return self.event, {"Lambda-Runtime-Aws-Request-Id": "request-1", "Lambda-Runtime-Deadline-Ms": str(int(time.time() * 1000) + 60000)}
+
+    def post_response(self, request_id: str, body: bytes) -> None:
+        self.posted = body
+
+
+class StubS3Client:
+    def __init__(self, objects: Dict[str, bytes]):
+        self.objects = objects
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs: Any) -> None:
+        self.objects[f"s3://{Bucket}/{Key}"] = Body
+
+    def get_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        return {"Body": io.BytesIO(self.objects[f"s3://{Bucket}/{Key}"])}
+
+
+def measure(call: Callable[[Any], Any], repeat: int, setup: Callable[[], Any] = lambda: None) -> Dict[str, float]:
+    """Median CPU time and peak of Python allocations of the call, given what the untimed setup returns.
+
+    Allocations are traced in a separate run, tracing slows down the allocating code.
+    """
+    cpu: List[float] = []
+    for _ in range(repeat):
+        value = setup()
+        start = time.process_time()
+        call(value)
+        cpu.append((time.process_time() - start) * 1000)
+
+    value = setup()
+    tracemalloc.start()
+    try:
+        call(value)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"cpuMs": statistics.median(cpu), "peakAllocMb": peak / 1024 / 1024}
+
+
+def run_benchmark(runtime: ModuleType, size: int, repeat: int) -> Dict[str, Dict[str, float]]:
+    """Measure each hop of the debug path for an event and a response of the given size."""
+    document = make_document(size)
+    objects: Dict[str, bytes] = {"s3://payloads/response.json": document}
+    runtime_api = StubRuntimeApiClient(document)
+    runtime.get_runtime_api_client = lambda _: runtime_api
+    runtime.get_s3_client = lambda _: StubS3Client(objects)
+    runtime.get_payload_bucket = lambda: "payloads"
+
+    event, context = runtime.get_next_invocation("stub")
+    response = runtime.read_response(None, "", "s3://payloads/response.json")
+    environment = runtime.EnvironmentSnapshot({"AWS_LAMBDA_FUNCTION_NAME": "benchmark"})
+    rules = {"functions": ["benchmark"]}
+
+    results = {
+        "NextInvocation": measure(lambda _: runtime.get_next_invocation("stub"), repeat),
+        # A fresh event for each run, a document is decoded on first access by the hop that needs it
+        "Routing": measure(lambda fresh: runtime.matches_routing_rules(rules, fresh, "benchmark"), repeat, lambda: runtime.get_next_invocation("stub")[0]),
+        "PayloadOffload": measure(lambda _: runtime.offload_request_payload(None, "session-1", "request-1", event, context.to_dict(), None, environment), repeat),
+        "ResponseRead": measure(lambda _: runtime.read_response(None, "", "s3://payloads/response.json"), repeat),
+        "RuntimeResponse": measure(lambda _: runtime.send_response("stub", "request-1", response), repeat),
+    }
+    assert runtime_api.posted is not None and json.loads(runtime_api.posted) == json.loads(document)
+    return results
+
+
+def format_results(results: Dict[str, Dict[str, Dict[str, float]]]) -> str:
+    lines = []
+    for size, hops in results.items():
+        lines.append(f"{size} MB payloads:")
+        for name, stats in hops.items():
+            lines.append(f"  {name:<16} cpu {stats['cpuMs']:>9.3f} ms  peak allocations {stats['peakAllocMb']:>8.2f} MB")
+        total_cpu = sum(stats["cpuMs"] for stats in hops.values())
+        lines.append(f"  {'Total':<16} cpu {total_cpu:>9.3f} ms")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure the per-hop cost of large payloads in the PLLDB layer runtime")
+    parser.add_argument("--runtime", type=Path, default=RUNTIME_PATH, help="lambda_runtime.py to measure (default: the one of the layer)")
+    parser.add_argument("--size-mb", type=float, action="append", help="Payload size in MB, can be repeated (default: 1 and 4)")
+    parser.add_argument("--repeat", type=int, default=10, help="Measurements per hop, the median CPU time is reported")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    args = parser.parse_args(argv)
+
+    # The stubs stand in for every AWS call, keep the runtime from looking for credentials
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    runtime = load_runtime(args.runtime)
+    # The runtime logs every offloaded payload
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {str(size): run_benchmark(runtime, int(size * 1024 * 1024), args.repeat) for size in args.size_mb or DEFAULT_SIZES_MB}
+
+    print(format_results(results))
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps({"version": 1, "runtime": str(args.runtime), "sizes": results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,374 @@
+"""Offline benchmark of the layer runtime.
+
+Runs the real runtime loop (`lambda_runtime.py`) in a subprocess, the way Lambda runs the
+bootstrap, against local stand-ins for everything it talks to:
+
+- the Lambda Runtime API, served by `benchmarks.fake_runtime_api.FakeRuntimeApi`
+- STS and DynamoDB, served by a moto server
+- the API Gateway Management API of the WebSocket API, served by `FakeManagementApi`,
+  which acts as the debugger and stores an answer for every request it is notified about
+
+Each mode drives a number of invocations and reports throughput and p50/p99 latencies.
+In the debug modes the per-phase durations are read from the EMF lines the runtime writes.
+`debug-builtin` makes the AWS calls with the built-in SigV4 client instead of boto3. The
+init duration (until the runtime asks for the first invocation) and the peak memory of
+the runtime process are reported as well.
+Results are written as JSON and can be compared to a previous run to catch regressions:
+
+    python -m benchmarks.runtime_benchmark --invocations 2000 --output baseline.json
+    python -m benchmarks.runtime_benchmark --invocations 2000 --baseline baseline.json
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+from benchmarks.fake_runtime_api import FakeRuntimeApi
+
+RUNTIME_PATH = Path(__file__).resolve().parent.parent / "plldb" / "cloudformation" / "layer" / "lambda_runtime.py"
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+RESULTS_VERSION = 1
+
+MODES = ("normal", "debug", "debug-builtin")
+SESSION_ID = "benchmark-session"
+CONNECTION_ID = "benchmark-connection"
+FUNCTION_NAME = "BenchmarkFunction"
+REGION = "us-east-1"
+
+HANDLER_SOURCE = """import json
+
+
+def handler(event, context):
+    return {"statusCode": 200, "body": json.dumps({"path": event["path"], "length": len(event["body"])})}
+"""
+
+EVENT = {
+    "httpMethod": "POST",
+    "path": "/orders",
+    "headers": {"Content-Type": "application/json", "User-Agent": "plldb-benchmark"},
+    "requestContext": {"stage": "prod", "requestId": "benchmark"},
+    "body": json.dumps({"items": [{"sku": f"SKU-{i}", "quantity": i} for i in range(32)]}),
+}
+
+
+class FakeManagementApi:
+    """Stand-in for the API Gateway Management API that answers like an attached debugger.
+
+    Requests posted to `/@connections/{id}` are acknowledged right away and answered
+    by a worker thread, which writes the response to the PLLDBDebugger table like the
+    WebSocket API default route does. `GET /@connections/{id}` reports the connection
+    as alive.
+    """
+
+    def __init__(self, dynamodb_endpoint: str):
+        self._table = boto3.resource("dynamodb", endpoint_url=dynamodb_endpoint, region_name=REGION).Table("PLLDBDebugger")
+        self._requests: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._threads = [threading.Thread(target=self._server.serve_forever, daemon=True), threading.Thread(target=self._answer_requests, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def shutdown(self) -> None:
+        self._requests.put(None)
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _answer_requests(self) -> None:
+        while (request := self._requests.get()) is not None:
+            event = json.loads(request["event"])
+            response = json.dumps({"statusCode": 200, "body": json.dumps({"path": event["path"], "length": len(event["body"])})})
+            try:
+                self._table.update_item(
+                    Key={"RequestId": request["requestId"]},
+                    UpdateExpression="SET #resp = :resp, StatusCode = :status",
+                    ConditionExpression="attribute_not_exists(Superseded)",
+                    ExpressionAttributeNames={"#resp": "Response"},
+                    ExpressionAttributeValues={":resp": response, ":status": 200},
+                )
+            except Exception as e:
+                print(f"Failed to answer request {request['requestId']}: {e}", file=sys.stderr)
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if not self.path.startswith("/@connections/"):
+                    self._reply(404, b"")
+                    return
+                connection = {"ConnectedAt": datetime.now(timezone.utc).isoformat(), "Identity": {"SourceIp": "127.0.0.1", "UserAgent": "plldb"}}
+                self._reply(200, json.dumps(connection).encode())
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not self.path.startswith("/@connections/"):
+                    self._reply(404, b"")
+                    return
+                api._requests.put(json.loads(body))
+                self._reply(200, b"")
+
+            def _reply(self, status: int, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """p50, p99 and mean of latencies in milliseconds."""
+    return {"p50": round(percentile(values, 50), 3), "p99": round(percentile(values, 99), 3), "mean": round(sum(values) / len(values), 3)}
+
+
+def read_peak_memory_kb(pid: int) -> Optional[int]:
+    """Peak resident memory of a process, None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def create_tables(dynamodb_endpoint: str) -> None:
+    """Create the PLLDB tables and an active debugger session."""
+    dynamodb = boto3.resource("dynamodb", endpoint_url=dynamodb_endpoint, region_name=REGION)
+    for name, key in (("PLLDBDebugger", "RequestId"), ("PLLDBSessions", "SessionId")):
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+    dynamodb.Table("PLLDBSessions").put_item(Item={"SessionId": SESSION_ID, "ConnectionId": CONNECTION_ID, "Status": "ACTIVE", "StackName": "benchmark"})
+
+
+def runtime_environment(mode: str, runtime_api: str, task_root: str, aws_endpoint: str, management_endpoint: str) -> Dict[str, str]:
+    """Environment of the runtime process, as Lambda and the debugger instrumentation would set it."""
+    environment = {
+        "PATH": os.environ.get("PATH", ""),
+        "PYTHONPATH": os.pathsep.join(sys.path),
+        "AWS_LAMBDA_RUNTIME_API": runtime_api,
+        "AWS_LAMBDA_FUNCTION_NAME": FUNCTION_NAME,
+        "AWS_LAMBDA_FUNCTION_VERSION": "$LATEST",
+        "AWS_LAMBDA_FUNCTION_MEMORY_SIZE": "128",
+        "AWS_REGION": REGION,
+        "AWS_DEFAULT_REGION": REGION,
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_ENDPOINT_URL": aws_endpoint,
+        "LAMBDA_TASK_ROOT": task_root,
+        "_HANDLER": "benchmark_handler.handler",
+    }
+    if mode.startswith("debug"):
+        environment.update(
+            {
+                "DEBUGGER_SESSION_ID": SESSION_ID,
+                "DEBUGGER_CONNECTION_ID": CONNECTION_ID,
+                "DEBUGGER_WEBSOCKET_API_ENDPOINT": management_endpoint,
+                # The stand-in cannot accept WebSocket connections, responses are read from the table
+                "DEBUGGER_RESPONSE_PUSH": "0",
+                "DEBUGGER_POLL_INITIAL_INTERVAL_MS": "2",
+                "DEBUGGER_POLL_MAX_INTERVAL_MS": "20",
+            }
+        )
+    if mode == "debug-builtin":
+        environment["DEBUGGER_AWS_BACKEND"] = "builtin"
+    return environment
+
+
+def run_mode(mode: str, invocations: int, warmup: int, aws_endpoint: str, management_endpoint: str, task_root: str, timeout: float) -> Dict[str, Any]:
+    """Drive the invocations through a fresh runtime process and summarize the measurements.
+
+    The warm-up invocations, including the cold start, are not measured. The first one
+    tells how long the runtime took from being started to asking for an invocation.
+    """
+    runtime_api = FakeRuntimeApi(next_timeout=timeout)
+    environment = runtime_environment(mode, runtime_api.address, task_root, aws_endpoint, management_endpoint)
+    spawned = time.perf_counter()
+    process = subprocess.Popen([sys.executable, str(RUNTIME_PATH)], env=environment, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    emf_lines: List[Dict[str, Any]] = []
+
+    def read_output() -> None:
+        assert process.stdout is not None
+        for line in process.stdout:
+            if line.startswith('{"_aws"'):
+                emf_lines.append(json.loads(line))
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+
+    try:
+        for i in range(warmup):
+            runtime_api.add_invocation(EVENT, f"warmup-{i}")
+        runtime_api.wait_for_results(warmup, timeout=timeout)
+
+        started = time.perf_counter()
+        for i in range(invocations):
+            runtime_api.add_invocation(EVENT, f"{mode}-{i}")
+        runtime_api.wait_for_results(warmup + invocations, timeout=timeout + invocations)
+        elapsed = time.perf_counter() - started
+        peak_memory_kb = read_peak_memory_kb(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+        reader.join()
+        runtime_api.shutdown()
+
+    measured = [f"{mode}-{i}" for i in range(invocations)]
+    latencies: Dict[str, List[float]] = {"Init": [(runtime_api.handed_out["warmup-0"] - spawned) * 1000]} if warmup else {}
+    latencies["Invocation"] = [(runtime_api.completed[request_id] - runtime_api.handed_out[request_id]) * 1000 for request_id in measured]
+    for line in emf_lines:
+        if line["RequestId"].startswith("warmup-"):
+            continue
+        for name, value in line.items():
+            if name.endswith("Duration"):
+                latencies.setdefault(name[: -len("Duration")], []).append(value)
+
+    return {
+        "invocations": invocations,
+        "errors": len(runtime_api.errors),
+        "durationSeconds": round(elapsed, 3),
+        "throughput": round(invocations / elapsed, 2),
+        "peakMemoryKb": peak_memory_kb,
+        "latency": {name: summarize(values) for name, values in latencies.items()},
+    }
+
+
+def run_benchmark(modes: List[str], invocations: int, warmup: int = 20, timeout: float = 30.0) -> Dict[str, Any]:
+    """Run the benchmark in the given modes against freshly started stand-ins."""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    aws_endpoint = f"http://{host}:{port}"
+    management_api = None
+    try:
+        # moto keeps its state in this process, the runtime only reaches it over HTTP
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        create_tables(aws_endpoint)
+        management_api = FakeManagementApi(aws_endpoint)
+        with tempfile.TemporaryDirectory() as task_root:
+            Path(task_root, "benchmark_handler.py").write_text(HANDLER_SOURCE)
+            results = {mode: run_mode(mode, invocations, warmup, aws_endpoint, management_api.endpoint, task_root, timeout) for mode in modes}
+    finally:
+        if management_api is not None:
+            management_api.shutdown()
+        server.stop()
+
+    return {
+        "version": RESULTS_VERSION,
+        "createdAt": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "modes": results,
+    }
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float, min_delta_ms: float = 0.5) -> List[str]:
+    """Describe the regressions of the current results against the baseline.
+
+    A latency regressed when its p50 or p99 grew by more than the threshold (a fraction)
+    and by more than `min_delta_ms`, so sub-millisecond phases do not flap on noise.
+    Throughput regressed when it dropped by more than the threshold.
+    """
+    if baseline.get("version") != current.get("version"):
+        raise ValueError(f"Cannot compare results of version {baseline.get('version')} and {current.get('version')}")
+
+    regressions = []
+    for mode, result in current["modes"].items():
+        base = baseline["modes"].get(mode)
+        if base is None:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - threshold):
+            regressions.append(f"{mode}: throughput {base['throughput']:.2f}/s -> {result['throughput']:.2f}/s")
+        for name, stats in result["latency"].items():
+            base_stats = base["latency"].get(name)
+            if base_stats is None:
+                continue
+            for key in ("p50", "p99"):
+                if stats[key] > base_stats[key] * (1 + threshold) and stats[key] - base_stats[key] > min_delta_ms:
+                    regressions.append(f"{mode}: {name} {key} {base_stats[key]:.3f} ms -> {stats[key]:.3f} ms")
+    return regressions
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    lines = []
+    for mode, result in results["modes"].items():
+        memory = f", peak memory {result['peakMemoryKb'] / 1024:.1f} MB" if result.get("peakMemoryKb") else ""
+        lines.append(f"{mode}: {result['invocations']} invocations in {result['durationSeconds']:.2f} s, {result['throughput']:.2f}/s, {result['errors']} errors{memory}")
+        for name, stats in result["latency"].items():
+            lines.append(f"  {name:<20} p50 {stats['p50']:>9.3f} ms  p99 {stats['p99']:>9.3f} ms  mean {stats['mean']:>9.3f} ms")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the PLLDB layer runtime against local stand-ins of AWS")
+    parser.add_argument("--mode", choices=MODES, action="append", help="Mode to run, can be repeated (default: all modes)")
+    parser.add_argument("--invocations", type=int, default=1000, help="Measured invocations per mode")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured invocations before the measured ones")
+    parser.add_argument("--output", type=Path, help="Where to write the results (default: benchmarks/results/runtime-<timestamp>.json)")
+    parser.add_argument("--baseline", type=Path, help="Results of a previous run to compare to, exits with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown when comparing to the baseline")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.mode or list(MODES), args.invocations, args.warmup)
+    print(format_results(results))
+
+    output = args.output or RESULTS_DIR / f"runtime-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        regressions = compare_results(json.loads(args.baseline.read_text()), results, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
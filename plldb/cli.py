@@ -1,5 +1,7 @@
 import asyncio
+import json
 import logging
+from typing import Any, Dict, Tuple
 
 import boto3
 import click
@@ -60,11 +62,39 @@ def destroy(ctx):
 @click.option("--debugpy", is_flag=True, default=False, help="Enable debugpy server")
 @click.option("--debugpy-port", default=5678, type=int, help="Port for the debugpy server (default: 5678)")
 @click.option("--debugpy-host", default="127.0.0.1", help="Host for the debugpy server (default: 127.0.0.1)")
+@click.option("--compression", type=click.Choice(["none", "zlib"]), default="none", help="Compress debug payloads exchanged with the stack (default: none)")
+@click.option(
+    "--mode",
+    type=click.Choice(["debug", "shadow"]),
+    default="debug",
+    help="debug: invocations wait for the local debugger; shadow: the deployed handler answers and a copy is replayed locally (default: debug)",
+)
+@click.option(
+    "--interception",
+    type=click.Choice(["runtime", "extension"]),
+    default="runtime",
+    help="runtime: the layer replaces the Python runtime; extension: the managed runtime keeps running and a Lambda extension redirects the handler calls (default: runtime)",
+)
+@click.option(
+    "--snapstart",
+    is_flag=True,
+    default=False,
+    help="Enable SnapStart on the instrumented functions and publish a version of each, which starts from a snapshot of the initialized debug runtime",
+)
+@click.option(
+    "--access",
+    type=click.Choice(["assume-role", "direct"]),
+    default="assume-role",
+    help="assume-role: the debug runtime assumes PLLDBDebuggerRole; direct: the function roles are granted its permissions, saving the STS round trips (default: assume-role)",
+)
 @click.pass_context
-def attach(ctx, stack_name: str, debugpy: bool, debugpy_port: int, debugpy_host: str):
+def attach(ctx, stack_name: str, debugpy: bool, debugpy_port: int, debugpy_host: str, compression: str, mode: str, interception: str, snapstart: bool, access: str):
     """Attach debugger to a CloudFormation stack"""
     session = ctx.obj["session"]
 
+    if snapstart and interception != "runtime":
+        raise click.UsageError("--snapstart requires --interception runtime")
+
     try:
         # Start debugpy server if enabled
         if debugpy:
@@ -104,7 +134,15 @@ def attach(ctx, stack_name: str, debugpy: bool, debugpy_port: int, debugpy_host:
 
         # Create debug session via REST API
         rest_client = RestApiClient(session)
-        session_id = rest_client.create_session(endpoints["rest_api_url"], stack_name)
+        session_id = rest_client.create_session(
+            endpoints["rest_api_url"],
+            stack_name,
+            None if compression == "none" else compression,
+            None if mode == "debug" else mode,
+            None if interception == "runtime" else interception,
+            snapstart,
+            None if access == "assume-role" else access,
+        )
 
         click.echo(f"Created debug session: {session_id}")
         click.echo("Connecting to WebSocket API...")
@@ -126,6 +164,68 @@ def attach(ctx, stack_name: str, debugpy: bool, debugpy_port: int, debugpy_host:
         ctx.exit(1)
 
 
+def parse_predicate(text: str) -> Dict[str, Any]:
+    """Parse an event predicate given as PATH=VALUE, or PATH to only require the path to exist."""
+    path, separator, value = text.partition("=")
+    if not path.startswith("$"):
+        raise click.BadParameter(f"Event path must start with $: {path}", param_hint="--match")
+    if not separator:
+        return {"path": path}
+    try:
+        return {"path": path, "equals": json.loads(value)}
+    except json.JSONDecodeError:
+        return {"path": path, "equals": value}
+
+
+@cli.command()
+@click.option("--session-id", required=True, help="ID of the debug session created by plldb attach")
+@click.option("--stack-name", help="Name of the attached CloudFormation stack, required with --function")
+@click.option("--function", "functions", multiple=True, help="Logical ID of a function to forward, can be repeated")
+@click.option("--sample-rate", type=click.FloatRange(0, 100), help="Percentage of the selected invocations to forward")
+@click.option("--match", "predicates", multiple=True, help="Event predicate PATH=VALUE or PATH, e.g. '$.httpMethod=POST', can be repeated")
+@click.pass_context
+def route(ctx, session_id: str, stack_name: str, functions: Tuple[str, ...], sample_rate: float, predicates: Tuple[str, ...]):
+    """Select the invocations forwarded to the debugger.
+
+    The rules apply to the running session without reinstrumenting the stack. Without
+    options, every invocation is forwarded again.
+    """
+    session = ctx.obj["session"]
+
+    try:
+        routing_rules: Dict[str, Any] = {}
+        if functions:
+            if not stack_name:
+                raise click.BadParameter("--stack-name is required with --function", param_hint="--stack-name")
+            # The runtime knows its function name, not the logical ID in the stack
+            cfn_client = session.client("cloudformation")
+            routing_rules["functions"] = [
+                cfn_client.describe_stack_resource(StackName=stack_name, LogicalResourceId=logical_id)["StackResourceDetail"]["PhysicalResourceId"] for logical_id in functions
+            ]
+        if sample_rate is not None:
+            routing_rules["sampleRate"] = sample_rate
+        if predicates:
+            routing_rules["predicates"] = [parse_predicate(predicate) for predicate in predicates]
+
+        discovery = StackDiscovery(session)
+        endpoints = discovery.get_api_endpoints("plldb")
+
+        rest_client = RestApiClient(session)
+        rest_client.update_routing_rules(endpoints["rest_api_url"], session_id, routing_rules)
+
+        if routing_rules:
+            click.echo(f"Updated routing rules of session {session_id}")
+        else:
+            click.echo(f"Session {session_id} forwards every invocation")
+
+    except (ValueError, click.BadParameter) as e:
+        click.echo(f"Error: {e}", err=True)
+        ctx.exit(1)
+    except Exception as e:
+        click.echo(f"Unexpected error: {e}", err=True)
+        ctx.exit(1)
+
+
 @cli.group(invoke_without_command=True)
 @click.pass_context
 def simulator(ctx):
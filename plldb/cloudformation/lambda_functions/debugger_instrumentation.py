@@ -2,11 +2,40 @@ import json
 import boto3
 import logging
 import os
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 from datetime import datetime, timezone
+from urllib.parse import urlparse
 
 logger = logging.getLogger(__name__)
 
+# Description of the versions published for SnapStart sessions, followed by the session ID
+SESSION_VERSION_DESCRIPTION = "PLLDB debug session"
+
+# Inline policies of the function roles, the first lets the runtime assume PLLDBDebuggerRole,
+# the second grants the permissions of the debug path to the role with direct access
+ASSUME_ROLE_POLICY_NAME = "PLLDBAssumeRolePolicy"
+DIRECT_ACCESS_POLICY_NAME = "PLLDBDirectAccessPolicy"
+ACCESS_DIRECT = "direct"
+
+
+def build_direct_access_policy(account_id: str, region: str, websocket_endpoint: Optional[str], payload_bucket: Optional[str]) -> Dict[str, Any]:
+    """Policy granting a function role what the runtime does with PLLDBDebuggerRole on the debug path."""
+    statements: List[Dict[str, Any]] = [
+        {
+            "Effect": "Allow",
+            "Action": ["dynamodb:PutItem", "dynamodb:GetItem", "dynamodb:UpdateItem"],
+            "Resource": f"arn:aws:dynamodb:{region}:{account_id}:table/PLLDBDebugger",
+        },
+        {"Effect": "Allow", "Action": "dynamodb:GetItem", "Resource": f"arn:aws:dynamodb:{region}:{account_id}:table/PLLDBSessions"},
+    ]
+    if websocket_endpoint:
+        # https://{api_id}.execute-api.{region}.amazonaws.com/{stage}
+        api_id = urlparse(websocket_endpoint).netloc.split(".")[0]
+        statements.append({"Effect": "Allow", "Action": "execute-api:ManageConnections", "Resource": f"arn:aws:execute-api:{region}:{account_id}:{api_id}/*"})
+    if payload_bucket:
+        statements.append({"Effect": "Allow", "Action": ["s3:PutObject", "s3:GetObject"], "Resource": f"arn:aws:s3:::{payload_bucket}/payloads/*"})
+    return {"Version": "2012-10-17", "Statement": statements}
+
 
 def send_debugger_info(connection_id: str, session_id: str, log_level: str, message: str) -> None:
     """Send a DebuggerInfo message to the WebSocket connection."""
@@ -52,8 +81,37 @@ def get_latest_layer_version(lambda_client: Any, layer_name: str = "PLLDBDebugge
         return None
 
 
-def instrument_lambda_functions(stack_name: str, session_id: str, connection_id: str) -> None:
-    """Instrument all Lambda functions in the stack with debug configuration."""
+def delete_session_versions(lambda_client: Any, function_name: str) -> List[str]:
+    """Delete the versions published for debug sessions, versions an alias still points to are kept."""
+    deleted = []
+    for page in lambda_client.get_paginator("list_versions_by_function").paginate(FunctionName=function_name):
+        for version in page.get("Versions", []):
+            if not version.get("Description", "").startswith(SESSION_VERSION_DESCRIPTION):
+                continue
+            try:
+                lambda_client.delete_function(FunctionName=function_name, Qualifier=version["Version"])
+                deleted.append(version["Version"])
+            except Exception as e:
+                logger.warning(f"Failed to delete version {version['Version']} of {function_name}: {e}")
+    return deleted
+
+
+def instrument_lambda_functions(
+    stack_name: str,
+    session_id: str,
+    connection_id: str,
+    compression: Optional[str] = None,
+    mode: Optional[str] = None,
+    interception: Optional[str] = None,
+    snapstart: bool = False,
+    access: Optional[str] = None,
+    runtime_secret: Optional[str] = None,
+) -> None:
+    """Instrument all Lambda functions in the stack with debug configuration.
+
+    The function roles may assume PLLDBDebuggerRole, or with direct access are granted
+    its permissions, so the runtime does not call STS.
+    """
     cloudformation = boto3.client("cloudformation")
     lambda_client = boto3.client("lambda")
     iam_client = boto3.client("iam")
@@ -103,6 +161,35 @@ def instrument_lambda_functions(stack_name: str, session_id: str, connection_id:
                 websocket_endpoint = os.environ.get("WEBSOCKET_ENDPOINT")
                 if websocket_endpoint:
                     env_vars["DEBUGGER_WEBSOCKET_API_ENDPOINT"] = websocket_endpoint
+                # Add bucket for payloads too large to travel through DynamoDB and WebSocket
+                payload_bucket = os.environ.get("PAYLOAD_BUCKET")
+                if payload_bucket:
+                    env_vars["DEBUGGER_PAYLOAD_BUCKET"] = payload_bucket
+                # Compression negotiated for the session
+                if compression:
+                    env_vars["DEBUGGER_COMPRESSION"] = compression
+                else:
+                    env_vars.pop("DEBUGGER_COMPRESSION", None)
+                # Mode of the session, the runtime forwards invocations in debug mode when not set
+                if mode:
+                    env_vars["DEBUGGER_SESSION_MODE"] = mode
+                else:
+                    env_vars.pop("DEBUGGER_SESSION_MODE", None)
+                # Interception of invocations, the layer replaces the runtime when not set
+                if interception:
+                    env_vars["DEBUGGER_INTERCEPTION"] = interception
+                else:
+                    env_vars.pop("DEBUGGER_INTERCEPTION", None)
+                # Secret with which the runtime connects to the session to receive pushed responses
+                if runtime_secret:
+                    env_vars["DEBUGGER_RUNTIME_SECRET"] = runtime_secret
+                else:
+                    env_vars.pop("DEBUGGER_RUNTIME_SECRET", None)
+                # Access of the debug path, the runtime assumes PLLDBDebuggerRole when not set
+                if access == ACCESS_DIRECT:
+                    env_vars["DEBUGGER_ACCESS"] = access
+                else:
+                    env_vars.pop("DEBUGGER_ACCESS", None)
 
                 # Prepare layers - add our layer if not already present
                 layers = current_config.get("Layers", [])
@@ -110,28 +197,50 @@ def instrument_lambda_functions(stack_name: str, session_id: str, connection_id:
                 if layer_arn not in layer_arns:
                     layer_arns.append(layer_arn)
 
+                update_params = {"FunctionName": function_name, "Layers": layer_arns}
+                # SnapStart snapshots published versions after their init phase, in which the runtime sets up the debug path
+                if snapstart:
+                    apply_on = current_config.get("SnapStart", {}).get("ApplyOn", "None")
+                    # Remembered to restore the setting of the function when uninstrumenting
+                    env_vars.setdefault("DEBUGGER_SNAPSTART", apply_on)
+                    if apply_on != "PublishedVersions":
+                        update_params["SnapStart"] = {"ApplyOn": "PublishedVersions"}
+
                 # Update function configuration
-                lambda_client.update_function_configuration(
-                    FunctionName=function_name,
-                    Environment={"Variables": env_vars},
-                    Layers=layer_arns,
-                )
+                lambda_client.update_function_configuration(Environment={"Variables": env_vars}, **update_params)
 
                 # Get the function's execution role
                 function_role_arn = current_config.get("Role")
                 if function_role_arn:
                     role_name = function_role_arn.split("/")[-1]
 
-                    # Create inline policy to allow assuming PLLDBDebuggerRole
                     account_id = boto3.client("sts").get_caller_identity()["Account"]
-                    policy_document = {"Version": "2012-10-17", "Statement": [{"Effect": "Allow", "Action": "sts:AssumeRole", "Resource": f"arn:aws:iam::{account_id}:role/PLLDBDebuggerRole"}]}
+                    if access == ACCESS_DIRECT:
+                        # Create inline policy granting the permissions of the debug path
+                        region = os.environ.get("AWS_REGION", "us-east-1")
+                        policy_name, policy_kind = DIRECT_ACCESS_POLICY_NAME, "direct access policy"
+                        policy_document = build_direct_access_policy(account_id, region, websocket_endpoint, payload_bucket)
+                    else:
+                        # Create inline policy to allow assuming PLLDBDebuggerRole
+                        policy_name, policy_kind = ASSUME_ROLE_POLICY_NAME, "assume role policy"
+                        policy_document = {
+                            "Version": "2012-10-17",
+                            "Statement": [{"Effect": "Allow", "Action": "sts:AssumeRole", "Resource": f"arn:aws:iam::{account_id}:role/PLLDBDebuggerRole"}],
+                        }
 
                     try:
-                        iam_client.put_role_policy(RoleName=role_name, PolicyName="PLLDBAssumeRolePolicy", PolicyDocument=json.dumps(policy_document))
-                        logger.info(f"Added assume role policy to {role_name}")
+                        iam_client.put_role_policy(RoleName=role_name, PolicyName=policy_name, PolicyDocument=json.dumps(policy_document))
+                        logger.info(f"Added {policy_kind} to {role_name}")
                     except Exception as e:
-                        logger.warning(f"Failed to add assume role policy to {role_name}: {e}")
-                        send_debugger_info(connection_id, session_id, "WARNING", f"Could not add assume role policy to {role_name}: {e}")
+                        logger.warning(f"Failed to add {policy_kind} to {role_name}: {e}")
+                        send_debugger_info(connection_id, session_id, "WARNING", f"Could not add {policy_kind} to {role_name}: {e}")
+
+                if snapstart:
+                    # Only $LATEST is instrumented, invocations start from a snapshot through the published version
+                    lambda_client.get_waiter("function_updated_v2").wait(FunctionName=function_name)
+                    version = lambda_client.publish_version(FunctionName=function_name, Description=f"{SESSION_VERSION_DESCRIPTION} {session_id}")["Version"]
+                    logger.info(f"Published version {version} of {function_name} with SnapStart")
+                    send_debugger_info(connection_id, session_id, "INFO", f"Published version {version} of {function_name} with SnapStart, invoke {function_name}:{version}")
 
                 logger.info(f"Successfully instrumented: {function_name}")
                 send_debugger_info(connection_id, session_id, "INFO", f"Instrumented Lambda function: {function_name}")
@@ -190,6 +299,13 @@ def uninstrument_lambda_functions(stack_name: str, session_id: Optional[str] = N
                 env_vars.pop("DEBUGGER_CONNECTION_ID", None)
                 env_vars.pop("AWS_LAMBDA_EXEC_WRAPPER", None)
                 env_vars.pop("DEBUGGER_WEBSOCKET_API_ENDPOINT", None)
+                env_vars.pop("DEBUGGER_PAYLOAD_BUCKET", None)
+                env_vars.pop("DEBUGGER_COMPRESSION", None)
+                env_vars.pop("DEBUGGER_SESSION_MODE", None)
+                env_vars.pop("DEBUGGER_INTERCEPTION", None)
+                env_vars.pop("DEBUGGER_ACCESS", None)
+                env_vars.pop("DEBUGGER_RUNTIME_SECRET", None)
+                snapstart_apply_on = env_vars.pop("DEBUGGER_SNAPSTART", None)
 
                 # Remove any PLLDBDebuggerRuntime layer (regardless of version)
                 layers = current_config.get("Layers", [])
@@ -205,22 +321,31 @@ def uninstrument_lambda_functions(stack_name: str, session_id: Optional[str] = N
                     # If no layers remain, we need to pass an empty list
                     update_params["Layers"] = []
 
+                # Restore the SnapStart setting the function had before a SnapStart session
+                if snapstart_apply_on is not None and snapstart_apply_on != "PublishedVersions":
+                    update_params["SnapStart"] = {"ApplyOn": snapstart_apply_on}
+
                 lambda_client.update_function_configuration(**update_params)
 
-                # Remove the inline policy that allows assuming PLLDBDebuggerRole
+                if snapstart_apply_on is not None:
+                    for version in delete_session_versions(lambda_client, function_name):
+                        logger.info(f"Deleted version {version} of {function_name}")
+
+                # Remove both inline policies, allowing to assume PLLDBDebuggerRole and granting direct
+                # access, whatever access the session used; a missing policy is already removed
                 function_role_arn = current_config.get("Role")
                 if function_role_arn:
                     role_name = function_role_arn.split("/")[-1]
-
-                    try:
-                        iam_client.delete_role_policy(RoleName=role_name, PolicyName="PLLDBAssumeRolePolicy")
-                        logger.info(f"Removed assume role policy from {role_name}")
-                    except iam_client.exceptions.NoSuchEntityException:
-                        logger.debug(f"Policy PLLDBAssumeRolePolicy not found on role {role_name}")
-                    except Exception as e:
-                        logger.warning(f"Failed to remove assume role policy from {role_name}: {e}")
-                        if connection_id and session_id:
-                            send_debugger_info(connection_id, session_id, "WARNING", f"Could not remove assume role policy from {role_name}: {e}")
+                    for policy_name, policy_kind in ((ASSUME_ROLE_POLICY_NAME, "assume role policy"), (DIRECT_ACCESS_POLICY_NAME, "direct access policy")):
+                        try:
+                            iam_client.delete_role_policy(RoleName=role_name, PolicyName=policy_name)
+                            logger.info(f"Removed {policy_kind} from {role_name}")
+                        except iam_client.exceptions.NoSuchEntityException:
+                            logger.debug(f"Policy {policy_name} not found on role {role_name}")
+                        except Exception as e:
+                            logger.warning(f"Failed to remove {policy_kind} from {role_name}: {e}")
+                            if connection_id and session_id:
+                                send_debugger_info(connection_id, session_id, "WARNING", f"Could not remove {policy_kind} from {role_name}: {e}")
 
                 logger.info(f"Successfully uninstrumented: {function_name}")
                 if connection_id and session_id:
@@ -254,6 +379,12 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
         stack_name = event.get("stackName")
         session_id = event.get("sessionId")
         connection_id = event.get("connectionId")
+        compression = event.get("compression")
+        mode = event.get("mode")
+        interception = event.get("interception")
+        snapstart = bool(event.get("snapStart"))
+        access = event.get("access")
+        runtime_secret = event.get("runtimeSecret")
 
         # Validate required parameters
         if not command or not stack_name:
@@ -268,7 +399,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
                 logger.error(error_msg)
                 return {"statusCode": 400, "body": json.dumps({"error": error_msg})}
 
-            instrument_lambda_functions(stack_name, session_id, connection_id)
+            instrument_lambda_functions(stack_name, session_id, connection_id, compression, mode, interception, snapstart, access, runtime_secret)
             logger.info(f"Instrumentation completed for stack: {stack_name}")
             return {"statusCode": 200, "body": json.dumps({"message": f"Stack {stack_name} instrumented successfully"})}
 
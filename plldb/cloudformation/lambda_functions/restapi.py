@@ -1,14 +1,31 @@
 import json
+import re
+import secrets
 import uuid
 import time
 import boto3
 import logging
 import os
-from typing import Dict, Any
+from decimal import Decimal
+from typing import Dict, Any, Optional
 
 logging.getLogger().setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
+# Payload encodings understood by the debugger runtime
+SUPPORTED_COMPRESSIONS = ("zlib",)
+
+# In shadow mode the deployed handler answers and the runtime mirrors invocations to the debugger
+SUPPORTED_MODES = ("debug", "shadow")
+
+# Invocations are intercepted by the layer runtime, or by the layer extension in the managed runtime
+SUPPORTED_INTERCEPTIONS = ("runtime", "extension")
+
+# The debug runtime assumes PLLDBDebuggerRole, or the function roles are granted its permissions directly
+SUPPORTED_ACCESSES = ("assume-role", "direct")
+
+ROUTING_PATH = re.compile(r"^/sessions/([^/]+)/routing$")
+
 
 def lambda_handler(event: Dict[str, Any], _context: Any) -> Dict[str, Any]:
     """Handle REST API requests for session management."""
@@ -23,6 +40,12 @@ def lambda_handler(event: Dict[str, Any], _context: Any) -> Dict[str, Any]:
         logger.debug(f"Return value: {json.dumps(result)}")
         return result
 
+    routing_path = ROUTING_PATH.match(path)
+    if http_method == "PUT" and routing_path:
+        result = update_routing_rules(event, routing_path.group(1))
+        logger.debug(f"Return value: {json.dumps(result)}")
+        return result
+
     logger.info(f"Unauthorized access attempted: {http_method=} {path=}")
     result = {"statusCode": 404, "body": json.dumps({"error": "Not Found"})}
     logger.debug(f"Return value: {json.dumps(result)}")
@@ -42,6 +65,32 @@ def create_session(event: Dict[str, Any]) -> Dict[str, Any]:
             logger.info(f"Session creation failed: missing stackName")
             return {"statusCode": 400, "body": json.dumps({"error": "stackName is required"})}
 
+        compression = body.get("compression")
+        if compression is not None and compression not in SUPPORTED_COMPRESSIONS:
+            logger.info(f"Session creation failed: unsupported {compression=}")
+            return {"statusCode": 400, "body": json.dumps({"error": f"Unsupported compression: {compression}"})}
+
+        mode = body.get("mode")
+        if mode is not None and mode not in SUPPORTED_MODES:
+            logger.info(f"Session creation failed: unsupported {mode=}")
+            return {"statusCode": 400, "body": json.dumps({"error": f"Unsupported mode: {mode}"})}
+
+        interception = body.get("interception")
+        if interception is not None and interception not in SUPPORTED_INTERCEPTIONS:
+            logger.info(f"Session creation failed: unsupported {interception=}")
+            return {"statusCode": 400, "body": json.dumps({"error": f"Unsupported interception: {interception}"})}
+
+        # Only the layer runtime renews the connections of the debug path after a SnapStart restore
+        snapstart = body.get("snapStart", False)
+        if not isinstance(snapstart, bool) or (snapstart and interception not in (None, "runtime")):
+            logger.info(f"Session creation failed: unsupported {snapstart=} {interception=}")
+            return {"statusCode": 400, "body": json.dumps({"error": "snapStart must be a boolean and requires the runtime interception"})}
+
+        access = body.get("access")
+        if access is not None and access not in SUPPORTED_ACCESSES:
+            logger.info(f"Session creation failed: unsupported {access=}")
+            return {"statusCode": 400, "body": json.dumps({"error": f"Unsupported access: {access}"})}
+
         # Generate session ID
         session_id = str(uuid.uuid4())
         logger.info(f"Session creation: {session_id=} {stack_name=}")
@@ -52,7 +101,19 @@ def create_session(event: Dict[str, Any]) -> Dict[str, Any]:
         # Create session item
         dynamodb = boto3.resource("dynamodb")
         table = dynamodb.Table("PLLDBSessions")
-        table.put_item(Item={"SessionId": session_id, "StackName": stack_name, "TTL": ttl, "Status": "PENDING"})
+        # Runtimes of the instrumented functions authenticate their connections with the secret
+        item = {"SessionId": session_id, "StackName": stack_name, "TTL": ttl, "Status": "PENDING", "RuntimeSecret": secrets.token_urlsafe(32)}
+        if compression:
+            item["Compression"] = compression
+        if mode:
+            item["Mode"] = mode
+        if interception:
+            item["Interception"] = interception
+        if snapstart:
+            item["SnapStart"] = True
+        if access:
+            item["Access"] = access
+        table.put_item(Item=item)
 
         logger.info(f"Session created successfully: {session_id=}")
         return {"statusCode": 201, "body": json.dumps({"sessionId": session_id})}
@@ -60,3 +121,71 @@ def create_session(event: Dict[str, Any]) -> Dict[str, Any]:
     except Exception as e:
         logger.error(f"Error creating session: {e=}")
         return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+
+
+def validate_routing_rules(rules: Any) -> Optional[str]:
+    """Return why the routing rules are invalid, or None when the runtime can evaluate them."""
+    if not isinstance(rules, dict):
+        return "routingRules must be an object"
+
+    unknown = set(rules) - {"functions", "sampleRate", "predicates"}
+    if unknown:
+        return f"Unknown routing rules: {', '.join(sorted(unknown))}"
+
+    functions = rules.get("functions")
+    if functions is not None and (not isinstance(functions, list) or not all(isinstance(name, str) for name in functions)):
+        return "functions must be a list of function names"
+
+    sample_rate = rules.get("sampleRate")
+    if sample_rate is not None and (isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, Decimal)) or not 0 <= sample_rate <= 100):
+        return "sampleRate must be a percentage between 0 and 100"
+
+    predicates = rules.get("predicates")
+    if predicates is not None:
+        if not isinstance(predicates, list):
+            return "predicates must be a list"
+        for predicate in predicates:
+            if not isinstance(predicate, dict) or not str(predicate.get("path", "")).startswith("$") or set(predicate) - {"path", "equals"}:
+                return "predicates must be objects with a path starting with $ and an optional equals"
+
+    return None
+
+
+def update_routing_rules(event: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+    """Store the routing rules on the session item, where the debugger runtime picks them up."""
+
+    try:
+        # DynamoDB does not accept floats, the sample rate may be fractional
+        body = json.loads(event.get("body") or "{}", parse_float=Decimal)
+        rules = body.get("routingRules")
+        logger.debug(f"Request body: {event.get('body')}")
+
+        error = validate_routing_rules(rules)
+        if error:
+            logger.info(f"Routing rules update failed: {session_id=} {error=}")
+            return {"statusCode": 400, "body": json.dumps({"error": error})}
+
+        table = boto3.resource("dynamodb").Table("PLLDBSessions")
+        try:
+            if rules:
+                table.update_item(
+                    Key={"SessionId": session_id},
+                    UpdateExpression="SET RoutingRules = :rules",
+                    ConditionExpression="attribute_exists(SessionId)",
+                    ExpressionAttributeValues={":rules": rules},
+                )
+            else:
+                # Without rules every invocation is forwarded
+                table.update_item(Key={"SessionId": session_id}, UpdateExpression="REMOVE RoutingRules", ConditionExpression="attribute_exists(SessionId)")
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.info(f"Routing rules update failed: session not found {session_id=}")
+            return {"statusCode": 404, "body": json.dumps({"error": "Session not found"})}
+
+        logger.info(f"Routing rules updated: {session_id=}")
+        return {"statusCode": 200, "body": json.dumps({"sessionId": session_id})}
+
+    except json.JSONDecodeError:
+        return {"statusCode": 400, "body": json.dumps({"error": "Invalid JSON in request body"})}
+    except Exception as e:
+        logger.error(f"Error updating routing rules: {e=}")
+        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
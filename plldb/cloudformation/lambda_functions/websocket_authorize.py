@@ -1,4 +1,5 @@
 import boto3
+import hmac
 import logging
 import os
 import json
@@ -14,7 +15,10 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
     This function validates that:
     1. A sessionId is provided in the query parameters
     2. The sessionId exists in the PLLDBSessions table
-    3. The session status is PENDING
+    3. The session status is PENDING, or ACTIVE for connections of instrumented
+       Lambda runtimes (role=runtime) that receive debugger responses
+    4. Runtimes present the runtimeSecret of the session, the sessionId alone does not
+       authenticate them
     """
     logger.debug(f"Event: {json.dumps(event)}")
 
@@ -22,6 +26,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
         # Extract sessionId from query parameters
         query_params = event.get("queryStringParameters", {})
         session_id = query_params.get("sessionId") if query_params else None
+        role = query_params.get("role", "debugger") if query_params else "debugger"
 
         if not session_id:
             logger.warning(f"Unauthorized access: missing sessionId. The sessionId was supposed to be set by the authorizer.")
@@ -46,21 +51,29 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
 
         session = response["Item"]
 
-        # Check if session is PENDING
-        if session.get("Status") != "PENDING":
-            logger.info(f"Unauthorized access: session not PENDING {session_id=} status={session.get('Status')}")
+        # Debuggers connect to PENDING sessions, runtimes join sessions that are already ACTIVE
+        expected_status = "ACTIVE" if role == "runtime" else "PENDING"
+        if session.get("Status") != expected_status:
+            logger.info(f"Unauthorized access: session not {expected_status} {session_id=} {role=} status={session.get('Status')}")
+            result = generate_policy("user", "Deny", event["methodArn"])
+            logger.debug(f"Return value: {json.dumps(result)}")
+            return result
+
+        # The secret is set only on the instrumented functions, the sessionId is shared with the debugger
+        if role == "runtime" and not is_runtime_secret_valid(session, query_params.get("runtimeSecret")):
+            logger.info(f"Unauthorized access: invalid runtime secret {session_id=}")
             result = generate_policy("user", "Deny", event["methodArn"])
             logger.debug(f"Return value: {json.dumps(result)}")
             return result
 
         # Session is valid - allow connection
-        # Pass the sessionId as context so the connect handler can use it
-        logger.info(f"Session authorized: {session_id=}")
+        # Pass the sessionId and role as context so the connect handler can use them
+        logger.info(f"Session authorized: {session_id=} {role=}")
         policy = generate_policy(
             "user",
             "Allow",
             event["methodArn"],
-            context={"sessionId": session_id},
+            context={"sessionId": session_id, "role": role},
         )
         logger.debug(f"Return value: {json.dumps(policy)}")
         return policy
@@ -72,6 +85,14 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
         return result
 
 
+def is_runtime_secret_valid(session: Dict[str, Any], runtime_secret: Optional[str]) -> bool:
+    """Compare the secret presented by a runtime with the one of the session in constant time."""
+    expected = session.get("RuntimeSecret")
+    if not expected or not runtime_secret:
+        return False
+    return hmac.compare_digest(str(expected).encode(), runtime_secret.encode())
+
+
 def generate_policy(
     principal_id: str,
     effect: str,
@@ -6,17 +6,40 @@ from typing import Dict, Any
 logger = logging.getLogger(__name__)
 
 
-def invoke_instrumentation_lambda(command: str, stack_name: str, session_id: str | None = None, connection_id: str | None = None) -> None:
+def invoke_instrumentation_lambda(
+    command: str,
+    stack_name: str,
+    session_id: str | None = None,
+    connection_id: str | None = None,
+    compression: str | None = None,
+    mode: str | None = None,
+    interception: str | None = None,
+    snapstart: bool = False,
+    access: str | None = None,
+    runtime_secret: str | None = None,
+) -> None:
     """Invoke the instrumentation lambda function asynchronously."""
     lambda_client = boto3.client("lambda")
 
     # Prepare the payload
-    payload = {"command": command, "stackName": stack_name}
+    payload: Dict[str, Any] = {"command": command, "stackName": stack_name}
 
     if session_id:
         payload["sessionId"] = session_id
     if connection_id:
         payload["connectionId"] = connection_id
+    if compression:
+        payload["compression"] = compression
+    if mode:
+        payload["mode"] = mode
+    if interception:
+        payload["interception"] = interception
+    if snapstart:
+        payload["snapStart"] = True
+    if access:
+        payload["access"] = access
+    if runtime_secret:
+        payload["runtimeSecret"] = runtime_secret
 
     try:
         # Invoke the instrumentation lambda asynchronously
@@ -54,6 +77,17 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
             logger.debug(f"Return value: {json.dumps(result)}")
             return result
 
+        # Runtimes of instrumented functions connect only to receive pushed responses,
+        # they must not take over the session or trigger another instrumentation
+        if authorizer_context.get("role") == "runtime":
+            logger.info(f"Runtime connected: {session_id=} {connection_id=}")
+            result = {
+                "statusCode": 200,
+                "body": json.dumps({"message": "Connected", "sessionId": session_id}),
+            }
+            logger.debug(f"Return value: {json.dumps(result)}")
+            return result
+
         # Update session status to ACTIVE and store connection ID
         dynamodb = boto3.resource("dynamodb")
         table = dynamodb.Table("PLLDBSessions")
@@ -88,7 +122,18 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
         )
 
         # Invoke instrumentation lambda asynchronously
-        invoke_instrumentation_lambda("instrument", stack_name, session_id, connection_id)
+        invoke_instrumentation_lambda(
+            "instrument",
+            stack_name,
+            session_id,
+            connection_id,
+            response["Item"].get("Compression"),
+            response["Item"].get("Mode"),
+            response["Item"].get("Interception"),
+            bool(response["Item"].get("SnapStart")),
+            response["Item"].get("Access"),
+            response["Item"].get("RuntimeSecret"),
+        )
 
         logger.info(f"Session connected and instrumentation initiated: {session_id=} {stack_name=}")
         result = {
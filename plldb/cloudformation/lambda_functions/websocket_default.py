@@ -1,6 +1,8 @@
+import base64
 import json
 import logging
-from dataclasses import dataclass
+import time
+from dataclasses import asdict, dataclass
 from typing import Dict, Any, Optional
 
 import boto3
@@ -18,7 +20,17 @@ class DebuggerRequest:
     lambdaFunctionName: str
     lambdaFunctionVersion: str
     event: str
+    invokedFunctionArn: Optional[str] = None
     environmentVariables: Optional[Dict[str, str]] = None
+    deadlineMs: Optional[int] = None
+    payloadLocation: Optional[str] = None
+    encoding: Optional[str] = None
+    payload: Optional[str] = None
+    environmentHash: Optional[str] = None
+    environmentDelta: Optional[Dict[str, str]] = None
+    shadow: Optional[bool] = None
+    deployedResponse: Optional[str] = None
+    deployedErrorMessage: Optional[str] = None
 
 
 @dataclass
@@ -29,6 +41,23 @@ class DebuggerResponse:
     statusCode: int
     response: str
     errorMessage: Optional[str] = None
+    responseLocation: Optional[str] = None
+    encoding: Optional[str] = None
+    chunk: Optional[int] = None
+    streamed: Optional[int] = None
+
+
+# Responses are stored only on requests of the session of the debugger that were not superseded
+RESPONSE_CONDITION = "attribute_not_exists(Superseded) AND (attribute_not_exists(SessionId) OR SessionId = :session_id)"
+
+
+# Chunks are read while the invocation runs, after that the TTL of the PLLDBDebugger table expires them
+STREAM_CHUNK_TTL_SECONDS = 3600
+
+
+def stream_chunk_key(request_id: str, sequence: int) -> str:
+    """Key of the item storing a chunk of a streamed response, must match the layer runtime."""
+    return f"{request_id}#chunk#{sequence}"
 
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # noqa: ARG001
@@ -39,10 +68,21 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
         # Parse the incoming message
         body = json.loads(event.get("body", "{}"))
 
+        # Check if this is a runtime subscribing for pushed responses
+        if body.get("action") == "registerRuntime":
+            return handle_runtime_registration(event)
+
         # Check if this is a debugger response
         if all(key in body for key in ["requestId", "statusCode", "response"]):
+            session_id = get_debugger_session_id(event)
+            if not session_id:
+                logger.warning(f"Rejected response not sent by the debugger of its session: connectionId={event.get('requestContext', {}).get('connectionId')}")
+                return {"statusCode": 403, "body": json.dumps({"error": "Only the debugger of the session may respond"})}
+            # Chunks of streamed responses are relayed as they arrive
+            if body.get("chunk") is not None:
+                return handle_debugger_chunk(body, session_id, get_management_endpoint(event))
             # Handle debugger response
-            return handle_debugger_response(body)
+            return handle_debugger_response(body, session_id, get_management_endpoint(event))
         else:
             # Unknown message type
             return {"statusCode": 400, "body": json.dumps({"error": "Invalid message format"})}
@@ -54,11 +94,69 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:  # no
         return {"statusCode": 500, "body": json.dumps({"error": "Internal server error"})}
 
 
-def handle_debugger_response(body: Dict[str, Any]) -> Dict[str, Any]:
-    """Handle debugger response by updating DynamoDB."""
+def get_management_endpoint(event: Dict[str, Any]) -> Optional[str]:
+    """Build the API Gateway Management API endpoint of the WebSocket API that received the event."""
+    request_context = event.get("requestContext", {})
+    domain_name = request_context.get("domainName")
+    stage = request_context.get("stage")
+    if not domain_name or not stage:
+        return None
+    return f"https://{domain_name}/{stage}"
+
+
+def get_debugger_session_id(event: Dict[str, Any]) -> Optional[str]:
+    """Return the session of the debugger that sent the message, or None when it was not sent on the debugger connection.
+
+    Runtimes of the instrumented functions connect to the same session, so only the connection
+    stored on the session when the debugger connected may answer its requests.
+    """
+    request_context = event.get("requestContext", {})
+    authorizer_context = request_context.get("authorizer") or {}
+    session_id = authorizer_context.get("sessionId")
+    connection_id = request_context.get("connectionId")
+    if not session_id or not connection_id or authorizer_context.get("role") == "runtime":
+        return None
+
+    session = boto3.resource("dynamodb").Table("PLLDBSessions").get_item(Key={"SessionId": session_id}).get("Item")
+    if not session or session.get("ConnectionId") != connection_id:
+        return None
+    return session_id
+
+
+def handle_runtime_registration(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Tell a connected Lambda runtime its connection ID, so it can ask for responses to be pushed to it."""
+    connection_id = event.get("requestContext", {}).get("connectionId")
+    endpoint = get_management_endpoint(event)
+    if not connection_id or not endpoint:
+        return {"statusCode": 400, "body": json.dumps({"error": "Missing connection context"})}
+
+    try:
+        client = boto3.client("apigatewaymanagementapi", endpoint_url=endpoint)
+        client.post_to_connection(ConnectionId=connection_id, Data=json.dumps({"runtimeConnectionId": connection_id}).encode("utf-8"))
+        logger.info(f"Runtime registered for pushed responses: {connection_id=}")
+        return {"statusCode": 200, "body": json.dumps({"message": "Runtime registered"})}
+
+    except Exception as e:
+        logger.error(f"Error registering runtime: {e}")
+        return {"statusCode": 500, "body": json.dumps({"error": f"Failed to register runtime: {str(e)}"})}
+
+
+def handle_debugger_response(body: Dict[str, Any], session_id: str, endpoint: Optional[str] = None) -> Dict[str, Any]:
+    """Handle debugger response by updating DynamoDB and pushing it to the waiting runtime.
+
+    Only requests of the session of the debugger are answered.
+    """
     try:
         # Create DebuggerResponse from body
-        response = DebuggerResponse(requestId=body["requestId"], statusCode=body["statusCode"], response=body["response"], errorMessage=body.get("errorMessage"))
+        response = DebuggerResponse(
+            requestId=body["requestId"],
+            statusCode=body["statusCode"],
+            response=body["response"],
+            errorMessage=body.get("errorMessage"),
+            responseLocation=body.get("responseLocation"),
+            encoding=body.get("encoding"),
+            streamed=body.get("streamed"),
+        )
 
         # Update DynamoDB
         dynamodb = boto3.resource("dynamodb")
@@ -67,21 +165,126 @@ def handle_debugger_response(body: Dict[str, Any]) -> Dict[str, Any]:
         # Update the item with response data
         update_expression = "SET #resp = :resp, StatusCode = :status"
         expression_attribute_names = {"#resp": "Response"}
-        expression_attribute_values = {":resp": response.response, ":status": response.statusCode}
+        expression_attribute_values = {":resp": response.response, ":status": response.statusCode, ":session_id": session_id}
+
+        # Encoded responses arrive as base64 and are stored as Binary, billed by their compressed size
+        if response.encoding:
+            update_expression += ", Encoding = :encoding"
+            expression_attribute_values[":resp"] = base64.b64decode(response.response)
+            expression_attribute_values[":encoding"] = response.encoding
 
         # Add error message if present
         if response.errorMessage:
             update_expression += ", ErrorMessage = :error"
             expression_attribute_values[":error"] = response.errorMessage
 
-        table.update_item(
-            Key={"RequestId": response.requestId}, UpdateExpression=update_expression, ExpressionAttributeNames=expression_attribute_names, ExpressionAttributeValues=expression_attribute_values
-        )
+        # Large responses are offloaded to S3 by the debugger, only the location is stored
+        if response.responseLocation:
+            update_expression += ", ResponseLocation = :location"
+            expression_attribute_values[":location"] = response.responseLocation
+
+        # A streamed response ends with the number of chunks, which are stored as items of their own
+        if response.streamed is not None:
+            update_expression += ", Streamed = :streamed"
+            expression_attribute_values[":streamed"] = response.streamed
+
+        try:
+            # A request answered by the deployed handler after the hedging delay is marked superseded,
+            # the response may be stored before the request, which then has no session yet
+            result = table.update_item(
+                Key={"RequestId": response.requestId},
+                UpdateExpression=update_expression,
+                ConditionExpression=RESPONSE_CONDITION,
+                ExpressionAttributeNames=expression_attribute_names,
+                ExpressionAttributeValues=expression_attribute_values,
+                ReturnValues="ALL_NEW",
+            )
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+            logger.info(f"Discarded response for superseded request or request of another session {response.requestId}")
+            return {"statusCode": 409, "body": json.dumps({"error": "Request was superseded or belongs to another session, response discarded"})}
 
         logger.info(f"Updated DynamoDB for request {response.requestId}")
 
+        # The stored response is the fallback, the runtime normally gets it pushed
+        runtime_connection_id = result.get("Attributes", {}).get("RuntimeConnectionId")
+        if runtime_connection_id and endpoint:
+            push_response_to_runtime(endpoint, runtime_connection_id, response)
+
         return {"statusCode": 200, "body": json.dumps({"message": "Response stored successfully"})}
 
     except Exception as e:
         logger.error(f"Error updating DynamoDB: {e}")
         return {"statusCode": 500, "body": json.dumps({"error": f"Failed to store response: {str(e)}"})}
+
+
+def handle_debugger_chunk(body: Dict[str, Any], session_id: str, endpoint: Optional[str] = None) -> Dict[str, Any]:
+    """Store a chunk of a streamed response and push it to the waiting runtime.
+
+    The request is marked as streaming, so the runtime no longer hedges it and a runtime
+    polling DynamoDB starts reading the chunks.
+    """
+    try:
+        sequence = int(body["chunk"])
+        chunk = DebuggerResponse(
+            requestId=body["requestId"],
+            statusCode=body["statusCode"],
+            response=body["response"],
+            encoding=body.get("encoding"),
+            chunk=sequence,
+        )
+
+        table = boto3.resource("dynamodb").Table("PLLDBDebugger")
+        try:
+            result = table.update_item(
+                Key={"RequestId": chunk.requestId},
+                UpdateExpression="SET Streaming = :streaming",
+                ConditionExpression=RESPONSE_CONDITION,
+                ExpressionAttributeValues={":streaming": True, ":session_id": session_id},
+                ReturnValues="ALL_NEW",
+            )
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+            logger.info(f"Discarded chunk for superseded request or request of another session {chunk.requestId}")
+            return {"statusCode": 409, "body": json.dumps({"error": "Request was superseded or belongs to another session, chunk discarded"})}
+
+        # Chunks arrive base64 encoded and are stored as Binary, the runtime reads the ones it was not pushed
+        attributes = result.get("Attributes", {})
+        item: Dict[str, Any] = {
+            "RequestId": stream_chunk_key(chunk.requestId, sequence),
+            "Chunk": base64.b64decode(chunk.response),
+            "TTL": int(time.time()) + STREAM_CHUNK_TTL_SECONDS,
+        }
+        if attributes.get("SessionId"):
+            item["SessionId"] = attributes["SessionId"]
+        if chunk.encoding:
+            item["Encoding"] = chunk.encoding
+        table.put_item(Item=item)
+
+        runtime_connection_id = attributes.get("RuntimeConnectionId")
+        if runtime_connection_id and endpoint:
+            push_response_to_runtime(endpoint, runtime_connection_id, chunk)
+
+        return {"statusCode": 200, "body": json.dumps({"message": "Chunk stored successfully"})}
+
+    except Exception as e:
+        logger.error(f"Error storing chunk: {e}")
+        return {"statusCode": 500, "body": json.dumps({"error": f"Failed to store chunk: {str(e)}"})}
+
+
+def push_response_to_runtime(endpoint: str, runtime_connection_id: str, response: DebuggerResponse) -> None:
+    """Push the debugger response to the connection of the runtime waiting for it."""
+    try:
+        client = boto3.client("apigatewaymanagementapi", endpoint_url=endpoint)
+        message = asdict(response)
+        # The fields of streamed responses are sent only with them
+        for key in ("chunk", "streamed"):
+            if message[key] is None:
+                del message[key]
+        client.post_to_connection(ConnectionId=runtime_connection_id, Data=json.dumps(message).encode("utf-8"))
+        logger.info(f"Pushed response for request {response.requestId} to runtime {runtime_connection_id=}")
+    except Exception as e:
+        # The runtime falls back to reading the response from DynamoDB
+        logger.warning(f"Failed to push response to runtime {runtime_connection_id=}: {e}")
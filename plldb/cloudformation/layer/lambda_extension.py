@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+PLLDB Lambda Extension
+
+Alternative to replacing the runtime through AWS_LAMBDA_EXEC_WRAPPER. With
+DEBUGGER_INTERCEPTION=extension the managed runtime keeps its own invoke loop and
+only the handler is replaced by plldb_wrapper. The wrapper hands every invocation
+to this external extension over localhost, the extension forwards it to the
+debugger with the debug path of lambda_runtime and tells the wrapper to either
+return the answer of the debugger or run the deployed handler.
+
+Being registered with the Lambda Extensions API, the extension opens the
+connections of the debug path during the init phase and keeps them across
+invocations. In shadow mode it finishes an invocation only once the copy was
+sent, so copies are not held back while the sandbox is frozen.
+
+Without a session, or with the runtime interception, the extension exits before
+registering, so a dormant layer adds no process to the sandbox.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Set
+
+try:
+    import lambda_runtime
+except ImportError:  # imported from the plldb package
+    from plldb.cloudformation.layer import lambda_runtime
+
+
+EXTENSION_NAME = "plldb-extension"
+
+EXTENSION_EVENT_INVOKE = "INVOKE"
+EXTENSION_EVENT_SHUTDOWN = "SHUTDOWN"
+
+# Port on localhost on which the extension serves the wrapper
+DEFAULT_EXTENSION_PORT = 9229
+
+
+def get_extension_port() -> int:
+    """Get the localhost port shared by the extension and the wrapper."""
+    return int(os.environ.get("DEBUGGER_EXTENSION_PORT", DEFAULT_EXTENSION_PORT))
+
+
+class ExtensionsApiClient(lambda_runtime.RuntimeApiClient):
+    """Keep-alive HTTP client for the Lambda Extensions API."""
+
+    def __init__(self, runtime_api: str):
+        super().__init__(runtime_api)
+        self.extension_id: Optional[str] = None
+
+    def register(self, events: List[str], name: str = EXTENSION_NAME) -> str:
+        """Register the extension for the given lifecycle events, returns its identifier."""
+        body = json.dumps({"events": events}).encode()
+        _, headers, _ = self._request("POST", "/2020-01-01/extension/register", body, {"Lambda-Extension-Name": name, "Content-Type": "application/json"})
+        extension_id = headers.get("Lambda-Extension-Identifier")
+        if not extension_id:
+            raise lambda_runtime.RuntimeApiError("Extension registration returned no Lambda-Extension-Identifier")
+        self.extension_id = extension_id
+        return extension_id
+
+    def next_event(self) -> Dict[str, Any]:
+        """Block until the next lifecycle event arrives."""
+        _, _, body = self._request("GET", "/2020-01-01/extension/event/next", headers=self._identifier())
+        return json.loads(body)
+
+    def init_error(self, error_message: str, error_type: str = "Extension.Error") -> None:
+        """Report that the extension failed to initialize."""
+        body = json.dumps({"errorMessage": error_message, "errorType": error_type}).encode()
+        self._request("POST", "/2020-01-01/extension/init/error", body, {**self._identifier(), "Lambda-Extension-Function-Error-Type": error_type})
+
+    def _identifier(self) -> Dict[str, str]:
+        return {"Lambda-Extension-Identifier": self.extension_id or ""}
+
+
+class InvocationResults:
+    """Request IDs of invocations the wrapper reported as finished."""
+
+    def __init__(self):
+        self._finished: Set[str] = set()
+        self._condition = threading.Condition()
+
+    def report(self, request_id: str) -> None:
+        with self._condition:
+            self._finished.add(request_id)
+            self._condition.notify_all()
+
+    def wait(self, request_id: str, timeout: Optional[float]) -> bool:
+        """Wait until the invocation was reported, returns False when the timeout expired first."""
+        with self._condition:
+            finished = self._condition.wait_for(lambda: request_id in self._finished, timeout)
+            self._finished.discard(request_id)
+            return finished
+
+
+def handle_invocation(session_id: str, connection_id: str, event: Dict[str, Any], context: lambda_runtime.LambdaContext, environment: lambda_runtime.EnvironmentSnapshot) -> Dict[str, Any]:
+    """Forward an invocation received by the wrapper to the debugger.
+
+    Returns the answer for the wrapper: the outcome, with the response or the error message
+    when the debugger answered. The wrapper runs the deployed handler for any other outcome.
+    """
+    request_id = context.aws_request_id
+    metrics = lambda_runtime.start_invocation_metrics(request_id)
+    forwarded = True
+    try:
+        outcome, response, error = lambda_runtime.forward_invocation(session_id, connection_id, event, context, metrics, environment)
+        forwarded = outcome != lambda_runtime.FORWARD_SKIPPED
+    except lambda_runtime.DebuggerConnectionGone as e:
+        print(f"{e}, running the handler {request_id=}", file=sys.stderr)
+        metrics.counts["ConnectionGone"] = 1
+        return {"outcome": lambda_runtime.FORWARD_SKIPPED}
+    except Exception as e:
+        return {"outcome": lambda_runtime.FORWARD_ANSWERED, "errorMessage": f"Debugger error: {str(e)}"}
+    finally:
+        if forwarded:
+            lambda_runtime.emit_invocation_metrics(metrics, session_id)
+
+    if outcome != lambda_runtime.FORWARD_ANSWERED:
+        return {"outcome": outcome}
+    if error:
+        return {"outcome": outcome, "errorMessage": error}
+    if lambda_runtime.is_streaming_result(response):
+        # The managed runtime answers buffered, a streamed response is joined
+        try:
+            return {"outcome": outcome, "response": b"".join(response).decode(errors="replace")}
+        except lambda_runtime.DebuggerStreamError as e:
+            return {"outcome": outcome, "errorMessage": str(e)}
+    return {"outcome": outcome, "response": response}
+
+
+def mirror_result(session_id: str, connection_id: str, event: Dict[str, Any], context: lambda_runtime.LambdaContext, environment: lambda_runtime.EnvironmentSnapshot, result: Dict[str, Any]) -> None:
+    """Queue the shadow copy of an invocation the deployed handler answered in the wrapper."""
+    lambda_runtime.mirror_invocation(session_id, connection_id, event, context, result.get("response"), result.get("errorMessage"), environment)
+
+
+class _ExtensionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def create_server(port: int, session_id: str, connection_id: str, results: InvocationResults) -> ThreadingHTTPServer:
+    """Create the localhost server the wrapper hands invocations to.
+
+    `POST /invocations` forwards an invocation to the debugger and answers with the outcome,
+    `POST /invocations/{requestId}/result` reports the result of the deployed handler, which
+    is mirrored to the debugger in shadow mode. Both take the event, the context and the
+    environment of the invocation.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                event = body["event"]
+                context = lambda_runtime.LambdaContext.from_dict(body["context"])
+                environment = lambda_runtime.EnvironmentSnapshot(body["environment"])
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {"errorMessage": f"Malformed request: {e}"})
+                return
+
+            parts = self.path.strip("/").split("/")
+            if parts == ["invocations"]:
+                self._reply(200, handle_invocation(session_id, connection_id, event, context, environment))
+            elif len(parts) == 3 and parts[0] == "invocations" and parts[2] == "result":
+                try:
+                    if lambda_runtime.get_session_mode() == lambda_runtime.SESSION_MODE_SHADOW:
+                        mirror_result(session_id, connection_id, event, context, environment, body)
+                finally:
+                    results.report(parts[1])
+                self._reply(202, {})
+            else:
+                self._reply(404, {"errorMessage": f"Unknown path {self.path}"})
+
+        def _reply(self, status: int, payload: Dict[str, Any]):
+            # The response of the debugger is passed on as it arrived
+            data = lambda_runtime.dumps_document(**payload)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return _ExtensionServer(("127.0.0.1", port), Handler)
+
+
+def seconds_until(deadline_ms: Optional[int]) -> Optional[float]:
+    """Seconds left until the deadline of a lifecycle event, None without a deadline."""
+    if deadline_ms is None:
+        return None
+    return max(0.0, deadline_ms / 1000 - time.time())
+
+
+def finish_invocation(results: InvocationResults, request_id: str, deadline_ms: Optional[int]) -> None:
+    """Keep the invocation open until the wrapper reported its result and its shadow copy was sent."""
+    if not results.wait(request_id, seconds_until(deadline_ms)):
+        print(f"Wrapper did not report the result of the invocation {request_id=}", file=sys.stderr)
+        return
+    if not lambda_runtime._shadow_forwarder.join(seconds_until(deadline_ms)):
+        print(f"Shadow copy was not sent before the deadline {request_id=}", file=sys.stderr)
+
+
+def main():
+    """Register with the Extensions API and serve the wrapper until the sandbox shuts down."""
+    session_id = os.environ.get("DEBUGGER_SESSION_ID")
+    connection_id = os.environ.get("DEBUGGER_CONNECTION_ID")
+    if not (session_id and connection_id) or lambda_runtime.get_interception() != lambda_runtime.INTERCEPTION_EXTENSION:
+        # The layer is shared by both interceptions, exit before registering so no process stays in the sandbox
+        return
+
+    runtime_api = lambda_runtime.get_lambda_runtime_api()
+    if not runtime_api:
+        print("AWS_LAMBDA_RUNTIME_API not set", file=sys.stderr)
+        sys.exit(1)
+
+    client = ExtensionsApiClient(runtime_api)
+    client.register([EXTENSION_EVENT_INVOKE, EXTENSION_EVENT_SHUTDOWN])
+    results = InvocationResults()
+    try:
+        server = create_server(get_extension_port(), session_id, connection_id, results)
+    except OSError as e:
+        print(f"Init error: {e}", file=sys.stderr)
+        client.init_error(f"Cannot listen on port {get_extension_port()}: {e}")
+        sys.exit(1)
+    threading.Thread(target=server.serve_forever, name="plldb-extension", daemon=True).start()
+
+    # Extensions are initialized before the first invocation, outside of its billed duration
+    lambda_runtime.prewarm_debugger_connections(session_id, connection_id)
+    shadowing = lambda_runtime.get_session_mode() == lambda_runtime.SESSION_MODE_SHADOW
+
+    while True:
+        event = client.next_event()
+        if event.get("eventType") == EXTENSION_EVENT_SHUTDOWN:
+            server.shutdown()
+            server.server_close()
+            lambda_runtime._shadow_forwarder.join(seconds_until(event.get("deadlineMs")))
+            return
+
+        if shadowing:
+            finish_invocation(results, event["requestId"], event.get("deadlineMs"))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,189 +4,2846 @@ PLLDB Lambda Runtime Wrapper
 
 This script intercepts Lambda invocations when DEBUGGER_SESSION_ID and
 DEBUGGER_CONNECTION_ID environment variables are set, forwarding them
-to a remote debugger via WebSocket.
+to a remote debugger via WebSocket. Responses are pushed back to the
+runtime over its own WebSocket connection, with the PLLDBDebugger table
+as a fallback.
+
+boto3 is imported only on the debug path, so a sandbox that never forwards an
+invocation does not pay for loading it. With DEBUGGER_AWS_BACKEND=builtin, the debug
+path signs its few AWS calls itself and imports boto3 only to offload payloads to S3.
+
+Handlers returning an iterator, and debuggers streaming their response, are answered with
+the streaming response mode of the Runtime API, relaying chunks as they are produced.
+
+With DEBUGGER_ACCESS=direct, the debug path uses the credentials of the execution role,
+which instrumentation granted its permissions, instead of assuming PLLDBDebuggerRole.
+
+With DEBUGGER_CAPTURE_SAMPLE_RATE, and no debugger session, the handler answers and a
+sample of the invocations is uploaded in batches to S3, to build replay corpora.
+
+With SnapStart, the handler and the clients of the debug path are set up before the
+snapshot, and the connections and credentials are renewed after each restore.
 """
 
-import json
-import os
-import sys
-import time
-import urllib.request
-import urllib.error
-from typing import Dict, Any, Optional, Tuple
-import boto3
+from __future__ import annotations
+
+import base64
+import gzip
+import hashlib
+import hmac
+import http.client
+import json
+import math
+import os
+import queue
+import random
+import re
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import weakref
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from decimal import Decimal
+from xml.etree import ElementTree
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import boto3
+
+
+def get_lambda_runtime_api() -> str:
+    """Get the Lambda Runtime API endpoint from environment."""
+    return os.environ.get("AWS_LAMBDA_RUNTIME_API", "")
+
+
+class RuntimeApiError(Exception):
+    """Raised when the Lambda Runtime API rejects a request."""
+
+
+class RuntimeApiClient:
+    """Keep-alive HTTP client for the Lambda Runtime API.
+
+    A single connection is reused for fetching invocations and posting results. Bodies
+    are passed through as bytes. A reused connection that turns out to be stale, e.g.
+    after the sandbox was frozen, is reopened and the request is sent once more.
+    """
+
+    def __init__(self, runtime_api: str):
+        self.runtime_api = runtime_api
+        self._connection: Optional[http.client.HTTPConnection] = None
+
+    def next_invocation(self) -> Tuple[bytes, http.client.HTTPMessage]:
+        """Block until the next invocation arrives and return its raw event and headers."""
+        _, headers, body = self._request("GET", "/2018-06-01/runtime/invocation/next")
+        return body, headers
+
+    def post_response(self, request_id: str, body: bytes) -> None:
+        """Post the raw result of an invocation."""
+        self._request("POST", f"/2018-06-01/runtime/invocation/{request_id}/response", body, {"Content-Type": "application/json"})
+
+    def post_streaming_response(self, request_id: str, chunks: Iterable[bytes]) -> Optional[Exception]:
+        """Stream the result of an invocation, sending every chunk as soon as it is produced.
+
+        The body is sent with chunked transfer encoding. When producing the chunks fails, the
+        stream is ended with the error in the trailers, which Lambda reports as the error of
+        the invocation, and the exception is returned. Unlike the other requests, a failed
+        stream is not sent again; it follows the fetch of its invocation on the same connection.
+        """
+        failure: List[Exception] = []
+
+        def body() -> Iterator[bytes]:
+            try:
+                for chunk in chunks:
+                    if chunk:
+                        yield b"%x\r\n%s\r\n" % (len(chunk), chunk)
+            except Exception as e:
+                failure.append(e)
+                error_body = base64.b64encode(json.dumps({"errorMessage": str(e), "errorType": type(e).__name__}).encode()).decode()
+                yield f"0\r\nLambda-Runtime-Function-Error-Type: {type(e).__name__}\r\nLambda-Runtime-Function-Error-Body: {error_body}\r\n\r\n".encode()
+                return
+            yield b"0\r\n\r\n"
+
+        if self._connection is None:
+            self._connection = http.client.HTTPConnection(self.runtime_api)
+        path = f"/2018-06-01/runtime/invocation/{request_id}/response"
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Lambda-Runtime-Function-Response-Mode": "streaming",
+            "Transfer-Encoding": "chunked",
+            "Trailer": "Lambda-Runtime-Function-Error-Type, Lambda-Runtime-Function-Error-Body",
+        }
+        try:
+            self._connection.request("POST", path, body=body(), headers=headers)
+            response = self._connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.close()
+            raise
+
+        if response.will_close:
+            self.close()
+        if response.status >= 300:
+            raise RuntimeApiError(f"POST {path} failed with status {response.status}: {data[:200]!r}")
+        return failure[0] if failure else None
+
+    def post_error(self, request_id: str, body: bytes, error_type: str) -> None:
+        """Post the raw error of an invocation."""
+        self._request("POST", f"/2018-06-01/runtime/invocation/{request_id}/error", body, {"Content-Type": "application/json", "Lambda-Runtime-Function-Error-Type": error_type})
+
+    def post_init_error(self, body: bytes, error_type: str) -> None:
+        """Post the raw error of a failed init phase."""
+        self._request("POST", "/2018-06-01/runtime/init/error", body, {"Content-Type": "application/json", "Lambda-Runtime-Function-Error-Type": error_type})
+
+    def restore_next(self) -> None:
+        """Signal that the init phase is complete and block until the snapshot was restored."""
+        self._request("GET", "/2018-06-01/runtime/restore/next")
+
+    def post_restore_error(self, body: bytes, error_type: str) -> None:
+        """Post the raw error of a failed restore."""
+        self._request("POST", "/2018-06-01/runtime/restore/error", body, {"Content-Type": "application/json", "Lambda-Runtime-Function-Error-Type": error_type})
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _request(self, method: str, path: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        while True:
+            reused = self._connection is not None
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(self.runtime_api)
+
+            try:
+                self._connection.request(method, path, body=body, headers=headers or {})
+                response = self._connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if reused:
+                    continue
+                raise
+
+            if response.will_close:
+                self.close()
+            if response.status >= 300:
+                raise RuntimeApiError(f"{method} {path} failed with status {response.status}: {data[:200]!r}")
+            return response.status, response.headers, data
+
+
+_runtime_api_clients: Dict[str, RuntimeApiClient] = {}
+
+
+def get_runtime_api_client(runtime_api: str) -> RuntimeApiClient:
+    """Return the keep-alive client of the sandbox for the Runtime API endpoint."""
+    client = _runtime_api_clients.get(runtime_api)
+    if client is None:
+        client = _runtime_api_clients[runtime_api] = RuntimeApiClient(runtime_api)
+    return client
+
+
+DEFAULT_REMAINING_TIME_MS = 300000
+
+
+def _parse_json_header(value: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        print(f"Ignoring malformed invocation header: {value[:200]}", file=sys.stderr)
+        return None
+
+
+class LambdaContext:
+    """Context object passed to the handler, mirroring the one of the managed runtime.
+
+    Invocation specific values come from the Lambda-Runtime-* headers of the next
+    invocation, the rest from the function environment. Without a deadline the
+    remaining time falls back to DEFAULT_REMAINING_TIME_MS.
+    """
+
+    def __init__(
+        self,
+        aws_request_id: str,
+        deadline_ms: Optional[int] = None,
+        invoked_function_arn: Optional[str] = None,
+        trace_id: Optional[str] = None,
+        client_context: Optional[Dict[str, Any]] = None,
+        identity: Optional[Dict[str, Any]] = None,
+    ):
+        self.aws_request_id = aws_request_id
+        self.deadline_ms = deadline_ms
+        self.function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "")
+        self.function_version = os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", "")
+        self.invoked_function_arn = invoked_function_arn or os.environ.get("AWS_LAMBDA_FUNCTION_INVOKED_ARN", "")
+        self.memory_limit_in_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "")
+        self.log_group_name = os.environ.get("AWS_LAMBDA_LOG_GROUP_NAME", "")
+        self.log_stream_name = os.environ.get("AWS_LAMBDA_LOG_STREAM_NAME", "")
+        self.trace_id = trace_id
+        self._client_context = client_context
+        self._identity = identity
+
+        self.identity = None
+        if identity is not None:
+            self.identity = SimpleNamespace(cognito_identity_id=identity.get("cognitoIdentityId"), cognito_identity_pool_id=identity.get("cognitoIdentityPoolId"))
+
+        self.client_context = None
+        if client_context is not None:
+            client = client_context.get("client")
+            self.client_context = SimpleNamespace(
+                client=SimpleNamespace(**{key: client.get(key) for key in ("installation_id", "app_title", "app_version_name", "app_version_code", "app_package_name")}) if client else None,
+                custom=client_context.get("custom"),
+                env=client_context.get("env"),
+            )
+
+    @classmethod
+    def from_headers(cls, headers: Any) -> LambdaContext:
+        """Build the context from the headers of a next invocation response."""
+        deadline = headers.get("Lambda-Runtime-Deadline-Ms")
+        return cls(
+            aws_request_id=headers.get("Lambda-Runtime-Aws-Request-Id", ""),
+            deadline_ms=int(deadline) if deadline else None,
+            invoked_function_arn=headers.get("Lambda-Runtime-Invoked-Function-Arn"),
+            trace_id=headers.get("Lambda-Runtime-Trace-Id"),
+            client_context=_parse_json_header(headers.get("Lambda-Runtime-Client-Context")),
+            identity=_parse_json_header(headers.get("Lambda-Runtime-Cognito-Identity")),
+        )
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> LambdaContext:
+        """Rebuild the context from its serializable form."""
+        return cls(
+            aws_request_id=data.get("aws_request_id", ""),
+            deadline_ms=data.get("deadline_ms"),
+            invoked_function_arn=data.get("invoked_function_arn"),
+            trace_id=data.get("trace_id"),
+            client_context=data.get("client_context"),
+            identity=data.get("identity"),
+        )
+
+    def get_remaining_time_in_millis(self) -> int:
+        if self.deadline_ms is None:
+            return DEFAULT_REMAINING_TIME_MS
+        return max(0, self.deadline_ms - int(time.time() * 1000))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serializable form of the context forwarded to the debugger."""
+        return {
+            "aws_request_id": self.aws_request_id,
+            "function_name": self.function_name,
+            "function_version": self.function_version,
+            "invoked_function_arn": self.invoked_function_arn,
+            "memory_limit_in_mb": self.memory_limit_in_mb,
+            "deadline_ms": self.deadline_ms,
+            "trace_id": self.trace_id,
+            "client_context": self._client_context,
+            "identity": self._identity,
+        }
+
+
+class RawJson:
+    """JSON document kept as the bytes it arrived as.
+
+    Events and debugger responses only pass through the runtime on the debug path, so they
+    are carried opaquely and spliced into the documents that embed them. The document is
+    decoded on first access to `value`, e.g. when a routing rule inspects the event or the
+    deployed handler runs, and compares equal to its decoded value.
+    """
+
+    __slots__ = ("raw", "_value")
+
+    _UNDECODED = object()
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._value: Any = RawJson._UNDECODED
+
+    @property
+    def value(self) -> Any:
+        if self._value is RawJson._UNDECODED:
+            self._value = json.loads(self.raw)
+        return self._value
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, RawJson):
+            return self.raw == other.raw or self.value == other.value
+        return self.value == other
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"RawJson({self.raw[:100]!r}{'...' if len(self.raw) > 100 else ''})"
+
+
+def json_value(value: Any) -> Any:
+    """Decode a raw JSON document, other values are returned as they are."""
+    return value.value if isinstance(value, RawJson) else value
+
+
+def json_bytes(value: Any) -> bytes:
+    """Serialize a value to JSON, a raw document is returned without re-encoding it."""
+    return value.raw if isinstance(value, RawJson) else json.dumps(value).encode()
+
+
+def dumps_document(**fields: Any) -> bytes:
+    """Serialize a JSON object, splicing in the fields that hold raw documents.
+
+    The output matches json.dumps of the decoded fields, without decoding them, and raw
+    documents are copied only once, into the output.
+    """
+    parts = [b"{"]
+    for name, value in fields.items():
+        parts += [b", " if len(parts) > 1 else b"", json.dumps(name).encode(), b": ", json_bytes(value)]
+    parts.append(b"}")
+    return b"".join(parts)
+
+
+def get_next_invocation(runtime_api: str) -> Tuple[RawJson, LambdaContext]:
+    """Get the next invocation from Lambda Runtime API together with its context, the event is not decoded."""
+    try:
+        body, headers = get_runtime_api_client(runtime_api).next_invocation()
+        return RawJson(body), LambdaContext.from_headers(headers)
+    except Exception as e:
+        print(f"Error getting next invocation: {e}", file=sys.stderr)
+        raise
+
+
+def send_response(runtime_api: str, request_id: str, response_data: Any) -> None:
+    """Send successful response to Lambda Runtime API, bytes and raw documents are sent as they are."""
+    data = response_data if isinstance(response_data, bytes) else json_bytes(response_data)
+
+    try:
+        get_runtime_api_client(runtime_api).post_response(request_id, data)
+    except Exception as e:
+        print(f"Error sending response: {e}", file=sys.stderr)
+        raise
+
+
+def is_streaming_result(result: Any) -> bool:
+    """Whether a handler result is a streamed response, i.e. an iterator of chunks."""
+    return isinstance(result, Iterator)
+
+
+def stream_chunks(result: Iterable[Any]) -> Iterator[bytes]:
+    """Serialize the chunks of a streamed response, chunks other than bytes and strings are sent as JSON."""
+    for chunk in result:
+        if isinstance(chunk, (bytes, bytearray, memoryview)):
+            yield bytes(chunk)
+        elif isinstance(chunk, str):
+            yield chunk.encode()
+        else:
+            yield json_bytes(chunk)
+
+
+def send_streaming_response(runtime_api: str, request_id: str, chunks: Iterable[Any]) -> Optional[str]:
+    """Stream a response to Lambda Runtime API as its chunks are produced.
+
+    Returns the error message when producing the chunks failed, the error was reported with the stream.
+    """
+    try:
+        error = get_runtime_api_client(runtime_api).post_streaming_response(request_id, stream_chunks(chunks))
+    except Exception as e:
+        print(f"Error streaming response: {e}", file=sys.stderr)
+        raise
+    if error is not None:
+        print(f"Streamed response failed: {error}", file=sys.stderr)
+        return str(error)
+    return None
+
+
+def send_error(runtime_api: str, request_id: str, error_message: str, error_type: str = "Error") -> None:
+    """Send error response to Lambda Runtime API."""
+    data = json.dumps({"errorMessage": error_message, "errorType": error_type}).encode()
+
+    try:
+        get_runtime_api_client(runtime_api).post_error(request_id, data, error_type)
+    except Exception as e:
+        print(f"Error sending error response: {e}", file=sys.stderr)
+        raise
+
+
+def send_init_error(runtime_api: str, error_message: str, error_type: str = "Error") -> None:
+    """Report an init phase failure to Lambda Runtime API."""
+    data = json.dumps({"errorMessage": error_message, "errorType": error_type}).encode()
+
+    try:
+        get_runtime_api_client(runtime_api).post_init_error(data, error_type)
+    except Exception as e:
+        print(f"Error sending init error: {e}", file=sys.stderr)
+        raise
+
+
+def send_restore_error(runtime_api: str, error_message: str, error_type: str = "Error") -> None:
+    """Report a failed restore of a SnapStart snapshot to Lambda Runtime API."""
+    data = json.dumps({"errorMessage": error_message, "errorType": error_type}).encode()
+
+    try:
+        get_runtime_api_client(runtime_api).post_restore_error(data, error_type)
+    except Exception as e:
+        print(f"Error sending restore error: {e}", file=sys.stderr)
+        raise
+
+
+# The debug path talks to AWS through boto3 by default. With DEBUGGER_AWS_BACKEND=builtin,
+# the few operations it needs are made by the built-in client below instead, so the
+# sandbox does not pay for importing boto3 and botocore.
+AWS_BACKEND_BOTO3 = "boto3"
+AWS_BACKEND_BUILTIN = "builtin"
+
+# Retries of the built-in client follow the standard retry mode of botocore
+AWS_RETRY_MAX_ATTEMPTS = 3
+AWS_RETRY_BASE_SECONDS = 0.05
+AWS_RETRY_MAX_BACKOFF_SECONDS = 20.0
+AWS_RETRYABLE_STATUS_CODES = frozenset({500, 502, 503, 504})
+AWS_RETRYABLE_ERROR_CODES = frozenset(
+    {
+        "Throttling",
+        "ThrottlingException",
+        "ThrottledException",
+        "RequestThrottledException",
+        "TooManyRequestsException",
+        "ProvisionedThroughputExceededException",
+        "TransactionInProgressException",
+        "RequestLimitExceeded",
+        "BandwidthLimitExceeded",
+        "LimitExceededException",
+        "RequestThrottled",
+        "SlowDown",
+        "PriorRequestNotComplete",
+        "EC2ThrottledException",
+        "RequestTimeout",
+        "RequestTimeoutException",
+        "InternalError",
+    }
+)
+AWS_HTTP_TIMEOUT_SECONDS = 60
+
+_STS_API_VERSION = "2011-06-15"
+
+
+def get_aws_backend() -> str:
+    """Return the backend used for AWS calls on the debug path, boto3 unless the built-in client is selected."""
+    return AWS_BACKEND_BUILTIN if os.environ.get("DEBUGGER_AWS_BACKEND") == AWS_BACKEND_BUILTIN else AWS_BACKEND_BOTO3
+
+
+class AwsClientError(Exception):
+    """Raised by the built-in client when AWS rejects a request.
+
+    Like botocore's ClientError, it carries the parsed error in `response`, so callers
+    check `e.response["Error"]["Code"]` regardless of the backend.
+    """
+
+    def __init__(self, code: str, message: str, status: int):
+        super().__init__(f"An error occurred ({code}): {message}")
+        self.response = {"Error": {"Code": code, "Message": message}, "ResponseMetadata": {"HTTPStatusCode": status}}
+
+
+class AwsCredentials:
+    """Access key, secret key and optional session token used to sign requests.
+
+    `expiration` is the UNIX time the credentials expire at, when it is known.
+    """
+
+    def __init__(self, access_key: str, secret_key: str, token: Optional[str] = None, expiration: Optional[float] = None):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.token = token
+        self.expiration = expiration
+
+    @classmethod
+    def from_environment(cls) -> "AwsCredentials":
+        """Credentials of the function's execution role.
+
+        Lambda sets them in the environment, or serves them on the container credentials
+        endpoint to SnapStart functions, whose environment is captured in the snapshot.
+        """
+        if "AWS_ACCESS_KEY_ID" not in os.environ and os.environ.get("AWS_CONTAINER_CREDENTIALS_FULL_URI"):
+            return cls.from_container()
+        return cls(os.environ["AWS_ACCESS_KEY_ID"], os.environ["AWS_SECRET_ACCESS_KEY"], os.environ.get("AWS_SESSION_TOKEN"))
+
+    @classmethod
+    def from_container(cls) -> "AwsCredentials":
+        """Credentials served on AWS_CONTAINER_CREDENTIALS_FULL_URI, like boto3's container provider reads them."""
+        url = urllib.parse.urlsplit(os.environ["AWS_CONTAINER_CREDENTIALS_FULL_URI"])
+        headers = {}
+        token = os.environ.get("AWS_CONTAINER_AUTHORIZATION_TOKEN")
+        if token:
+            headers["Authorization"] = token
+
+        connection = http.client.HTTPConnection(url.netloc, timeout=AWS_HTTP_TIMEOUT_SECONDS)
+        try:
+            connection.request("GET", url.path + (f"?{url.query}" if url.query else ""), headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status >= 300:
+            raise AwsClientError(str(response.status), f"Container credentials unavailable: {data[:200]!r}", response.status)
+
+        credentials = json.loads(data)
+        expiration = credentials.get("Expiration")
+        return cls(
+            credentials["AccessKeyId"],
+            credentials["SecretAccessKey"],
+            credentials.get("Token"),
+            datetime.fromisoformat(expiration.replace("Z", "+00:00")).timestamp() if expiration else None,
+        )
+
+
+def get_aws_region() -> str:
+    return os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"
+
+
+def resolve_aws_endpoint(service_id: str, endpoint_prefix: str, region: str) -> str:
+    """Endpoint of a service, honouring the AWS_ENDPOINT_URL variables like boto3 does."""
+    return os.environ.get(f"AWS_ENDPOINT_URL_{service_id}") or os.environ.get("AWS_ENDPOINT_URL") or f"https://{endpoint_prefix}.{region}.amazonaws.com"
+
+
+def sigv4_sign(method: str, url: str, headers: Dict[str, str], body: bytes, credentials: AwsCredentials, region: str, service: str, timestamp: Optional[float] = None) -> Dict[str, str]:
+    """Return the headers with the AWS Signature Version 4 of the request added.
+
+    All given headers are signed. Like botocore, the path is URI-encoded once more for
+    the canonical request, except the unreserved characters and slashes.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(time.time() if timestamp is None else timestamp))
+    signed = {**headers, "Host": parsed.netloc, "X-Amz-Date": amz_date}
+    if credentials.token:
+        signed["X-Amz-Security-Token"] = credentials.token
+
+    canonical_headers = sorted((name.lower(), " ".join(str(value).split())) for name, value in signed.items())
+    signed_headers = ";".join(name for name, _ in canonical_headers)
+    query = "&".join(f"{urllib.parse.quote(name, safe='-_.~')}={urllib.parse.quote(value, safe='-_.~')}" for name, value in sorted(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)))
+    canonical_request = "\n".join(
+        [
+            method.upper(),
+            urllib.parse.quote(parsed.path or "/", safe="/~"),
+            query,
+            "".join(f"{name}:{value}\n" for name, value in canonical_headers),
+            signed_headers,
+            hashlib.sha256(body).hexdigest(),
+        ]
+    )
+
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+    key = ("AWS4" + credentials.secret_key).encode()
+    for part in (amz_date[:8], region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    signed["Authorization"] = f"AWS4-HMAC-SHA256 Credential={credentials.access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}"
+    return signed
+
+
+def parse_aws_error(status: int, headers: http.client.HTTPMessage, body: bytes) -> AwsClientError:
+    """Parse the error of a JSON, REST-JSON or query protocol response."""
+    code = headers.get("x-amzn-ErrorType", "")
+    message = ""
+    try:
+        data = json.loads(body)
+        code = code or data.get("__type") or data.get("code", "")
+        message = data.get("message") or data.get("Message", "")
+    except ValueError:
+        try:
+            root = ElementTree.fromstring(body)
+            code = code or root.findtext(".//{*}Code") or root.findtext(".//Code") or ""
+            message = root.findtext(".//{*}Message") or root.findtext(".//Message") or ""
+        except ElementTree.ParseError:
+            message = body.decode(errors="replace")
+    # DynamoDB prefixes the code with its namespace, API Gateway appends details after a colon
+    code = code.rsplit("#", 1)[-1].split(":", 1)[0]
+    return AwsClientError(code or str(status), message, status)
+
+
+class AwsHttpClient:
+    """Keep-alive HTTP client signing requests to one AWS endpoint.
+
+    Idle connections are pooled, so the client can be used from several threads. Failed
+    requests are retried with exponential backoff and full jitter when the connection
+    broke, the service is throttling or it reports a transient error.
+    """
+
+    def __init__(self, endpoint_url: str, service: str, region: str, credentials: AwsCredentials, max_attempts: int = AWS_RETRY_MAX_ATTEMPTS):
+        self.endpoint_url = endpoint_url.rstrip("/")
+        self.service = service
+        self.region = region
+        self.credentials = credentials
+        self.max_attempts = max_attempts
+        self._parsed = urllib.parse.urlsplit(self.endpoint_url)
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def request(self, method: str, path: str, body: bytes = b"", headers: Optional[Dict[str, str]] = None) -> bytes:
+        """Send a request to a path below the endpoint and return the response body."""
+        url = self.endpoint_url + path
+        attempt = 0
+        while True:
+            attempt += 1
+            signed = sigv4_sign(method, url, {"User-Agent": "plldb-runtime", **(headers or {})}, body, self.credentials, self.region, self.service)
+            try:
+                status, response_headers, data = self._send(method, self._parsed.path + path, body, signed)
+            except (http.client.HTTPException, OSError):
+                if attempt >= self.max_attempts:
+                    raise
+                self._backoff(attempt)
+                continue
+
+            if status < 300:
+                return data
+            error = parse_aws_error(status, response_headers, data)
+            if attempt >= self.max_attempts or (status not in AWS_RETRYABLE_STATUS_CODES and error.response["Error"]["Code"] not in AWS_RETRYABLE_ERROR_CODES):
+                raise error
+            self._backoff(attempt)
+
+    def _send(self, method: str, path: str, body: bytes, headers: Dict[str, str]) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            if self._parsed.scheme == "https":
+                connection = http.client.HTTPSConnection(self._parsed.netloc, timeout=AWS_HTTP_TIMEOUT_SECONDS, context=ssl.create_default_context())
+            else:
+                connection = http.client.HTTPConnection(self._parsed.netloc, timeout=AWS_HTTP_TIMEOUT_SECONDS)
+
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._idle.append(connection)
+        return response.status, response.headers, data
+
+    def _backoff(self, attempt: int) -> None:
+        time.sleep(random.uniform(0, min(AWS_RETRY_MAX_BACKOFF_SECONDS, AWS_RETRY_BASE_SECONDS * 2**attempt)))
+
+
+def serialize_attribute(value: Any) -> Dict[str, Any]:
+    """Serialize a Python value to a DynamoDB attribute value, like boto3's TypeSerializer."""
+    if value is None:
+        return {"NULL": True}
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, (int, Decimal)):
+        return {"N": str(value)}
+    if isinstance(value, str):
+        return {"S": value}
+    if isinstance(value, (bytes, bytearray)):
+        return {"B": base64.b64encode(value).decode()}
+    if isinstance(value, dict):
+        return {"M": {key: serialize_attribute(item) for key, item in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {"L": [serialize_attribute(item) for item in value]}
+    raise TypeError(f"Unsupported type {type(value).__name__} for DynamoDB attribute")
+
+
+def deserialize_attribute(value: Dict[str, Any]) -> Any:
+    """Deserialize a DynamoDB attribute value, numbers become Decimal and binaries bytes."""
+    kind, data = next(iter(value.items()))
+    if kind == "NULL":
+        return None
+    if kind in ("S", "BOOL"):
+        return data
+    if kind == "N":
+        return Decimal(data)
+    if kind == "B":
+        return base64.b64decode(data)
+    if kind == "M":
+        return {key: deserialize_attribute(item) for key, item in data.items()}
+    if kind == "L":
+        return [deserialize_attribute(item) for item in data]
+    if kind == "SS":
+        return set(data)
+    if kind == "NS":
+        return {Decimal(item) for item in data}
+    if kind == "BS":
+        return {base64.b64decode(item) for item in data}
+    raise TypeError(f"Unsupported DynamoDB attribute type {kind}")
+
+
+class BuiltinTable:
+    """The subset of the boto3 Table resource used by the runtime, over the DynamoDB JSON protocol."""
+
+    def __init__(self, http: AwsHttpClient, name: str):
+        self.http = http
+        self.name = name
+
+    def put_item(self, **kwargs: Any) -> Dict[str, Any]:
+        return self._call("PutItem", kwargs)
+
+    def get_item(self, **kwargs: Any) -> Dict[str, Any]:
+        return self._call("GetItem", kwargs)
+
+    def update_item(self, **kwargs: Any) -> Dict[str, Any]:
+        return self._call("UpdateItem", kwargs)
+
+    def _call(self, operation: str, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        payload = {"TableName": self.name, **parameters}
+        for key in ("Item", "Key", "ExpressionAttributeValues"):
+            if key in payload:
+                payload[key] = {name: serialize_attribute(value) for name, value in payload[key].items()}
+
+        data = self.http.request("POST", "/", json.dumps(payload).encode(), {"Content-Type": "application/x-amz-json-1.0", "X-Amz-Target": f"DynamoDB_20120810.{operation}"})
+
+        result = json.loads(data)
+        for key in ("Item", "Attributes"):
+            if key in result:
+                result[key] = {name: deserialize_attribute(value) for name, value in result[key].items()}
+        return result
+
+
+class BuiltinDynamoDBResource:
+    def __init__(self, http: AwsHttpClient):
+        self.http = http
+
+    def Table(self, name: str) -> BuiltinTable:  # noqa: N802 - mirrors the boto3 resource
+        return BuiltinTable(self.http, name)
+
+
+class BuiltinStsClient:
+    """GetCallerIdentity and AssumeRole over the STS query protocol."""
+
+    def __init__(self, http: AwsHttpClient):
+        self.http = http
+
+    def get_caller_identity(self) -> Dict[str, Any]:
+        result = self._call({"Action": "GetCallerIdentity"}).find(".//{*}GetCallerIdentityResult")
+        return {name: result.findtext(f"{{*}}{name}") for name in ("UserId", "Account", "Arn")} if result is not None else {}
+
+    def assume_role(self, RoleArn: str, RoleSessionName: str, ExternalId: Optional[str] = None) -> Dict[str, Any]:  # noqa: N803 - mirrors boto3
+        parameters = {"Action": "AssumeRole", "RoleArn": RoleArn, "RoleSessionName": RoleSessionName}
+        if ExternalId:
+            parameters["ExternalId"] = ExternalId
+        credentials = self._call(parameters).find(".//{*}Credentials")
+        if credentials is None:
+            raise AwsClientError("MalformedResponse", "AssumeRole response has no credentials", 200)
+
+        expiration = credentials.findtext("{*}Expiration", "").replace("Z", "+00:00")
+        return {
+            "Credentials": {
+                "AccessKeyId": credentials.findtext("{*}AccessKeyId"),
+                "SecretAccessKey": credentials.findtext("{*}SecretAccessKey"),
+                "SessionToken": credentials.findtext("{*}SessionToken"),
+                "Expiration": datetime.fromisoformat(expiration),
+            }
+        }
+
+    def _call(self, parameters: Dict[str, str]) -> ElementTree.Element:
+        body = urllib.parse.urlencode({**parameters, "Version": _STS_API_VERSION}).encode()
+        return ElementTree.fromstring(self.http.request("POST", "/", body, {"Content-Type": "application/x-www-form-urlencoded; charset=utf-8"}))
+
+
+class BuiltinApiGatewayManagementClient:
+    """PostToConnection and GetConnection of the API Gateway Management API."""
+
+    def __init__(self, http: AwsHttpClient):
+        self.http = http
+
+    def post_to_connection(self, ConnectionId: str, Data: bytes) -> Dict[str, Any]:  # noqa: N803 - mirrors boto3
+        self.http.request("POST", self._path(ConnectionId), Data)
+        return {}
+
+    def get_connection(self, ConnectionId: str) -> Dict[str, Any]:  # noqa: N803 - mirrors boto3
+        data = self.http.request("GET", self._path(ConnectionId))
+        connection = json.loads(data) if data else {}
+        return {key[0].upper() + key[1:]: value for key, value in connection.items()}
+
+    def _path(self, connection_id: str) -> str:
+        return f"/@connections/{urllib.parse.quote(connection_id, safe='')}"
+
+
+class BuiltinSession:
+    """Stand-in for boto3.Session that creates the built-in clients.
+
+    Only DynamoDB, STS and the API Gateway Management API are built in. Other clients,
+    e.g. S3 for offloaded payloads, are created by a boto3 session with the same credentials.
+    """
+
+    def __init__(self, credentials: AwsCredentials, region: Optional[str] = None):
+        self.credentials = credentials
+        self.region = region or get_aws_region()
+        self._boto3_session: Any = None
+
+    def resource(self, service_name: str) -> Any:
+        if service_name != "dynamodb":
+            return self._get_boto3_session().resource(service_name)
+        return BuiltinDynamoDBResource(AwsHttpClient(resolve_aws_endpoint("DYNAMODB", "dynamodb", self.region), "dynamodb", self.region, self.credentials))
+
+    def client(self, service_name: str, endpoint_url: Optional[str] = None) -> Any:
+        if service_name == "sts":
+            return BuiltinStsClient(AwsHttpClient(endpoint_url or resolve_aws_endpoint("STS", "sts", self.region), "sts", self.region, self.credentials))
+        if service_name == "apigatewaymanagementapi" and endpoint_url:
+            return BuiltinApiGatewayManagementClient(AwsHttpClient(endpoint_url, "execute-api", self.region, self.credentials))
+        return self._get_boto3_session().client(service_name, endpoint_url=endpoint_url)
+
+    def _get_boto3_session(self) -> Any:
+        if self._boto3_session is None:
+            self._boto3_session = create_boto3_session(
+                aws_access_key_id=self.credentials.access_key, aws_secret_access_key=self.credentials.secret_key, aws_session_token=self.credentials.token, region_name=self.region
+            )
+        return self._boto3_session
+
+
+_botocore_loader: Any = None
+
+
+def create_boto3_session(**kwargs: Any) -> boto3.Session:
+    """Create a boto3 session that shares the service models loaded by the previous ones.
+
+    Each botocore session loads and parses the models of its clients again, and a session
+    is created whenever the role credentials are refreshed, e.g. after a SnapStart restore.
+    """
+    global _botocore_loader
+
+    import boto3
+    import botocore.session
+
+    botocore_session = botocore.session.Session()
+    if _botocore_loader is None:
+        _botocore_loader = botocore_session.get_component("data_loader")
+    else:
+        botocore_session.register_component("data_loader", _botocore_loader)
+
+    session = boto3.Session(botocore_session=botocore_session, **kwargs)
+    # boto3 appends the path of its resource models to the loader of every session
+    _botocore_loader.search_paths[:] = dict.fromkeys(_botocore_loader.search_paths)
+    return session
+
+
+def create_aws_session(access_key: str, secret_key: str, token: str) -> boto3.Session:
+    """Create a session of the configured backend for the given credentials."""
+    if get_aws_backend() == AWS_BACKEND_BUILTIN:
+        return BuiltinSession(AwsCredentials(access_key, secret_key, token))  # type: ignore[return-value]
+
+    return create_boto3_session(aws_access_key_id=access_key, aws_secret_access_key=secret_key, aws_session_token=token)
+
+
+# Refresh the assumed role credentials this many seconds before they expire
+CREDENTIALS_REFRESH_MARGIN_SECONDS = 300
+
+
+# The debug path assumes PLLDBDebuggerRole, unless instrumentation granted its
+# permissions to the execution role of the function with DEBUGGER_ACCESS=direct
+DEBUGGER_ACCESS_ASSUME_ROLE = "assume-role"
+DEBUGGER_ACCESS_DIRECT = "direct"
+
+
+def get_debugger_access() -> str:
+    """Return how the debug path gets its permissions, by assuming PLLDBDebuggerRole unless direct access is granted."""
+    return DEBUGGER_ACCESS_DIRECT if os.environ.get("DEBUGGER_ACCESS") == DEBUGGER_ACCESS_DIRECT else DEBUGGER_ACCESS_ASSUME_ROLE
+
+
+class DebuggerSessionCache:
+    """Container-lifetime cache of the session of the debug path.
+
+    The sandbox is reused across invocations, so the STS round trips are paid
+    only when the cached credentials are missing or close to their expiration.
+    With direct access the session uses the credentials of the execution role
+    and STS is not called at all.
+    """
+
+    def __init__(self, refresh_margin: int = CREDENTIALS_REFRESH_MARGIN_SECONDS):
+        self.refresh_margin = refresh_margin
+        self._sts_client: Any = None
+        self._account_id: Optional[str] = None
+        self._session: Optional[boto3.Session] = None
+        self._expiration: float = 0.0
+
+    def get_account_id(self) -> Optional[str]:
+        """Return the account ID of the function, resolving it only once, None when STS returned none."""
+        if self._account_id is None:
+            self._account_id = self._get_sts_client().get_caller_identity().get("Account")
+        return self._account_id
+
+    def get_session(self) -> boto3.Session:
+        """Return the cached session, assuming the role again when it is about to expire."""
+        if self._session is None or time.time() >= self._expiration - self.refresh_margin:
+            if get_debugger_access() == DEBUGGER_ACCESS_DIRECT:
+                self._session, self._expiration = self._create_direct_session()
+                return self._session
+
+            account_id = self.get_account_id()
+            if account_id is None:
+                raise RuntimeError("Cannot assume PLLDBDebuggerRole, the account ID of the function is unknown")
+            response = self._get_sts_client().assume_role(RoleArn=f"arn:aws:iam::{account_id}:role/PLLDBDebuggerRole", RoleSessionName="plldb-lambda-runtime", ExternalId="plldb-debugger")
+
+            credentials = response["Credentials"]
+            self._session = create_aws_session(credentials["AccessKeyId"], credentials["SecretAccessKey"], credentials["SessionToken"])
+            self._expiration = credentials["Expiration"].timestamp()
+
+        return self._session
+
+    def _create_direct_session(self) -> Tuple[boto3.Session, float]:
+        """Session with the credentials of the execution role, and the time it has to be created again."""
+        if get_aws_backend() == AWS_BACKEND_BUILTIN:
+            credentials = AwsCredentials.from_environment()
+            # Credentials in the environment are valid for the lifetime of the sandbox
+            return BuiltinSession(credentials), credentials.expiration or math.inf  # type: ignore[return-value]
+
+        # boto3 refreshes the credentials of the execution role by itself
+        return create_boto3_session(), math.inf
+
+    def invalidate(self) -> None:
+        """Drop the cached session so the next call creates it again."""
+        self._session = None
+        self._expiration = 0.0
+
+    def forget_credentials(self) -> None:
+        """Drop every credential held by the cache, the account ID is kept.
+
+        boto3 resolves and refreshes the credentials of the execution role used for STS by
+        itself, the built-in client holds the ones it read when it was created.
+        """
+        self.invalidate()
+        if get_aws_backend() == AWS_BACKEND_BUILTIN:
+            self._sts_client = None
+
+    def _get_sts_client(self) -> Any:
+        if self._sts_client is None:
+            if get_aws_backend() == AWS_BACKEND_BUILTIN:
+                self._sts_client = BuiltinSession(AwsCredentials.from_environment()).client("sts")
+            else:
+                import boto3
+
+                self._sts_client = boto3.client("sts")
+        return self._sts_client
+
+
+_session_cache = DebuggerSessionCache()
+
+# Clients are bound to the credentials of the session that created them, so they are
+# cached per session and dropped together with it when the credentials are refreshed
+_dynamodb_resource_cache: "weakref.WeakKeyDictionary[Any, Any]" = weakref.WeakKeyDictionary()
+_table_cache: "weakref.WeakKeyDictionary[Any, Any]" = weakref.WeakKeyDictionary()
+_apigateway_client_cache: "weakref.WeakKeyDictionary[Any, Dict[str, Any]]" = weakref.WeakKeyDictionary()
+_s3_client_cache: "weakref.WeakKeyDictionary[Any, Any]" = weakref.WeakKeyDictionary()
+_sessions_table_cache: "weakref.WeakKeyDictionary[Any, Any]" = weakref.WeakKeyDictionary()
+
+
+def assume_debugger_role() -> boto3.Session:
+    """Return a session for the PLLDBDebuggerRole, reusing cached credentials when possible.
+
+    With direct access, the session uses the credentials of the function's execution role.
+    """
+    try:
+        return _session_cache.get_session()
+    except Exception as e:
+        print(f"Error assuming debugger role: {e}", file=sys.stderr)
+        raise
+
+
+def get_dynamodb_resource(session: boto3.Session) -> Any:
+    """Return the DynamoDB resource bound to the session, its tables share one connection pool."""
+    resource = _dynamodb_resource_cache.get(session)
+    if resource is None:
+        resource = session.resource("dynamodb")
+        _dynamodb_resource_cache[session] = resource
+    return resource
+
+
+def get_debugger_table(session: boto3.Session) -> Any:
+    """Return the PLLDBDebugger table resource bound to the session."""
+    table = _table_cache.get(session)
+    if table is None:
+        table = get_dynamodb_resource(session).Table("PLLDBDebugger")
+        _table_cache[session] = table
+    return table
+
+
+def get_sessions_table(session: boto3.Session) -> Any:
+    """Return the PLLDBSessions table resource bound to the session."""
+    table = _sessions_table_cache.get(session)
+    if table is None:
+        table = get_dynamodb_resource(session).Table("PLLDBSessions")
+        _sessions_table_cache[session] = table
+    return table
+
+
+def get_apigateway_client(session: boto3.Session, endpoint_url: str) -> Any:
+    """Return the API Gateway Management API client bound to the session."""
+    clients = _apigateway_client_cache.setdefault(session, {})
+    if endpoint_url not in clients:
+        clients[endpoint_url] = session.client("apigatewaymanagementapi", endpoint_url=endpoint_url)
+    return clients[endpoint_url]
+
+
+def get_s3_client(session: boto3.Session) -> Any:
+    """Return the S3 client bound to the session."""
+    client = _s3_client_cache.get(session)
+    if client is None:
+        client = session.client("s3")
+        _s3_client_cache[session] = client
+    return client
+
+
+# post_to_connection accepts 128 KB and DynamoDB items 400 KB, larger payloads travel through S3
+PAYLOAD_OFFLOAD_THRESHOLD_BYTES = 96 * 1024
+
+
+def get_payload_bucket() -> Optional[str]:
+    """Return the bucket for offloaded payloads, None when offloading is not configured."""
+    return os.environ.get("DEBUGGER_PAYLOAD_BUCKET") or None
+
+
+SUPPORTED_ENCODINGS = ("zlib",)
+ZLIB_LEVEL = 6
+
+
+def get_payload_encoding() -> Optional[str]:
+    """Return the payload encoding negotiated for the session, None for plain JSON."""
+    encoding = os.environ.get("DEBUGGER_COMPRESSION") or None
+    if encoding is not None and encoding not in SUPPORTED_ENCODINGS:
+        print(f"Unsupported DEBUGGER_COMPRESSION {encoding=}, sending plain JSON", file=sys.stderr)
+        return None
+    return encoding
+
+
+def encode_payload(data: bytes, encoding: Optional[str]) -> bytes:
+    """Compress a serialized payload with the session encoding."""
+    if encoding == "zlib":
+        return zlib.compress(data, ZLIB_LEVEL)
+    return data
+
+
+def decode_payload(data: bytes, encoding: Optional[str]) -> bytes:
+    """Decompress a payload encoded with the session encoding."""
+    if encoding == "zlib":
+        return zlib.decompress(data)
+    return data
+
+
+# Set by the runtime for every invocation, or rotated by Lambda during the life of the
+# sandbox, sent as a delta instead of changing the snapshot
+VOLATILE_ENVIRONMENT_VARIABLES = ("_X_AMZN_TRACE_ID", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN")
+# Snapshots are expired by the TTL of the PLLDBDebugger table once the session is over,
+# the WebSocket API closes the debugger connection, and so ends the session, after 2 hours
+ENVIRONMENT_SNAPSHOT_TTL_SECONDS = 3 * 3600
+
+
+class EnvironmentSnapshot:
+    """Environment variables of the sandbox, referenced by a content hash.
+
+    The variables are published once per session and requests carry only the hash and
+    the delta of volatile variables. `inline` is set for the request that first publishes
+    the snapshot, which sends the variables along so the debugger does not need to fetch them.
+    """
+
+    def __init__(self, environment: Optional[Dict[str, str]] = None):
+        variables = dict(os.environ if environment is None else environment)
+        self.delta = {name: variables.pop(name) for name in VOLATILE_ENVIRONMENT_VARIABLES if name in variables}
+        self.variables = variables
+        self.digest = hashlib.sha256(json.dumps(variables, sort_keys=True).encode()).hexdigest()
+        self.inline = False
+
+    def to_message_fields(self) -> Dict[str, Any]:
+        """Environment fields of the DebuggerRequest."""
+        return {"environmentVariables": self.variables if self.inline else None, "environmentHash": self.digest, "environmentDelta": self.delta}
+
+
+def environment_message_fields(environment: Optional[EnvironmentSnapshot]) -> Dict[str, Any]:
+    """Environment fields of the DebuggerRequest, all variables when no snapshot is used."""
+    return environment.to_message_fields() if environment else {"environmentVariables": dict(os.environ)}
+
+
+_published_environments: Dict[str, str] = {}
+
+
+def publish_environment(session: boto3.Session, session_id: str, environment: EnvironmentSnapshot, encoding: Optional[str] = None) -> None:
+    """Store the environment snapshot as an `environment#<hash>` item, once per session and sandbox.
+
+    Sandboxes sharing the same environment publish it only once, the conditional write of
+    later ones is rejected. The snapshot is marked inline only when this call published it,
+    otherwise the debugger reads the published one.
+    """
+    if _published_environments.get(session_id) == environment.digest:
+        return
+
+    item: Dict[str, Any] = {"RequestId": f"environment#{environment.digest}", "SessionId": session_id, "TTL": int(time.time()) + ENVIRONMENT_SNAPSHOT_TTL_SECONDS}
+    if encoding:
+        item["EnvironmentVariables"] = encode_payload(json.dumps(environment.variables).encode(), encoding)
+        item["Encoding"] = encoding
+    else:
+        item["EnvironmentVariables"] = environment.variables
+
+    try:
+        get_debugger_table(session).put_item(Item=item, ConditionExpression="attribute_not_exists(RequestId)")
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+        _published_environments[session_id] = environment.digest
+        print(f"Environment snapshot already published {session_id=} digest={environment.digest}")
+        return
+
+    _published_environments[session_id] = environment.digest
+    environment.inline = True
+    print(f"Published environment snapshot {session_id=} digest={environment.digest}")
+
+
+def escaped_json_size(raw: bytes) -> int:
+    """Size of a JSON document once embedded as a string in another one, without building the string.
+
+    A valid document holds no control characters besides whitespace, so only quotes,
+    backslashes, whitespace escapes and non-ASCII characters grow.
+    """
+    if not raw.isascii():
+        return len(json.dumps(raw.decode()))
+    return len(raw) + 2 + sum(raw.count(char) for char in (b'"', b"\\", b"\n", b"\r", b"\t"))
+
+
+def debugger_request_message_size(
+    request_id: str, session_id: str, event: Any, body: bytes, encoding: Optional[str], environment: Optional[EnvironmentSnapshot], invoked_function_arn: Optional[str] = None
+) -> int:
+    """Size of the inline WebSocket notification of a request, see build_debugger_request_message.
+
+    Computed from the serialized fields without the event, and the event or the encoded
+    payload as they are embedded, so the payload is not copied again.
+    """
+    fields = build_debugger_request_message(request_id, session_id, "", None, None, None, None, environment, invoked_function_arn)
+    fields["environmentVariables"] = None if encoding else fields["environmentVariables"]
+    if encoding:
+        return len(json.dumps(fields)) + 4 * ((len(body) + 2) // 3)
+    return len(json.dumps(fields)) + escaped_json_size(json_bytes(event))
+
+
+def offload_request_payload(
+    session: boto3.Session,
+    session_id: str,
+    request_id: str,
+    event: Any,
+    context: Dict[str, Any],
+    encoding: Optional[str] = None,
+    environment: Optional[EnvironmentSnapshot] = None,
+) -> Optional[str]:
+    """Upload the request payload to S3 when it is too large to travel inline.
+
+    The object holds the event, the context and the environment fields in the session
+    encoding, about what the request item would hold. The WebSocket notification is larger,
+    it carries the event as an escaped JSON string, or the encoded payload in base64, so
+    the payload is offloaded when either of them is above the threshold. Returns its s3://
+    location, or None when the payload is small enough or no bucket is configured.
+    """
+    bucket = get_payload_bucket()
+    if not bucket:
+        return None
+
+    body = encode_payload(dumps_document(event=event, context=context, **environment_message_fields(environment)), encoding)
+    message_size = debugger_request_message_size(request_id, session_id, event, body, encoding, environment, context.get("invoked_function_arn"))
+    if max(len(body), message_size) <= PAYLOAD_OFFLOAD_THRESHOLD_BYTES:
+        return None
+
+    key = f"payloads/{session_id}/{request_id}/request.json"
+    get_s3_client(session).put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/json")
+    print(f"Offloaded request payload {request_id=} size={len(body)} to s3://{bucket}/{key}")
+    return f"s3://{bucket}/{key}"
+
+
+def read_payload(session: boto3.Session, location: str) -> bytes:
+    """Read an offloaded payload from its s3:// location."""
+    bucket, _, key = location.removeprefix("s3://").partition("/")
+    return get_s3_client(session).get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+def create_debugger_request(
+    session: boto3.Session,
+    request_id: str,
+    session_id: str,
+    connection_id: str,
+    event: Any,
+    context: Dict[str, Any],
+    runtime_connection_id: Optional[str] = None,
+    payload_location: Optional[str] = None,
+    encoding: Optional[str] = None,
+    environment: Optional[EnvironmentSnapshot] = None,
+) -> bool:
+    """Create a request entry in the PLLDBDebugger table.
+
+    When the runtime has a response channel, its connection ID is stored with the request
+    so that the response can be pushed to it. An offloaded payload is only referenced by
+    its location. With an encoding, the request and environment are stored as Binary.
+    With an environment snapshot, only its hash and delta are stored.
+
+    Returns False when the response of the debugger was stored first and the request was not written.
+    """
+    table = get_debugger_table(session)
+
+    item = {
+        "RequestId": request_id,
+        "SessionId": session_id,
+        "ConnectionId": connection_id,
+        "StatusCode": 0,  # Indicates pending
+    }
+    if environment:
+        item["EnvironmentHash"] = environment.digest
+        item["EnvironmentDelta"] = environment.delta
+    if payload_location:
+        item["PayloadLocation"] = payload_location
+    elif encoding:
+        item["Request"] = encode_payload(dumps_document(event=event, context=context), encoding)
+        if not environment:
+            item["EnvironmentVariables"] = encode_payload(json.dumps(dict(os.environ)).encode(), encoding)
+    else:
+        item["Request"] = dumps_document(event=event, context=context).decode()
+        if not environment:
+            item["EnvironmentVariables"] = dict(os.environ)
+    if encoding:
+        item["Encoding"] = encoding
+    if runtime_connection_id:
+        item["RuntimeConnectionId"] = runtime_connection_id
+
+    try:
+        # The notification is sent concurrently, so the debugger may answer before this write
+        # lands. Its response then must not be overwritten, only an item of a previous attempt is.
+        table.put_item(Item=item, ConditionExpression="attribute_not_exists(StatusCode) OR attribute_exists(SessionId)")
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            print(f"Response to {request_id} arrived before the request was stored")
+            return False
+        print(f"Error creating debugger request: {e}", file=sys.stderr)
+        raise
+    return True
+
+
+# WebSocket API closes idle connections after 10 minutes and any connection after 2 hours
+RESPONSE_CHANNEL_MAX_IDLE_SECONDS = 540
+RESPONSE_CHANNEL_MAX_AGE_SECONDS = 6600
+RESPONSE_CHANNEL_CONNECT_TIMEOUT_SECONDS = 3.0
+RESPONSE_CHANNEL_RETRY_AFTER_SECONDS = 60
+# With responses pushed, DynamoDB is polled only as a fallback at this interval
+PUSH_FALLBACK_POLL_INTERVAL_SECONDS = 5.0
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class ResponseChannelClosed(Exception):
+    """Raised when the response channel connection is lost."""
+
+
+class ResponseChannel:
+    """Long-lived WebSocket connection on which debugger responses are pushed to the runtime.
+
+    The runtime connects to the debugger WebSocket API as role=runtime and registers itself,
+    which tells it its own connection ID. That ID is stored on every request item, so that
+    websocket_default can push the response to this sandbox as soon as the debugger sends it.
+    This is a minimal RFC 6455 client built on the standard library, so it works in any sandbox.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.connection_id: Optional[str] = None
+        self._socket: Optional[socket.socket] = None
+        self._buffer = bytearray()
+        self._connected_at = 0.0
+        self._last_activity = 0.0
+
+    def connect(self, timeout: float = RESPONSE_CHANNEL_CONNECT_TIMEOUT_SECONDS) -> None:
+        """Open the connection, perform the handshake and register the runtime."""
+        parsed = urllib.parse.urlparse(self.url)
+        secure = parsed.scheme == "wss"
+        host = parsed.hostname or ""
+        port = parsed.port or (443 if secure else 80)
+
+        sock = socket.create_connection((host, port), timeout=timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        self._socket = sock
+        self._buffer = bytearray()
+
+        try:
+            key = base64.b64encode(os.urandom(16)).decode()
+            path = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+            handshake = f"GET {path} HTTP/1.1\r\nHost: {parsed.netloc}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+            sock.sendall(handshake.encode())
+
+            while b"\r\n\r\n" not in self._buffer:
+                self._receive_into_buffer()
+            header_end = self._buffer.index(b"\r\n\r\n") + 4
+            status_line, *header_lines = bytes(self._buffer[:header_end]).decode("latin-1").split("\r\n")
+            del self._buffer[:header_end]
+
+            if " 101 " not in f"{status_line} ":
+                raise ResponseChannelClosed(f"WebSocket handshake rejected: {status_line}")
+            headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(":") for line in header_lines if line)}
+            expected_accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+            if headers.get("sec-websocket-accept") != expected_accept:
+                raise ResponseChannelClosed("Invalid WebSocket handshake response")
+
+            self._connected_at = self._last_activity = time.time()
+            self.send({"action": "registerRuntime"})
+
+            deadline = time.time() + timeout
+            while self.connection_id is None:
+                message = self.receive(deadline - time.time())
+                if message is None:
+                    raise ResponseChannelClosed("Runtime registration was not acknowledged")
+                self.connection_id = message.get("runtimeConnectionId")
+        except Exception:
+            self.close()
+            raise
+
+    def is_usable(self) -> bool:
+        """Check that the connection is open and not about to be closed by the WebSocket API."""
+        now = time.time()
+        return (
+            self._socket is not None
+            and self.connection_id is not None
+            and now - self._last_activity < RESPONSE_CHANNEL_MAX_IDLE_SECONDS
+            and now - self._connected_at < RESPONSE_CHANNEL_MAX_AGE_SECONDS
+        )
+
+    def send(self, message: Dict[str, Any]) -> None:
+        """Send a JSON message as a masked text frame."""
+        self._send_frame(0x1, json.dumps(message).encode())
+
+    def receive(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """Receive the next JSON message, or None when none arrives within the timeout."""
+        deadline = time.time() + timeout
+        fragments = bytearray()
+
+        while True:
+            frame = self._parse_frame()
+            if frame is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    self._receive_into_buffer(remaining)
+                except socket.timeout:
+                    return None
+                continue
+
+            fin, opcode, payload = frame
+            self._last_activity = time.time()
+            if opcode == 0x8:
+                self.close()
+                raise ResponseChannelClosed("WebSocket connection closed by server")
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+
+            fragments.extend(payload)
+            if fin:
+                try:
+                    return json.loads(bytes(fragments))
+                except ValueError:
+                    print(f"Ignoring malformed message on response channel: {bytes(fragments)[:100]!r}", file=sys.stderr)
+                    fragments = bytearray()
+
+    def wait_for_response(self, request_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Wait for the pushed response to the request, skipping messages for other requests."""
+        deadline = time.time() + timeout
+        while True:
+            message = self.receive(deadline - time.time())
+            if message is None:
+                return None
+            if message.get("requestId") == request_id:
+                return message
+            print(f"Ignoring pushed message for another request: {message.get('requestId')}", file=sys.stderr)
+
+    def close(self) -> None:
+        """Close the connection; the channel has to be connected again before it can be used."""
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self.connection_id = None
+
+    def _send_frame(self, opcode: int, payload: bytes) -> None:
+        if self._socket is None:
+            raise ResponseChannelClosed("WebSocket connection is not open")
+
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, length)
+
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        try:
+            self._socket.sendall(header + mask + masked)
+        except OSError as e:
+            self.close()
+            raise ResponseChannelClosed(f"Failed to send on WebSocket connection: {e}") from e
+        self._last_activity = time.time()
+
+    def _parse_frame(self) -> Optional[Tuple[bool, int, bytes]]:
+        """Take one complete frame from the buffer, or return None when more data is needed."""
+        if len(self._buffer) < 2:
+            return None
+
+        first, second = self._buffer[0], self._buffer[1]
+        length = second & 0x7F
+        offset = 2
+        if length == 126:
+            if len(self._buffer) < 4:
+                return None
+            length = struct.unpack("!H", self._buffer[2:4])[0]
+            offset = 4
+        elif length == 127:
+            if len(self._buffer) < 10:
+                return None
+            length = struct.unpack("!Q", self._buffer[2:10])[0]
+            offset = 10
+
+        mask = b""
+        if second & 0x80:
+            mask = bytes(self._buffer[offset : offset + 4])
+            offset += 4
+        if len(self._buffer) < offset + length:
+            return None
+
+        payload = bytes(self._buffer[offset : offset + length])
+        del self._buffer[: offset + length]
+        if mask:
+            payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        return bool(first & 0x80), first & 0x0F, payload
+
+    def _receive_into_buffer(self, timeout: Optional[float] = None) -> None:
+        if self._socket is None:
+            raise ResponseChannelClosed("WebSocket connection is not open")
+
+        if timeout is not None:
+            self._socket.settimeout(timeout)
+        try:
+            data = self._socket.recv(65536)
+        except socket.timeout:
+            raise
+        except OSError as e:
+            self.close()
+            raise ResponseChannelClosed(f"Failed to receive on WebSocket connection: {e}") from e
+        if not data:
+            self.close()
+            raise ResponseChannelClosed("WebSocket connection closed by server")
+        self._buffer.extend(data)
+
+
+_response_channel: Optional[ResponseChannel] = None
+_response_channel_retry_at = 0.0
+
+
+def get_response_channel_url(session_id: str) -> Optional[str]:
+    """Get the WebSocket URL on which the runtime receives pushed responses, if pushing is enabled."""
+    if os.environ.get("DEBUGGER_RESPONSE_PUSH", "1") == "0":
+        return None
+    websocket_endpoint = os.environ.get("DEBUGGER_WEBSOCKET_API_ENDPOINT")
+    if not websocket_endpoint:
+        return None
+
+    parsed = urllib.parse.urlparse(websocket_endpoint)
+    scheme = {"https": "wss", "http": "ws"}.get(parsed.scheme, parsed.scheme)
+    # Without the secret of the session the authorizer rejects the runtime
+    runtime_secret = os.environ.get("DEBUGGER_RUNTIME_SECRET")
+    if not runtime_secret:
+        return None
+    query = urllib.parse.urlencode({"sessionId": session_id, "role": "runtime", "runtimeSecret": runtime_secret})
+    return urllib.parse.urlunparse((scheme, parsed.netloc, parsed.path, "", query, ""))
+
+
+def get_response_channel(session_id: str) -> Optional[ResponseChannel]:
+    """Return a connected response channel for the sandbox, or None to rely on polling.
+
+    The connection is reused across invocations and reopened when it was lost or is about
+    to be closed by the WebSocket API. After a failed attempt the runtime polls only, and
+    tries to connect again after a while.
+    """
+    global _response_channel, _response_channel_retry_at
+
+    if _response_channel is not None and _response_channel.is_usable():
+        return _response_channel
+    if _response_channel is not None:
+        _response_channel.close()
+        _response_channel = None
+
+    url = get_response_channel_url(session_id)
+    if not url or time.time() < _response_channel_retry_at:
+        return None
+
+    channel = ResponseChannel(url)
+    try:
+        channel.connect()
+    except Exception as e:
+        print(f"Response channel unavailable, falling back to polling: {e}", file=sys.stderr)
+        _response_channel_retry_at = time.time() + RESPONSE_CHANNEL_RETRY_AFTER_SECONDS
+        return None
+
+    _response_channel = channel
+    return channel
+
+
+# Response polling starts with tight intervals and backs off exponentially up to the maximum
+POLL_INITIAL_INTERVAL_SECONDS = 0.05
+POLL_MAX_INTERVAL_SECONDS = 1.0
+POLL_BACKOFF_MULTIPLIER = 2.0
+
+# Time left to report a timeout before the invocation deadline
+DEADLINE_MARGIN_MS = 1000
+
+
+HEDGE_TIMEOUT_MESSAGE = "Debugger did not respond before the hedging delay"
+
+
+def get_hedge_after_ms() -> Optional[int]:
+    """Get the hedging delay of the function, after which the deployed handler answers instead of the debugger."""
+    value = os.environ.get("DEBUGGER_HEDGE_AFTER_MS")
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        print(f"Invalid DEBUGGER_HEDGE_AFTER_MS={value!r}, waiting for the debugger", file=sys.stderr)
+        return None
+
+
+def get_poll_intervals() -> Tuple[float, float]:
+    """Get the initial and maximum polling intervals, optionally tuned from environment."""
+    initial = float(os.environ.get("DEBUGGER_POLL_INITIAL_INTERVAL_MS", POLL_INITIAL_INTERVAL_SECONDS * 1000)) / 1000
+    maximum = float(os.environ.get("DEBUGGER_POLL_MAX_INTERVAL_MS", POLL_MAX_INTERVAL_SECONDS * 1000)) / 1000
+    return initial, max(initial, maximum)
+
+
+def read_response(session: boto3.Session, response: Any, location: Optional[str], encoding: Optional[str] = None) -> Optional[RawJson]:
+    """Read the serialized handler result sent by the debugger, fetching it from S3 when offloaded.
+
+    Encoded responses arrive base64 encoded over the WebSocket and as Binary from DynamoDB.
+    The result is returned undecoded, an empty one means None.
+    """
+    if location:
+        data = decode_payload(read_payload(session, location), encoding)
+    elif encoding:
+        data = decode_payload(base64.b64decode(response) if isinstance(response, str) else bytes(response), encoding)
+    else:
+        data = response.encode() if isinstance(response, str) else bytes(response or b"")
+    return RawJson(data) if data else None
+
+
+def stream_chunk_key(request_id: str, sequence: int) -> str:
+    """Key of the item storing a chunk of a streamed response, must match websocket_default."""
+    return f"{request_id}#chunk#{sequence}"
+
+
+class DebuggerStreamError(Exception):
+    """Raised when a streamed response failed in the debugger or did not end in time."""
+
+
+class StreamedResponse:
+    """Response the debugger streams, iterated as its chunks in order.
+
+    The debugger sends numbered chunks, then a final message with their number, or with
+    the error that ended the stream. Chunks are pushed over the response channel as they
+    are produced and stored as `<request id>#chunk#<n>` items in the PLLDBDebugger table.
+    Pushes can arrive out of order or not at all, a chunk that is not pushed in time is
+    read from the table. Without a channel, the table is polled like for a response.
+    Iteration raises DebuggerStreamError with the error of the debugger, or when the stream
+    does not end before the deadline.
+    """
+
+    def __init__(
+        self,
+        session: boto3.Session,
+        request_id: str,
+        deadline: float,
+        channel: Optional[ResponseChannel] = None,
+        first: Optional[Dict[str, Any]] = None,
+        count: Optional[int] = None,
+        error: Optional[str] = None,
+    ):
+        self.session = session
+        self.request_id = request_id
+        self.deadline = deadline
+        self.channel = channel
+        self.count = count
+        self.error = error
+        self.position = 0
+        self._pending: Dict[int, bytes] = {}
+        self._interval, self._max_interval = get_poll_intervals()
+        if first is not None:
+            self._accept(first)
+
+    def __iter__(self) -> StreamedResponse:
+        return self
+
+    def __next__(self) -> bytes:
+        while self.position not in self._pending:
+            if self.count is not None and self.position >= self.count:
+                if self.error is not None:
+                    raise DebuggerStreamError(self.error)
+                raise StopIteration
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise DebuggerStreamError("Debugger did not finish the streamed response before the function deadline")
+
+            if self.channel is not None and self._receive(min(PUSH_FALLBACK_POLL_INTERVAL_SECONDS, remaining)):
+                continue
+            if not self._read_table() and self.channel is None:
+                time.sleep(min(random.uniform(self._interval / 2, self._interval), max(0.0, self.deadline - time.time())))
+                self._interval = min(self._interval * POLL_BACKOFF_MULTIPLIER, self._max_interval)
+
+        self.position += 1
+        return self._pending.pop(self.position - 1)
+
+    def _accept(self, message: Dict[str, Any]) -> None:
+        if message.get("chunk") is not None:
+            sequence = int(message["chunk"])
+            if sequence >= self.position:
+                self._pending[sequence] = decode_payload(base64.b64decode(message.get("response") or ""), message.get("encoding"))
+        elif message.get("streamed") is not None:
+            self.count, self.error = int(message["streamed"]), message.get("errorMessage")
+
+    def _receive(self, timeout: float) -> bool:
+        if self.channel is None:
+            return False
+        try:
+            message = self.channel.wait_for_response(self.request_id, timeout)
+        except ResponseChannelClosed as e:
+            print(f"Response channel lost, reading the streamed response from DynamoDB: {e}", file=sys.stderr)
+            self.channel = None
+            return False
+        if message is None:
+            return False
+        self._accept(message)
+        return True
+
+    def _read_table(self) -> bool:
+        """Read the next chunk, or the end of the stream while it is not known, from the table."""
+        table = get_debugger_table(self.session)
+        try:
+            item = table.get_item(Key={"RequestId": stream_chunk_key(self.request_id, self.position)}, ConsistentRead=True).get("Item")
+            if item is not None:
+                self._pending[self.position] = decode_payload(bytes(item["Chunk"]), item.get("Encoding"))
+                return True
+            if self.count is None:
+                item = table.get_item(Key={"RequestId": self.request_id}, ProjectionExpression="Streamed, ErrorMessage", ConsistentRead=True).get("Item", {})
+                if "Streamed" in item:
+                    self.count, self.error = int(item["Streamed"]), item.get("ErrorMessage")
+                    return True
+        except Exception as e:
+            print(f"Error reading streamed response: {e}", file=sys.stderr)
+        return False
+
+
+def poll_for_response(
+    session: boto3.Session,
+    request_id: str,
+    timeout: float = 300,
+    stats: Optional[Dict[str, Any]] = None,
+    channel: Optional[ResponseChannel] = None,
+    deadline_ms: Optional[int] = None,
+    hedge_after_ms: Optional[int] = None,
+    poll_first: bool = False,
+) -> Tuple[Optional[Any], Optional[str]]:
+    """Wait for the debugger response, pushed over the response channel or polled from DynamoDB.
+
+    With a response channel the runtime waits on the connection and reads DynamoDB only as a
+    fallback at a slow fixed interval. Without one, or once the connection is lost, DynamoDB is
+    polled with intervals that start tight and grow exponentially with jitter. With poll_first,
+    DynamoDB is read before waiting on the channel, for a response stored before the request.
+
+    Only the StatusCode is read until the response is ready, using strongly consistent
+    reads so the response is seen as soon as it is written. Poll count and time spent
+    waiting are reported to the log and, when given, stored in the stats dictionary.
+
+    With the deadline of the invocation given, waiting stops DEADLINE_MARGIN_MS before it,
+    so the runtime can report the timeout itself instead of the platform killing the sandbox.
+    With a hedging delay that ends first, waiting stops after it with HEDGE_TIMEOUT_MESSAGE;
+    whether the request is hedged is decided by the caller superseding it.
+
+    Once the debugger starts streaming, a StreamedResponse is returned at once, reading the
+    rest of the stream until the deadline of the invocation.
+    """
+    table = get_debugger_table(session)
+    interval, max_interval = get_poll_intervals()
+
+    start_time = time.time()
+    polls = 0
+    pushed = False
+    result: Tuple[Optional[Any], Optional[str]] = (None, "Timeout waiting for debugger response")
+
+    if deadline_ms is not None and (deadline_ms - DEADLINE_MARGIN_MS) / 1000 - start_time < timeout:
+        timeout = max(0.0, (deadline_ms - DEADLINE_MARGIN_MS) / 1000 - start_time)
+        result = (None, "Debugger did not respond before the function deadline")
+    stream_deadline = start_time + timeout
+
+    hedging = False
+    if hedge_after_ms is not None and hedge_after_ms / 1000 < timeout:
+        hedging = True
+        timeout = hedge_after_ms / 1000
+        result = (None, HEDGE_TIMEOUT_MESSAGE)
+
+    # The item has just been written, with a channel there is nothing to poll yet
+    skip_poll = channel is not None and not poll_first
+
+    while time.time() - start_time < timeout:
+        if not skip_poll:
+            try:
+                polls += 1
+                response = table.get_item(Key={"RequestId": request_id}, ProjectionExpression="StatusCode, Streaming", ConsistentRead=True)
+
+                # Check if response is ready
+                if response.get("Item", {}).get("StatusCode", 0) > 0:
+                    item = table.get_item(
+                        Key={"RequestId": request_id},
+                        ProjectionExpression="StatusCode, #resp, ResponseLocation, ErrorMessage, Encoding, Streamed",
+                        ExpressionAttributeNames={"#resp": "Response"},
+                        ConsistentRead=True,
+                    )["Item"]
+
+                    if "Streamed" in item:
+                        result = (StreamedResponse(session, request_id, stream_deadline, channel, count=int(item["Streamed"]), error=item.get("ErrorMessage")), None)
+                        break
+                    elif "ErrorMessage" in item:
+                        result = (None, item["ErrorMessage"])
+                        break
+                    elif "Response" in item or "ResponseLocation" in item:
+                        result = (read_response(session, item.get("Response", ""), item.get("ResponseLocation"), item.get("Encoding")), None)
+                        break
+                elif response.get("Item", {}).get("Streaming"):
+                    result = (StreamedResponse(session, request_id, stream_deadline, channel), None)
+                    break
+
+            except Exception as e:
+                print(f"Error polling for response: {e}", file=sys.stderr)
+        skip_poll = False
+
+        remaining = timeout - (time.time() - start_time)
+        if remaining <= 0:
+            break
+
+        if channel is not None:
+            try:
+                message = channel.wait_for_response(request_id, min(PUSH_FALLBACK_POLL_INTERVAL_SECONDS, remaining))
+            except ResponseChannelClosed as e:
+                print(f"Response channel lost, falling back to polling: {e}", file=sys.stderr)
+                channel = None
+                continue
+
+            if message is not None:
+                pushed = True
+                if message.get("chunk") is not None or message.get("streamed") is not None:
+                    result = (StreamedResponse(session, request_id, stream_deadline, channel, first=message), None)
+                elif message.get("errorMessage"):
+                    result = (None, message["errorMessage"])
+                else:
+                    result = (read_response(session, message.get("response", ""), message.get("responseLocation"), message.get("encoding")), None)
+                break
+        else:
+            time.sleep(min(random.uniform(interval / 2, interval), remaining))
+            interval = min(interval * POLL_BACKOFF_MULTIPLIER, max_interval)
+
+    wait_ms = int((time.time() - start_time) * 1000)
+    print(f"Waited for debugger response {request_id=} {polls=} {pushed=} {wait_ms=}")
+    if stats is not None:
+        stats["polls"] = polls
+        stats["pushed"] = pushed
+        stats["waitMs"] = wait_ms
+
+    return result
+
+
+def supersede_debugger_request(session: boto3.Session, request_id: str) -> bool:
+    """Mark the request as answered by the sandbox, so that a late debugger response is discarded.
+
+    Returns False when the debugger response was stored, or started streaming, in the meantime
+    and must be used instead.
+    """
+    try:
+        get_debugger_table(session).update_item(
+            Key={"RequestId": request_id},
+            UpdateExpression="SET Superseded = :superseded",
+            ConditionExpression="StatusCode = :pending AND attribute_not_exists(Streaming)",
+            ExpressionAttributeValues={":superseded": True, ":pending": 0},
+        )
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        # The late response is then stored but never read
+        print(f"Error superseding debugger request {request_id}: {e}", file=sys.stderr)
+    return True
+
 
+def build_debugger_request_message(
+    request_id: str,
+    session_id: str,
+    connection_id: str,
+    event: Any,
+    deadline_ms: Optional[int],
+    payload_location: Optional[str] = None,
+    encoding: Optional[str] = None,
+    environment: Optional[EnvironmentSnapshot] = None,
+    invoked_function_arn: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Build the DebuggerRequest sent to the debugger.
+
+    The event and environment are sent inline as JSON, in payload as base64 of the encoded
+    JSON when the session negotiated an encoding, or not at all when offloaded to S3.
+    With an environment snapshot, the hash and delta are always sent inline.
+    """
+    environment_fields = environment_message_fields(environment)
+    message: Dict[str, Any] = {
+        "requestId": request_id,
+        "sessionId": session_id,
+        "connectionId": connection_id,
+        "lambdaFunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""),
+        "lambdaFunctionVersion": os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", ""),
+        "invokedFunctionArn": invoked_function_arn,
+        "event": "",
+        "environmentVariables": None,
+        "deadlineMs": deadline_ms,
+        "payloadLocation": payload_location,
+        "encoding": encoding,
+        "environmentHash": environment_fields.get("environmentHash"),
+        "environmentDelta": environment_fields.get("environmentDelta"),
+    }
+    if payload_location:
+        return message
+
+    if encoding:
+        body = dumps_document(event=event, environmentVariables=environment_fields["environmentVariables"])
+        message["payload"] = base64.b64encode(encode_payload(body, encoding)).decode()
+    else:
+        message["event"] = json_bytes(event).decode()
+        message["environmentVariables"] = environment_fields["environmentVariables"]
+    return message
 
-def get_lambda_runtime_api() -> str:
-    """Get the Lambda Runtime API endpoint from environment."""
-    return os.environ.get("AWS_LAMBDA_RUNTIME_API", "")
 
+def send_debugger_request(session: boto3.Session, connection_id: str, message: Dict[str, Any]) -> None:
+    """Send notification to WebSocket connection."""
+    # Get WebSocket API endpoint from environment
+    websocket_endpoint = os.environ.get("DEBUGGER_WEBSOCKET_API_ENDPOINT")
+    if not websocket_endpoint:
+        print("DEBUGGER_WEBSOCKET_API_ENDPOINT not set", file=sys.stderr)
+        return
 
-def get_next_invocation(runtime_api: str) -> Tuple[Dict[str, Any], str]:
-    """Get the next invocation from Lambda Runtime API."""
-    url = f"http://{runtime_api}/2018-06-01/runtime/invocation/next"
+    apigateway = get_apigateway_client(session, websocket_endpoint)
 
     try:
-        with urllib.request.urlopen(url) as response:
-            request_id = response.headers.get("Lambda-Runtime-Aws-Request-Id", "")
-            event = json.loads(response.read().decode())
-            return event, request_id
+        apigateway.post_to_connection(ConnectionId=connection_id, Data=json.dumps(message).encode())
     except Exception as e:
-        print(f"Error getting next invocation: {e}", file=sys.stderr)
-        raise
+        # Nobody will answer on a connection that is gone, the handler runs in the sandbox instead
+        if getattr(e, "response", {}).get("Error", {}).get("Code") == "GoneException":
+            _circuit_breaker.trip(f"debugger connection {connection_id} is gone")
+            raise DebuggerConnectionGone(f"Debugger connection {connection_id} is gone") from e
+        # Nobody will be notified, the invocation would wait until its deadline
+        if getattr(e, "response", {}).get("Error", {}).get("Code") == "PayloadTooLargeException":
+            raise DebuggerPayloadTooLarge(f"Debugger request of {len(json.dumps(message))} bytes is too large for the WebSocket API") from e
+        print(f"Error sending WebSocket notification: {e}", file=sys.stderr)
+        # Don't raise - WebSocket errors shouldn't fail the invocation
 
 
-def send_response(runtime_api: str, request_id: str, response_data: Any) -> None:
-    """Send successful response to Lambda Runtime API."""
-    url = f"http://{runtime_api}/2018-06-01/runtime/invocation/{request_id}/response"
+CIRCUIT_BREAKER_PROBE_INTERVAL_SECONDS = 30
+
+
+class DebuggerConnectionGone(Exception):
+    """Raised when the WebSocket connection of the debugger no longer exists."""
+
+
+class DebuggerPayloadTooLarge(Exception):
+    """Raised when the WebSocket API rejects a notification as too large."""
+
+
+class DebuggerCircuitBreaker:
+    """Sandbox-level circuit breaker skipping the debugger while it is known to be unreachable.
+
+    While open, invocations run the handler in the sandbox without waiting on the debugger.
+    After the probe interval one invocation is forwarded again, which closes the breaker
+    when the debugger is reachable or opens it for another interval when not.
+    """
+
+    def __init__(self, probe_interval: float = CIRCUIT_BREAKER_PROBE_INTERVAL_SECONDS):
+        self.probe_interval = probe_interval
+        self._open_until: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._open_until is not None
+
+    def allow(self) -> bool:
+        """Return whether the invocation may be forwarded, as a probe when the breaker is open."""
+        return self._open_until is None or time.time() >= self._open_until
+
+    def trip(self, reason: str) -> None:
+        if self._open_until is None:
+            print(f"Debugger circuit opened: {reason}", file=sys.stderr)
+        self._open_until = time.time() + self.probe_interval
+
+    def reset(self) -> None:
+        if self._open_until is not None:
+            print("Debugger circuit closed")
+        self._open_until = None
+
+
+_circuit_breaker = DebuggerCircuitBreaker()
+
+
+SESSION_ITEM_TTL_SECONDS = 10
+
+
+def normalize_numbers(value: Any) -> Any:
+    """Turn the Decimal numbers DynamoDB returns into the int and float values JSON events hold.
+
+    Decimal("0.1") does not equal the float 0.1 an event is parsed to, so rules are compared
+    in the types of the event.
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: normalize_numbers(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [normalize_numbers(item) for item in value]
+    return value
+
+
+class SessionItemCache:
+    """Sandbox cache of the routing rules and status stored on the session item.
+
+    The CLI updates the rules and the WebSocket API the status on the PLLDBSessions item at
+    any time, so the item is read again once the TTL has passed. When it cannot be read,
+    the last known values keep applying.
+    """
+
+    def __init__(self, ttl: float = SESSION_ITEM_TTL_SECONDS):
+        self.ttl = ttl
+        self._session_id: Optional[str] = None
+        self._item: Dict[str, Any] = {}
+        self._fetched_at = 0.0
+
+    def get_rules(self, session: boto3.Session, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return the routing rules of the session, None when every invocation is forwarded."""
+        return self._get_item(session, session_id).get("RoutingRules")
+
+    def get_status(self, session: boto3.Session, session_id: str) -> Optional[str]:
+        """Return the status of the session, None when it is not known."""
+        return self._get_item(session, session_id).get("Status")
+
+    def _get_item(self, session: boto3.Session, session_id: str) -> Dict[str, Any]:
+        now = time.time()
+        if session_id == self._session_id and now < self._fetched_at + self.ttl:
+            return self._item
+
+        try:
+            self._item = (
+                get_sessions_table(session).get_item(Key={"SessionId": session_id}, ProjectionExpression="RoutingRules, #status", ExpressionAttributeNames={"#status": "Status"}).get("Item", {})
+            )
+            if "RoutingRules" in self._item:
+                self._item["RoutingRules"] = normalize_numbers(self._item["RoutingRules"])
+        except Exception as e:
+            print(f"Error reading session {session_id}: {e}", file=sys.stderr)
+            if session_id != self._session_id:
+                self._item = {}
+
+        self._session_id = session_id
+        self._fetched_at = now
+        return self._item
+
+
+_session_item_cache = SessionItemCache()
+
+_EVENT_PATH_TOKEN = re.compile(r"\.([^.\[]+)|\[(\d+)\]|\['([^']*)'\]")
+
+
+def resolve_event_path(event: Any, path: str) -> Tuple[bool, Any]:
+    """Resolve a JSONPath-style path such as `$.requestContext.http.method` or `$.Records[0]['eventName']`.
+
+    Returns whether the path exists in the event and the value found there.
+    """
+    if not path.startswith("$"):
+        raise ValueError(f"Event path must start with $: {path}")
+
+    value = event
+    position = 1
+    while position < len(path):
+        match = _EVENT_PATH_TOKEN.match(path, position)
+        if not match:
+            raise ValueError(f"Invalid event path: {path}")
+        key, index, quoted = match.groups()
+        if index is not None:
+            if not isinstance(value, list) or int(index) >= len(value):
+                return False, None
+            value = value[int(index)]
+        else:
+            name = key if key is not None else quoted
+            if not isinstance(value, dict) or name not in value:
+                return False, None
+            value = value[name]
+        position = match.end()
+    return True, value
+
+
+def matches_routing_rules(rules: Dict[str, Any], event: Any, function_name: str) -> bool:
+    """Evaluate the routing rules of the session against the invocation.
 
-    data = json.dumps(response_data).encode()
-    req = urllib.request.Request(url, data=data, method="POST")
-    req.add_header("Content-Type", "application/json")
+    The function must be on the `functions` allow list, every predicate must hold, a
+    predicate without `equals` only requires the path to exist, and the invocation must be
+    picked by the `sampleRate` percentage. Missing rules do not restrict forwarding.
+    """
+    functions = rules.get("functions")
+    if functions and function_name not in functions:
+        return False
 
+    for predicate in rules.get("predicates") or []:
+        found, value = resolve_event_path(json_value(event), predicate["path"])
+        if not found or ("equals" in predicate and value != predicate["equals"]):
+            return False
+
+    sample_rate = rules.get("sampleRate")
+    if sample_rate is not None and random.uniform(0, 100) >= float(sample_rate):
+        return False
+
+    return True
+
+
+def debugger_available(session: boto3.Session, session_id: str) -> bool:
+    """Check the circuit breaker and the cached status of the session before forwarding.
+
+    A session the WebSocket API no longer reports as ACTIVE opens the breaker. An unknown
+    status does not, so a session item that cannot be read never blocks debugging.
+    """
+    if not _circuit_breaker.allow():
+        return False
+
+    status = _session_item_cache.get_status(session, session_id)
+    if status is not None and status != "ACTIVE":
+        _circuit_breaker.trip(f"session {session_id} is {status}")
+        return False
+    return True
+
+
+def should_forward_invocation(session: boto3.Session, session_id: str, event: Any) -> bool:
+    """Decide whether the invocation goes to the debugger or runs in the sandbox.
+
+    Everything is forwarded when the session has no routing rules, and when they cannot be
+    evaluated, so a broken rule never silently hides invocations from the developer.
+    """
     try:
-        with urllib.request.urlopen(req):
-            pass
+        rules = _session_item_cache.get_rules(session, session_id)
+        return rules is None or matches_routing_rules(rules, event, os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""))
     except Exception as e:
-        print(f"Error sending response: {e}", file=sys.stderr)
-        raise
+        print(f"Error evaluating routing rules, forwarding the invocation: {e}", file=sys.stderr)
+        return True
 
 
-def send_error(runtime_api: str, request_id: str, error_message: str, error_type: str = "Error") -> None:
-    """Send error response to Lambda Runtime API."""
-    url = f"http://{runtime_api}/2018-06-01/runtime/invocation/{request_id}/error"
+METRICS_NAMESPACE = "PLLDB"
+# Phases of a debug invocation in the order they run, the debugger wait is the developer's think time
+INVOCATION_PHASES = ("Prewarm", "AssumeRole", "ResponseChannel", "PayloadPreparation", "RequestWrite", "Notification", "DebuggerWait", "RuntimeResponse", "Hedge")
+
+
+class InvocationMetrics:
+    """Durations of the phases of a debug invocation, emitted as one CloudWatch EMF line.
+
+    CloudWatch extracts the metrics from the log line, so no API calls are made. The line
+    carries a REPORT-style summary that separates the debug overhead from the time spent
+    waiting on the debugger.
+    """
 
-    error_data = {"errorMessage": error_message, "errorType": error_type}
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.durations: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.stats: Dict[str, Any] = {}
+        self._start = time.perf_counter()
 
-    data = json.dumps(error_data).encode()
-    req = urllib.request.Request(url, data=data, method="POST")
-    req.add_header("Content-Type", "application/json")
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = (time.perf_counter() - start) * 1000
+
+    def timed(self, name: str, call: Callable[[], Any]) -> Callable[[], Any]:
+        """Wrap the call to record its duration as the phase, for calls run on another thread."""
+
+        def run() -> Any:
+            with self.phase(name):
+                return call()
+
+        return run
+
+    def summary(self) -> Dict[str, float]:
+        """Durations in milliseconds, with the total and the overhead excluding the debugger wait."""
+        total = (time.perf_counter() - self._start) * 1000
+        durations = {name: round(self.durations[name], 2) for name in INVOCATION_PHASES if name in self.durations}
+        durations["Total"] = round(total, 2)
+        durations["Overhead"] = round(total - self.durations.get("DebuggerWait", 0.0), 2)
+        return durations
+
+    def stats_properties(self) -> Dict[str, Any]:
+        """Stats as log properties, with flags as 0/1 and names taken by a count left to the count."""
+        properties = {}
+        for key, value in self.stats.items():
+            name = key[0].upper() + key[1:]
+            if name not in self.counts:
+                properties[name] = int(value) if isinstance(value, bool) else value
+        return properties
+
+    def to_emf(self, function_name: str, session_id: str) -> Dict[str, Any]:
+        durations = self.summary()
+        metrics: List[Dict[str, str]] = [{"Name": f"{name}Duration", "Unit": "Milliseconds"} for name in durations]
+        metrics += [{"Name": name, "Unit": "Count"} for name in self.counts]
+        record: Dict[str, Any] = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [["FunctionName", "SessionId"]], "Metrics": metrics}],
+            },
+            "FunctionName": function_name,
+            "SessionId": session_id,
+            "RequestId": self.request_id,
+            **{f"{name}Duration": duration for name, duration in durations.items()},
+            **self.stats_properties(),
+            **{name: int(count) for name, count in self.counts.items()},
+        }
+        record["Report"] = f"REPORT RequestId: {self.request_id}\t" + "\t".join(f"{name}: {duration:.2f} ms" for name, duration in durations.items())
+        return record
 
+
+def emit_invocation_metrics(metrics: InvocationMetrics, session_id: str) -> None:
+    """Write the EMF line of the invocation to the function log."""
     try:
-        with urllib.request.urlopen(req):
-            pass
+        print(json.dumps(metrics.to_emf(os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""), session_id)), flush=True)
     except Exception as e:
-        print(f"Error sending error response: {e}", file=sys.stderr)
-        raise
+        print(f"Error emitting invocation metrics: {e}", file=sys.stderr)
 
 
-def assume_debugger_role() -> boto3.Session:
-    """Assume the PLLDBDebuggerRole and return a session."""
-    sts = boto3.client("sts")
+_dispatch_pool: Optional[ThreadPoolExecutor] = None
+
+
+def get_dispatch_pool() -> ThreadPoolExecutor:
+    """Return the thread pool the request write and notification run on, shared across invocations."""
+    global _dispatch_pool
+    if _dispatch_pool is None:
+        _dispatch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="plldb-dispatch")
+    return _dispatch_pool
+
+
+def dispatch_debugger_request(session: boto3.Session, *calls: Callable[[], Any]) -> List[Any]:
+    """Run the calls handing a request to the debugger concurrently and wait until all are acknowledged.
 
+    The clients are created up front, a boto3 session must not create clients from several
+    threads at once. The first failure is raised once every call has finished, otherwise
+    the results of the calls are returned in order.
+    """
+    get_debugger_table(session)
+    websocket_endpoint = os.environ.get("DEBUGGER_WEBSOCKET_API_ENDPOINT")
+    if websocket_endpoint:
+        get_apigateway_client(session, websocket_endpoint)
+
+    futures = [get_dispatch_pool().submit(call) for call in calls]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+class HandlerNotFoundError(Exception):
+    """Raised when the function handler cannot be resolved."""
+
+
+_handler: Optional[Callable[[Any, Any], Any]] = None
+
+
+def resolve_handler(handler_name: Optional[str] = None) -> Callable[[Any, Any], Any]:
+    """Import the handler named by _HANDLER, or the given name, from the task root."""
+    if handler_name is None:
+        handler_name = os.environ.get("_HANDLER", "")
+    if not handler_name or "." not in handler_name:
+        raise HandlerNotFoundError("No handler specified")
+
+    module_name, function_name = handler_name.rsplit(".", 1)
+    task_root = os.environ.get("LAMBDA_TASK_ROOT", "/var/task")
+    if task_root not in sys.path:
+        sys.path.insert(0, task_root)
+
+    module = __import__(module_name.replace("/", "."), fromlist=[function_name])
     try:
-        response = sts.assume_role(
-            RoleArn=f"arn:aws:iam::{boto3.client('sts').get_caller_identity()['Account']}:role/PLLDBDebuggerRole", RoleSessionName="plldb-lambda-runtime", ExternalId="plldb-debugger"
-        )
+        return getattr(module, function_name)
+    except AttributeError:
+        raise HandlerNotFoundError(f"Handler '{function_name}' missing on module '{module_name}'")
 
-        credentials = response["Credentials"]
-        return boto3.Session(aws_access_key_id=credentials["AccessKeyId"], aws_secret_access_key=credentials["SecretAccessKey"], aws_session_token=credentials["SessionToken"])
-    except Exception as e:
-        print(f"Error assuming debugger role: {e}", file=sys.stderr)
-        raise
 
+def get_handler() -> Callable[[Any, Any], Any]:
+    """Return the handler, resolving it only once per sandbox."""
+    global _handler
+    if _handler is None:
+        _handler = resolve_handler()
+    return _handler
 
-def create_debugger_request(session: boto3.Session, request_id: str, session_id: str, connection_id: str, event: Dict[str, Any], context: Dict[str, Any]) -> None:
-    """Create a request entry in the PLLDBDebugger table."""
-    dynamodb = session.resource("dynamodb")
-    table = dynamodb.Table("PLLDBDebugger")
 
+def run_normal_handler(event: Any, request_id: str, runtime_api: str, context: Optional[LambdaContext] = None, keep_stream: bool = False) -> Tuple[Any, Optional[str]]:
+    """Run the normal Lambda handler when not debugging.
+
+    Returns the result and the error message of the handler, once it was sent to the Runtime API.
+    A handler returning an iterator streams its response, which is only kept, joined into bytes,
+    with keep_stream.
+    """
     try:
-        table.put_item(
-            Item={
-                "RequestId": request_id,
-                "SessionId": session_id,
-                "ConnectionId": connection_id,
-                "Request": json.dumps({"event": event, "context": context}),
-                "EnvironmentVariables": dict(os.environ),
-                "StatusCode": 0,  # Indicates pending
-            }
-        )
+        handler = get_handler()
     except Exception as e:
-        print(f"Error creating debugger request: {e}", file=sys.stderr)
-        raise
+        send_error(runtime_api, request_id, str(e), type(e).__name__)
+        return None, str(e)
 
+    try:
+        result = handler(json_value(event), context or LambdaContext(request_id))
+    except Exception as e:
+        send_error(runtime_api, request_id, str(e), type(e).__name__)
+        return None, str(e)
 
-def poll_for_response(session: boto3.Session, request_id: str, timeout: int = 300) -> Tuple[Optional[Any], Optional[str]]:
-    """Poll DynamoDB for debugger response."""
-    dynamodb = session.resource("dynamodb")
-    table = dynamodb.Table("PLLDBDebugger")
+    if is_streaming_result(result):
+        kept: List[bytes] = []
+        chunks = stream_chunks(result)
+        error = send_streaming_response(runtime_api, request_id, (kept.append(chunk) or chunk for chunk in chunks) if keep_stream else chunks)
+        return (b"".join(kept) if keep_stream else None), error
 
-    start_time = time.time()
+    send_response(runtime_api, request_id, result)
+    return result, None
 
-    while time.time() - start_time < timeout:
+
+SESSION_MODE_DEBUG = "debug"
+SESSION_MODE_SHADOW = "shadow"
+
+# Shadow copies wait in a bounded queue, when it is full further copies are dropped
+SHADOW_QUEUE_SIZE = 8
+# Copies queued longer, e.g. while the sandbox was frozen between invocations, are dropped
+SHADOW_MAX_AGE_SECONDS = 30
+# Longest wait for the copy to be sent before the sandbox is frozen
+SHADOW_FREEZE_TIMEOUT_SECONDS = 0.5
+
+
+def get_session_mode() -> str:
+    """Return the mode of the debugger session, debug unless the session mirrors invocations."""
+    return SESSION_MODE_SHADOW if os.environ.get("DEBUGGER_SESSION_MODE") == SESSION_MODE_SHADOW else SESSION_MODE_DEBUG
+
+
+# Invocations are intercepted by replacing the runtime with this script, or by the
+# plldb-extension together with a wrapper of the handler in the managed runtime
+INTERCEPTION_RUNTIME = "runtime"
+INTERCEPTION_EXTENSION = "extension"
+
+
+def get_interception() -> str:
+    """Return how invocations are intercepted, by this runtime unless the extension is selected."""
+    return INTERCEPTION_EXTENSION if os.environ.get("DEBUGGER_INTERCEPTION") == INTERCEPTION_EXTENSION else INTERCEPTION_RUNTIME
+
+
+class ShadowForwarder:
+    """Forward shadow copies of invocations to the debugger on a background thread.
+
+    Submitting never blocks: the queue is bounded and copies that do not fit are dropped,
+    so a slow debugger or AWS endpoint cannot hold up invocations or pile up work. Failed
+    forwards are only logged.
+    """
+
+    def __init__(self, max_pending: int = SHADOW_QUEUE_SIZE, max_age: float = SHADOW_MAX_AGE_SECONDS):
+        self.max_age = max_age
+        self.dropped = 0
+        self._queue: "queue.Queue[Tuple[float, Callable[[], None]]]" = queue.Queue(maxsize=max_pending)
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, forward: Callable[[], None]) -> bool:
+        """Queue the forward, returns False when it was dropped because the queue is full."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="plldb-shadow", daemon=True)
+            self._thread.start()
         try:
-            response = table.get_item(Key={"RequestId": request_id})
+            self._queue.put_nowait((time.time(), forward))
+        except queue.Full:
+            self.dropped += 1
+            print(f"Shadow queue is full, dropped a copy dropped={self.dropped}", file=sys.stderr)
+            return False
+        return True
 
-            if "Item" in response:
-                item = response["Item"]
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued forward was processed, returns False when the timeout expired first."""
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
 
-                # Check if response is ready
-                if item.get("StatusCode") and item["StatusCode"] > 0:
-                    if "ErrorMessage" in item:
-                        return None, item["ErrorMessage"]
-                    elif "Response" in item:
-                        return json.loads(item["Response"]), None
+    def _run(self) -> None:
+        while True:
+            submitted_at, forward = self._queue.get()
+            try:
+                if time.time() - submitted_at > self.max_age:
+                    self.dropped += 1
+                    print(f"Dropped a shadow copy queued for more than {self.max_age} seconds", file=sys.stderr)
+                else:
+                    forward()
+            except Exception as e:
+                print(f"Error forwarding shadow copy: {e}", file=sys.stderr)
+            finally:
+                self._queue.task_done()
 
-        except Exception as e:
-            print(f"Error polling for response: {e}", file=sys.stderr)
 
-        time.sleep(1)  # Poll every second
+_shadow_forwarder = ShadowForwarder()
 
-    return None, "Timeout waiting for debugger response"
 
+def build_shadow_message(
+    request_id: str,
+    session_id: str,
+    connection_id: str,
+    event: Any,
+    deadline_ms: Optional[int],
+    response: Any,
+    error: Optional[str],
+    encoding: Optional[str] = None,
+    environment: Optional[EnvironmentSnapshot] = None,
+    invoked_function_arn: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Build the DebuggerRequest of a shadow copy, carrying the result of the deployed handler."""
+    message = build_debugger_request_message(request_id, session_id, connection_id, event, deadline_ms, None, encoding, environment, invoked_function_arn)
+    message["shadow"] = True
+    if error is not None:
+        message["deployedErrorMessage"] = error
+    elif isinstance(response, bytes):
+        message["deployedResponse"] = response.decode(errors="replace")
+    else:
+        message["deployedResponse"] = json.dumps(response)
+    return message
 
-def send_debugger_request(session: boto3.Session, connection_id: str, message: Dict[str, Any]) -> None:
-    """Send notification to WebSocket connection."""
-    # Get WebSocket API endpoint from environment
-    websocket_endpoint = os.environ.get("DEBUGGER_WEBSOCKET_API_ENDPOINT")
-    if not websocket_endpoint:
-        print("DEBUGGER_WEBSOCKET_API_ENDPOINT not set", file=sys.stderr)
+
+def forward_shadow_copy(
+    session_id: str,
+    connection_id: str,
+    request_id: str,
+    event: Any,
+    deadline_ms: Optional[int],
+    response: Any,
+    error: Optional[str],
+    environment: EnvironmentSnapshot,
+    invoked_function_arn: Optional[str] = None,
+) -> None:
+    """Send the shadow copy of an answered invocation to the debugger, subject to the routing rules.
+
+    Nothing is stored in the PLLDBDebugger table and no response is awaited. Copies too large
+    for a WebSocket frame are not offloaded but skipped.
+    """
+    debugger_session = assume_debugger_role()
+    if not debugger_available(debugger_session, session_id) or not should_forward_invocation(debugger_session, session_id, event):
         return
 
-    apigateway = session.client("apigatewaymanagementapi", endpoint_url=websocket_endpoint)
+    encoding = get_payload_encoding()
+    publish_environment(debugger_session, session_id, environment, encoding)
+    message = build_shadow_message(request_id, session_id, connection_id, event, deadline_ms, response, error, encoding, environment, invoked_function_arn)
 
+    size = len(json.dumps(message))
+    if size > PAYLOAD_OFFLOAD_THRESHOLD_BYTES:
+        print(f"Shadow copy of {request_id} is {size} bytes, too large to mirror", file=sys.stderr)
+        return
+
+    send_debugger_request(debugger_session, connection_id, message)
+    _circuit_breaker.reset()
+    print(f"Mirrored invocation to the debugger {request_id=}")
+
+
+def mirror_invocation(session_id: str, connection_id: str, event: Any, context: LambdaContext, response: Any, error: Optional[str], environment: Optional[EnvironmentSnapshot] = None) -> bool:
+    """Queue the shadow copy of an invocation the deployed handler has already answered.
+
+    Unless given, the environment is captured right away, before the next invocation changes
+    the trace header.
+    """
+    environment = environment or EnvironmentSnapshot()
+    return _shadow_forwarder.submit(
+        lambda: forward_shadow_copy(session_id, connection_id, context.aws_request_id, event, context.deadline_ms, response, error, environment, context.invoked_function_arn)
+    )
+
+
+# Capture of sampled invocations answered by the deployed handler, e.g. to build replay
+# corpora, without a debugger session. Records are kept in memory as JSON lines and
+# uploaded in batches, as gzipped objects, by a background thread.
+CAPTURE_KEY_PREFIX = "captures"
+# A batch is uploaded once it holds this many bytes, or before the sandbox freezes once its
+# oldest record waited this long, which bounds what a sandbox shut down while frozen loses
+CAPTURE_FLUSH_BYTES = 1024 * 1024
+CAPTURE_FLUSH_INTERVAL_SECONDS = 30.0
+# Records that do not fit the buffer, e.g. while uploads are slow, are dropped
+CAPTURE_BUFFER_MAX_BYTES = 4 * 1024 * 1024
+CAPTURE_RECORD_MAX_BYTES = 1024 * 1024
+# Longest wait for the uploads in flight before the sandbox is frozen, slower ones go on once it is thawed
+CAPTURE_FREEZE_TIMEOUT_SECONDS = 0.2
+
+
+def get_capture_sample_rate() -> float:
+    """Get the share of invocations to capture, between 0 and 1, capturing nothing unless set."""
+    value = os.environ.get("DEBUGGER_CAPTURE_SAMPLE_RATE")
+    if not value:
+        return 0.0
     try:
-        apigateway.post_to_connection(ConnectionId=connection_id, Data=json.dumps(message).encode())
+        return min(1.0, max(0.0, float(value)))
+    except ValueError:
+        print(f"Invalid DEBUGGER_CAPTURE_SAMPLE_RATE={value!r}, capturing nothing", file=sys.stderr)
+        return 0.0
+
+
+def get_capture_bucket(invoked_function_arn: str) -> Optional[str]:
+    """Return the bucket of captured invocations, the bootstrap bucket of the account unless set.
+
+    The account is read from the ARN the function was invoked with, so no AWS call is needed.
+    """
+    bucket = os.environ.get("DEBUGGER_CAPTURE_BUCKET")
+    if bucket:
+        return bucket
+    # arn:aws:lambda:{region}:{account}:function:{name}
+    parts = (invoked_function_arn or "").split(":")
+    if len(parts) < 5 or not parts[4]:
+        return None
+    return f"plldb-core-infrastructure-{get_aws_region()}-{parts[4]}"
+
+
+def build_capture_record(event: Any, context: LambdaContext, response: Any, error: Optional[str], started_at: float, duration_ms: float) -> bytes:
+    """Serialize a captured invocation as one JSON line, the event is spliced in as it arrived."""
+    fields: Dict[str, Any] = {
+        "requestId": context.aws_request_id,
+        "functionName": context.function_name,
+        "functionVersion": context.function_version,
+        "timestamp": int(started_at * 1000),
+        "durationMs": round(duration_ms, 3),
+        "event": event,
+    }
+    if error is not None:
+        fields["errorMessage"] = error
+    elif isinstance(response, bytes):
+        # Streamed responses are kept joined
+        fields["streamedResponse"] = response.decode(errors="replace")
+    else:
+        fields["response"] = response
+    return dumps_document(**fields)
+
+
+class TrafficCapture:
+    """Buffer of captured invocations, uploaded in batches to S3.
+
+    Records are added after the response was sent, so the caller never waits for the
+    capture. The buffer and the batches waiting for upload are bounded, records that do
+    not fit are dropped. Uploads run on a background thread with the credentials of the
+    execution role; batches that fail to upload are dropped and only logged.
+    """
+
+    def __init__(
+        self,
+        bucket: Optional[str],
+        sample_rate: float,
+        flush_bytes: int = CAPTURE_FLUSH_BYTES,
+        max_buffer_bytes: int = CAPTURE_BUFFER_MAX_BYTES,
+        max_record_bytes: int = CAPTURE_RECORD_MAX_BYTES,
+        flush_interval: float = CAPTURE_FLUSH_INTERVAL_SECONDS,
+    ):
+        self.bucket = bucket
+        self.sample_rate = sample_rate
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_buffer_bytes = max_buffer_bytes
+        self.max_record_bytes = max_record_bytes
+        self.dropped = 0
+        self._records: List[bytes] = []
+        self._size = 0
+        self._buffered_at = 0.0
+        # One batch uploading and one waiting
+        self._queue: "queue.Queue[List[bytes]]" = queue.Queue(maxsize=1)
+        self._thread: Optional[threading.Thread] = None
+        self._s3_client: Any = None
+
+    def sample(self) -> bool:
+        """Decide whether the next invocation is captured."""
+        return random.random() < self.sample_rate
+
+    def add(self, record: bytes) -> bool:
+        """Buffer the record, returns False when it was dropped."""
+        if len(record) > self.max_record_bytes or self._size + len(record) > self.max_buffer_bytes:
+            self.dropped += 1
+            print(f"Dropped a captured invocation of {len(record)} bytes dropped={self.dropped}", file=sys.stderr)
+            return False
+
+        if not self._records:
+            self._buffered_at = time.monotonic()
+        self._records.append(record)
+        self._size += len(record)
+        if self._size >= self.flush_bytes:
+            self.flush()
+        return True
+
+    def flush(self) -> bool:
+        """Hand the buffered records to the upload thread, returns False when they stay buffered.
+
+        While a batch is uploading and another one waits, the records stay in the buffer.
+        """
+        if not self._records:
+            return True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="plldb-capture", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(self._records)
+        except queue.Full:
+            return False
+        self._records, self._size = [], 0
+        return True
+
+    def before_freeze(self, timeout: float = CAPTURE_FREEZE_TIMEOUT_SECONDS) -> None:
+        """Hand over the buffered records once the oldest one is due and let the uploads in flight finish.
+
+        Called once the response was sent, before the runtime asks for the next invocation,
+        which freezes the sandbox until it arrives. Records are batched across invocations,
+        a frozen sandbox that is shut down without running again loses those buffered for
+        less than flush_interval. The wait is bounded by the timeout, uploads still running
+        go on once the sandbox is thawed.
+        """
+        if self._records and time.monotonic() - self._buffered_at >= self.flush_interval:
+            self.flush()
+        if not self.join(timeout):
+            print(f"Captured invocations still uploading after {timeout} seconds", file=sys.stderr)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every handed over batch was uploaded, returns False when the timeout expired first."""
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
+
+    def _run(self) -> None:
+        while True:
+            records = self._queue.get()
+            try:
+                self._upload(records)
+            except Exception as e:
+                self.dropped += len(records)
+                print(f"Error uploading {len(records)} captured invocations: {e}", file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, records: List[bytes]) -> None:
+        if self._s3_client is None:
+            self._s3_client = create_boto3_session().client("s3")
+        now = time.time()
+        function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "unknown")
+        key = f"{CAPTURE_KEY_PREFIX}/{function_name}/{time.strftime('%Y/%m/%d/%H', time.gmtime(now))}/{int(now * 1000)}-{os.urandom(4).hex()}.jsonl.gz"
+        body = gzip.compress(b"\n".join(records) + b"\n", compresslevel=ZLIB_LEVEL)
+        self._s3_client.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType="application/gzip")
+        print(f"Uploaded {len(records)} captured invocations to s3://{self.bucket}/{key}")
+
+
+def create_traffic_capture() -> Optional[TrafficCapture]:
+    """Create the capture of the sandbox, None when capturing is not configured.
+
+    Unless DEBUGGER_CAPTURE_BUCKET is set, the bucket is resolved with the first captured invocation.
+    """
+    sample_rate = get_capture_sample_rate()
+    if not sample_rate:
+        return None
+    return TrafficCapture(os.environ.get("DEBUGGER_CAPTURE_BUCKET") or None, sample_rate)
+
+
+def capture_invocation(capture: TrafficCapture, event: Any, request_id: str, runtime_api: str, context: LambdaContext) -> None:
+    """Run the handler and, once it answered, add the invocation to the capture.
+
+    The capture only logs its failures, it never fails the invocation.
+    """
+    started_at, start = time.time(), time.perf_counter()
+    response, error = run_normal_handler(event, request_id, runtime_api, context, keep_stream=True)
+    duration_ms = (time.perf_counter() - start) * 1000
+    if capture.bucket is None:
+        capture.bucket = get_capture_bucket(context.invoked_function_arn)
+        if capture.bucket is None:
+            print(f"No bucket for captured invocations in {context.invoked_function_arn=}, capturing nothing", file=sys.stderr)
+            capture.sample_rate = 0.0
+            return
+    try:
+        capture.add(build_capture_record(event, context, response, error, started_at, duration_ms))
     except Exception as e:
-        print(f"Error sending WebSocket notification: {e}", file=sys.stderr)
-        # Don't raise - WebSocket errors shouldn't fail the invocation
+        print(f"Error capturing invocation {request_id=}: {e}", file=sys.stderr)
 
 
-def run_normal_handler(event: Dict[str, Any], request_id: str, runtime_api: str) -> None:
-    """Run the normal Lambda handler when not debugging."""
-    # Import and execute the original handler
-    handler_name = os.environ.get("_HANDLER", "")
-    if not handler_name:
-        send_error(runtime_api, request_id, "No handler specified")
-        return
+_prewarm_ms: Optional[float] = None
 
+
+def prewarm_debugger_connections(session_id: str, connection_id: str) -> None:
+    """Build the clients of the debug path and open their connections during the init phase.
+
+    Importing boto3, assuming the role, resolving endpoints and the TLS handshakes are then
+    not paid by the first invocation. The clients are cached for the sandbox and keep their
+    connections alive across invocations. Failures are only logged, the first invocation
+    retries whatever did not succeed here.
+    """
+    global _prewarm_ms
+    start = time.perf_counter()
     try:
-        module_name, function_name = handler_name.rsplit(".", 1)
-        sys.path.insert(0, os.environ.get("LAMBDA_TASK_ROOT", "/var/task"))
-
-        module = __import__(module_name, fromlist=[function_name])
-        handler = getattr(module, function_name)
-
-        # Create context object
-        context = type(
-            "LambdaContext",
-            (),
-            {
-                "aws_request_id": request_id,
-                "function_name": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""),
-                "function_version": os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", ""),
-                "invoked_function_arn": os.environ.get("AWS_LAMBDA_FUNCTION_INVOKED_ARN", ""),
-                "memory_limit_in_mb": os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", ""),
-                "remaining_time_in_millis": lambda: 300000,  # Placeholder
-            },
-        )()
+        # STS: the role session is cached until its credentials are about to expire
+        session = assume_debugger_role()
+
+        # DynamoDB: reading the session item also fills the cache used for routing
+        get_debugger_table(session)
+        debugger_available(session, session_id)
 
-        result = handler(event, context)
-        send_response(runtime_api, request_id, result)
+        # API Gateway Management API: also tells whether the debugger is still connected
+        websocket_endpoint = os.environ.get("DEBUGGER_WEBSOCKET_API_ENDPOINT")
+        if websocket_endpoint:
+            get_apigateway_client(session, websocket_endpoint).get_connection(ConnectionId=connection_id)
 
+        if get_payload_bucket():
+            get_s3_client(session)
+
+        get_response_channel(session_id)
     except Exception as e:
-        send_error(runtime_api, request_id, str(e), type(e).__name__)
+        if getattr(e, "response", {}).get("Error", {}).get("Code") == "GoneException":
+            _circuit_breaker.trip(f"debugger connection {connection_id} is gone")
+        print(f"Error pre-warming debugger connections: {e}", file=sys.stderr)
+
+    _prewarm_ms = (time.perf_counter() - start) * 1000
+    print(f"Pre-warmed debugger connections in {_prewarm_ms:.2f} ms")
+
+
+def take_prewarm_duration() -> Optional[float]:
+    """Return the duration of the pre-warming once, for the metrics of the first invocation."""
+    global _prewarm_ms
+    duration, _prewarm_ms = _prewarm_ms, None
+    return duration
+
+
+# Lambda sets AWS_LAMBDA_INITIALIZATION_TYPE to this value when the init phase ends in a snapshot
+INITIALIZATION_TYPE_SNAPSTART = "snap-start"
+
+SnapshotHook = Tuple[Callable[..., Any], Tuple[Any, ...], Dict[str, Any]]
+
+_before_snapshot_hooks: List[SnapshotHook] = []
+_after_restore_hooks: List[SnapshotHook] = []
+
+
+def snapstart_enabled() -> bool:
+    return os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE") == INITIALIZATION_TYPE_SNAPSTART
+
+
+def register_before_snapshot(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Callable[..., Any]:
+    """Run the function before the snapshot is taken, hooks run in reverse order of registration."""
+    _before_snapshot_hooks.append((func, args, kwargs))
+    return func
+
+
+def register_after_restore(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Callable[..., Any]:
+    """Run the function after the snapshot was restored, hooks run in order of registration."""
+    _after_restore_hooks.append((func, args, kwargs))
+    return func
+
+
+def get_snapshot_hooks() -> Tuple[List[SnapshotHook], List[SnapshotHook]]:
+    """Hooks of the runtime, followed by the ones the function registered with snapshot_restore_py.
+
+    The managed runtime runs the hooks of snapshot_restore_py, the layer runtime replaces it
+    and runs them instead.
+    """
+    before, after = list(_before_snapshot_hooks), list(_after_restore_hooks)
+    try:
+        # Shipped only with the managed Python runtime of SnapStart functions
+        import snapshot_restore_py  # pyright: ignore[reportMissingImports]
+    except ImportError:
+        return before, after
+    return before + list(snapshot_restore_py.get_before_snapshot()), after + list(snapshot_restore_py.get_after_restore())
+
+
+def snapshot_and_restore(runtime_api: str) -> None:
+    """End the init phase of a SnapStart function and resume once the snapshot was restored.
+
+    Like in the managed runtime, a failing before-snapshot hook fails the init phase and a
+    failing after-restore hook fails the restore.
+    """
+    before, after = get_snapshot_hooks()
+    try:
+        while before:
+            func, args, kwargs = before.pop()
+            func(*args, **kwargs)
+    except Exception as e:
+        print(f"Init error: {e}", file=sys.stderr)
+        send_init_error(runtime_api, str(e), type(e).__name__)
+        sys.exit(1)
+
+    get_runtime_api_client(runtime_api).restore_next()
+
+    try:
+        for func, args, kwargs in after:
+            func(*args, **kwargs)
+    except Exception as e:
+        print(f"Restore error: {e}", file=sys.stderr)
+        send_restore_error(runtime_api, str(e), type(e).__name__)
+        sys.exit(1)
+
+
+def release_debugger_connections() -> None:
+    """Close the connections of the debug path and drop its credentials before the snapshot.
+
+    A snapshot is restored in many sandboxes, possibly long after it was taken. Imports and
+    the loaded service models stay in the snapshot, the clients are built again on restore.
+    """
+    global _response_channel, _response_channel_retry_at
+    if _response_channel is not None:
+        _response_channel.close()
+        _response_channel = None
+    _response_channel_retry_at = 0.0
+    _session_cache.forget_credentials()
+
+
+def refresh_debugger_connections(session_id: str, connection_id: str) -> None:
+    """Assume the role and open the connections of the debug path again after the restore."""
+    # Every restored sandbox starts from the same random state, e.g. for the retry jitter
+    random.seed()
+    get_runtime_api_client(get_lambda_runtime_api()).close()
+    prewarm_debugger_connections(session_id, connection_id)
+
+
+# Outcomes of forwarding an invocation to the debugger
+FORWARD_ANSWERED = "answered"
+FORWARD_SKIPPED = "skipped"
+FORWARD_HEDGED = "hedged"
+
+
+def start_invocation_metrics(request_id: str) -> InvocationMetrics:
+    """Create the metrics of a forwarded invocation, the first one of a sandbox reports the pre-warming."""
+    metrics = InvocationMetrics(request_id)
+    prewarm_ms = take_prewarm_duration()
+    metrics.counts["ColdStart"] = int(prewarm_ms is not None)
+    if prewarm_ms is not None:
+        metrics.durations["Prewarm"] = prewarm_ms
+    return metrics
+
+
+def forward_invocation(
+    session_id: str, connection_id: str, event: Any, context: LambdaContext, metrics: InvocationMetrics, environment: Optional[EnvironmentSnapshot] = None
+) -> Tuple[str, Any, Optional[str]]:
+    """Forward an invocation to the debugger and wait for its answer.
+
+    Returns the outcome together with the response and the error message of the debugger.
+    Invocations not selected by the routing rules of the session, or while the debugger is
+    unreachable, are skipped, and when the debugger does not answer within the hedging delay
+    the invocation is hedged. In both cases the deployed handler has to answer it. Raises
+    DebuggerConnectionGone when the debugger disconnected. The environment of the sandbox is
+    captured unless given.
+    """
+    request_id = context.aws_request_id
+
+    # Assume debugger role
+    with metrics.phase("AssumeRole"):
+        debugger_session = assume_debugger_role()
+
+    if not debugger_available(debugger_session, session_id) or not should_forward_invocation(debugger_session, session_id, event):
+        return FORWARD_SKIPPED, None, None
+
+    # Connect (or reuse) the channel on which the response will be pushed
+    with metrics.phase("ResponseChannel"):
+        channel = get_response_channel(session_id)
+    runtime_connection_id = channel.connection_id if channel else None
+
+    with metrics.phase("PayloadPreparation"):
+        # Payloads too large for DynamoDB and WebSocket frames travel through S3
+        encoding = get_payload_encoding()
+
+        # The environment is published once, requests reference it by hash
+        environment = environment or EnvironmentSnapshot()
+        publish_environment(debugger_session, session_id, environment, encoding)
+
+        payload_location = offload_request_payload(debugger_session, session_id, request_id, event, context.to_dict(), encoding, environment)
+
+    # Create request in DynamoDB and send WebSocket notification with DebuggerRequest schema,
+    # both go out together and polling starts once both are acknowledged
+    websocket_message = build_debugger_request_message(request_id, session_id, connection_id, event, context.deadline_ms, payload_location, encoding, environment, context.invoked_function_arn)
+    stored, _ = dispatch_debugger_request(
+        debugger_session,
+        metrics.timed(
+            "RequestWrite",
+            lambda: create_debugger_request(debugger_session, request_id, session_id, connection_id, event, context.to_dict(), runtime_connection_id, payload_location, encoding, environment),
+        ),
+        metrics.timed("Notification", lambda: send_debugger_request(debugger_session, connection_id, websocket_message)),
+    )
+    _circuit_breaker.reset()
+
+    # Wait for the pushed response, polling DynamoDB as a fallback
+    hedge_after_ms = get_hedge_after_ms()
+    with metrics.phase("DebuggerWait"):
+        # A response that beat the request item has no runtime connection to be pushed to
+        response, error = poll_for_response(debugger_session, request_id, stats=metrics.stats, channel=channel, deadline_ms=context.deadline_ms, hedge_after_ms=hedge_after_ms, poll_first=not stored)
+
+    # Only a request superseded before the debugger answered counts as hedged
+    hedge_expired = response is None and error == HEDGE_TIMEOUT_MESSAGE
+    hedged = hedge_expired and supersede_debugger_request(debugger_session, request_id)
+    if hedge_after_ms is not None:
+        metrics.counts["Hedged"] = int(hedged)
+
+    if hedged:
+        # The debugger is too slow, the deployed handler answers instead
+        print(f"Debugger did not respond within {hedge_after_ms} ms, running the handler {request_id=}")
+        return FORWARD_HEDGED, None, None
+
+    if hedge_expired:
+        # The response was stored while the request was being superseded
+        response, error = poll_for_response(debugger_session, request_id, deadline_ms=context.deadline_ms)
+
+    return FORWARD_ANSWERED, response, error
+
+
+def init(runtime_api: str, debugging: bool) -> None:
+    """Run the init phase: resolve the handler once before the first invocation.
+
+    Failures are reported to the Runtime API as init errors. While debugging, the code
+    runs on the developer machine, so a handler that cannot be imported in the sandbox
+    does not prevent forwarding invocations.
+    """
+    try:
+        get_handler()
+    except Exception as e:
+        if debugging:
+            print(f"Handler could not be resolved, continuing with the debugger: {e}", file=sys.stderr)
+            return
+        print(f"Init error: {e}", file=sys.stderr)
+        send_init_error(runtime_api, str(e), type(e).__name__)
+        sys.exit(1)
 
 
 def main():
@@ -200,54 +2857,83 @@ def main():
     session_id = os.environ.get("DEBUGGER_SESSION_ID")
     connection_id = os.environ.get("DEBUGGER_CONNECTION_ID")
 
+    shadowing = get_session_mode() == SESSION_MODE_SHADOW
+
+    init(runtime_api, bool(session_id and connection_id) and not shadowing)
+    if session_id and connection_id:
+        # Outside of the billed duration of the first invocation
+        prewarm_debugger_connections(session_id, connection_id)
+
+    if snapstart_enabled():
+        if session_id and connection_id:
+            register_before_snapshot(release_debugger_connections)
+            register_after_restore(refresh_debugger_connections, session_id, connection_id)
+        snapshot_and_restore(runtime_api)
+
+    # Captures are only taken while no debugger session is configured
+    capture = None if session_id and connection_id else create_traffic_capture()
+
     while True:
         try:
+            if capture is not None:
+                # The sandbox is frozen while waiting for the next invocation
+                capture.before_freeze()
+
             # Get next invocation
-            event, request_id = get_next_invocation(runtime_api)
+            event, context = get_next_invocation(runtime_api)
+            request_id = context.aws_request_id
+
+            # Propagate the trace header like the managed runtime does
+            if context.trace_id:
+                os.environ["_X_AMZN_TRACE_ID"] = context.trace_id
+            else:
+                os.environ.pop("_X_AMZN_TRACE_ID", None)
 
-            if session_id and connection_id:
+            if session_id and connection_id and shadowing:
+                # Shadow mode - the deployed handler answers, a copy is mirrored to the debugger afterwards
+                response, error = run_normal_handler(event, request_id, runtime_api, context, keep_stream=True)
+                mirror_invocation(session_id, connection_id, event, context, response, error)
+                # The sandbox is frozen while waiting for the next invocation, which would hold the copy back
+                if not _shadow_forwarder.join(SHADOW_FREEZE_TIMEOUT_SECONDS):
+                    print(f"Shadow copy still sending after {SHADOW_FREEZE_TIMEOUT_SECONDS} seconds {request_id=}", file=sys.stderr)
+            elif session_id and connection_id:
                 # Debugging mode
+                metrics = start_invocation_metrics(request_id)
+                forwarded = True
                 try:
-                    # Assume debugger role
-                    debugger_session = assume_debugger_role()
-
-                    # Create context dict
-                    context = {
-                        "aws_request_id": request_id,
-                        "function_name": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""),
-                        "function_version": os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", ""),
-                        "invoked_function_arn": os.environ.get("AWS_LAMBDA_FUNCTION_INVOKED_ARN", ""),
-                        "memory_limit_in_mb": os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", ""),
-                    }
-
-                    # Create request in DynamoDB
-                    create_debugger_request(debugger_session, request_id, session_id, connection_id, event, context)
-
-                    # Send WebSocket notification with DebuggerRequest schema
-                    websocket_message = {
-                        "requestId": request_id,
-                        "sessionId": session_id,
-                        "connectionId": connection_id,
-                        "lambdaFunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""),
-                        "lambdaFunctionVersion": os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", ""),
-                        "event": json.dumps(event),
-                        "environmentVariables": dict(os.environ),
-                    }
-                    send_debugger_request(debugger_session, connection_id, websocket_message)
-
-                    # Poll for response
-                    response, error = poll_for_response(debugger_session, request_id)
-
-                    if error:
-                        send_error(runtime_api, request_id, error)
+                    outcome, response, error = forward_invocation(session_id, connection_id, event, context, metrics)
+
+                    if outcome == FORWARD_SKIPPED:
+                        forwarded = False
+                        run_normal_handler(event, request_id, runtime_api, context)
+                    elif outcome == FORWARD_HEDGED:
+                        with metrics.phase("Hedge"):
+                            run_normal_handler(event, request_id, runtime_api, context)
                     else:
-                        send_response(runtime_api, request_id, response)
+                        with metrics.phase("RuntimeResponse"):
+                            if error:
+                                send_error(runtime_api, request_id, error)
+                            elif is_streaming_result(response):
+                                # Chunks are relayed as the debugger produces them
+                                send_streaming_response(runtime_api, request_id, response)
+                            else:
+                                send_response(runtime_api, request_id, response)
 
+                except DebuggerConnectionGone as e:
+                    print(f"{e}, running the handler {request_id=}", file=sys.stderr)
+                    metrics.counts["ConnectionGone"] = 1
+                    run_normal_handler(event, request_id, runtime_api, context)
                 except Exception as e:
                     send_error(runtime_api, request_id, f"Debugger error: {str(e)}")
+                finally:
+                    if forwarded:
+                        emit_invocation_metrics(metrics, session_id)
+            elif capture is not None and capture.sample():
+                # Capture mode - the handler answers, the invocation is kept for replay
+                capture_invocation(capture, event, request_id, runtime_api, context)
             else:
                 # Normal mode - run the handler directly
-                run_normal_handler(event, request_id, runtime_api)
+                run_normal_handler(event, request_id, runtime_api, context)
 
         except Exception as e:
             print(f"Runtime error: {e}", file=sys.stderr)
@@ -0,0 +1,194 @@
+"""
+PLLDB Handler Wrapper
+
+Handler of functions instrumented with DEBUGGER_INTERCEPTION=extension. The
+bootstrap points _HANDLER at `plldb_wrapper.handler` and keeps the handler of the
+function in DEBUGGER_ORIGINAL_HANDLER, so the managed runtime keeps running its own
+invoke loop and only the handler call is redirected.
+
+Every invocation is handed to the plldb-extension over localhost. The wrapper returns
+the answer of the debugger, or runs the original handler when the extension tells it
+to or cannot be reached. In shadow mode the original handler always answers and its
+result is reported to the extension, which mirrors it to the debugger.
+
+Handler resolution and the shared constants come from lambda_runtime, shipped in
+/opt/bin. Importing it does not load boto3, the function process does not load the
+debug path.
+"""
+
+from __future__ import annotations
+
+import http.client
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, Optional
+
+# The layer runtime is shipped outside of the path of the managed runtime, appended so it shadows no module of the function
+LAYER_BIN_DIR = "/opt/bin"
+if LAYER_BIN_DIR not in sys.path:
+    sys.path.append(LAYER_BIN_DIR)
+
+try:
+    import lambda_runtime
+except ImportError:  # imported from the plldb package
+    from plldb.cloudformation.layer import lambda_runtime
+
+# Must match the default of lambda_extension
+DEFAULT_EXTENSION_PORT = 9229
+
+CLIENT_CONTEXT_FIELDS = ("installation_id", "app_title", "app_version_name", "app_version_code", "app_package_name")
+
+
+class DebuggerError(Exception):
+    """Error the debugger answered an invocation with."""
+
+
+_original_handler: Optional[Callable[[Any, Any], Any]] = None
+_original_handler_error: Optional[Exception] = None
+
+
+def load_original_handler() -> None:
+    """Resolve the original handler during the init phase.
+
+    While debugging, the code runs on the developer machine, so a handler that cannot be
+    imported in the sandbox only fails the invocations that have to run it.
+    """
+    global _original_handler, _original_handler_error
+    try:
+        _original_handler, _original_handler_error = lambda_runtime.resolve_handler(os.environ.get("DEBUGGER_ORIGINAL_HANDLER", "")), None
+    except Exception as e:
+        print(f"Handler could not be resolved, continuing with the debugger: {e}", file=sys.stderr)
+        _original_handler, _original_handler_error = None, e
+
+
+def run_original_handler(event: Any, context: Any) -> Any:
+    if _original_handler is None:
+        raise _original_handler_error or lambda_runtime.HandlerNotFoundError("No handler specified")
+    return _original_handler(event, context)
+
+
+def context_to_dict(context: Any) -> Dict[str, Any]:
+    """Serializable form of the context of the managed runtime, as the layer runtime forwards it."""
+    identity = getattr(context, "identity", None)
+    client_context = getattr(context, "client_context", None)
+    client = getattr(client_context, "client", None)
+    return {
+        "aws_request_id": context.aws_request_id,
+        "function_name": getattr(context, "function_name", ""),
+        "function_version": getattr(context, "function_version", ""),
+        "invoked_function_arn": getattr(context, "invoked_function_arn", ""),
+        "memory_limit_in_mb": getattr(context, "memory_limit_in_mb", ""),
+        "deadline_ms": int(time.time() * 1000) + context.get_remaining_time_in_millis(),
+        "trace_id": os.environ.get("_X_AMZN_TRACE_ID"),
+        "client_context": (
+            {
+                "client": {key: getattr(client, key, None) for key in CLIENT_CONTEXT_FIELDS} if client is not None else None,
+                "custom": getattr(client_context, "custom", None),
+                "env": getattr(client_context, "env", None),
+            }
+            if client_context is not None
+            else None
+        ),
+        "identity": (
+            {"cognitoIdentityId": getattr(identity, "cognito_identity_id", None), "cognitoIdentityPoolId": getattr(identity, "cognito_identity_pool_id", None)}
+            if getattr(identity, "cognito_identity_id", None)
+            else None
+        ),
+    }
+
+
+def get_environment() -> Dict[str, str]:
+    """Environment of the function as the debugger should see it, with its own handler."""
+    environment = dict(os.environ)
+    environment["_HANDLER"] = environment.pop("DEBUGGER_ORIGINAL_HANDLER", environment.get("_HANDLER", ""))
+    return environment
+
+
+class ExtensionClient:
+    """Keep-alive HTTP client for the plldb-extension on localhost."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self._connection: Optional[http.client.HTTPConnection] = None
+
+    def post(self, path: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        body = json.dumps(payload, default=str).encode()
+        while True:
+            reused = self._connection is not None
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=timeout)
+            elif self._connection.sock is not None:
+                self._connection.sock.settimeout(timeout)
+
+            try:
+                self._connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+                response = self._connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                # A kept-alive connection may have gone stale while the sandbox was frozen
+                self.close()
+                if reused:
+                    continue
+                raise
+
+            if response.will_close:
+                self.close()
+            if response.status >= 300:
+                raise http.client.HTTPException(f"POST {path} failed with status {response.status}: {data[:200]!r}")
+            return json.loads(data)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+_extension_client: Optional[ExtensionClient] = None
+
+
+def get_extension_client() -> ExtensionClient:
+    global _extension_client
+    if _extension_client is None:
+        _extension_client = ExtensionClient(int(os.environ.get("DEBUGGER_EXTENSION_PORT", DEFAULT_EXTENSION_PORT)))
+    return _extension_client
+
+
+def report_result(payload: Dict[str, Any], timeout: float, **result: Any) -> None:
+    """Report the result of the original handler to the extension, failures are only logged."""
+    try:
+        get_extension_client().post(f"/invocations/{payload['context']['aws_request_id']}/result", {**payload, **result}, timeout)
+    except Exception as e:
+        print(f"Error reporting the result to the extension: {e}", file=sys.stderr)
+
+
+def handler(event: Any, context: Any) -> Any:
+    """Hand the invocation to the extension and answer it as the extension tells."""
+    payload = {"event": event, "context": context_to_dict(context), "environment": get_environment()}
+    timeout = max(context.get_remaining_time_in_millis() / 1000, 0.001)
+
+    if lambda_runtime.get_session_mode() == lambda_runtime.SESSION_MODE_SHADOW:
+        # The original handler answers, the extension mirrors the result to the debugger
+        try:
+            result = run_original_handler(event, context)
+        except Exception as e:
+            report_result(payload, timeout, errorMessage=str(e))
+            raise
+        report_result(payload, timeout, response=result)
+        return result
+
+    try:
+        answer = get_extension_client().post("/invocations", payload, timeout)
+    except Exception as e:
+        print(f"Extension cannot be reached, running the handler: {e}", file=sys.stderr)
+        return run_original_handler(event, context)
+
+    if answer.get("outcome") != lambda_runtime.FORWARD_ANSWERED:
+        return run_original_handler(event, context)
+    if answer.get("errorMessage"):
+        raise DebuggerError(answer["errorMessage"])
+    return answer.get("response")
+
+
+load_original_handler()
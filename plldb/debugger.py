@@ -1,12 +1,20 @@
+import base64
+import dataclasses
+import difflib
 import json
 import logging
-from typing import Dict, Union
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
 import boto3
-from plldb.protocol import DebuggerRequest, DebuggerResponse, DebuggerInfo
-from plldb.executor import Executor
+from plldb.protocol import DebuggerRequest, DebuggerResponse, DebuggerInfo, decode_payload, encode_payload
+from plldb.executor import Executor, is_streaming_result
 
 logger = logging.getLogger(__name__)
 
+# The WebSocket API accepts frames up to 32 KB from clients, larger responses travel through S3
+RESPONSE_OFFLOAD_THRESHOLD_BYTES = 30 * 1024
+# Chunks of streamed responses are split so that their base64 fits a frame
+STREAM_CHUNK_MAX_BYTES = 22 * 1024
+
 
 class Debugger:
     def __init__(
@@ -18,6 +26,8 @@ class Debugger:
         self.stack_name = stack_name
         self._lambda_functions_lookup = {}
         self._executor = Executor()
+        self._s3_client: Optional[Any] = None
+        self._environments: Dict[str, Dict[str, str]] = {}
         self._inspect_stack()
 
     def _inspect_stack(self) -> None:
@@ -47,7 +57,7 @@ class Debugger:
                         logger.debug(f"Found lambda function {logical_id} with physical id {physical_id}")
         logger.debug("Stack inspection complete")
 
-    def handle_message(self, message: Dict) -> Union[DebuggerResponse, None]:
+    def handle_message(self, message: Dict) -> Union[DebuggerResponse, Iterator[DebuggerResponse], None]:
         # Check if this is a DebuggerInfo message
         if "logLevel" in message and "timestamp" in message:
             info = DebuggerInfo(**message)
@@ -66,17 +76,29 @@ class Debugger:
             logger.error(f"Resource {lambda_function_logical_id} not found in current stack")
             raise InvalidMessageError(f"Lambda function {lambda_function_physical_id} not found in the stack")
 
+        if request.shadow:
+            # The deployed handler already answered, nothing is sent back
+            self._replay_shadow(request, lambda_function_logical_id)
+            return None
+
         try:
+            event, environment = self._load_request_payload(request)
+            environment = self._resolve_environment(request, environment)
             response = self._executor.invoke_lambda_function(
                 lambda_function_logical_id=lambda_function_logical_id,
-                event=json.loads(request.event),
-                environment=request.environmentVariables,
+                event=event,
+                environment=environment,
+                deadline_ms=request.deadlineMs,
+                stream=True,
+                aws_request_id=request.requestId,
+                invoked_function_arn=request.invokedFunctionArn,
             )
-            return DebuggerResponse(
-                requestId=request.requestId,
-                statusCode=200,
-                response=json.dumps(response) if response and not isinstance(response, str) else (response or ""),
-                errorMessage=None,
+            if is_streaming_result(response):
+                return self._stream_response(request, response)
+            return self._build_response(
+                request,
+                json.dumps(response) if response and not isinstance(response, str) else (response or ""),
+                environment,
             )
         except Exception as e:
             return DebuggerResponse(
@@ -86,6 +108,143 @@ class Debugger:
                 errorMessage=str(e),
             )
 
+    def _replay_shadow(self, request: DebuggerRequest, lambda_function_logical_id: str) -> None:
+        """Re-execute a shadow copy locally and report how the local result differs from the deployed one."""
+        local_response, local_error = None, None
+        try:
+            event, environment = self._load_request_payload(request)
+            environment = self._resolve_environment(request, environment)
+            local_response = self._executor.invoke_lambda_function(
+                lambda_function_logical_id=lambda_function_logical_id,
+                event=event,
+                environment=environment,
+                deadline_ms=request.deadlineMs,
+                aws_request_id=request.requestId,
+                invoked_function_arn=request.invokedFunctionArn,
+            )
+        except Exception as e:
+            local_error = str(e)
+        if isinstance(local_response, bytes):
+            # Streamed responses are compared by their joined chunks, the deployed ones are mirrored the same way
+            local_response = decode_result(local_response.decode(errors="replace"))
+
+        deployed = {"errorMessage": request.deployedErrorMessage} if request.deployedErrorMessage is not None else decode_result(request.deployedResponse or "")
+        local = {"errorMessage": local_error} if local_error is not None else local_response
+        diff = diff_results(deployed, local)
+        if diff:
+            logger.warning(f"SHADOW requestId={request.requestId} local result differs from deployed:\n{diff}")
+        else:
+            logger.info(f"SHADOW requestId={request.requestId} local result matches deployed")
+
+    def _get_s3_client(self) -> Any:
+        if self._s3_client is None:
+            self._s3_client = self.session.client("s3")
+        return self._s3_client
+
+    def _load_request_payload(self, request: DebuggerRequest) -> Tuple[Any, Optional[Dict[str, str]]]:
+        """Return the event and environment of the request, fetching them from S3 when offloaded."""
+        if request.payloadLocation:
+            bucket, _, key = request.payloadLocation.removeprefix("s3://").partition("/")
+            logger.debug(f"Fetching offloaded payload s3://{bucket}/{key}")
+            body = self._get_s3_client().get_object(Bucket=bucket, Key=key)["Body"]
+            payload = json.loads(decode_payload(body.read(), request.encoding)) if request.encoding else json.load(body)
+            return payload["event"], payload.get("environmentVariables")
+
+        if request.encoding:
+            payload = json.loads(decode_payload(base64.b64decode(request.payload or ""), request.encoding))
+            return payload["event"], payload.get("environmentVariables")
+
+        return json.loads(request.event), request.environmentVariables
+
+    def _resolve_environment(self, request: DebuggerRequest, environment: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+        """Resolve the environment snapshot referenced by the request and apply its delta.
+
+        Snapshots are cached by hash. A snapshot not seen inline, e.g. published while the
+        debugger was not attached, is fetched from the PLLDBDebugger table.
+        """
+        if not request.environmentHash:
+            return environment
+
+        if environment is not None:
+            self._environments[request.environmentHash] = environment
+        elif request.environmentHash not in self._environments:
+            self._environments[request.environmentHash] = self._fetch_environment(request.environmentHash)
+
+        return {**self._environments[request.environmentHash], **(request.environmentDelta or {})}
+
+    def _fetch_environment(self, environment_hash: str) -> Dict[str, str]:
+        logger.debug(f"Fetching environment snapshot {environment_hash}")
+        table = self.session.resource("dynamodb").Table("PLLDBDebugger")
+        item = table.get_item(Key={"RequestId": f"environment#{environment_hash}"}).get("Item")
+        if not item:
+            raise ValueError(f"Environment snapshot {environment_hash} not found")
+        if item.get("Encoding"):
+            return json.loads(decode_payload(bytes(item["EnvironmentVariables"]), item["Encoding"]))
+        return item["EnvironmentVariables"]
+
+    def _build_response(self, request: DebuggerRequest, response: str, environment: Optional[Dict[str, str]]) -> DebuggerResponse:
+        """Build the response in the encoding of the request, offloading it to S3 next to the request payload when too large for a frame.
+
+        The frame is the JSON of the whole DebuggerResponse, in which the response is escaped, so its serialized size decides.
+        """
+        data = encode_payload(response.encode(), request.encoding)
+        inline = base64.b64encode(data).decode() if request.encoding else response
+        inline_response = DebuggerResponse(requestId=request.requestId, statusCode=200, response=inline, errorMessage=None, encoding=request.encoding)
+        frame_size = len(json.dumps(dataclasses.asdict(inline_response)))
+        if frame_size <= RESPONSE_OFFLOAD_THRESHOLD_BYTES:
+            return inline_response
+
+        if request.payloadLocation:
+            bucket = request.payloadLocation.removeprefix("s3://").partition("/")[0]
+        else:
+            bucket = (environment or {}).get("DEBUGGER_PAYLOAD_BUCKET")
+        if not bucket:
+            logger.warning(f"Response of {request.requestId} is {frame_size} bytes but no payload bucket is configured, sending it inline")
+            return inline_response
+
+        key = f"payloads/{request.sessionId}/{request.requestId}/response.json"
+        self._get_s3_client().put_object(Bucket=bucket, Key=key, Body=data, ContentType="application/json")
+        logger.debug(f"Offloaded response of {request.requestId} to s3://{bucket}/{key}")
+        return DebuggerResponse(requestId=request.requestId, statusCode=200, response="", errorMessage=None, responseLocation=f"s3://{bucket}/{key}", encoding=request.encoding)
+
+    def _stream_response(self, request: DebuggerRequest, chunks: Iterator[bytes]) -> Iterator[DebuggerResponse]:
+        """Relay the chunks of a streamed response as they are produced, ending with the number of chunks sent.
+
+        A handler failing mid-stream ends it with its error, the chunks sent before stay delivered.
+        """
+        sequence = 0
+        try:
+            for chunk in chunks:
+                for start in range(0, len(chunk), STREAM_CHUNK_MAX_BYTES):
+                    data = encode_payload(chunk[start : start + STREAM_CHUNK_MAX_BYTES], request.encoding)
+                    yield DebuggerResponse(requestId=request.requestId, statusCode=200, response=base64.b64encode(data).decode(), errorMessage=None, encoding=request.encoding, chunk=sequence)
+                    sequence += 1
+        except Exception as e:
+            logger.error(f"Streamed response of {request.requestId} failed after {sequence} chunks: {e}")
+            yield DebuggerResponse(requestId=request.requestId, statusCode=500, response="", errorMessage=str(e), encoding=request.encoding, streamed=sequence)
+            return
+        logger.debug(f"Streamed response of {request.requestId} in {sequence} chunks")
+        yield DebuggerResponse(requestId=request.requestId, statusCode=200, response="", errorMessage=None, encoding=request.encoding, streamed=sequence)
+
+
+def decode_result(response: str) -> Any:
+    """Decode a serialized handler result, keeping it as a string when it is not JSON."""
+    if not response:
+        return None
+    try:
+        return json.loads(response)
+    except ValueError:
+        return response
+
+
+def diff_results(deployed: Any, local: Any) -> str:
+    """Unified diff of the deployed and local handler results as pretty JSON, empty when they are equal."""
+
+    def lines(result: Any) -> list:
+        return json.dumps(result, indent=2, sort_keys=True, default=str).splitlines()
+
+    return "\n".join(difflib.unified_diff(lines(deployed), lines(local), fromfile="deployed", tofile="local", lineterm=""))
+
 
 class InvalidMessageError(Exception):
     pass
@@ -1,10 +1,12 @@
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
+import json
 import logging
 import os
 import sys
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Generator
+from typing import Any, Generator, TypeGuard
+import time
 import uuid
 
 logger = logging.getLogger(__name__)
@@ -44,13 +46,27 @@ class Executor:
         event: dict,
         lambda_context: Any | None = None,
         environment: dict | None = None,
+        deadline_ms: int | None = None,
+        stream: bool = False,
+        aws_request_id: str | None = None,
+        invoked_function_arn: str | None = None,
     ) -> Any | None:
         """Invoke a Lambda function locally.
 
+        A handler streams its response by returning an iterator, e.g. by being a generator.
+        Its chunks are produced with the site-packages, handler module and environment of the
+        function still in place, and are returned as bytes.
+
         Args:
             lambda_function_logical_id: Logical ID of the Lambda function in the CloudFormation template
             event: Event data to pass to the Lambda function
             lambda_context: Optional Lambda context object. If None, a default context will be created.
+            environment: Optional environment variables to set during the invocation.
+            deadline_ms: Optional deadline of the invocation in epoch milliseconds, used by the default context.
+            stream: Return the chunks of a streamed response as an iterator, as the handler produces them.
+                Otherwise they are joined once the handler finished.
+            aws_request_id: Optional request ID of the remote invocation, used by the default context.
+            invoked_function_arn: Optional ARN the remote invocation was made with, used by the default context.
 
         Returns:
             The result of the Lambda function invocation.
@@ -61,20 +77,22 @@ class Executor:
         logger.debug(f"Invoking lambda function {lambda_function_logical_id} with event {event}")
 
         if lambda_context is None:
-            # create new type tha mimics the lambda context
-            lambda_context = type(
-                "LambdaContext",
-                (),
-                {
-                    "aws_request_id": str(uuid.uuid4()),
-                    "function_name": lambda_function_logical_id,
-                    "function_version": "1",
-                    "invoked_function_arn": f"arn:aws:lambda:us-east-1:123456789012:function:{lambda_function_logical_id}",
-                    "memory_limit_in_mb": 128,
-                    "remaining_time_in_millis": lambda: 300000,  # Placeholder
-                },
-            )()
+            lambda_context = LambdaContext(lambda_function_logical_id, aws_request_id=aws_request_id, deadline_ms=deadline_ms, invoked_function_arn=invoked_function_arn)
+
+        invocation = self._run_handler(lambda_function_logical_id, event, lambda_context, environment)
+        result = next(invocation)
+        if not is_streaming_result(result):
+            invocation.close()
+            return result
+
+        logger.debug("Lambda handler streams its response")
+        return invocation if stream else b"".join(invocation)
 
+    def _run_handler(self, lambda_function_logical_id: str, event: dict, lambda_context: Any, environment: dict | None) -> Generator[Any, None, None]:
+        """Yield the result of the handler, followed by its chunks when it streams.
+
+        The contexts of the invocation stay entered until the generator is exhausted or closed.
+        """
         with self.with_site_packages():
             logger.debug(f"Prepared local site-packages")
             with self.with_lambda_handler(lambda_function_logical_id) as handler:
@@ -82,7 +100,11 @@ class Executor:
                 with self.with_environment(environment):
                     logger.debug("Prepared environment")
                     logger.debug(f"Invoking lambda handler {handler}")
-                    return handler(event, lambda_context)
+                    result = handler(event, lambda_context)
+                    yield result
+                    if is_streaming_result(result):
+                        for chunk in result:
+                            yield chunk_bytes(chunk)
 
     @contextmanager
     def with_environment(self, environment: dict | None = None) -> Generator[None, None, None]:
@@ -249,6 +271,43 @@ class Executor:
             return load_yaml(file.read())
 
 
+def is_streaming_result(result: Any) -> TypeGuard[Iterator[Any]]:
+    """Whether a handler result is a streamed response, i.e. an iterator of chunks."""
+    return isinstance(result, Iterator)
+
+
+def chunk_bytes(chunk: Any) -> bytes:
+    """Serialize a chunk of a streamed response, chunks other than bytes and strings are sent as JSON."""
+    if isinstance(chunk, (bytes, bytearray, memoryview)):
+        return bytes(chunk)
+    if isinstance(chunk, str):
+        return chunk.encode()
+    return json.dumps(chunk).encode()
+
+
+DEFAULT_TIMEOUT_MS = 300000
+
+
+class LambdaContext:
+    """Context object that mimics the one passed to handlers by the Lambda runtime.
+
+    The remaining time counts down to the deadline of the remote invocation when it is
+    known, otherwise to DEFAULT_TIMEOUT_MS after the context was created. The request ID
+    and invoked ARN are those of the remote invocation when known, otherwise made up.
+    """
+
+    def __init__(self, function_name: str, aws_request_id: str | None = None, deadline_ms: int | None = None, invoked_function_arn: str | None = None):
+        self.aws_request_id = aws_request_id or str(uuid.uuid4())
+        self.function_name = function_name
+        self.function_version = "1"
+        self.invoked_function_arn = invoked_function_arn or f"arn:aws:lambda:us-east-1:123456789012:function:{function_name}"
+        self.memory_limit_in_mb = 128
+        self.deadline_ms = deadline_ms if deadline_ms is not None else int(time.time() * 1000) + DEFAULT_TIMEOUT_MS
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, self.deadline_ms - int(time.time() * 1000))
+
+
 class LambdaFunctionNotFoundError(Exception):
     """Exception raised when a Lambda function is not found in the CloudFormation template."""
 
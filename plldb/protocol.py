@@ -1,8 +1,30 @@
 """Protocol dataclasses for PLLDB debugger communication."""
 
+import zlib
 from dataclasses import dataclass
 from typing import Dict, Optional
 
+# Payload encodings negotiated per session, None means plain JSON
+SUPPORTED_ENCODINGS = ("zlib",)
+
+
+def encode_payload(data: bytes, encoding: Optional[str]) -> bytes:
+    """Compress a serialized payload with the session encoding."""
+    if encoding is None:
+        return data
+    if encoding == "zlib":
+        return zlib.compress(data, 6)
+    raise ValueError(f"Unsupported payload encoding: {encoding}")
+
+
+def decode_payload(data: bytes, encoding: Optional[str]) -> bytes:
+    """Decompress a payload encoded with the session encoding."""
+    if encoding is None:
+        return data
+    if encoding == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unsupported payload encoding: {encoding}")
+
 
 @dataclass
 class DebuggerRequest:
@@ -14,7 +36,20 @@ class DebuggerRequest:
     lambdaFunctionName: str
     lambdaFunctionVersion: str
     event: str
+    invokedFunctionArn: Optional[str] = None
     environmentVariables: Optional[Dict[str, str]] = None
+    deadlineMs: Optional[int] = None
+    payloadLocation: Optional[str] = None
+    # With an encoding, event and environment travel in payload, base64 of the encoded JSON
+    encoding: Optional[str] = None
+    payload: Optional[str] = None
+    # The environment is published once per sandbox, requests reference it by hash plus the volatile delta
+    environmentHash: Optional[str] = None
+    environmentDelta: Optional[Dict[str, str]] = None
+    # Shadow copies were answered by the deployed handler, whose result they carry, nothing is sent back
+    shadow: Optional[bool] = None
+    deployedResponse: Optional[str] = None
+    deployedErrorMessage: Optional[str] = None
 
 
 @dataclass
@@ -25,6 +60,13 @@ class DebuggerResponse:
     statusCode: int
     response: str
     errorMessage: Optional[str] = None
+    responseLocation: Optional[str] = None
+    # With an encoding, response is base64 of the encoded result
+    encoding: Optional[str] = None
+    # Streamed responses are sent as numbered chunks, response is base64 of the chunk, and end
+    # with a message carrying the number of chunks sent and the error that ended the stream, if any
+    chunk: Optional[int] = None
+    streamed: Optional[int] = None
 
 
 @dataclass
@@ -1,6 +1,6 @@
 import json
 import logging
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 from urllib.parse import urlparse
 
 import boto3
@@ -18,12 +18,26 @@ class RestApiClient:
         self.credentials = session.get_credentials()
         self.region = session.region_name
 
-    def create_session(self, api_url: str, stack_name: str) -> str:
+    def create_session(
+        self,
+        api_url: str,
+        stack_name: str,
+        compression: Optional[str] = None,
+        mode: Optional[str] = None,
+        interception: Optional[str] = None,
+        snapstart: bool = False,
+        access: Optional[str] = None,
+    ) -> str:
         """Create a new debug session using the REST API.
 
         Args:
             api_url: Base URL of the REST API
             stack_name: Name of the stack to debug
+            compression: Optional payload compression negotiated for the session, e.g. "zlib"
+            mode: Optional session mode, "shadow" to only mirror invocations to the debugger
+            interception: Optional interception of invocations, "extension" to keep the managed runtime
+            snapstart: Whether to enable SnapStart on the instrumented functions and publish a version of each
+            access: Optional access of the debug runtime, "direct" to grant the function roles its permissions
 
         Returns:
             Session ID from the API response
@@ -31,14 +45,62 @@ class RestApiClient:
         Raises:
             ValueError: If API request fails
         """
-        # Prepare request
-        endpoint = f"{api_url}/sessions"
-        method = "POST"
-        headers = {"Content-Type": "application/json"}
-        body = json.dumps({"stackName": stack_name})
+        payload: Dict[str, Any] = {"stackName": stack_name}
+        if compression:
+            payload["compression"] = compression
+        if mode:
+            payload["mode"] = mode
+        if interception:
+            payload["interception"] = interception
+        if snapstart:
+            payload["snapStart"] = True
+        if access:
+            payload["access"] = access
 
+        # Use requests library to send the prepared request
+        import requests
+
+        url, headers, body_data = self._sign("POST", f"{api_url}/sessions", payload)
+        response = requests.post(url, headers=headers, data=body_data, timeout=30)
+
+        if response.status_code != 201:
+            raise ValueError(f"Failed to create session: {response.status_code} - {response.text}")
+
+        # Parse response
+        data = response.json()
+        session_id = data.get("sessionId")
+
+        if not session_id:
+            raise ValueError("No sessionId returned from API")
+
+        logger.info(f"Created session: {session_id}")
+        return session_id
+
+    def update_routing_rules(self, api_url: str, session_id: str, routing_rules: Dict[str, Any]) -> None:
+        """Replace the routing rules of a debug session, applied by the runtime without reinstrumenting.
+
+        Args:
+            api_url: Base URL of the REST API
+            session_id: ID of the debug session
+            routing_rules: Rules with the optional keys functions, sampleRate and predicates, empty to forward everything
+
+        Raises:
+            ValueError: If API request fails
+        """
+        import requests
+
+        url, headers, body_data = self._sign("PUT", f"{api_url}/sessions/{session_id}/routing", {"routingRules": routing_rules})
+        response = requests.put(url, headers=headers, data=body_data, timeout=30)
+
+        if response.status_code != 200:
+            raise ValueError(f"Failed to update routing rules: {response.status_code} - {response.text}")
+
+        logger.info(f"Updated routing rules of session: {session_id}")
+
+    def _sign(self, method: str, endpoint: str, payload: Dict[str, Any]) -> Tuple[str, Dict[str, str], Optional[bytes]]:
+        """Sign a JSON request with SigV4 and return its URL, headers and body."""
         # Create AWS request
-        request = AWSRequest(method=method, url=endpoint, data=body, headers=headers)
+        request = AWSRequest(method=method, url=endpoint, data=json.dumps(payload), headers={"Content-Type": "application/json"})
 
         # Sign request with SigV4
         if not self.credentials:
@@ -48,9 +110,6 @@ class RestApiClient:
         # Send request using prepared request
         prepared_request = request.prepare()
 
-        # Use requests library to send the prepared request
-        import requests
-
         # Convert body to bytes if needed
         body_data: Optional[bytes] = None
         if prepared_request.body:
@@ -59,17 +118,4 @@ class RestApiClient:
             elif isinstance(prepared_request.body, (bytes, bytearray)):
                 body_data = bytes(prepared_request.body)
 
-        response = requests.post(prepared_request.url, headers=dict(prepared_request.headers), data=body_data, timeout=30)
-
-        if response.status_code != 201:
-            raise ValueError(f"Failed to create session: {response.status_code} - {response.text}")
-
-        # Parse response
-        data = response.json()
-        session_id = data.get("sessionId")
-
-        if not session_id:
-            raise ValueError("No sessionId returned from API")
-
-        logger.info(f"Created session: {session_id}")
-        return session_id
+        return prepared_request.url, dict(prepared_request.headers), body_data
@@ -93,6 +93,13 @@ class BootstrapManager:
                 runtime_path = layer_dir / "lambda_runtime.py"
                 zipf.write(runtime_path, "bin/lambda_runtime.py")
 
+                # Add the extension, Lambda starts the executables in /opt/extensions
+                zipf.write(layer_dir / "plldb-extension", "extensions/plldb-extension")
+                zipf.write(layer_dir / "lambda_extension.py", "bin/lambda_extension.py")
+
+                # Add the handler wrapper to python/ directory, which is on the path of the managed runtime
+                zipf.write(layer_dir / "plldb_wrapper.py", "python/plldb_wrapper.py")
+
             with open(temp_path, "rb") as f:
                 layer_content = f.read()
 
@@ -189,6 +196,12 @@ class BootstrapManager:
             else:
                 raise
 
+        # Offloaded debugger payloads are only needed while the invocation is in flight
+        self.s3_client.put_bucket_lifecycle_configuration(
+            Bucket=bucket_name,
+            LifecycleConfiguration={"Rules": [{"ID": "expire-debugger-payloads", "Filter": {"Prefix": "payloads/"}, "Status": "Enabled", "Expiration": {"Days": 1}}]},
+        )
+
         click.echo("Bootstrap setup completed successfully")
 
         click.echo("\nPackaging and uploading Lambda functions...")
@@ -5,7 +5,7 @@ import logging
 import signal
 import sys
 from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Callable, Dict, Optional, Union
+from typing import Any, Callable, Dict, Iterator, Optional, Union
 from urllib.parse import urlparse, urlunparse
 
 import websockets
@@ -89,7 +89,7 @@ class WebSocketClient:
 
     async def run_loop(
         self,
-        message_handler: Optional[Callable[[Dict[str, Any]], Union[DebuggerResponse, None]]] = None,
+        message_handler: Optional[Callable[[Dict[str, Any]], Union[DebuggerResponse, Iterator[DebuggerResponse], None]]] = None,
     ) -> None:
         """Run the main message loop.
 
@@ -144,6 +144,9 @@ class WebSocketClient:
                                 # Send WebSocket message with result
                                 logger.debug(f"Got DebuggerResponse from message handler {result}")
                                 await self.send_message(dataclasses.asdict(result))
+                            elif result is not None:
+                                # Streamed responses are relayed chunk by chunk as the handler produces them
+                                await self._relay_stream(loop, result)
                             # If result is None (from DebuggerInfo), don't send response
                         except InvalidMessageError as e:
                             logger.error(f"Invalid message: {e}")
@@ -179,6 +182,22 @@ class WebSocketClient:
             await self.disconnect()
             self._executor.shutdown(wait=True)
 
+    async def _relay_stream(self, loop: asyncio.AbstractEventLoop, messages: Iterator[DebuggerResponse]) -> None:
+        """Send the messages of a streamed response, producing each one in the handler thread.
+
+        When sending fails, the stream is closed so that the invocation leaves its environment.
+        """
+        try:
+            while True:
+                message = await loop.run_in_executor(self._executor, next, messages, None)
+                if message is None:
+                    return
+                await self.send_message(dataclasses.asdict(message))
+        finally:
+            close = getattr(messages, "close", None)
+            if close is not None:
+                await loop.run_in_executor(self._executor, close)
+
     def stop(self) -> None:
         """Stop the message loop."""
         self._running = False
@@ -0,0 +1,105 @@
+"""Local stand-in for the Lambda Extensions API used by the layer extension tests."""
+
+import json
+import queue
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+
+class _ExtensionsApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class FakeExtensionsApi:
+    """Record registrations and serve queued lifecycle events.
+
+    Events are queued with `add_invoke` and `add_shutdown` and handed out by the
+    `/extension/event/next` endpoint, which blocks like the real one does. The
+    registered extension, its events and any reported init errors are kept in
+    `registrations` and `init_errors`. `next_calls` counts how often the extension
+    asked for the next event, i.e. signalled it finished the previous one.
+    """
+
+    def __init__(self, next_timeout: float = 5.0):
+        self.next_timeout = next_timeout
+        self.events: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self.registrations: List[Dict[str, Any]] = []
+        self.init_errors: List[Dict[str, Any]] = []
+        self.next_calls = 0
+        self._next = threading.Condition()
+        self._server = _ExtensionsApiServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def add_invoke(self, request_id: str, deadline_ms: int) -> None:
+        self.events.put({"eventType": "INVOKE", "requestId": request_id, "deadlineMs": deadline_ms, "invokedFunctionArn": "arn:aws:lambda:us-east-1:123456789012:function:test"})
+
+    def add_shutdown(self, deadline_ms: int, reason: str = "spindown") -> None:
+        self.events.put({"eventType": "SHUTDOWN", "shutdownReason": reason, "deadlineMs": deadline_ms})
+
+    def wait_for_next_calls(self, count: int, timeout: float = 10.0) -> None:
+        """Wait until the extension asked for the given number of events."""
+        with self._next:
+            if not self._next.wait_for(lambda: self.next_calls >= count, timeout):
+                raise TimeoutError(f"Extension asked for {self.next_calls} of {count} events")
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if not self.path.endswith("/extension/event/next") or not self._registered():
+                    self._reply(403, {"errorMessage": "Extension not registered"})
+                    return
+                with api._next:
+                    api.next_calls += 1
+                    api._next.notify_all()
+                try:
+                    event = api.events.get(timeout=api.next_timeout)
+                except queue.Empty:
+                    self._reply(500, {"errorMessage": "No event queued"})
+                    return
+                self._reply(200, event)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.endswith("/extension/register"):
+                    extension_id = str(uuid.uuid4())
+                    api.registrations.append({"name": self.headers.get("Lambda-Extension-Name"), "events": body.get("events"), "id": extension_id})
+                    self._reply(200, {"functionName": "test", "functionVersion": "$LATEST", "handler": "app.handler"}, {"Lambda-Extension-Identifier": extension_id})
+                elif self.path.endswith("/extension/init/error") and self._registered():
+                    api.init_errors.append({"errorType": self.headers.get("Lambda-Extension-Function-Error-Type"), **body})
+                    self._reply(202, {"status": "OK"})
+                else:
+                    self._reply(403, {"errorMessage": "Extension not registered"})
+
+            def _registered(self) -> bool:
+                return any(registration["id"] == self.headers.get("Lambda-Extension-Identifier") for registration in api.registrations)
+
+            def _reply(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
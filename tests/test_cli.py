@@ -132,7 +132,7 @@ def test_attach_command_success(mock_asyncio_run, mock_ws_client_class, mock_res
 
     # Verify calls
     mock_discovery.get_api_endpoints.assert_called_once_with("plldb")
-    mock_rest_client.create_session.assert_called_once_with("https://test.execute-api.us-east-1.amazonaws.com/prod", "test-stack")
+    mock_rest_client.create_session.assert_called_once_with("https://test.execute-api.us-east-1.amazonaws.com/prod", "test-stack", None, None, None, False, None)
     mock_ws_client_class.assert_called_once_with("wss://test.execute-api.us-east-1.amazonaws.com/prod", "test-session-id")
     mock_debugger_class.assert_called_once_with(session=mock_aws_session, stack_name="test-stack")
     mock_asyncio_run.assert_called_once()
@@ -213,3 +213,101 @@ def test_attach_command_stack_not_found(mock_discovery_class, runner, mock_aws_s
 
     assert result.exit_code == 1
     assert "Error: Stack 'plldb' not found" in result.output
+
+
+@patch("plldb.cli.Debugger")
+@patch("plldb.cli.StackDiscovery")
+@patch("plldb.cli.RestApiClient")
+@patch("plldb.cli.WebSocketClient")
+@patch("plldb.cli.asyncio.run")
+def test_attach_command_shadow_mode(mock_asyncio_run, mock_ws_client_class, mock_rest_client_class, mock_discovery_class, mock_debugger_class, runner, mock_aws_session, monkeypatch):
+    """Test that the shadow mode and the other options are requested for the session."""
+    monkeypatch.setattr(boto3, "Session", lambda: mock_aws_session)
+    mock_discovery_class.return_value.get_api_endpoints.return_value = {
+        "websocket_url": "wss://test.execute-api.us-east-1.amazonaws.com/prod",
+        "rest_api_url": "https://test.execute-api.us-east-1.amazonaws.com/prod",
+    }
+    mock_rest_client = mock_rest_client_class.return_value
+    mock_rest_client.create_session.return_value = "test-session-id"
+
+    result = runner.invoke(cli, ["attach", "--stack-name", "test-stack", "--mode", "shadow", "--compression", "zlib", "--interception", "extension", "--access", "direct"], catch_exceptions=False)
+
+    assert result.exit_code == 0
+    mock_rest_client.create_session.assert_called_once_with("https://test.execute-api.us-east-1.amazonaws.com/prod", "test-stack", "zlib", "shadow", "extension", False, "direct")
+
+
+@patch("plldb.cli.Debugger")
+@patch("plldb.cli.StackDiscovery")
+@patch("plldb.cli.RestApiClient")
+@patch("plldb.cli.WebSocketClient")
+@patch("plldb.cli.asyncio.run")
+def test_attach_command_snapstart(mock_asyncio_run, mock_ws_client_class, mock_rest_client_class, mock_discovery_class, mock_debugger_class, runner, mock_aws_session, monkeypatch):
+    """Test that SnapStart is requested for the session and needs the runtime interception."""
+    monkeypatch.setattr(boto3, "Session", lambda: mock_aws_session)
+    mock_discovery_class.return_value.get_api_endpoints.return_value = {
+        "websocket_url": "wss://test.execute-api.us-east-1.amazonaws.com/prod",
+        "rest_api_url": "https://test.execute-api.us-east-1.amazonaws.com/prod",
+    }
+    mock_rest_client = mock_rest_client_class.return_value
+    mock_rest_client.create_session.return_value = "test-session-id"
+
+    result = runner.invoke(cli, ["attach", "--stack-name", "test-stack", "--snapstart"], catch_exceptions=False)
+
+    assert result.exit_code == 0
+    mock_rest_client.create_session.assert_called_once_with("https://test.execute-api.us-east-1.amazonaws.com/prod", "test-stack", None, None, None, True, None)
+
+    result = runner.invoke(cli, ["attach", "--stack-name", "test-stack", "--snapstart", "--interception", "extension"])
+
+    assert result.exit_code == 2
+    assert "--snapstart requires --interception runtime" in result.output
+    mock_rest_client.create_session.assert_called_once()
+
+
+@patch("plldb.cli.StackDiscovery")
+@patch("plldb.cli.RestApiClient")
+def test_route_command(mock_rest_client_class, mock_discovery_class, runner, monkeypatch):
+    """Test that routing rules are resolved to function names and sent to the session."""
+    mock_session = Mock()
+    mock_session.client.return_value.describe_stack_resource.return_value = {"StackResourceDetail": {"PhysicalResourceId": "test-stack-CreateOrder-abc123"}}
+    monkeypatch.setattr(boto3, "Session", lambda: mock_session)
+    mock_discovery_class.return_value.get_api_endpoints.return_value = {"rest_api_url": "https://test.execute-api.us-east-1.amazonaws.com/prod"}
+    mock_rest_client = mock_rest_client_class.return_value
+
+    result = runner.invoke(
+        cli,
+        ["route", "--session-id", "session-1", "--stack-name", "test-stack", "--function", "CreateOrder", "--sample-rate", "25", "--match", "$.httpMethod=POST", "--match", "$.body"],
+        catch_exceptions=False,
+    )
+
+    assert result.exit_code == 0
+    assert "Updated routing rules of session session-1" in result.output
+    mock_session.client.return_value.describe_stack_resource.assert_called_once_with(StackName="test-stack", LogicalResourceId="CreateOrder")
+    mock_rest_client.update_routing_rules.assert_called_once_with(
+        "https://test.execute-api.us-east-1.amazonaws.com/prod",
+        "session-1",
+        {"functions": ["test-stack-CreateOrder-abc123"], "sampleRate": 25.0, "predicates": [{"path": "$.httpMethod", "equals": "POST"}, {"path": "$.body"}]},
+    )
+
+
+@patch("plldb.cli.StackDiscovery")
+@patch("plldb.cli.RestApiClient")
+def test_route_command_clears_rules(mock_rest_client_class, mock_discovery_class, runner, monkeypatch):
+    """Test that the route command without options forwards every invocation again."""
+    monkeypatch.setattr(boto3, "Session", Mock)
+    mock_discovery_class.return_value.get_api_endpoints.return_value = {"rest_api_url": "https://api.example.com"}
+
+    result = runner.invoke(cli, ["route", "--session-id", "session-1"], catch_exceptions=False)
+
+    assert result.exit_code == 0
+    assert "Session session-1 forwards every invocation" in result.output
+    mock_rest_client_class.return_value.update_routing_rules.assert_called_once_with("https://api.example.com", "session-1", {})
+
+
+def test_route_command_requires_stack_name_with_function(runner, monkeypatch):
+    """Test that function logical IDs cannot be resolved without the stack name."""
+    monkeypatch.setattr(boto3, "Session", Mock)
+
+    result = runner.invoke(cli, ["route", "--session-id", "session-1", "--function", "CreateOrder"])
+
+    assert result.exit_code == 1
+    assert "--stack-name is required with --function" in result.output
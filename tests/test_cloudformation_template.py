@@ -42,6 +42,8 @@ class TestCloudFormationTemplate:
         debugger_table = resources["PLLDBDebugger"]
         assert debugger_table["Type"] == "AWS::DynamoDB::Table"
         assert debugger_table["Properties"]["TableName"] == "PLLDBDebugger"
+        # Environment snapshots expire once the session is over
+        assert debugger_table["Properties"]["TimeToLiveSpecification"] == {"AttributeName": "TTL", "Enabled": True}
 
         # Check table attributes
         attributes = {attr["AttributeName"] for attr in debugger_table["Properties"]["AttributeDefinitions"]}
@@ -0,0 +1,21 @@
+from benchmarks.cold_start_benchmark import RUNTIME_PATH, STATEMENTS, loads_boto3, run_benchmark
+
+
+class TestColdStartBenchmark:
+    def test_measures_lazy_and_eager_imports(self):
+        """Test that the import of the runtime is measured with lazy and eager boto3."""
+        results = run_benchmark(RUNTIME_PATH, repeat=1)
+
+        assert set(results) == {"lazy", "eager"}
+        assert all(duration > 0 for duration in results.values())
+
+    def test_dormant_import_does_not_load_boto3(self):
+        """Test that importing the runtime, as a dormant sandbox does, leaves boto3 unloaded."""
+        assert not loads_boto3(RUNTIME_PATH, STATEMENTS["lazy"])
+        assert loads_boto3(RUNTIME_PATH, STATEMENTS["eager"])
+
+    def test_lazy_import_is_not_slower(self):
+        """Test that the lazy import is not slower than the eager one, beyond the noise of fresh interpreters."""
+        results = run_benchmark(RUNTIME_PATH, repeat=3)
+
+        assert results["lazy"] <= results["eager"] * 1.1 + 5
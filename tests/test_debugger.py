@@ -1,6 +1,10 @@
+import base64
+import json
+import zlib
+
 import pytest
-from unittest.mock import MagicMock
-from plldb.debugger import Debugger
+from unittest.mock import MagicMock, patch
+from plldb.debugger import RESPONSE_OFFLOAD_THRESHOLD_BYTES, STREAM_CHUNK_MAX_BYTES, Debugger, diff_results
 
 
 class TestDebugger:
@@ -101,3 +105,275 @@ class TestDebugger:
 
         # Verify the lookup table contains both functions
         assert debugger._lambda_functions_lookup == {"function-1": "Lambda1", "function-2": "Lambda2"}
+
+
+class TestDebuggerPayloadOffload:
+    BUCKET = "plldb-core-infrastructure-us-east-1-123456789012"
+
+    @pytest.fixture
+    def debugger(self, mock_aws_session):
+        mock_aws_session.client("s3").create_bucket(Bucket=self.BUCKET)
+        with patch.object(Debugger, "_inspect_stack"):
+            debugger = Debugger(session=mock_aws_session, stack_name="test-stack")
+        debugger._lambda_functions_lookup = {"my-function-xyz123": "MyLambdaFunction"}
+        debugger._executor = MagicMock()
+        return debugger
+
+    def request(self, **fields):
+        return {
+            "requestId": "request-1",
+            "sessionId": "session-1",
+            "connectionId": "connection-1",
+            "lambdaFunctionName": "my-function-xyz123",
+            "lambdaFunctionVersion": "$LATEST",
+            **fields,
+        }
+
+    def test_offloaded_request_is_fetched(self, debugger, mock_aws_session):
+        event = {"records": ["x" * 1024] * 200}
+        payload = {"event": event, "context": {}, "environmentVariables": {"DEBUGGER_PAYLOAD_BUCKET": self.BUCKET}}
+        mock_aws_session.client("s3").put_object(Bucket=self.BUCKET, Key="payloads/session-1/request-1/request.json", Body=json.dumps(payload).encode())
+        debugger._executor.invoke_lambda_function.return_value = {"ok": True}
+
+        response = debugger.handle_message(self.request(event="", payloadLocation=f"s3://{self.BUCKET}/payloads/session-1/request-1/request.json"))
+
+        kwargs = debugger._executor.invoke_lambda_function.call_args[1]
+        assert kwargs["event"] == event
+        assert kwargs["environment"] == {"DEBUGGER_PAYLOAD_BUCKET": self.BUCKET}
+        assert response.statusCode == 200
+        assert response.response == json.dumps({"ok": True})
+        assert response.responseLocation is None
+
+    def test_large_response_is_offloaded(self, debugger, mock_aws_session):
+        result = {"body": "y" * RESPONSE_OFFLOAD_THRESHOLD_BYTES}
+        debugger._executor.invoke_lambda_function.return_value = result
+
+        response = debugger.handle_message(self.request(event="{}", environmentVariables={"DEBUGGER_PAYLOAD_BUCKET": self.BUCKET}))
+
+        assert response.response == ""
+        assert response.responseLocation == f"s3://{self.BUCKET}/payloads/session-1/request-1/response.json"
+        stored = mock_aws_session.client("s3").get_object(Bucket=self.BUCKET, Key="payloads/session-1/request-1/response.json")["Body"].read()
+        assert json.loads(stored) == result
+
+    def test_escaped_response_under_threshold_is_offloaded(self, debugger, mock_aws_session):
+        """Test that a response whose escaping makes the frame exceed the threshold is offloaded."""
+        result = {"records": ['"'] * (RESPONSE_OFFLOAD_THRESHOLD_BYTES // 7)}
+        assert len(json.dumps(result)) < RESPONSE_OFFLOAD_THRESHOLD_BYTES
+        debugger._executor.invoke_lambda_function.return_value = result
+
+        response = debugger.handle_message(self.request(event="{}", environmentVariables={"DEBUGGER_PAYLOAD_BUCKET": self.BUCKET}))
+
+        assert response.response == ""
+        assert response.responseLocation == f"s3://{self.BUCKET}/payloads/session-1/request-1/response.json"
+        stored = mock_aws_session.client("s3").get_object(Bucket=self.BUCKET, Key="payloads/session-1/request-1/response.json")["Body"].read()
+        assert json.loads(stored) == result
+
+    def test_large_response_without_bucket_stays_inline(self, debugger):
+        result = {"body": "y" * RESPONSE_OFFLOAD_THRESHOLD_BYTES}
+        debugger._executor.invoke_lambda_function.return_value = result
+
+        response = debugger.handle_message(self.request(event="{}"))
+
+        assert json.loads(response.response) == result
+        assert response.responseLocation is None
+
+    def test_context_of_remote_invocation_is_passed(self, debugger):
+        arn = "arn:aws:lambda:us-east-1:123456789012:function:my-function-xyz123:live"
+        debugger._executor.invoke_lambda_function.return_value = {"ok": True}
+
+        debugger.handle_message(self.request(event="{}", invokedFunctionArn=arn))
+
+        kwargs = debugger._executor.invoke_lambda_function.call_args[1]
+        assert kwargs["aws_request_id"] == "request-1"
+        assert kwargs["invoked_function_arn"] == arn
+
+
+class TestDebuggerStreaming:
+    @pytest.fixture
+    def debugger(self, mock_aws_session):
+        with patch.object(Debugger, "_inspect_stack"):
+            debugger = Debugger(session=mock_aws_session, stack_name="test-stack")
+        debugger._lambda_functions_lookup = {"my-function-xyz123": "MyLambdaFunction"}
+        debugger._executor = MagicMock()
+        return debugger
+
+    def request(self, **fields):
+        return {
+            "requestId": "request-1",
+            "sessionId": "session-1",
+            "connectionId": "connection-1",
+            "lambdaFunctionName": "my-function-xyz123",
+            "lambdaFunctionVersion": "$LATEST",
+            "event": "{}",
+            **fields,
+        }
+
+    def test_chunks_are_relayed_as_produced(self, debugger):
+        produced = []
+
+        def chunks():
+            for chunk in (b"first", b"x" * (STREAM_CHUNK_MAX_BYTES + 1)):
+                produced.append(chunk)
+                yield chunk
+
+        debugger._executor.invoke_lambda_function.return_value = chunks()
+
+        messages = debugger.handle_message(self.request())
+
+        assert debugger._executor.invoke_lambda_function.call_args[1]["stream"] is True
+        first = next(messages)
+        assert produced == [b"first"]
+        assert (first.chunk, base64.b64decode(first.response)) == (0, b"first")
+        rest = list(messages)
+        # Chunks too large for a frame are split
+        assert [message.chunk for message in rest[:-1]] == [1, 2]
+        assert b"".join(base64.b64decode(message.response) for message in rest[:-1]) == b"x" * (STREAM_CHUNK_MAX_BYTES + 1)
+        assert (rest[-1].statusCode, rest[-1].streamed, rest[-1].chunk) == (200, 3, None)
+
+    def test_chunks_use_the_session_encoding(self, debugger):
+        debugger._executor.invoke_lambda_function.return_value = iter([b"compressed"])
+
+        chunk, final = list(debugger.handle_message(self.request(encoding="zlib", payload=base64.b64encode(zlib.compress(b'{"event": {}}')).decode())))
+
+        assert zlib.decompress(base64.b64decode(chunk.response)) == b"compressed"
+        assert (chunk.encoding, final.encoding) == ("zlib", "zlib")
+
+    def test_failure_ends_the_stream(self, debugger):
+        def chunks():
+            yield b"partial"
+            raise ValueError("broken")
+
+        debugger._executor.invoke_lambda_function.return_value = chunks()
+
+        chunk, final = list(debugger.handle_message(self.request()))
+
+        assert chunk.chunk == 0
+        assert (final.statusCode, final.errorMessage, final.streamed) == (500, "broken", 1)
+
+
+class TestDebuggerEnvironmentSnapshot:
+    @pytest.fixture
+    def debugger(self, mock_aws_session):
+        with patch.object(Debugger, "_inspect_stack"):
+            debugger = Debugger(session=mock_aws_session, stack_name="test-stack")
+        debugger._lambda_functions_lookup = {"my-function-xyz123": "MyLambdaFunction"}
+        debugger._executor = MagicMock()
+        debugger._executor.invoke_lambda_function.return_value = {"ok": True}
+        return debugger
+
+    def request(self, request_id, **fields):
+        return {
+            "requestId": request_id,
+            "sessionId": "session-1",
+            "connectionId": "connection-1",
+            "lambdaFunctionName": "my-function-xyz123",
+            "lambdaFunctionVersion": "$LATEST",
+            "event": "{}",
+            "environmentHash": "abc123",
+            **fields,
+        }
+
+    def test_inline_snapshot_is_cached(self, debugger):
+        debugger.handle_message(self.request("request-1", environmentVariables={"TABLE_NAME": "orders"}))
+        debugger.handle_message(self.request("request-2", environmentDelta={"_X_AMZN_TRACE_ID": "Root=1-b"}))
+
+        kwargs = debugger._executor.invoke_lambda_function.call_args[1]
+        assert kwargs["environment"] == {"TABLE_NAME": "orders", "_X_AMZN_TRACE_ID": "Root=1-b"}
+
+    def test_unknown_snapshot_is_fetched(self, debugger, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBDebugger",
+            KeySchema=[{"AttributeName": "RequestId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "RequestId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        environment = zlib.compress(json.dumps({"TABLE_NAME": "orders"}).encode())
+        dynamodb.Table("PLLDBDebugger").put_item(Item={"RequestId": "environment#abc123", "EnvironmentVariables": environment, "Encoding": "zlib"})
+
+        debugger.handle_message(self.request("request-1"))
+
+        kwargs = debugger._executor.invoke_lambda_function.call_args[1]
+        assert kwargs["environment"] == {"TABLE_NAME": "orders"}
+        assert debugger._environments["abc123"] == {"TABLE_NAME": "orders"}
+
+    def test_missing_snapshot_fails_the_request(self, debugger, mock_aws_session):
+        mock_aws_session.resource("dynamodb").create_table(
+            TableName="PLLDBDebugger",
+            KeySchema=[{"AttributeName": "RequestId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "RequestId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        response = debugger.handle_message(self.request("request-1"))
+
+        assert response.statusCode == 500
+        assert "abc123" in response.errorMessage
+
+
+class TestDebuggerShadow:
+    @pytest.fixture
+    def debugger(self, mock_aws_session):
+        with patch.object(Debugger, "_inspect_stack"):
+            debugger = Debugger(session=mock_aws_session, stack_name="test-stack")
+        debugger._lambda_functions_lookup = {"my-function-xyz123": "MyLambdaFunction"}
+        debugger._executor = MagicMock()
+        return debugger
+
+    def request(self, **fields):
+        return {
+            "requestId": "request-1",
+            "sessionId": "session-1",
+            "connectionId": "connection-1",
+            "lambdaFunctionName": "my-function-xyz123",
+            "lambdaFunctionVersion": "$LATEST",
+            "event": json.dumps({"key": "value"}),
+            "environmentVariables": {"TABLE_NAME": "orders"},
+            "shadow": True,
+            **fields,
+        }
+
+    def test_matching_result_is_reported(self, debugger, caplog):
+        debugger._executor.invoke_lambda_function.return_value = {"statusCode": 200, "body": "ok"}
+
+        with caplog.at_level("INFO", logger="plldb.debugger"):
+            response = debugger.handle_message(self.request(deployedResponse=json.dumps({"body": "ok", "statusCode": 200})))
+
+        assert response is None
+        kwargs = debugger._executor.invoke_lambda_function.call_args[1]
+        assert kwargs["event"] == {"key": "value"}
+        assert kwargs["environment"] == {"TABLE_NAME": "orders"}
+        assert "local result matches deployed" in caplog.text
+
+    def test_differing_result_is_diffed(self, debugger, caplog):
+        debugger._executor.invoke_lambda_function.return_value = {"statusCode": 500}
+
+        with caplog.at_level("INFO", logger="plldb.debugger"):
+            response = debugger.handle_message(self.request(deployedResponse=json.dumps({"statusCode": 200})))
+
+        assert response is None
+        assert "local result differs from deployed" in caplog.text
+        assert '-  "statusCode": 200' in caplog.text
+        assert '+  "statusCode": 500' in caplog.text
+
+    def test_local_error_is_compared_to_deployed_result(self, debugger, caplog):
+        debugger._executor.invoke_lambda_function.side_effect = KeyError("id")
+
+        with caplog.at_level("INFO", logger="plldb.debugger"):
+            response = debugger.handle_message(self.request(deployedErrorMessage="'id'"))
+
+        assert response is None
+        assert "local result matches deployed" in caplog.text
+
+    def test_streamed_result_is_compared_to_deployed_result(self, debugger, caplog):
+        debugger._executor.invoke_lambda_function.return_value = b'{"body": "ok"}'
+
+        with caplog.at_level("INFO", logger="plldb.debugger"):
+            response = debugger.handle_message(self.request(deployedResponse='{"body": "ok"}'))
+
+        assert response is None
+        assert "local result matches deployed" in caplog.text
+
+    def test_diff_results(self):
+        assert diff_results({"a": [1, 2]}, {"a": (1, 2)}) == ""
+        assert diff_results(None, "text").splitlines()[:2] == ["--- deployed", "+++ local"]
@@ -111,6 +111,7 @@ class TestInstrumentLambdaFunctions:
         """Test successful instrumentation of lambda functions."""
         # Mock the WEBSOCKET_ENDPOINT environment variable
         monkeypatch.setenv("WEBSOCKET_ENDPOINT", "https://test.execute-api.us-east-1.amazonaws.com/prod")
+        monkeypatch.setenv("PAYLOAD_BUCKET", "plldb-core-infrastructure-us-east-1-123456789012")
 
         instrument_lambda_functions("test-stack", "session-123", "connection-456")
 
@@ -133,6 +134,7 @@ class TestInstrumentLambdaFunctions:
             assert kwargs["Environment"]["Variables"]["DEBUGGER_CONNECTION_ID"] == "connection-456"
             assert kwargs["Environment"]["Variables"]["AWS_LAMBDA_EXEC_WRAPPER"] == "/opt/bin/bootstrap"
             assert kwargs["Environment"]["Variables"]["DEBUGGER_WEBSOCKET_API_ENDPOINT"] == "https://test.execute-api.us-east-1.amazonaws.com/prod"
+            assert kwargs["Environment"]["Variables"]["DEBUGGER_PAYLOAD_BUCKET"] == "plldb-core-infrastructure-us-east-1-123456789012"
             assert "arn:aws:lambda:us-east-1:123456789012:layer:PLLDBDebuggerRuntime:3" in kwargs["Layers"]
 
         # Verify IAM policy was added - should be called twice (for two functions)
@@ -152,6 +154,30 @@ class TestInstrumentLambdaFunctions:
             assert policy_doc["Statement"][0]["Action"] == "sts:AssumeRole"
             assert policy_doc["Statement"][0]["Resource"] == "arn:aws:iam::123456789012:role/PLLDBDebuggerRole"
 
+    def test_instrument_lambda_functions_direct_access(self, mock_aws_services, monkeypatch):
+        """Test that direct access grants the permissions of the debug path instead of assuming the role."""
+        monkeypatch.setenv("WEBSOCKET_ENDPOINT", "https://abc123.execute-api.eu-west-1.amazonaws.com/prod")
+        monkeypatch.setenv("PAYLOAD_BUCKET", "plldb-bucket")
+        monkeypatch.setenv("AWS_REGION", "eu-west-1")
+
+        instrument_lambda_functions("test-stack", "session-123", "connection-456", access="direct", runtime_secret="runtime-secret")
+
+        for call in mock_aws_services["lambda_client"].update_function_configuration.call_args_list:
+            assert call[1]["Environment"]["Variables"]["DEBUGGER_ACCESS"] == "direct"
+            assert call[1]["Environment"]["Variables"]["DEBUGGER_RUNTIME_SECRET"] == "runtime-secret"
+        iam_calls = mock_aws_services["iam_client"].put_role_policy.call_args_list
+        assert [call[1]["PolicyName"] for call in iam_calls] == ["PLLDBDirectAccessPolicy", "PLLDBDirectAccessPolicy"]
+        statements = json.loads(iam_calls[0][1]["PolicyDocument"])["Statement"]
+        resources = [statement["Resource"] for statement in statements]
+        assert resources == [
+            "arn:aws:dynamodb:eu-west-1:123456789012:table/PLLDBDebugger",
+            "arn:aws:dynamodb:eu-west-1:123456789012:table/PLLDBSessions",
+            "arn:aws:execute-api:eu-west-1:123456789012:abc123/*",
+            "arn:aws:s3:::plldb-bucket/payloads/*",
+        ]
+        assert statements[2]["Action"] == "execute-api:ManageConnections"
+        assert not any("sts:AssumeRole" in json.dumps(statement) for statement in statements)
+
     def test_instrument_lambda_functions_idempotent(self, mock_aws_services, monkeypatch):
         """Test that instrumentation is idempotent."""
         # Mock the WEBSOCKET_ENDPOINT environment variable
@@ -200,6 +226,7 @@ class TestUninstrumentLambdaFunctions:
                         "DEBUGGER_CONNECTION_ID": "connection-456",
                         "AWS_LAMBDA_EXEC_WRAPPER": "/opt/bin/bootstrap",
                         "DEBUGGER_WEBSOCKET_API_ENDPOINT": "https://test.execute-api.us-east-1.amazonaws.com/prod",
+                        "DEBUGGER_PAYLOAD_BUCKET": "plldb-core-infrastructure-us-east-1-123456789012",
                         "OTHER_VAR": "value",
                     }
                 },
@@ -213,6 +240,7 @@ class TestUninstrumentLambdaFunctions:
                         "DEBUGGER_CONNECTION_ID": "connection-456",
                         "AWS_LAMBDA_EXEC_WRAPPER": "/opt/bin/bootstrap",
                         "DEBUGGER_WEBSOCKET_API_ENDPOINT": "https://test.execute-api.us-east-1.amazonaws.com/prod",
+                        "DEBUGGER_PAYLOAD_BUCKET": "plldb-core-infrastructure-us-east-1-123456789012",
                         "OTHER_VAR": "value",
                     }
                 },
@@ -236,21 +264,81 @@ class TestUninstrumentLambdaFunctions:
             assert "DEBUGGER_CONNECTION_ID" not in kwargs["Environment"]["Variables"]
             assert "AWS_LAMBDA_EXEC_WRAPPER" not in kwargs["Environment"]["Variables"]
             assert "DEBUGGER_WEBSOCKET_API_ENDPOINT" not in kwargs["Environment"]["Variables"]
+            assert "DEBUGGER_PAYLOAD_BUCKET" not in kwargs["Environment"]["Variables"]
             assert kwargs["Environment"]["Variables"].get("OTHER_VAR") == "value"
             # Should remove only the debug layer
             assert len(kwargs["Layers"]) == 1
             assert kwargs["Layers"][0] == "arn:aws:lambda:us-east-1:123456789012:layer:OtherLayer:1"
 
-        # Verify IAM policy was removed - should be called twice (for two functions)
-        assert mock_aws_services["iam_client"].delete_role_policy.call_count == 2
+        # Verify both IAM policies were removed from the roles of the two functions
+        assert [call[1] for call in mock_aws_services["iam_client"].delete_role_policy.call_args_list] == [
+            {"RoleName": "test-function-1-role", "PolicyName": "PLLDBAssumeRolePolicy"},
+            {"RoleName": "test-function-1-role", "PolicyName": "PLLDBDirectAccessPolicy"},
+            {"RoleName": "test-function-2-role", "PolicyName": "PLLDBAssumeRolePolicy"},
+            {"RoleName": "test-function-2-role", "PolicyName": "PLLDBDirectAccessPolicy"},
+        ]
 
-        # Check the IAM policy deletion calls
-        iam_calls = mock_aws_services["iam_client"].delete_role_policy.call_args_list
-        for i, call in enumerate(iam_calls):
-            args, kwargs = call
-            expected_role = f"test-function-{i + 1}-role"
-            assert kwargs["RoleName"] == expected_role
-            assert kwargs["PolicyName"] == "PLLDBAssumeRolePolicy"
+    def test_uninstrument_snapstart_session(self, mock_aws_services):
+        """Test that SnapStart is turned off again and the versions published for sessions are deleted."""
+        mock_aws_services["lambda_client"].get_function_configuration.side_effect = lambda FunctionName: {
+            "Environment": {"Variables": {"DEBUGGER_SESSION_ID": "session-123", "DEBUGGER_CONNECTION_ID": "connection-456", "DEBUGGER_SNAPSTART": "None", "OTHER_VAR": "value"}},
+            "Layers": [],
+            "SnapStart": {"ApplyOn": "PublishedVersions"},
+        }
+        mock_aws_services["lambda_client"].get_paginator.return_value.paginate.return_value = [
+            {"Versions": [{"Version": "$LATEST", "Description": ""}, {"Version": "3", "Description": "release"}, {"Version": "4", "Description": "PLLDB debug session session-123"}]}
+        ]
+
+        uninstrument_lambda_functions("test-stack")
+
+        for call in mock_aws_services["lambda_client"].update_function_configuration.call_args_list:
+            assert call[1]["SnapStart"] == {"ApplyOn": "None"}
+            assert "DEBUGGER_SNAPSTART" not in call[1]["Environment"]["Variables"]
+        mock_aws_services["lambda_client"].get_paginator.assert_called_with("list_versions_by_function")
+        deleted = mock_aws_services["lambda_client"].delete_function.call_args_list
+        assert [call[1] for call in deleted] == [{"FunctionName": "test-function-1", "Qualifier": "4"}, {"FunctionName": "test-function-2", "Qualifier": "4"}]
+
+    def test_uninstrument_direct_access_session(self, mock_aws_services):
+        """Test that both policies are removed whatever access the session used, a missing one counting as removed."""
+
+        class NoSuchEntityException(Exception):
+            pass
+
+        mock_aws_services["lambda_client"].get_function_configuration.side_effect = lambda FunctionName: {
+            "Environment": {
+                "Variables": {
+                    "DEBUGGER_SESSION_ID": "session-123",
+                    "DEBUGGER_CONNECTION_ID": "connection-456",
+                    "DEBUGGER_ACCESS": "direct",
+                    "DEBUGGER_RUNTIME_SECRET": "runtime-secret",
+                    "OTHER_VAR": "value",
+                }
+            },
+            "Layers": [],
+            "Role": f"arn:aws:iam::123456789012:role/{FunctionName}-role",
+        }
+        iam_client = mock_aws_services["iam_client"]
+        iam_client.exceptions.NoSuchEntityException = NoSuchEntityException
+
+        def delete_role_policy(RoleName, PolicyName):
+            if PolicyName == "PLLDBAssumeRolePolicy":
+                raise NoSuchEntityException(f"The role policy with name {PolicyName} cannot be found.")
+
+        iam_client.delete_role_policy.side_effect = delete_role_policy
+
+        with patch("plldb.cloudformation.lambda_functions.debugger_instrumentation.send_debugger_info") as mock_send_info:
+            uninstrument_lambda_functions("test-stack", "session-123", "connection-456")
+
+        for call in mock_aws_services["lambda_client"].update_function_configuration.call_args_list:
+            assert "DEBUGGER_ACCESS" not in call[1]["Environment"]["Variables"]
+            assert "DEBUGGER_RUNTIME_SECRET" not in call[1]["Environment"]["Variables"]
+        assert [call[1] for call in iam_client.delete_role_policy.call_args_list] == [
+            {"RoleName": "test-function-1-role", "PolicyName": "PLLDBAssumeRolePolicy"},
+            {"RoleName": "test-function-1-role", "PolicyName": "PLLDBDirectAccessPolicy"},
+            {"RoleName": "test-function-2-role", "PolicyName": "PLLDBAssumeRolePolicy"},
+            {"RoleName": "test-function-2-role", "PolicyName": "PLLDBDirectAccessPolicy"},
+        ]
+        assert all(call[0][2] == "INFO" for call in mock_send_info.call_args_list)
 
     def test_uninstrument_lambda_functions_idempotent(self, mock_aws_services):
         """Test that uninstrumentation is idempotent."""
@@ -278,6 +366,69 @@ class TestLambdaHandler:
         assert result["statusCode"] == 200
         assert "instrumented successfully" in json.loads(result["body"])["message"]
 
+    def test_lambda_handler_instrument_with_compression(self, mock_aws_services):
+        """Test that the compression negotiated for the session is set on instrumented functions."""
+        event = {"command": "instrument", "stackName": "test-stack", "sessionId": "session-123", "connectionId": "connection-456", "compression": "zlib"}
+
+        lambda_handler(event, None)
+
+        for call in mock_aws_services["lambda_client"].update_function_configuration.call_args_list:
+            assert call[1]["Environment"]["Variables"]["DEBUGGER_COMPRESSION"] == "zlib"
+
+    def test_lambda_handler_instrument_with_mode(self, mock_aws_services):
+        """Test that the mode of the session is set on instrumented functions."""
+        event = {"command": "instrument", "stackName": "test-stack", "sessionId": "session-123", "connectionId": "connection-456", "mode": "shadow"}
+
+        lambda_handler(event, None)
+
+        calls = mock_aws_services["lambda_client"].update_function_configuration.call_args_list
+        assert calls
+        for call in calls:
+            assert call[1]["Environment"]["Variables"]["DEBUGGER_SESSION_MODE"] == "shadow"
+
+    def test_lambda_handler_instrument_with_interception(self, mock_aws_services):
+        """Test that the interception of the session is set on instrumented functions."""
+        event = {"command": "instrument", "stackName": "test-stack", "sessionId": "session-123", "connectionId": "connection-456", "interception": "extension"}
+
+        lambda_handler(event, None)
+
+        calls = mock_aws_services["lambda_client"].update_function_configuration.call_args_list
+        assert calls
+        for call in calls:
+            variables = call[1]["Environment"]["Variables"]
+            assert variables["DEBUGGER_INTERCEPTION"] == "extension"
+            assert variables["AWS_LAMBDA_EXEC_WRAPPER"] == "/opt/bin/bootstrap"
+
+    def test_lambda_handler_instrument_with_snapstart(self, mock_aws_services):
+        """Test that SnapStart is enabled and a version is published once the function is updated."""
+        event = {"command": "instrument", "stackName": "test-stack", "sessionId": "session-123", "connectionId": "connection-456", "snapStart": True}
+        lambda_client = mock_aws_services["lambda_client"]
+        lambda_client.publish_version.return_value = {"Version": "7"}
+
+        lambda_handler(event, None)
+
+        calls = lambda_client.update_function_configuration.call_args_list
+        assert calls
+        for call in calls:
+            assert call[1]["SnapStart"] == {"ApplyOn": "PublishedVersions"}
+            assert call[1]["Environment"]["Variables"]["DEBUGGER_SNAPSTART"] == "None"
+        lambda_client.get_waiter.assert_called_with("function_updated_v2")
+        assert [call[1] for call in lambda_client.publish_version.call_args_list] == [
+            {"FunctionName": "test-function-1", "Description": "PLLDB debug session session-123"},
+            {"FunctionName": "test-function-2", "Description": "PLLDB debug session session-123"},
+        ]
+
+    def test_lambda_handler_instrument_without_snapstart(self, mock_aws_services):
+        """Test that SnapStart is left alone and nothing is published by default."""
+        event = {"command": "instrument", "stackName": "test-stack", "sessionId": "session-123", "connectionId": "connection-456"}
+
+        lambda_handler(event, None)
+
+        for call in mock_aws_services["lambda_client"].update_function_configuration.call_args_list:
+            assert "SnapStart" not in call[1]
+            assert "DEBUGGER_SNAPSTART" not in call[1]["Environment"]["Variables"]
+        mock_aws_services["lambda_client"].publish_version.assert_not_called()
+
     def test_lambda_handler_uninstrument_success(self, mock_aws_services):
         """Test successful uninstrument command."""
         event = {"command": "uninstrument", "stackName": "test-stack"}
@@ -514,6 +514,11 @@ def lambda_handler(event, context):
 
 def error_handler(event, context):
     raise ValueError("Test error from lambda")
+
+def streaming_handler(event, context):
+    yield "env: "
+    yield os.environ.get("TEST_ENV_VAR", "default").encode()
+    yield {"done": True}
 """)
 
         # Create CloudFormation template
@@ -521,6 +526,7 @@ def error_handler(event, context):
             "Resources": {
                 "TestLambda": {"Type": "AWS::Serverless::Function", "Properties": {"CodeUri": "lambda_code", "Handler": "app.lambda_handler"}},
                 "ErrorLambda": {"Type": "AWS::Serverless::Function", "Properties": {"CodeUri": "lambda_code", "Handler": "app.error_handler"}},
+                "StreamingLambda": {"Type": "AWS::Serverless::Function", "Properties": {"CodeUri": "lambda_code", "Handler": "app.streaming_handler"}},
             }
         }
 
@@ -604,6 +610,31 @@ def error_handler(event, context):
         except ValueError:
             pytest.fail("Request ID is not a valid UUID")
 
+    def test_default_context_of_remote_invocation(self, mock_lambda_setup, monkeypatch):
+        """Test that the default context carries the request ID and invoked ARN of the remote invocation."""
+        from plldb.executor import LambdaContext
+
+        working_dir, template = mock_lambda_setup
+        executor = Executor(working_dir=working_dir)
+        monkeypatch.setattr(executor, "load_cfn_template", lambda: template)
+        arn = "arn:aws:lambda:eu-west-1:210987654321:function:test-function:live"
+
+        result = executor.invoke_lambda_function("TestLambda", {"test": "data"}, aws_request_id="remote-request-1", invoked_function_arn=arn)
+
+        assert result["requestId"] == "remote-request-1"
+        assert LambdaContext("TestLambda", invoked_function_arn=arn).invoked_function_arn == arn
+
+    def test_default_context_counts_down_to_deadline(self):
+        """Test that the default context reports the time left until the remote deadline."""
+        import time
+
+        from plldb.executor import DEFAULT_TIMEOUT_MS, LambdaContext
+
+        context = LambdaContext("TestLambda", deadline_ms=int(time.time() * 1000) + 5000)
+        assert 4000 < context.get_remaining_time_in_millis() <= 5000
+        assert LambdaContext("TestLambda", deadline_ms=0).get_remaining_time_in_millis() == 0
+        assert DEFAULT_TIMEOUT_MS - 1000 < LambdaContext("TestLambda").get_remaining_time_in_millis() <= DEFAULT_TIMEOUT_MS
+
     def test_invoke_lambda_function_error_propagation(self, mock_lambda_setup, monkeypatch):
         """Test that lambda function errors are propagated correctly."""
         working_dir, template = mock_lambda_setup
@@ -664,6 +695,30 @@ def error_handler(event, context):
         result3 = executor.invoke_lambda_function("TestLambda", {}, environment=env3)
         assert "Env: third_value" in result3["body"]
 
+    def test_invoke_lambda_function_streams_chunks(self, mock_lambda_setup, monkeypatch):
+        """Test that chunks of a streaming handler are produced within the environment of the function."""
+        working_dir, template = mock_lambda_setup
+
+        executor = Executor(working_dir=working_dir)
+        monkeypatch.setattr(executor, "load_cfn_template", lambda: template)
+
+        chunks = executor.invoke_lambda_function("StreamingLambda", {}, environment={"TEST_ENV_VAR": "streamed"}, stream=True)
+
+        assert next(chunks) == b"env: "
+        assert os.environ.get("TEST_ENV_VAR") == "streamed"
+        assert list(chunks) == [b"streamed", b'{"done": true}']
+        assert "TEST_ENV_VAR" not in os.environ
+        assert "app" not in sys.modules
+
+    def test_invoke_lambda_function_joins_streamed_chunks(self, mock_lambda_setup, monkeypatch):
+        """Test that chunks of a streaming handler are joined when not streaming."""
+        working_dir, template = mock_lambda_setup
+
+        executor = Executor(working_dir=working_dir)
+        monkeypatch.setattr(executor, "load_cfn_template", lambda: template)
+
+        assert executor.invoke_lambda_function("StreamingLambda", {}) == b'env: default{"done": true}'
+
 
 class TestExecutorSimulator:
     def test_with_real_filesystem(self, tmp_path):
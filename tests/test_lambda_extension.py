@@ -0,0 +1,282 @@
+import socket
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from plldb.cloudformation.layer import lambda_extension, lambda_runtime, plldb_wrapper
+from tests.fake_extensions_api import FakeExtensionsApi
+
+
+@pytest.fixture(autouse=True)
+def reset_sandbox(monkeypatch):
+    """Give every test a fresh sandbox: shadow queue, pre-warming, wrapper connection and handler."""
+    monkeypatch.setattr(lambda_runtime, "_shadow_forwarder", lambda_runtime.ShadowForwarder())
+    monkeypatch.setattr(lambda_runtime, "_prewarm_ms", None)
+    monkeypatch.setattr(lambda_runtime, "prewarm_debugger_connections", Mock())
+    monkeypatch.setattr(plldb_wrapper, "_extension_client", None)
+    monkeypatch.setattr(plldb_wrapper, "_original_handler", Mock(return_value={"statusCode": 200, "body": "deployed"}))
+    monkeypatch.setattr(plldb_wrapper, "_original_handler_error", None)
+
+
+@pytest.fixture
+def extensions_api(monkeypatch):
+    api = FakeExtensionsApi()
+    monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", api.address)
+    yield api
+    api.shutdown()
+
+
+@pytest.fixture
+def session(monkeypatch):
+    """Instrument the sandbox for the extension interception on a free port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+    monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+    monkeypatch.setenv("DEBUGGER_INTERCEPTION", "extension")
+    monkeypatch.setenv("DEBUGGER_EXTENSION_PORT", str(port))
+    monkeypatch.setenv("DEBUGGER_ORIGINAL_HANDLER", "app.handler")
+    monkeypatch.setenv("_HANDLER", "plldb_wrapper.handler")
+    return port
+
+
+def make_context(request_id: str = "request-1", remaining_ms: int = 5000):
+    """Context object as the managed runtime passes it to the handler."""
+    return SimpleNamespace(
+        aws_request_id=request_id,
+        function_name="test-function",
+        function_version="$LATEST",
+        invoked_function_arn="arn:aws:lambda:us-east-1:123456789012:function:test-function",
+        memory_limit_in_mb="128",
+        identity=SimpleNamespace(cognito_identity_id=None, cognito_identity_pool_id=None),
+        client_context=None,
+        get_remaining_time_in_millis=lambda: remaining_ms,
+    )
+
+
+def deadline_in(seconds: float) -> int:
+    return int((time.time() + seconds) * 1000)
+
+
+def start_extension(extensions_api: FakeExtensionsApi) -> threading.Thread:
+    """Run the extension until its init phase is over, i.e. it asked for the first event."""
+    thread = threading.Thread(target=lambda_extension.main, daemon=True)
+    thread.start()
+    extensions_api.wait_for_next_calls(1)
+    return thread
+
+
+class TestExtensionLifecycle:
+    def test_exits_without_extension_interception(self, extensions_api, monkeypatch):
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        monkeypatch.delenv("DEBUGGER_INTERCEPTION", raising=False)
+
+        lambda_extension.main()
+
+        assert extensions_api.registrations == []
+        lambda_runtime.prewarm_debugger_connections.assert_not_called()
+
+    def test_exits_without_session(self, extensions_api, monkeypatch):
+        monkeypatch.delenv("DEBUGGER_SESSION_ID", raising=False)
+        monkeypatch.setenv("DEBUGGER_INTERCEPTION", "extension")
+
+        lambda_extension.main()
+
+        assert extensions_api.registrations == []
+        assert extensions_api.next_calls == 0
+
+    def test_registers_and_prewarms(self, extensions_api, session):
+        thread = start_extension(extensions_api)
+
+        assert [registration["events"] for registration in extensions_api.registrations] == [["INVOKE", "SHUTDOWN"]]
+        lambda_runtime.prewarm_debugger_connections.assert_called_once_with("test-session", "test-connection")
+
+        extensions_api.add_shutdown(deadline_in(2))
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def test_register_requires_identifier(self, monkeypatch):
+        client = lambda_extension.ExtensionsApiClient("127.0.0.1:9001")
+        monkeypatch.setattr(client, "_request", Mock(return_value=(200, {}, b"{}")))
+
+        with pytest.raises(lambda_runtime.RuntimeApiError, match="Lambda-Extension-Identifier"):
+            client.register(["INVOKE"])
+        assert client.extension_id is None
+
+    def test_reports_init_error_when_port_is_taken(self, extensions_api, session):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", session))
+            sock.listen()
+            with pytest.raises(SystemExit):
+                lambda_extension.main()
+
+        assert len(extensions_api.init_errors) == 1
+        assert str(session) in extensions_api.init_errors[0]["errorMessage"]
+
+
+class TestDebugInterception:
+    @pytest.fixture
+    def extension(self, extensions_api, session):
+        thread = start_extension(extensions_api)
+        yield thread
+        extensions_api.add_shutdown(deadline_in(2))
+        thread.join(5)
+
+    def test_returns_debugger_response(self, extension, monkeypatch):
+        forward = Mock(return_value=(lambda_runtime.FORWARD_ANSWERED, {"statusCode": 200, "body": "debugger"}, None))
+        monkeypatch.setattr(lambda_runtime, "forward_invocation", forward)
+        monkeypatch.setattr(lambda_runtime, "emit_invocation_metrics", Mock())
+
+        result = plldb_wrapper.handler({"key": "value"}, make_context())
+
+        assert result == {"statusCode": 200, "body": "debugger"}
+        plldb_wrapper._original_handler.assert_not_called()
+        session_id, connection_id, event, context, _, environment = forward.call_args[0]
+        assert (session_id, connection_id, event, context.aws_request_id) == ("test-session", "test-connection", {"key": "value"}, "request-1")
+        assert context.deadline_ms > time.time() * 1000
+        # The debugger sees the handler of the function, not the wrapper
+        assert environment.variables["_HANDLER"] == "app.handler"
+        assert "DEBUGGER_ORIGINAL_HANDLER" not in environment.variables
+        lambda_runtime.emit_invocation_metrics.assert_called_once()
+
+    def test_passes_raw_debugger_response(self, extension, monkeypatch):
+        response = lambda_runtime.RawJson(b'{"statusCode": 200, "body": "debugger"}')
+        monkeypatch.setattr(lambda_runtime, "forward_invocation", Mock(return_value=(lambda_runtime.FORWARD_ANSWERED, response, None)))
+        monkeypatch.setattr(lambda_runtime, "emit_invocation_metrics", Mock())
+
+        assert plldb_wrapper.handler({}, make_context()) == {"statusCode": 200, "body": "debugger"}
+
+    def test_joins_streamed_debugger_response(self, extension, monkeypatch):
+        monkeypatch.setattr(lambda_runtime, "forward_invocation", Mock(return_value=(lambda_runtime.FORWARD_ANSWERED, iter([b"streamed ", b"body"]), None)))
+        monkeypatch.setattr(lambda_runtime, "emit_invocation_metrics", Mock())
+
+        assert plldb_wrapper.handler({}, make_context()) == "streamed body"
+
+    def test_raises_debugger_error(self, extension, monkeypatch):
+        monkeypatch.setattr(lambda_runtime, "forward_invocation", Mock(return_value=(lambda_runtime.FORWARD_ANSWERED, None, "KeyError: 'id'")))
+        monkeypatch.setattr(lambda_runtime, "emit_invocation_metrics", Mock())
+
+        with pytest.raises(plldb_wrapper.DebuggerError, match="KeyError: 'id'"):
+            plldb_wrapper.handler({}, make_context())
+
+    @pytest.mark.parametrize("outcome", [lambda_runtime.FORWARD_SKIPPED, lambda_runtime.FORWARD_HEDGED])
+    def test_runs_original_handler(self, extension, monkeypatch, outcome):
+        monkeypatch.setattr(lambda_runtime, "forward_invocation", Mock(return_value=(outcome, None, None)))
+        monkeypatch.setattr(lambda_runtime, "emit_invocation_metrics", Mock())
+        context = make_context()
+
+        result = plldb_wrapper.handler({"key": "value"}, context)
+
+        assert result == {"statusCode": 200, "body": "deployed"}
+        plldb_wrapper._original_handler.assert_called_once_with({"key": "value"}, context)
+        # Skipped invocations were not forwarded and do not emit debug metrics
+        assert lambda_runtime.emit_invocation_metrics.called == (outcome == lambda_runtime.FORWARD_HEDGED)
+
+    def test_runs_original_handler_when_debugger_is_gone(self, extension, monkeypatch):
+        monkeypatch.setattr(lambda_runtime, "forward_invocation", Mock(side_effect=lambda_runtime.DebuggerConnectionGone("debugger connection is gone")))
+        monkeypatch.setattr(lambda_runtime, "emit_invocation_metrics", Mock())
+
+        assert plldb_wrapper.handler({}, make_context()) == {"statusCode": 200, "body": "deployed"}
+
+    def test_reports_debugger_errors(self, extension, monkeypatch):
+        monkeypatch.setattr(lambda_runtime, "forward_invocation", Mock(side_effect=RuntimeError("table is missing")))
+        monkeypatch.setattr(lambda_runtime, "emit_invocation_metrics", Mock())
+
+        with pytest.raises(plldb_wrapper.DebuggerError, match="Debugger error: table is missing"):
+            plldb_wrapper.handler({}, make_context())
+
+
+class TestShadowInterception:
+    def test_invocation_finishes_once_copy_was_sent(self, extensions_api, session, monkeypatch):
+        monkeypatch.setenv("DEBUGGER_SESSION_MODE", "shadow")
+        release = threading.Event()
+        forward = Mock(side_effect=lambda *args: release.wait(5))
+        monkeypatch.setattr(lambda_runtime, "forward_shadow_copy", forward)
+        thread = start_extension(extensions_api)
+
+        extensions_api.add_invoke("request-1", deadline_in(5))
+        result = plldb_wrapper.handler({"key": "value"}, make_context("request-1"))
+
+        # The deployed handler answered, the invocation stays open until the copy is sent
+        assert result == {"statusCode": 200, "body": "deployed"}
+        time.sleep(0.2)
+        assert extensions_api.next_calls == 1
+        release.set()
+        extensions_api.wait_for_next_calls(2)
+
+        session_id, connection_id, request_id, event, deadline_ms, response, error, environment, invoked_function_arn = forward.call_args[0]
+        assert (session_id, connection_id, request_id, event) == ("test-session", "test-connection", "request-1", {"key": "value"})
+        assert (response, error) == ({"statusCode": 200, "body": "deployed"}, None)
+        assert environment.variables["_HANDLER"] == "app.handler"
+        assert invoked_function_arn == "arn:aws:lambda:us-east-1:123456789012:function:test-function"
+
+        extensions_api.add_shutdown(deadline_in(2))
+        thread.join(5)
+
+    def test_mirrors_handler_error(self, extensions_api, session, monkeypatch):
+        monkeypatch.setenv("DEBUGGER_SESSION_MODE", "shadow")
+        monkeypatch.setattr(lambda_runtime, "forward_shadow_copy", Mock())
+        plldb_wrapper._original_handler.side_effect = ValueError("invalid order")
+        thread = start_extension(extensions_api)
+
+        extensions_api.add_invoke("request-1", deadline_in(5))
+        with pytest.raises(ValueError):
+            plldb_wrapper.handler({}, make_context("request-1"))
+        extensions_api.wait_for_next_calls(2)
+
+        assert lambda_runtime.forward_shadow_copy.call_args[0][5:7] == (None, "invalid order")
+
+        extensions_api.add_shutdown(deadline_in(2))
+        thread.join(5)
+
+    def test_invocation_is_not_held_past_deadline(self, extensions_api, session, monkeypatch):
+        monkeypatch.setenv("DEBUGGER_SESSION_MODE", "shadow")
+        thread = start_extension(extensions_api)
+
+        # The wrapper never reports the result
+        extensions_api.add_invoke("request-1", deadline_in(0.2))
+        extensions_api.wait_for_next_calls(2)
+
+        extensions_api.add_shutdown(deadline_in(2))
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+class TestWrapper:
+    def test_runs_original_handler_without_extension(self, session):
+        assert plldb_wrapper.handler({}, make_context()) == {"statusCode": 200, "body": "deployed"}
+
+    def test_unresolved_handler_fails_only_when_run(self, session, monkeypatch):
+        monkeypatch.setenv("DEBUGGER_ORIGINAL_HANDLER", "missing_module_for_test.handler")
+        plldb_wrapper.load_original_handler()
+
+        with pytest.raises(ModuleNotFoundError):
+            plldb_wrapper.handler({}, make_context())
+
+    def test_missing_handler_raises_runtime_error(self, session, monkeypatch):
+        monkeypatch.setenv("DEBUGGER_ORIGINAL_HANDLER", "")
+        plldb_wrapper.load_original_handler()
+
+        with pytest.raises(lambda_runtime.HandlerNotFoundError, match="No handler specified"):
+            plldb_wrapper.handler({}, make_context())
+
+    def test_context_round_trip(self, monkeypatch):
+        monkeypatch.setenv("_X_AMZN_TRACE_ID", "Root=1-abc")
+        context = make_context()
+        context.identity = SimpleNamespace(cognito_identity_id="identity-1", cognito_identity_pool_id="pool-1")
+        context.client_context = SimpleNamespace(client=SimpleNamespace(installation_id="install-1", app_title="app"), custom={"a": 1}, env={"b": 2})
+
+        restored = lambda_runtime.LambdaContext.from_dict(plldb_wrapper.context_to_dict(context))
+
+        assert restored.aws_request_id == "request-1"
+        assert restored.trace_id == "Root=1-abc"
+        assert restored.identity.cognito_identity_id == "identity-1"
+        assert restored.client_context.client.installation_id == "install-1"
+        assert restored.client_context.client.app_version_name is None
+        assert restored.client_context.custom == {"a": 1}
+        assert 4000 < restored.get_remaining_time_in_millis() <= 5000
@@ -1,16 +1,102 @@
+import base64
+import gzip
 import json
 import os
+import queue
+import random
 import sys
+import threading
 import time
-from unittest.mock import Mock, patch, MagicMock, mock_open
-from typing import Any, Dict
+import zlib
+from decimal import Decimal
+from unittest.mock import ANY, Mock, call, patch, MagicMock, mock_open
+from typing import Any, Dict, Optional
 
 import pytest
 import boto3
+from boto3.dynamodb.types import Binary
 from moto import mock_aws
 
 # Import the module under test
 from plldb.cloudformation.layer import lambda_runtime
+from benchmarks.fake_runtime_api import FakeRuntimeApi
+
+
+@pytest.fixture(autouse=True)
+def reset_session_cache(monkeypatch):
+    """Give every test a fresh sandbox: session cache, response channel and resolved handler."""
+    monkeypatch.setattr(lambda_runtime, "_session_cache", lambda_runtime.DebuggerSessionCache())
+    monkeypatch.setattr(lambda_runtime, "_handler", None)
+    monkeypatch.setattr(lambda_runtime, "_response_channel", None)
+    monkeypatch.setattr(lambda_runtime, "_response_channel_retry_at", 0.0)
+    monkeypatch.setattr(lambda_runtime, "_runtime_api_clients", {})
+    monkeypatch.setattr(lambda_runtime, "_published_environments", {})
+    monkeypatch.setattr(lambda_runtime, "_session_item_cache", lambda_runtime.SessionItemCache())
+    monkeypatch.setattr(lambda_runtime, "_circuit_breaker", lambda_runtime.DebuggerCircuitBreaker())
+    monkeypatch.setattr(lambda_runtime, "_prewarm_ms", None)
+    monkeypatch.setattr(lambda_runtime, "_shadow_forwarder", lambda_runtime.ShadowForwarder())
+    monkeypatch.setattr(lambda_runtime, "_before_snapshot_hooks", [])
+    monkeypatch.setattr(lambda_runtime, "_after_restore_hooks", [])
+
+
+@pytest.fixture
+def runtime_api():
+    api = FakeRuntimeApi()
+    yield api
+    api.shutdown()
+
+
+class StandInWebSocketApi:
+    """Local stand-in for the debugger WebSocket API as seen by a runtime connection."""
+
+    def __init__(self, acknowledge_registration: bool = True):
+        from websockets.sync.server import serve
+
+        self.acknowledge_registration = acknowledge_registration
+        self.outgoing: "queue.Queue[Any]" = queue.Queue()
+        self.received: list = []
+        self.request_paths: list = []
+        self._server = serve(self._handle, "127.0.0.1", 0, close_timeout=0.1)
+        self.port = self._server.socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.port}/prod"
+
+    def push(self, message: Optional[Dict[str, Any]]) -> None:
+        """Push a message to the runtime, None closes the connection."""
+        self.outgoing.put(message)
+
+    def _handle(self, websocket) -> None:
+        self.request_paths.append(websocket.request.path)
+        message = json.loads(websocket.recv())
+        self.received.append(message)
+        if message.get("action") == "registerRuntime" and self.acknowledge_registration:
+            websocket.send(json.dumps({"runtimeConnectionId": "runtime-connection-id"}))
+
+        while True:
+            outgoing = self.outgoing.get()
+            if outgoing is None:
+                websocket.close()
+                return
+            websocket.send(json.dumps(outgoing))
+
+    def shutdown(self) -> None:
+        self.outgoing.put(None)
+        self._server.shutdown()
+
+
+@pytest.fixture
+def websocket_api(monkeypatch):
+    api = StandInWebSocketApi()
+    monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", api.endpoint)
+    monkeypatch.setenv("DEBUGGER_RUNTIME_SECRET", "runtime-secret")
+    yield api
+    if lambda_runtime._response_channel is not None:
+        lambda_runtime._response_channel.close()
+    api.shutdown()
 
 
 class TestLambdaRuntimeUtilities:
@@ -28,88 +114,209 @@ class TestLambdaRuntimeUtilities:
         result = lambda_runtime.get_lambda_runtime_api()
         assert result == ""
 
-    @patch("urllib.request.urlopen")
-    def test_get_next_invocation_success(self, mock_urlopen):
+    def test_get_next_invocation_success(self, runtime_api):
         """Test successful retrieval of next invocation."""
-        # Mock response
-        mock_response = Mock()
-        mock_response.read.return_value = b'{"test": "event"}'
-        mock_response.headers = {"Lambda-Runtime-Aws-Request-Id": "test-request-id"}
-        mock_response.__enter__ = Mock(return_value=mock_response)
-        mock_response.__exit__ = Mock(return_value=None)
-        mock_urlopen.return_value = mock_response
+        runtime_api.add_invocation({"test": "event"}, "test-request-id")
 
-        event, request_id = lambda_runtime.get_next_invocation("127.0.0.1:9001")
+        event, context = lambda_runtime.get_next_invocation(runtime_api.address)
 
         assert event == {"test": "event"}
-        assert request_id == "test-request-id"
-        mock_urlopen.assert_called_once_with("http://127.0.0.1:9001/2018-06-01/runtime/invocation/next")
+        assert context.aws_request_id == "test-request-id"
+        assert runtime_api.requests[0][:2] == ("GET", "/2018-06-01/runtime/invocation/next")
 
-    @patch("urllib.request.urlopen")
-    def test_get_next_invocation_error(self, mock_urlopen):
+    def test_get_next_invocation_error(self):
         """Test error handling in get_next_invocation."""
-        mock_urlopen.side_effect = Exception("Connection error")
-
-        with pytest.raises(Exception, match="Connection error"):
-            lambda_runtime.get_next_invocation("127.0.0.1:9001")
+        with pytest.raises(Exception):
+            lambda_runtime.get_next_invocation("127.0.0.1:1")
 
-    @patch("urllib.request.urlopen")
-    def test_send_response_success(self, mock_urlopen):
+    def test_send_response_success(self, runtime_api):
         """Test successful response sending."""
-        mock_response = Mock()
-        mock_response.__enter__ = Mock(return_value=mock_response)
-        mock_response.__exit__ = Mock(return_value=None)
-        mock_urlopen.return_value = mock_response
-
-        lambda_runtime.send_response("127.0.0.1:9001", "test-request-id", {"result": "success"})
-
-        # Verify URL and data
-        args, kwargs = mock_urlopen.call_args
-        request = args[0]
-        assert request.get_full_url() == "http://127.0.0.1:9001/2018-06-01/runtime/invocation/test-request-id/response"
-        assert request.data == b'{"result": "success"}'
-        assert request.get_method() == "POST"
-
-    @patch("urllib.request.urlopen")
-    def test_send_response_error(self, mock_urlopen):
-        """Test error handling in send_response."""
-        mock_urlopen.side_effect = Exception("Network error")
+        lambda_runtime.send_response(runtime_api.address, "test-request-id", {"result": "success"})
 
-        with pytest.raises(Exception, match="Network error"):
-            lambda_runtime.send_response("127.0.0.1:9001", "test-request-id", {"result": "success"})
+        assert runtime_api.responses["test-request-id"] == b'{"result": "success"}'
+        method, path, headers = runtime_api.requests[0]
+        assert (method, path) == ("POST", "/2018-06-01/runtime/invocation/test-request-id/response")
+        assert headers["Content-Type"] == "application/json"
 
-    @patch("urllib.request.urlopen")
-    def test_send_error_success(self, mock_urlopen):
+    def test_send_response_bytes_are_passed_through(self, runtime_api):
+        """Test that a raw response body is sent without re-encoding."""
+        lambda_runtime.send_response(runtime_api.address, "test-request-id", b'{"raw": true}')
+
+        assert runtime_api.responses["test-request-id"] == b'{"raw": true}'
+
+    def test_send_response_error(self):
+        """Test error handling in send_response."""
+        with pytest.raises(Exception):
+            lambda_runtime.send_response("127.0.0.1:1", "test-request-id", {"result": "success"})
+
+    def test_send_error_success(self, runtime_api):
         """Test successful error response sending."""
-        mock_response = Mock()
-        mock_response.__enter__ = Mock(return_value=mock_response)
-        mock_response.__exit__ = Mock(return_value=None)
-        mock_urlopen.return_value = mock_response
-
-        lambda_runtime.send_error("127.0.0.1:9001", "test-request-id", "Test error", "TestException")
-
-        # Verify URL and data
-        args, kwargs = mock_urlopen.call_args
-        request = args[0]
-        assert request.get_full_url() == "http://127.0.0.1:9001/2018-06-01/runtime/invocation/test-request-id/error"
-        data = json.loads(request.data.decode())
+        lambda_runtime.send_error(runtime_api.address, "test-request-id", "Test error", "TestException")
+
+        data = runtime_api.errors["test-request-id"]
         assert data["errorMessage"] == "Test error"
         assert data["errorType"] == "TestException"
+        assert runtime_api.requests[0][2]["Lambda-Runtime-Function-Error-Type"] == "TestException"
 
-    @patch("urllib.request.urlopen")
-    def test_send_error_default_type(self, mock_urlopen):
+    def test_send_error_default_type(self, runtime_api):
         """Test error response with default error type."""
-        mock_response = Mock()
-        mock_response.__enter__ = Mock(return_value=mock_response)
-        mock_response.__exit__ = Mock(return_value=None)
-        mock_urlopen.return_value = mock_response
+        lambda_runtime.send_error(runtime_api.address, "test-request-id", "Test error")
+
+        assert runtime_api.errors["test-request-id"]["errorType"] == "Error"
+
+
+class TestRuntimeApiClient:
+    """Test the keep-alive Runtime API client."""
+
+    def test_connection_is_reused(self, runtime_api):
+        """Test that a whole invocation cycle runs over one connection."""
+        client = lambda_runtime.RuntimeApiClient(runtime_api.address)
+        for index in range(3):
+            runtime_api.add_invocation({"index": index}, f"request-{index}")
+            body, headers = client.next_invocation()
+            client.post_response(headers["Lambda-Runtime-Aws-Request-Id"], body)
+
+        assert runtime_api.connections == 1
+        assert runtime_api.responses == {f"request-{index}": json.dumps({"index": index}).encode() for index in range(3)}
+
+    def test_stale_connection_is_reopened(self, runtime_api):
+        """Test that a connection closed while idle is transparently replaced."""
+        client = lambda_runtime.RuntimeApiClient(runtime_api.address)
+        client.post_response("request-1", b"1")
+        client._connection.sock.close()
+
+        client.post_response("request-2", b"2")
+
+        assert runtime_api.responses == {"request-1": b"1", "request-2": b"2"}
+        assert runtime_api.connections == 2
+
+    def test_rejected_request_raises(self, runtime_api):
+        """Test that error statuses of the Runtime API are raised."""
+        client = lambda_runtime.RuntimeApiClient(runtime_api.address)
+        runtime_api.next_timeout = 0.01
+
+        with pytest.raises(lambda_runtime.RuntimeApiError, match="status 500"):
+            client.next_invocation()
+
+    def test_keep_alive_microbenchmark(self, runtime_api):
+        """Measure invocation round trips of the keep-alive client against per-request urllib connections."""
+        import urllib.request
+
+        rounds = 200
+        runtime_api.next_timeout = 1.0
+
+        def urllib_round(index: int) -> None:
+            with urllib.request.urlopen(f"http://{runtime_api.address}/2018-06-01/runtime/invocation/next") as response:
+                event = json.loads(response.read().decode())
+            request = urllib.request.Request(
+                f"http://{runtime_api.address}/2018-06-01/runtime/invocation/u-{index}/response", data=json.dumps(event).encode(), method="POST", headers={"Content-Type": "application/json"}
+            )
+            with urllib.request.urlopen(request):
+                pass
+
+        client = lambda_runtime.RuntimeApiClient(runtime_api.address)
+
+        def keep_alive_round(index: int) -> None:
+            body, _ = client.next_invocation()
+            client.post_response(f"k-{index}", body)
+
+        timings = {}
+        for name, round_trip in (("urllib", urllib_round), ("keep-alive", keep_alive_round)):
+            for index in range(rounds):
+                runtime_api.add_invocation({"index": index}, f"request-{index}")
+            connections_before = runtime_api.connections
+            start = time.perf_counter()
+            for index in range(rounds):
+                round_trip(index)
+            timings[name] = (time.perf_counter() - start) / rounds
+            print(f"{name}: {timings[name] * 1e6:.0f} us per invocation, {runtime_api.connections - connections_before} connections")
+
+        assert runtime_api.connections == 2 * rounds + 1
+        assert timings["keep-alive"] < timings["urllib"]
+
+
+class TestRawPayloads:
+    """Events and responses pass through the debug path without being decoded."""
+
+    # Key order and spacing no JSON round trip would keep
+    RAW_EVENT = b'{"b": [1,2],   "a": {"nested": true}}'
+
+    def test_next_invocation_keeps_event_undecoded(self, runtime_api):
+        runtime_api.add_invocation(self.RAW_EVENT, "request-1")
+
+        event, _ = lambda_runtime.get_next_invocation(runtime_api.address)
+
+        assert event.raw == self.RAW_EVENT
+        assert event._value is lambda_runtime.RawJson._UNDECODED
+        assert event == {"a": {"nested": True}, "b": [1, 2]}
+
+    def test_dumps_document_matches_json_dumps(self):
+        fields = {"event": {"key": ["value", 1]}, "context": {"aws_request_id": "request-1"}, "environmentVariables": None}
+
+        assert lambda_runtime.dumps_document(**fields) == json.dumps(fields).encode()
+        assert lambda_runtime.dumps_document(event=lambda_runtime.RawJson(self.RAW_EVENT), context={}) == b'{"event": ' + self.RAW_EVENT + b', "context": {}}'
+
+    def test_request_carries_raw_event(self, monkeypatch):
+        table = Mock()
+        monkeypatch.setattr(lambda_runtime, "get_debugger_table", Mock(return_value=table))
+        event = lambda_runtime.RawJson(self.RAW_EVENT)
+
+        lambda_runtime.create_debugger_request(Mock(), "request-1", "session-1", "connection-1", event, {"aws_request_id": "request-1"})
+        message = lambda_runtime.build_debugger_request_message("request-1", "session-1", "connection-1", event, None)
+
+        assert table.put_item.call_args[1]["Item"]["Request"] == '{"event": ' + self.RAW_EVENT.decode() + ', "context": {"aws_request_id": "request-1"}}'
+        assert message["event"] == self.RAW_EVENT.decode()
+        assert event._value is lambda_runtime.RawJson._UNDECODED
+
+    def test_request_carries_invoked_function_arn(self):
+        arn = "arn:aws:lambda:us-east-1:123456789012:function:test-function:live"
+
+        message = lambda_runtime.build_debugger_request_message("request-1", "session-1", "connection-1", {}, None, invoked_function_arn=arn)
+
+        assert message["invokedFunctionArn"] == arn
+        assert lambda_runtime.build_debugger_request_message("request-1", "session-1", "connection-1", {}, None)["invokedFunctionArn"] is None
+
+    def test_encoded_request_carries_raw_event(self):
+        event = lambda_runtime.RawJson(self.RAW_EVENT)
+
+        message = lambda_runtime.build_debugger_request_message("request-1", "session-1", "connection-1", event, None, encoding="zlib")
+
+        payload = zlib.decompress(base64.b64decode(message["payload"]))
+        assert payload.startswith(b'{"event": ' + self.RAW_EVENT + b', "environmentVariables": {')
 
-        lambda_runtime.send_error("127.0.0.1:9001", "test-request-id", "Test error")
+    def test_response_is_sent_as_received(self, runtime_api):
+        raw = '{"statusCode": 200,  "body": "ok"}'
 
-        args, kwargs = mock_urlopen.call_args
-        request = args[0]
-        data = json.loads(request.data.decode())
-        assert data["errorType"] == "Error"
+        response = lambda_runtime.read_response(Mock(), raw, None)
+        lambda_runtime.send_response(runtime_api.address, "request-1", response)
+
+        assert runtime_api.responses["request-1"] == raw.encode()
+        assert response._value is lambda_runtime.RawJson._UNDECODED
+
+    def test_empty_response_is_none(self, runtime_api):
+        assert lambda_runtime.read_response(Mock(), "", None) is None
+
+        lambda_runtime.send_response(runtime_api.address, "request-1", None)
+
+        assert runtime_api.responses["request-1"] == b"null"
+
+    def test_event_is_decoded_only_for_predicates(self, monkeypatch):
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "my-function")
+        event = lambda_runtime.RawJson(b'{"httpMethod": "POST"}')
+
+        assert lambda_runtime.matches_routing_rules({"functions": ["my-function"]}, event, "my-function")
+        assert event._value is lambda_runtime.RawJson._UNDECODED
+
+        assert lambda_runtime.matches_routing_rules({"predicates": [{"path": "$.httpMethod", "equals": "POST"}]}, event, "my-function")
+
+    def test_handler_gets_decoded_event(self, runtime_api, monkeypatch):
+        handler = Mock(return_value={"ok": True})
+        monkeypatch.setattr(lambda_runtime, "_handler", handler)
+
+        lambda_runtime.run_normal_handler(lambda_runtime.RawJson(self.RAW_EVENT), "request-1", runtime_api.address)
+
+        assert handler.call_args[0][0] == {"a": {"nested": True}, "b": [1, 2]}
+        assert type(handler.call_args[0][0]) is dict
 
 
 class TestAWSInteractions:
@@ -144,6 +351,100 @@ class TestAWSInteractions:
         credentials = session.get_credentials()
         assert credentials is not None
 
+    def test_assume_debugger_role_is_cached(self):
+        """Test that credentials are reused across invocations until they near expiration."""
+        from datetime import datetime, timedelta, timezone
+
+        mock_sts = Mock()
+        mock_sts.get_caller_identity.return_value = {"Account": "123456789012"}
+        mock_sts.assume_role.return_value = {
+            "Credentials": {"AccessKeyId": "AKIA", "SecretAccessKey": "secret", "SessionToken": "token", "Expiration": datetime.now(timezone.utc) + timedelta(hours=1)}
+        }
+
+        with patch("boto3.client", return_value=mock_sts):
+            first = lambda_runtime.assume_debugger_role()
+            second = lambda_runtime.assume_debugger_role()
+
+        assert first is second
+        mock_sts.get_caller_identity.assert_called_once()
+        mock_sts.assume_role.assert_called_once()
+        assert mock_sts.assume_role.call_args[1]["RoleArn"] == "arn:aws:iam::123456789012:role/PLLDBDebuggerRole"
+
+    def test_assume_debugger_role_refreshes_before_expiration(self):
+        """Test that credentials close to expiration are refreshed but the account ID is not resolved again."""
+        from datetime import datetime, timedelta, timezone
+
+        mock_sts = Mock()
+        mock_sts.get_caller_identity.return_value = {"Account": "123456789012"}
+        mock_sts.assume_role.return_value = {
+            "Credentials": {"AccessKeyId": "AKIA", "SecretAccessKey": "secret", "SessionToken": "token", "Expiration": datetime.now(timezone.utc) + timedelta(seconds=60)}
+        }
+
+        with patch("boto3.client", return_value=mock_sts):
+            first = lambda_runtime.assume_debugger_role()
+            second = lambda_runtime.assume_debugger_role()
+
+        assert first is not second
+        assert mock_sts.assume_role.call_count == 2
+        mock_sts.get_caller_identity.assert_called_once()
+
+    def test_unknown_account_does_not_assume_role(self):
+        """Test that the role is not assumed with an ARN lacking the account ID."""
+        mock_sts = Mock()
+        mock_sts.get_caller_identity.return_value = {}
+
+        with patch("boto3.client", return_value=mock_sts):
+            with pytest.raises(RuntimeError, match="account ID"):
+                lambda_runtime.assume_debugger_role()
+
+        mock_sts.assume_role.assert_not_called()
+
+    def test_direct_access_does_not_call_sts(self, monkeypatch):
+        """Test that direct access uses the credentials of the execution role without assuming the role."""
+        monkeypatch.setenv("DEBUGGER_ACCESS", "direct")
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "AKIAEXECUTIONROLE")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+        monkeypatch.setenv("AWS_SESSION_TOKEN", "token")
+
+        with patch("boto3.client") as mock_client:
+            first = lambda_runtime.assume_debugger_role()
+            second = lambda_runtime.assume_debugger_role()
+
+        assert first is second
+        assert first.get_credentials().access_key == "AKIAEXECUTIONROLE"
+        mock_client.assert_not_called()
+
+        monkeypatch.setenv("DEBUGGER_AWS_BACKEND", "builtin")
+        lambda_runtime._session_cache.invalidate()
+        session = lambda_runtime.assume_debugger_role()
+
+        assert isinstance(session, lambda_runtime.BuiltinSession)
+        assert session.credentials.access_key == "AKIAEXECUTIONROLE"
+        assert lambda_runtime._session_cache._sts_client is None
+
+    def test_clients_are_reused_per_session(self):
+        """Test that the DynamoDB table and API Gateway client are built once per session."""
+        mock_session = Mock(spec=boto3.Session)
+
+        assert lambda_runtime.get_debugger_table(mock_session) is lambda_runtime.get_debugger_table(mock_session)
+        mock_session.resource.assert_called_once_with("dynamodb")
+
+        endpoint = "https://test.execute-api.us-east-1.amazonaws.com/prod"
+        assert lambda_runtime.get_apigateway_client(mock_session, endpoint) is lambda_runtime.get_apigateway_client(mock_session, endpoint)
+        mock_session.client.assert_called_once_with("apigatewaymanagementapi", endpoint_url=endpoint)
+
+    def test_sessions_share_service_models(self, monkeypatch):
+        """Test that refreshed sessions reuse the service models loaded by the previous ones."""
+        monkeypatch.setattr(lambda_runtime, "_botocore_loader", None)
+
+        first = lambda_runtime.create_aws_session("AKIA1", "secret", "token")
+        second = lambda_runtime.create_aws_session("AKIA2", "secret", "token")
+
+        loader = first._session.get_component("data_loader")
+        assert second._session.get_component("data_loader") is loader
+        assert len(loader.search_paths) == len(set(loader.search_paths))
+        assert second.get_credentials().access_key == "AKIA2"
+
     @mock_aws
     def test_create_debugger_request_success(self, mock_aws_session, monkeypatch):
         """Test successful creation of debugger request in DynamoDB."""
@@ -200,6 +501,1183 @@ class TestAWSInteractions:
                 {},
             )
 
+    @mock_aws
+    def test_create_debugger_request_keeps_early_response(self, mock_aws_session):
+        """Test that a response stored before the request item is not overwritten."""
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBDebugger",
+            KeySchema=[{"AttributeName": "RequestId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "RequestId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        table = dynamodb.Table("PLLDBDebugger")
+        table.put_item(Item={"RequestId": "early-request-id", "Response": "done", "StatusCode": 200})
+
+        assert lambda_runtime.create_debugger_request(mock_aws_session, "early-request-id", "test-session-id", "test-connection-id", {}, {}) is False
+        assert lambda_runtime.create_debugger_request(mock_aws_session, "retried-request-id", "test-session-id", "test-connection-id", {}, {}) is True
+        table.update_item(Key={"RequestId": "retried-request-id"}, UpdateExpression="SET StatusCode = :status", ExpressionAttributeValues={":status": 200})
+        assert lambda_runtime.create_debugger_request(mock_aws_session, "retried-request-id", "test-session-id", "test-connection-id", {}, {}) is True
+
+        assert table.get_item(Key={"RequestId": "early-request-id"})["Item"]["StatusCode"] == 200
+        assert table.get_item(Key={"RequestId": "retried-request-id"})["Item"]["StatusCode"] == 0
+
+    def test_dispatch_debugger_request_runs_calls_concurrently(self, monkeypatch):
+        """Test that the request write and the notification are in flight at the same time."""
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "https://test.execute-api.us-east-1.amazonaws.com/prod")
+        both_in_flight = threading.Barrier(2, timeout=2)
+
+        lambda_runtime.dispatch_debugger_request(Mock(), both_in_flight.wait, both_in_flight.wait)
+
+    def test_dispatch_debugger_request_raises_after_all_calls(self):
+        """Test that a failed call is raised once the other call has been acknowledged."""
+        acknowledged = []
+
+        def write():
+            raise RuntimeError("write failed")
+
+        def notify():
+            time.sleep(0.05)
+            acknowledged.append(True)
+
+        with pytest.raises(RuntimeError, match="write failed"):
+            lambda_runtime.dispatch_debugger_request(Mock(), write, notify)
+        assert acknowledged == [True]
+
+
+class TestPayloadOffload:
+    """Test offloading of payloads too large for DynamoDB and WebSocket frames to S3."""
+
+    BUCKET = "plldb-core-infrastructure-us-east-1-123456789012"
+
+    @pytest.fixture
+    def payload_bucket(self, mock_aws_session, monkeypatch):
+        mock_aws_session.client("s3").create_bucket(Bucket=self.BUCKET)
+        monkeypatch.setenv("DEBUGGER_PAYLOAD_BUCKET", self.BUCKET)
+        return mock_aws_session
+
+    @mock_aws
+    def test_small_payload_stays_inline(self, payload_bucket):
+        """Test that payloads below the threshold are not offloaded."""
+        assert lambda_runtime.offload_request_payload(payload_bucket, "session", "request-1", {"small": True}, {}) is None
+
+    @mock_aws
+    def test_large_payload_is_offloaded(self, payload_bucket):
+        """Test that a large event is written to S3 and only referenced by the DynamoDB item."""
+        dynamodb = payload_bucket.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBDebugger",
+            KeySchema=[{"AttributeName": "RequestId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "RequestId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        event = {"records": ["x" * 1024] * 200}
+
+        location = lambda_runtime.offload_request_payload(payload_bucket, "session", "request-1", event, {"aws_request_id": "request-1"})
+        lambda_runtime.create_debugger_request(payload_bucket, "request-1", "session", "connection", event, {"aws_request_id": "request-1"}, payload_location=location)
+
+        assert location == f"s3://{self.BUCKET}/payloads/session/request-1/request.json"
+        payload = json.loads(lambda_runtime.read_payload(payload_bucket, location))
+        assert payload["event"] == event
+        assert payload["context"] == {"aws_request_id": "request-1"}
+        assert payload["environmentVariables"]["DEBUGGER_PAYLOAD_BUCKET"] == self.BUCKET
+
+        item = dynamodb.Table("PLLDBDebugger").get_item(Key={"RequestId": "request-1"})["Item"]
+        assert item["PayloadLocation"] == location
+        assert "Request" not in item
+        assert "EnvironmentVariables" not in item
+
+    @mock_aws
+    def test_escaped_payload_under_threshold_is_offloaded(self, payload_bucket):
+        """Test that the escaped event in the notification decides, not the size of the payload itself."""
+        # The quotes of the strings are escaped when the event is embedded as a JSON string
+        event = {"records": [""] * (lambda_runtime.PAYLOAD_OFFLOAD_THRESHOLD_BYTES // 5)}
+        payload = lambda_runtime.dumps_document(event=event, context={}, **lambda_runtime.environment_message_fields(None))
+        assert len(payload) < lambda_runtime.PAYLOAD_OFFLOAD_THRESHOLD_BYTES
+        inline = json.dumps(lambda_runtime.build_debugger_request_message("request-1", "session", "", event, None))
+        size = lambda_runtime.debugger_request_message_size("request-1", "session", event, payload, None, None)
+        assert len(inline) <= size < len(inline) + 64
+
+        location = lambda_runtime.offload_request_payload(payload_bucket, "session", "request-1", event, {})
+
+        assert location == f"s3://{self.BUCKET}/payloads/session/request-1/request.json"
+        message = lambda_runtime.build_debugger_request_message("request-1", "session", "connection", event, None, location)
+        assert len(json.dumps(message)) < lambda_runtime.PAYLOAD_OFFLOAD_THRESHOLD_BYTES
+
+    def test_large_payload_without_bucket_stays_inline(self, monkeypatch):
+        """Test that offloading is skipped when no payload bucket is configured."""
+        monkeypatch.delenv("DEBUGGER_PAYLOAD_BUCKET", raising=False)
+
+        assert lambda_runtime.offload_request_payload(Mock(), "session", "request-1", {"records": ["x" * 1024] * 200}, {}) is None
+
+    @mock_aws
+    def test_poll_for_response_reads_offloaded_response(self, payload_bucket):
+        """Test that a response stored in S3 by the debugger is read from its location."""
+        location = f"s3://{self.BUCKET}/payloads/session/request-1/response.json"
+        payload_bucket.client("s3").put_object(Bucket=self.BUCKET, Key="payloads/session/request-1/response.json", Body=json.dumps({"big": "y" * 1000}).encode())
+        mock_table = Mock()
+        mock_table.get_item.side_effect = [{"Item": {"StatusCode": 200}}, {"Item": {"StatusCode": 200, "Response": "", "ResponseLocation": location}}]
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            response, error = lambda_runtime.poll_for_response(payload_bucket, "request-1", timeout=5)
+
+        assert error is None
+        assert response == {"big": "y" * 1000}
+
+
+class TestEnvironmentSnapshot:
+    """Test that the environment is published once per sandbox and referenced by hash."""
+
+    @pytest.fixture
+    def debugger_table(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBDebugger",
+            KeySchema=[{"AttributeName": "RequestId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "RequestId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        return dynamodb.Table("PLLDBDebugger")
+
+    def test_volatile_variables_are_kept_out_of_the_hash(self):
+        """Test that the trace header travels as a delta and does not change the hash."""
+        first = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders", "_X_AMZN_TRACE_ID": "Root=1-a"})
+        second = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders", "_X_AMZN_TRACE_ID": "Root=1-b"})
+
+        assert first.digest == second.digest
+        assert first.variables == {"TABLE_NAME": "orders"}
+        assert second.delta == {"_X_AMZN_TRACE_ID": "Root=1-b"}
+        assert lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "payments"}).digest != first.digest
+
+    def test_credentials_are_kept_out_of_the_hash(self):
+        """Test that rotated credentials travel as a delta and do not change the hash."""
+        first = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders", "AWS_ACCESS_KEY_ID": "AKIA1", "AWS_SECRET_ACCESS_KEY": "secret-1", "AWS_SESSION_TOKEN": "token-1"})
+        second = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders", "AWS_ACCESS_KEY_ID": "AKIA2", "AWS_SECRET_ACCESS_KEY": "secret-2", "AWS_SESSION_TOKEN": "token-2"})
+
+        assert first.digest == second.digest
+        assert second.variables == {"TABLE_NAME": "orders"}
+        assert second.delta == {"AWS_ACCESS_KEY_ID": "AKIA2", "AWS_SECRET_ACCESS_KEY": "secret-2", "AWS_SESSION_TOKEN": "token-2"}
+
+    @mock_aws
+    def test_published_once_per_session(self, mock_aws_session, debugger_table):
+        """Test that only the first request of a sandbox carries the variables."""
+        first = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders"})
+        lambda_runtime.publish_environment(mock_aws_session, "session", first)
+        second = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders"})
+        lambda_runtime.publish_environment(mock_aws_session, "session", second)
+
+        item = debugger_table.get_item(Key={"RequestId": f"environment#{first.digest}"})["Item"]
+        assert item["EnvironmentVariables"] == {"TABLE_NAME": "orders"}
+        assert item["SessionId"] == "session"
+        assert int(time.time()) < item["TTL"] <= int(time.time()) + lambda_runtime.ENVIRONMENT_SNAPSHOT_TTL_SECONDS
+        assert first.inline and not second.inline
+
+        first_message = lambda_runtime.build_debugger_request_message("request-1", "session", "connection", {}, None, environment=first)
+        second_message = lambda_runtime.build_debugger_request_message("request-2", "session", "connection", {}, None, environment=second)
+        assert first_message["environmentVariables"] == {"TABLE_NAME": "orders"}
+        assert second_message["environmentVariables"] is None
+        assert second_message["environmentHash"] == first.digest
+
+    @mock_aws
+    def test_snapshot_published_by_another_sandbox(self, mock_aws_session, debugger_table):
+        """Test that a sandbox with the same environment does not fail on the existing snapshot."""
+        environment = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders"})
+        lambda_runtime.publish_environment(mock_aws_session, "session", environment)
+        lambda_runtime._published_environments.clear()
+
+        other = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders"})
+        lambda_runtime.publish_environment(mock_aws_session, "session", other)
+
+        # The debugger reads the snapshot published by the other sandbox
+        assert not other.inline
+
+    @mock_aws
+    def test_request_item_references_snapshot(self, mock_aws_session, debugger_table):
+        """Test that the request item stores the hash and delta instead of the variables."""
+        environment = lambda_runtime.EnvironmentSnapshot({"TABLE_NAME": "orders", "_X_AMZN_TRACE_ID": "Root=1-a"})
+
+        lambda_runtime.create_debugger_request(mock_aws_session, "request-1", "session", "connection", {}, {}, environment=environment)
+
+        item = debugger_table.get_item(Key={"RequestId": "request-1"})["Item"]
+        assert item["EnvironmentHash"] == environment.digest
+        assert item["EnvironmentDelta"] == {"_X_AMZN_TRACE_ID": "Root=1-a"}
+        assert "EnvironmentVariables" not in item
+
+
+def api_gateway_event(items: int = 50) -> Dict[str, Any]:
+    """A REST API proxy event as delivered by API Gateway, with a JSON body of the given number of items."""
+    headers = {
+        "Accept": "application/json, text/plain, */*",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Accept-Language": "en-US,en;q=0.9",
+        "Authorization": "Bearer " + "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpXVCJ9." + "a" * 600,
+        "CloudFront-Forwarded-Proto": "https",
+        "CloudFront-Is-Desktop-Viewer": "true",
+        "CloudFront-Viewer-Country": "US",
+        "Content-Type": "application/json",
+        "Host": "abcdef1234.execute-api.us-east-1.amazonaws.com",
+        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+        "Via": "2.0 5f2c3a1b0e4d6f7a8b9c0d1e2f3a4b5c.cloudfront.net (CloudFront)",
+        "X-Amz-Cf-Id": "kXm2Yx7bW0M7v8Q1zv0Yt4c5Jm0F6s8pL3q9R2w1E4t5Y6u7I8o9PA==",
+        "X-Amzn-Trace-Id": "Root=1-65a1b2c3-0123456789abcdef01234567",
+        "X-Forwarded-For": "203.0.113.10, 198.51.100.20",
+        "X-Forwarded-Port": "443",
+        "X-Forwarded-Proto": "https",
+    }
+    body = {
+        "orderId": "ord-000123",
+        "items": [{"sku": f"SKU-{index:05d}", "name": f"Product {index}", "quantity": index % 5 + 1, "price": {"amount": 1999 + index, "currency": "USD"}} for index in range(items)],
+    }
+    return {
+        "resource": "/orders/{orderId}",
+        "path": "/orders/ord-000123",
+        "httpMethod": "POST",
+        "headers": headers,
+        "multiValueHeaders": {name: [value] for name, value in headers.items()},
+        "queryStringParameters": {"expand": "items"},
+        "multiValueQueryStringParameters": {"expand": ["items"]},
+        "pathParameters": {"orderId": "ord-000123"},
+        "stageVariables": None,
+        "requestContext": {
+            "resourceId": "abc123",
+            "resourcePath": "/orders/{orderId}",
+            "httpMethod": "POST",
+            "extendedRequestId": "RkQ1aFz5IAMFb7g=",
+            "requestTime": "10/Mar/2024:12:00:00 +0000",
+            "path": "/prod/orders/ord-000123",
+            "accountId": "123456789012",
+            "protocol": "HTTP/1.1",
+            "stage": "prod",
+            "domainName": "abcdef1234.execute-api.us-east-1.amazonaws.com",
+            "requestId": "c6af9ac6-7b61-11e6-9a41-93e8deadbeef",
+            "identity": {"sourceIp": "203.0.113.10", "userAgent": headers["User-Agent"], "accountId": None, "caller": None, "user": None},
+            "authorizer": {"claims": {"sub": "5a6b7c8d-1234-5678-9abc-def012345678", "email": "user@example.com", "scope": "orders/write"}},
+            "apiId": "abcdef1234",
+        },
+        "body": json.dumps(body),
+        "isBase64Encoded": False,
+    }
+
+
+def lambda_environment() -> Dict[str, str]:
+    """Environment variables of an instrumented function, as forwarded to the debugger."""
+    environment = {
+        "AWS_LAMBDA_FUNCTION_NAME": "orders-api-CreateOrderFunction-AbCdEf123456",
+        "AWS_LAMBDA_FUNCTION_VERSION": "$LATEST",
+        "AWS_LAMBDA_FUNCTION_MEMORY_SIZE": "512",
+        "AWS_LAMBDA_LOG_GROUP_NAME": "/aws/lambda/orders-api-CreateOrderFunction-AbCdEf123456",
+        "AWS_LAMBDA_LOG_STREAM_NAME": "2024/03/10/[$LATEST]0123456789abcdef0123456789abcdef",
+        "AWS_REGION": "us-east-1",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_EXECUTION_ENV": "AWS_Lambda_python3.13",
+        "AWS_LAMBDA_RUNTIME_API": "127.0.0.1:9001",
+        "AWS_ACCESS_KEY_ID": "ASIAEXAMPLEEXAMPLE00",
+        "AWS_SECRET_ACCESS_KEY": "wJalrXUtnFEMI/K7MDENG/bPxRfiCYEXAMPLEKEY",
+        "AWS_SESSION_TOKEN": "IQoJb3JpZ2luX2VjE" + "Q" * 1100,
+        "LAMBDA_TASK_ROOT": "/var/task",
+        "LAMBDA_RUNTIME_DIR": "/var/runtime",
+        "PATH": "/var/lang/bin:/usr/local/bin:/usr/bin/:/bin:/opt/bin",
+        "LD_LIBRARY_PATH": "/var/lang/lib:/lib64:/usr/lib64:/var/runtime:/var/runtime/lib:/var/task:/var/task/lib:/opt/lib",
+        "PYTHONPATH": "/var/runtime",
+        "TZ": ":UTC",
+        "_HANDLER": "app.lambda_handler",
+        "TABLE_NAME": "orders-api-OrdersTable-1A2B3C4D5E6F",
+        "DEBUGGER_SESSION_ID": "5f0c6f8e-0d1f-4b7c-9a53-2f1f0f7c9d11",
+        "DEBUGGER_CONNECTION_ID": "Rk1aFz5IAMFb7g=",
+        "DEBUGGER_COMPRESSION": "zlib",
+    }
+    return environment
+
+
+class TestPayloadEncoding:
+    """Test the compressed payload encoding negotiated per session."""
+
+    @pytest.fixture
+    def environment(self, monkeypatch):
+        for name, value in lambda_environment().items():
+            monkeypatch.setenv(name, value)
+
+    def test_encoding_is_read_from_environment(self, monkeypatch):
+        """Test that only supported encodings are used."""
+        monkeypatch.setenv("DEBUGGER_COMPRESSION", "zlib")
+        assert lambda_runtime.get_payload_encoding() == "zlib"
+        monkeypatch.setenv("DEBUGGER_COMPRESSION", "brotli")
+        assert lambda_runtime.get_payload_encoding() is None
+        monkeypatch.delenv("DEBUGGER_COMPRESSION")
+        assert lambda_runtime.get_payload_encoding() is None
+
+    @mock_aws
+    def test_encoded_request_is_stored_as_binary(self, mock_aws_session, environment):
+        """Test that the request and environment are stored compressed in the PLLDBDebugger table."""
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBDebugger",
+            KeySchema=[{"AttributeName": "RequestId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "RequestId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        event = api_gateway_event()
+
+        lambda_runtime.create_debugger_request(mock_aws_session, "request-1", "session", "connection", event, {"aws_request_id": "request-1"}, encoding="zlib")
+
+        item = dynamodb.Table("PLLDBDebugger").get_item(Key={"RequestId": "request-1"})["Item"]
+        assert item["Encoding"] == "zlib"
+        assert json.loads(zlib.decompress(bytes(item["Request"])))["event"] == event
+        assert json.loads(zlib.decompress(bytes(item["EnvironmentVariables"])))["TABLE_NAME"] == "orders-api-OrdersTable-1A2B3C4D5E6F"
+
+    def test_round_trip_through_debugger_and_websocket_default(self, environment):
+        """Test that runtime, debugger and websocket_default agree on the encoding."""
+        from dataclasses import asdict
+
+        from plldb.cloudformation.lambda_functions import websocket_default
+        from plldb.debugger import Debugger
+
+        event = api_gateway_event()
+        result = {"statusCode": 201, "body": json.dumps({"orderId": "ord-000123", "items": 50})}
+        message = lambda_runtime.build_debugger_request_message("request-1", "session", "connection", event, None, encoding="zlib")
+        assert message["event"] == "" and message["environmentVariables"] is None
+
+        with patch.object(Debugger, "_inspect_stack"):
+            debugger = Debugger(session=Mock(), stack_name="orders-api")
+        debugger._lambda_functions_lookup = {os.environ["AWS_LAMBDA_FUNCTION_NAME"]: "CreateOrderFunction"}
+        debugger._executor = Mock()
+        debugger._executor.invoke_lambda_function.return_value = result
+
+        response = debugger.handle_message(message)
+
+        kwargs = debugger._executor.invoke_lambda_function.call_args[1]
+        assert kwargs["event"] == event
+        assert kwargs["environment"]["TABLE_NAME"] == "orders-api-OrdersTable-1A2B3C4D5E6F"
+        assert response.encoding == "zlib"
+
+        with patch.object(websocket_default, "boto3") as mock_boto3:
+            mock_table = mock_boto3.resource.return_value.Table.return_value
+            mock_table.update_item.return_value = {"Attributes": {}}
+            assert websocket_default.handle_debugger_response(asdict(response), "session-1")["statusCode"] == 200
+        stored = mock_table.update_item.call_args[1]["ExpressionAttributeValues"]
+        assert stored[":encoding"] == "zlib"
+
+        # Pushed over the WebSocket as base64, polled from DynamoDB as Binary
+        assert lambda_runtime.read_response(Mock(), response.response, None, "zlib") == result
+        assert lambda_runtime.read_response(Mock(), Binary(stored[":resp"]), None, "zlib") == result
+
+    def test_encoding_benchmark_on_api_gateway_events(self, environment):
+        """Measure size and encoding time of debugger requests for API Gateway events of increasing size."""
+        rounds = 50
+        for items in (1, 50, 500):
+            event = api_gateway_event(items)
+            plain = json.dumps(lambda_runtime.build_debugger_request_message("request-1", "session", "connection", event, None)).encode()
+            start = time.perf_counter()
+            for _ in range(rounds):
+                encoded = json.dumps(lambda_runtime.build_debugger_request_message("request-1", "session", "connection", event, None, encoding="zlib")).encode()
+            encode_ms = (time.perf_counter() - start) / rounds * 1000
+            payload = base64.b64decode(json.loads(encoded)["payload"])
+            start = time.perf_counter()
+            for _ in range(rounds):
+                lambda_runtime.decode_payload(payload, "zlib")
+            decode_ms = (time.perf_counter() - start) / rounds * 1000
+            print(f"items={items}: plain={len(plain)} B zlib={len(encoded)} B ({len(encoded) / len(plain):.0%}) encode={encode_ms:.2f} ms decode={decode_ms:.2f} ms")
+
+            assert len(encoded) < len(plain) * 0.6
+            assert encode_ms < 20
+
+
+class TestRoutingRules:
+    """Test selecting the invocations forwarded to the debugger."""
+
+    @pytest.fixture
+    def sessions_table(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        return dynamodb.Table("PLLDBSessions")
+
+    def test_resolve_event_path(self):
+        """Test dotted, indexed and quoted path segments."""
+        event = {"requestContext": {"http": {"method": "POST"}}, "Records": [{"event-name": "INSERT"}]}
+
+        assert lambda_runtime.resolve_event_path(event, "$.requestContext.http.method") == (True, "POST")
+        assert lambda_runtime.resolve_event_path(event, "$.Records[0]['event-name']") == (True, "INSERT")
+        assert lambda_runtime.resolve_event_path(event, "$.Records[1]") == (False, None)
+        assert lambda_runtime.resolve_event_path(event, "$.headers.host") == (False, None)
+        assert lambda_runtime.resolve_event_path(event, "$") == (True, event)
+        with pytest.raises(ValueError):
+            lambda_runtime.resolve_event_path(event, "requestContext.http")
+
+    def test_matches_routing_rules(self):
+        """Test the function allow list and the event predicates."""
+        event = {"httpMethod": "POST", "path": "/orders"}
+        rules = {"functions": ["orders-create"], "predicates": [{"path": "$.httpMethod", "equals": "POST"}, {"path": "$.path"}]}
+
+        assert lambda_runtime.matches_routing_rules(rules, event, "orders-create")
+        assert not lambda_runtime.matches_routing_rules(rules, event, "orders-list")
+        assert not lambda_runtime.matches_routing_rules(rules, {"httpMethod": "GET", "path": "/orders"}, "orders-create")
+        assert not lambda_runtime.matches_routing_rules(rules, {"httpMethod": "POST"}, "orders-create")
+        assert lambda_runtime.matches_routing_rules({}, event, "orders-list")
+
+    def test_sample_rate(self):
+        """Test that the sampling percentage selects a matching share of invocations."""
+        random.seed(7)
+        forwarded = sum(lambda_runtime.matches_routing_rules({"sampleRate": Decimal("25")}, {}, "f") for _ in range(2000))
+
+        assert 400 < forwarded < 600
+        assert not lambda_runtime.matches_routing_rules({"sampleRate": 0}, {}, "f")
+        assert lambda_runtime.matches_routing_rules({"sampleRate": 100}, {}, "f")
+
+    @mock_aws
+    def test_rules_are_cached_until_ttl(self, mock_aws_session, sessions_table, monkeypatch):
+        """Test that rules updated on the session item apply once the TTL has passed."""
+        sessions_table.put_item(Item={"SessionId": "session", "RoutingRules": {"functions": ["orders-create"]}})
+        cache = lambda_runtime.SessionItemCache(ttl=10)
+        now = time.time()
+        monkeypatch.setattr(lambda_runtime.time, "time", lambda: now)
+
+        assert cache.get_rules(mock_aws_session, "session") == {"functions": ["orders-create"]}
+        sessions_table.put_item(Item={"SessionId": "session"})
+        assert cache.get_rules(mock_aws_session, "session") == {"functions": ["orders-create"]}
+
+        now += 11
+        assert cache.get_rules(mock_aws_session, "session") is None
+
+    @mock_aws
+    def test_decimal_rules_match_event_numbers(self, mock_aws_session, sessions_table):
+        """Test that numbers of rules read from DynamoDB compare equal to the numbers of the event."""
+        rules = {"predicates": [{"path": "$.ratio", "equals": Decimal("0.1")}, {"path": "$.count", "equals": Decimal("3")}], "sampleRate": Decimal("100")}
+        sessions_table.put_item(Item={"SessionId": "session", "RoutingRules": rules})
+
+        loaded = lambda_runtime.SessionItemCache().get_rules(mock_aws_session, "session")
+
+        assert loaded == {"predicates": [{"path": "$.ratio", "equals": 0.1}, {"path": "$.count", "equals": 3}], "sampleRate": 100}
+        assert type(loaded["predicates"][0]["equals"]) is float and type(loaded["sampleRate"]) is int
+        assert lambda_runtime.matches_routing_rules(loaded, json.loads('{"ratio": 0.1, "count": 3}'), "f")
+        assert not lambda_runtime.matches_routing_rules(loaded, {"ratio": 0.2, "count": 3}, "f")
+
+    def test_rules_read_failure_keeps_last_rules(self):
+        """Test that the last known rules keep applying when the session item cannot be read."""
+        session = Mock()
+        table = session.resource.return_value.Table.return_value
+        table.get_item.side_effect = [{"Item": {"RoutingRules": {"sampleRate": 10}}}, Exception("ThrottlingException")]
+        cache = lambda_runtime.SessionItemCache(ttl=0)
+
+        assert cache.get_rules(session, "session") == {"sampleRate": 10}
+        assert cache.get_rules(session, "session") == {"sampleRate": 10}
+
+    def test_invalid_rules_forward_the_invocation(self, monkeypatch):
+        """Test that rules which cannot be evaluated do not hide invocations from the debugger."""
+        monkeypatch.setattr(lambda_runtime._session_item_cache, "get_rules", Mock(return_value={"predicates": [{"path": "no-dollar"}]}))
+
+        assert lambda_runtime.should_forward_invocation(Mock(), "session", {})
+
+
+class TestCircuitBreaker:
+    """Test skipping the debugger while it is unreachable."""
+
+    def test_breaker_probes_after_interval(self, monkeypatch):
+        """Test that an open breaker lets one invocation through per probe interval."""
+        now = 1000.0
+        monkeypatch.setattr(lambda_runtime.time, "time", lambda: now)
+        breaker = lambda_runtime.DebuggerCircuitBreaker(probe_interval=30)
+        assert breaker.allow() and not breaker.is_open
+
+        breaker.trip("connection is gone")
+        assert breaker.is_open and not breaker.allow()
+
+        now += 31
+        assert breaker.allow()
+        breaker.reset()
+        assert not breaker.is_open
+
+    @pytest.mark.parametrize("status, available", [("ACTIVE", True), (None, True), ("DISCONNECTED", False), ("PENDING", False)])
+    def test_debugger_available_checks_session_status(self, status, available, monkeypatch):
+        """Test that a session which is not active opens the breaker."""
+        monkeypatch.setattr(lambda_runtime._session_item_cache, "get_status", Mock(return_value=status))
+
+        assert lambda_runtime.debugger_available(Mock(), "session") is available
+        assert lambda_runtime._circuit_breaker.is_open is not available
+
+    def test_debugger_available_skips_lookup_while_open(self, monkeypatch):
+        """Test that an open breaker does not read the session item."""
+        get_status = Mock(return_value="ACTIVE")
+        monkeypatch.setattr(lambda_runtime._session_item_cache, "get_status", get_status)
+        lambda_runtime._circuit_breaker.trip("connection is gone")
+
+        assert not lambda_runtime.debugger_available(Mock(), "session")
+        get_status.assert_not_called()
+
+    @mock_aws
+    def test_session_status_is_read_from_session_item(self, mock_aws_session):
+        """Test that the status shares the cached read of the session item with the routing rules."""
+        dynamodb = mock_aws_session.resource("dynamodb")
+        table = dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        table.put_item(Item={"SessionId": "session", "Status": "DISCONNECTED", "RoutingRules": {"sampleRate": 10}})
+        cache = lambda_runtime.SessionItemCache()
+
+        assert cache.get_status(mock_aws_session, "session") == "DISCONNECTED"
+        assert cache.get_rules(mock_aws_session, "session") == {"sampleRate": 10}
+
+    def test_send_debugger_request_gone_opens_breaker(self, monkeypatch):
+        """Test that a gone debugger connection is raised and opens the breaker."""
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "https://test.execute-api.us-east-1.amazonaws.com/prod")
+        error = Exception("An error occurred (GoneException) when calling the PostToConnection operation")
+        error.response = {"Error": {"Code": "GoneException"}}
+        session = Mock()
+        session.client.return_value.post_to_connection.side_effect = error
+
+        with pytest.raises(lambda_runtime.DebuggerConnectionGone):
+            lambda_runtime.send_debugger_request(session, "test-connection-id", {"test": "data"})
+
+        assert lambda_runtime._circuit_breaker.is_open
+
+    def test_send_debugger_request_too_large_is_raised(self, monkeypatch):
+        """Test that a notification rejected as too large fails instead of leaving the invocation waiting."""
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "https://test.execute-api.us-east-1.amazonaws.com/prod")
+        error = Exception("An error occurred (PayloadTooLargeException) when calling the PostToConnection operation")
+        error.response = {"Error": {"Code": "PayloadTooLargeException"}}
+        session = Mock()
+        session.client.return_value.post_to_connection.side_effect = error
+
+        with pytest.raises(lambda_runtime.DebuggerPayloadTooLarge):
+            lambda_runtime.send_debugger_request(session, "test-connection-id", {"test": "data"})
+
+        assert not lambda_runtime._circuit_breaker.is_open
+
+
+class TestPrewarm:
+    """Test opening the connections of the debug path during init."""
+
+    @pytest.fixture
+    def debugger_session(self, monkeypatch):
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "https://test.execute-api.us-east-1.amazonaws.com/prod")
+        monkeypatch.setenv("DEBUGGER_RESPONSE_PUSH", "0")
+        session = Mock()
+        session.resource.return_value.Table.return_value.get_item.return_value = {"Item": {"Status": "ACTIVE"}}
+        monkeypatch.setattr(lambda_runtime, "assume_debugger_role", Mock(return_value=session))
+        return session
+
+    def test_prewarm_opens_connections(self, debugger_session):
+        """Test that STS, DynamoDB and the WebSocket API are contacted and the clients cached."""
+        lambda_runtime.prewarm_debugger_connections("session", "connection")
+
+        apigateway = debugger_session.client.return_value
+        apigateway.get_connection.assert_called_once_with(ConnectionId="connection")
+        assert lambda_runtime._session_item_cache.get_status(debugger_session, "session") == "ACTIVE"
+        assert lambda_runtime.get_apigateway_client(debugger_session, "https://test.execute-api.us-east-1.amazonaws.com/prod") is apigateway
+        debugger_session.resource.assert_called_once_with("dynamodb")
+        assert lambda_runtime.take_prewarm_duration() is not None
+        assert lambda_runtime.take_prewarm_duration() is None
+
+    def test_prewarm_detects_gone_connection(self, debugger_session):
+        """Test that a debugger that is already gone opens the breaker before the first invocation."""
+        error = Exception("GoneException")
+        error.response = {"Error": {"Code": "GoneException"}}
+        debugger_session.client.return_value.get_connection.side_effect = error
+
+        lambda_runtime.prewarm_debugger_connections("session", "connection")
+
+        assert lambda_runtime._circuit_breaker.is_open
+
+    def test_prewarm_failure_is_tolerated(self, monkeypatch):
+        """Test that failing to pre-warm leaves the work to the first invocation."""
+        monkeypatch.setattr(lambda_runtime, "assume_debugger_role", Mock(side_effect=Exception("AccessDenied")))
+
+        lambda_runtime.prewarm_debugger_connections("session", "connection")
+
+        assert lambda_runtime.take_prewarm_duration() is not None
+        assert not lambda_runtime._circuit_breaker.is_open
+
+
+@pytest.fixture(scope="module")
+def moto_server():
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+
+class StandInAwsService:
+    """Local HTTP server answering with queued status codes and bodies, recording the requests."""
+
+    def __init__(self, replies: list):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.replies = list(replies)
+        self.requests: list = []
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                service.requests.append((self.path, dict(self.headers), body))
+                status, headers, reply = service.replies.pop(0)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            do_GET = do_POST
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestBuiltinAwsBackend:
+    """Test the built-in SigV4 client selected with DEBUGGER_AWS_BACKEND=builtin."""
+
+    @pytest.fixture
+    def builtin_backend(self, monkeypatch, moto_server):
+        monkeypatch.setenv("DEBUGGER_AWS_BACKEND", "builtin")
+        monkeypatch.setenv("AWS_ENDPOINT_URL", moto_server)
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        monkeypatch.setenv("AWS_REGION", "us-east-1")
+        dynamodb = boto3.resource("dynamodb", endpoint_url=moto_server, region_name="us-east-1")
+        for name, key in (("PLLDBDebugger", "RequestId"), ("PLLDBSessions", "SessionId")):
+            if name not in dynamodb.meta.client.list_tables()["TableNames"]:
+                dynamodb.create_table(
+                    TableName=name, KeySchema=[{"AttributeName": key, "KeyType": "HASH"}], AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}], BillingMode="PAY_PER_REQUEST"
+                )
+        return dynamodb
+
+    def test_signature_matches_botocore(self):
+        """Test that requests are signed exactly like botocore signs them."""
+        import calendar
+
+        from botocore.auth import SigV4Auth
+        from botocore.awsrequest import AWSRequest
+        from botocore.credentials import Credentials
+
+        url = "https://abc.execute-api.us-east-1.amazonaws.com/prod/@connections/abc%3D"
+        headers = {"Content-Type": "application/x-amz-json-1.0", "X-Amz-Target": "DynamoDB_20120810.GetItem"}
+        body = b'{"TableName": "PLLDBDebugger"}'
+        request = AWSRequest(method="POST", url=url, data=body, headers={**headers, "Host": "abc.execute-api.us-east-1.amazonaws.com"})
+        SigV4Auth(Credentials("AKIDEXAMPLE", "secret", "token"), "execute-api", "us-east-1").add_auth(request)
+        timestamp = calendar.timegm(time.strptime(request.headers["X-Amz-Date"], "%Y%m%dT%H%M%SZ"))
+
+        signed = lambda_runtime.sigv4_sign("POST", url, headers, body, lambda_runtime.AwsCredentials("AKIDEXAMPLE", "secret", "token"), "us-east-1", "execute-api", timestamp)
+
+        assert signed["Authorization"] == request.headers["Authorization"]
+        assert signed["X-Amz-Security-Token"] == "token"
+
+    def test_credentials_from_container(self, monkeypatch):
+        """Test that without keys in the environment, as with SnapStart, the container endpoint is asked."""
+        credentials = {"AccessKeyId": "AKIACONTAINER", "SecretAccessKey": "secret", "Token": "token", "Expiration": "2030-01-01T00:00:00Z"}
+        service = StandInAwsService([(200, {}, json.dumps(credentials).encode())])
+        try:
+            monkeypatch.delenv("AWS_ACCESS_KEY_ID", raising=False)
+            monkeypatch.setenv("AWS_CONTAINER_CREDENTIALS_FULL_URI", f"{service.endpoint}/2021-04-23/credentials")
+            monkeypatch.setenv("AWS_CONTAINER_AUTHORIZATION_TOKEN", "authorization")
+
+            result = lambda_runtime.AwsCredentials.from_environment()
+        finally:
+            service.shutdown()
+
+        assert (result.access_key, result.secret_key, result.token) == ("AKIACONTAINER", "secret", "token")
+        path, headers, _ = service.requests[0]
+        assert path == "/2021-04-23/credentials"
+        assert headers["Authorization"] == "authorization"
+
+    def test_session_uses_builtin_clients(self, builtin_backend):
+        """Test that the role is assumed without boto3 and the tables are built-in."""
+        session = lambda_runtime.assume_debugger_role()
+
+        assert isinstance(session, lambda_runtime.BuiltinSession)
+        assert session.credentials.token
+        assert isinstance(lambda_runtime.get_debugger_table(session), lambda_runtime.BuiltinTable)
+        assert lambda_runtime._session_cache.get_account_id() == "123456789012"
+
+    def test_request_round_trip(self, builtin_backend):
+        """Test that a request written by the built-in client is read back like boto3 returns it."""
+        session = lambda_runtime.assume_debugger_role()
+        environment = lambda_runtime.EnvironmentSnapshot({"A": "1"})
+
+        lambda_runtime.create_debugger_request(session, "builtin-request", "session", "connection", {"key": "value"}, {"requestId": "builtin-request"}, encoding="zlib", environment=environment)
+
+        item = builtin_backend.Table("PLLDBDebugger").get_item(Key={"RequestId": "builtin-request"})["Item"]
+        assert item["StatusCode"] == 0
+        assert item["Encoding"] == "zlib"
+        assert json.loads(zlib.decompress(bytes(item["Request"])))["event"] == {"key": "value"}
+        assert item["EnvironmentHash"] == environment.digest
+
+        read = lambda_runtime.get_debugger_table(session).get_item(Key={"RequestId": "builtin-request"}, ConsistentRead=True)["Item"]
+        assert read["StatusCode"] == Decimal(0)
+        assert isinstance(read["Request"], bytes)
+        assert read["EnvironmentDelta"] == environment.delta
+
+    def test_conditional_failures_keep_their_code(self, builtin_backend):
+        """Test that conditional check failures surface with the code the runtime checks for."""
+        session = lambda_runtime.assume_debugger_role()
+        builtin_backend.Table("PLLDBDebugger").put_item(Item={"RequestId": "answered-request", "StatusCode": 200, "Response": '"ok"'})
+
+        lambda_runtime.create_debugger_request(session, "answered-request", "session", "connection", {}, {})
+
+        assert lambda_runtime.supersede_debugger_request(session, "answered-request") is False
+        assert builtin_backend.Table("PLLDBDebugger").get_item(Key={"RequestId": "answered-request"})["Item"]["Response"] == '"ok"'
+
+    def test_poll_and_supersede(self, builtin_backend):
+        """Test polling a stored response and superseding a pending request."""
+        session = lambda_runtime.assume_debugger_role()
+        table = builtin_backend.Table("PLLDBDebugger")
+        table.put_item(Item={"RequestId": "polled-request", "StatusCode": 200, "Response": json.dumps({"statusCode": 200})})
+        table.put_item(Item={"RequestId": "pending-request", "StatusCode": 0})
+
+        assert lambda_runtime.poll_for_response(session, "polled-request", timeout=1) == ({"statusCode": 200}, None)
+        assert lambda_runtime.supersede_debugger_request(session, "pending-request") is True
+        assert table.get_item(Key={"RequestId": "pending-request"})["Item"]["Superseded"] is True
+
+    def test_session_item(self, builtin_backend):
+        """Test that routing rules and status are read with the built-in client."""
+        session = lambda_runtime.assume_debugger_role()
+        builtin_backend.Table("PLLDBSessions").put_item(Item={"SessionId": "builtin-session", "Status": "ACTIVE", "RoutingRules": {"sampleRate": Decimal("12.5"), "functions": ["A"]}})
+
+        cache = lambda_runtime.SessionItemCache()
+
+        assert cache.get_status(session, "builtin-session") == "ACTIVE"
+        assert cache.get_rules(session, "builtin-session") == {"sampleRate": Decimal("12.5"), "functions": ["A"]}
+
+    def test_retries_transient_errors(self, monkeypatch):
+        """Test that throttling and server errors are retried and the connection is reused."""
+        monkeypatch.setattr(lambda_runtime, "AWS_RETRY_BASE_SECONDS", 0.001)
+        service = StandInAwsService(
+            [
+                (400, {}, json.dumps({"__type": "com.amazonaws.dynamodb.v20120810#ProvisionedThroughputExceededException", "message": "slow down"}).encode()),
+                (503, {}, b""),
+                (200, {}, json.dumps({"Item": {"StatusCode": {"N": "200"}}}).encode()),
+            ]
+        )
+        try:
+            http = lambda_runtime.AwsHttpClient(service.endpoint, "dynamodb", "us-east-1", lambda_runtime.AwsCredentials("AKID", "secret"))
+            item = lambda_runtime.BuiltinTable(http, "PLLDBDebugger").get_item(Key={"RequestId": "r"})["Item"]
+        finally:
+            service.shutdown()
+
+        assert item == {"StatusCode": Decimal(200)}
+        assert len(service.requests) == 3
+        assert service.requests[0][1]["X-Amz-Target"] == "DynamoDB_20120810.GetItem"
+        assert len(http._idle) == 1
+
+    def test_client_errors_are_not_retried(self):
+        """Test that a rejected request raises at once with the parsed error code."""
+        service = StandInAwsService([(410, {"x-amzn-ErrorType": "GoneException:http://internal.amazon.com/coral/"}, b'{"message": null}')])
+        try:
+            http = lambda_runtime.AwsHttpClient(service.endpoint + "/prod", "execute-api", "us-east-1", lambda_runtime.AwsCredentials("AKID", "secret"))
+            with pytest.raises(lambda_runtime.AwsClientError) as error:
+                lambda_runtime.BuiltinApiGatewayManagementClient(http).post_to_connection(ConnectionId="abc=", Data=b"{}")
+        finally:
+            service.shutdown()
+
+        assert error.value.response["Error"]["Code"] == "GoneException"
+        assert service.requests[0][0] == "/prod/@connections/abc%3D"
+        assert len(service.requests) == 1
+
+    def test_gone_connection_opens_breaker(self, monkeypatch):
+        """Test that a gone debugger reported to the built-in client trips the circuit breaker."""
+        service = StandInAwsService([(410, {"x-amzn-ErrorType": "GoneException"}, b"{}")])
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", service.endpoint + "/prod")
+        try:
+            session = lambda_runtime.BuiltinSession(lambda_runtime.AwsCredentials("AKID", "secret"), "us-east-1")
+            with pytest.raises(lambda_runtime.DebuggerConnectionGone):
+                lambda_runtime.send_debugger_request(session, "connection", {"requestId": "r"})
+        finally:
+            service.shutdown()
+
+        assert lambda_runtime._circuit_breaker.is_open
+
+    def test_attribute_serialization(self):
+        """Test that attribute values are converted like boto3's serializer and deserializer do."""
+        from boto3.dynamodb.types import TypeSerializer
+
+        value = {"s": "x", "n": 1, "d": Decimal("1.5"), "b": b"\x00\x01", "t": True, "z": None, "l": ["a", 2], "m": {"k": "v"}}
+
+        serialized = lambda_runtime.serialize_attribute(value)
+
+        expected = TypeSerializer().serialize(value)
+        expected["M"]["b"] = {"B": base64.b64encode(b"\x00\x01").decode()}
+        assert serialized == expected
+        assert lambda_runtime.deserialize_attribute(serialized) == {**value, "n": Decimal(1), "l": ["a", Decimal(2)]}
+        with pytest.raises(TypeError):
+            lambda_runtime.serialize_attribute(1.5)
+
+
+class TestShadowMode:
+    """Test mirroring answered invocations to the debugger in shadow mode."""
+
+    @pytest.fixture
+    def debugger_session(self, monkeypatch):
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "test-function")
+        session = Mock()
+        monkeypatch.setattr(lambda_runtime, "assume_debugger_role", Mock(return_value=session))
+        monkeypatch.setattr(lambda_runtime._session_item_cache, "get_rules", Mock(return_value=None))
+        monkeypatch.setattr(lambda_runtime._session_item_cache, "get_status", Mock(return_value="ACTIVE"))
+        monkeypatch.setattr(lambda_runtime, "publish_environment", Mock())
+        monkeypatch.setattr(lambda_runtime, "send_debugger_request", Mock())
+        monkeypatch.setattr(lambda_runtime, "create_debugger_request", Mock())
+        return session
+
+    def test_session_mode(self, monkeypatch):
+        """Test that shadow mode is only used when the instrumentation selected it."""
+        monkeypatch.delenv("DEBUGGER_SESSION_MODE", raising=False)
+        assert lambda_runtime.get_session_mode() == "debug"
+
+        monkeypatch.setenv("DEBUGGER_SESSION_MODE", "shadow")
+        assert lambda_runtime.get_session_mode() == "shadow"
+
+    def test_forward_sends_copy_with_deployed_result(self, debugger_session):
+        """Test that the copy carries the event and deployed result and nothing is stored or awaited."""
+        environment = lambda_runtime.EnvironmentSnapshot({"A": "1"})
+
+        lambda_runtime.forward_shadow_copy("session", "connection", "request-1", {"key": "value"}, None, {"statusCode": 200}, None, environment)
+
+        message = lambda_runtime.send_debugger_request.call_args[0][2]
+        assert lambda_runtime.send_debugger_request.call_args[0][:2] == (debugger_session, "connection")
+        assert message["shadow"] is True
+        assert json.loads(message["event"]) == {"key": "value"}
+        assert json.loads(message["deployedResponse"]) == {"statusCode": 200}
+        assert "deployedErrorMessage" not in message
+        assert message["environmentHash"] == environment.digest
+        lambda_runtime.create_debugger_request.assert_not_called()
+
+    def test_forward_carries_deployed_error(self, debugger_session):
+        """Test that a failed deployed invocation is mirrored with its error."""
+        lambda_runtime.forward_shadow_copy("session", "connection", "request-1", {}, None, None, "boom", lambda_runtime.EnvironmentSnapshot({}))
+
+        message = lambda_runtime.send_debugger_request.call_args[0][2]
+        assert message["deployedErrorMessage"] == "boom"
+        assert "deployedResponse" not in message
+
+    def test_forward_respects_routing_rules(self, debugger_session, monkeypatch):
+        """Test that invocations not selected by the sampling rules are not mirrored."""
+        monkeypatch.setattr(lambda_runtime._session_item_cache, "get_rules", Mock(return_value={"sampleRate": 0}))
+
+        lambda_runtime.forward_shadow_copy("session", "connection", "request-1", {}, None, {}, None, lambda_runtime.EnvironmentSnapshot({}))
+
+        lambda_runtime.send_debugger_request.assert_not_called()
+
+    def test_forward_skips_large_copies(self, debugger_session):
+        """Test that copies too large for a WebSocket frame are skipped instead of offloaded."""
+        event = {"body": "x" * lambda_runtime.PAYLOAD_OFFLOAD_THRESHOLD_BYTES}
+
+        lambda_runtime.forward_shadow_copy("session", "connection", "request-1", event, None, {}, None, lambda_runtime.EnvironmentSnapshot({}))
+
+        lambda_runtime.send_debugger_request.assert_not_called()
+
+    def test_forwarder_runs_in_background(self):
+        """Test that forwards run on another thread without the caller waiting for them."""
+        forwarder = lambda_runtime.ShadowForwarder()
+        release = threading.Event()
+        threads = []
+
+        assert forwarder.submit(lambda: (release.wait(5), threads.append(threading.current_thread().name)))
+        assert threads == []
+        release.set()
+        forwarder.join()
+
+        assert threads == ["plldb-shadow"]
+
+    def test_forwarder_drops_when_full(self):
+        """Test that submitting never blocks, copies beyond the queue size are dropped."""
+        forwarder = lambda_runtime.ShadowForwarder(max_pending=1)
+        release = threading.Event()
+        started = threading.Event()
+        forwards = Mock()
+
+        forwarder.submit(lambda: (started.set(), release.wait(5)))
+        started.wait(5)
+        assert forwarder.submit(forwards)
+        assert not forwarder.submit(forwards)
+        release.set()
+        forwarder.join()
+
+        assert forwards.call_count == 1
+        assert forwarder.dropped == 1
+
+    def test_forwarder_drops_stale_copies(self):
+        """Test that copies queued for too long, e.g. across a sandbox freeze, are not sent."""
+        forwarder = lambda_runtime.ShadowForwarder(max_age=-1)
+        forward = Mock()
+
+        forwarder.submit(forward)
+        forwarder.join()
+
+        forward.assert_not_called()
+        assert forwarder.dropped == 1
+
+    def test_forwarder_survives_failures(self):
+        """Test that a failing forward does not stop the following ones."""
+        forwarder = lambda_runtime.ShadowForwarder()
+        forward = Mock()
+
+        forwarder.submit(Mock(side_effect=Exception("GoneException")))
+        forwarder.submit(forward)
+        forwarder.join()
+
+        forward.assert_called_once()
+
+    def test_run_normal_handler_returns_result(self, runtime_api, monkeypatch):
+        """Test that the result of the deployed handler is returned once it was sent."""
+        monkeypatch.setattr(lambda_runtime, "get_handler", Mock(return_value=Mock(side_effect=ValueError("bad input"))))
+
+        assert lambda_runtime.run_normal_handler({}, "request-1", runtime_api.address) == (None, "bad input")
+        assert runtime_api.errors["request-1"]["errorMessage"] == "bad input"
+
+        monkeypatch.setattr(lambda_runtime, "get_handler", Mock(return_value=Mock(return_value={"ok": True})))
+
+        assert lambda_runtime.run_normal_handler({}, "request-2", runtime_api.address) == ({"ok": True}, None)
+
+
+class TestTrafficCapture:
+    """Test capturing sampled invocations to S3 without a debugger session."""
+
+    BUCKET = "plldb-core-infrastructure-us-east-1-123456789012"
+
+    @pytest.fixture
+    def capture_bucket(self, mock_aws_session, monkeypatch):
+        mock_aws_session.client("s3").create_bucket(Bucket=self.BUCKET)
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "test-function")
+        return mock_aws_session
+
+    def _read_captures(self, session) -> list:
+        s3 = session.client("s3")
+        objects = s3.list_objects_v2(Bucket=self.BUCKET, Prefix="captures/test-function/").get("Contents", [])
+        return [
+            [json.loads(line) for line in gzip.decompress(s3.get_object(Bucket=self.BUCKET, Key=item["Key"])["Body"].read()).splitlines()] for item in sorted(objects, key=lambda item: item["Key"])
+        ]
+
+    def test_configuration(self, monkeypatch):
+        """Test that capturing needs a sample rate and defaults to the bootstrap bucket of the account."""
+        monkeypatch.delenv("DEBUGGER_CAPTURE_SAMPLE_RATE", raising=False)
+        assert lambda_runtime.create_traffic_capture() is None
+
+        monkeypatch.setenv("DEBUGGER_CAPTURE_SAMPLE_RATE", "often")
+        assert lambda_runtime.get_capture_sample_rate() == 0.0
+        monkeypatch.setenv("DEBUGGER_CAPTURE_SAMPLE_RATE", "5")
+        assert lambda_runtime.get_capture_sample_rate() == 1.0
+
+        monkeypatch.setenv("DEBUGGER_CAPTURE_SAMPLE_RATE", "0.25")
+        monkeypatch.setenv("AWS_REGION", "us-east-1")
+        monkeypatch.delenv("DEBUGGER_CAPTURE_BUCKET", raising=False)
+        capture = lambda_runtime.create_traffic_capture()
+        assert capture.bucket is None
+        assert capture.sample_rate == 0.25
+        assert lambda_runtime.get_capture_bucket("arn:aws:lambda:us-east-1:123456789012:function:test-function:live") == self.BUCKET
+        assert lambda_runtime.get_capture_bucket("") is None
+
+        monkeypatch.setenv("DEBUGGER_CAPTURE_BUCKET", "corpora")
+        assert lambda_runtime.create_traffic_capture().bucket == "corpora"
+
+    def test_capture_stops_without_bucket(self, runtime_api, monkeypatch, capsys):
+        """Test that capturing is turned off with an error when the bucket cannot be resolved."""
+        monkeypatch.setattr(lambda_runtime, "get_handler", Mock(return_value=lambda event, context: {}))
+        capture = lambda_runtime.TrafficCapture(None, 1.0)
+
+        lambda_runtime.capture_invocation(capture, {}, "request-1", runtime_api.address, lambda_runtime.LambdaContext("request-1", invoked_function_arn="unknown"))
+
+        assert runtime_api.responses["request-1"] == b"{}"
+        assert capture.sample_rate == 0.0
+        assert "No bucket for captured invocations" in capsys.readouterr().err
+
+    @mock_aws
+    def test_batch_is_uploaded_as_gzipped_json_lines(self, capture_bucket, runtime_api, monkeypatch):
+        """Test that captured invocations are uploaded in one object once the batch is large enough."""
+        monkeypatch.setattr(lambda_runtime, "get_handler", Mock(return_value=lambda event, context: {"echo": event["n"]}))
+        record_size = len(lambda_runtime.build_capture_record(lambda_runtime.RawJson(b'{"n": 0}'), lambda_runtime.LambdaContext("request-0"), {"echo": 0}, None, 0.0, 0.0))
+        capture = lambda_runtime.TrafficCapture(None, 1.0, flush_bytes=record_size * 2)
+        arn = "arn:aws:lambda:us-east-1:123456789012:function:test-function"
+
+        for n in range(3):
+            context = lambda_runtime.LambdaContext(f"request-{n}", invoked_function_arn=arn)
+            lambda_runtime.capture_invocation(capture, lambda_runtime.RawJson(b'{"n": %d}' % n), f"request-{n}", runtime_api.address, context)
+        capture.join(5)
+
+        assert json.loads(runtime_api.responses["request-2"]) == {"echo": 2}
+        (records,) = self._read_captures(capture_bucket)
+        assert [record["requestId"] for record in records] == ["request-0", "request-1"]
+        assert records[1]["event"] == {"n": 1}
+        assert records[1]["response"] == {"echo": 1}
+        assert records[1]["functionName"] == "test-function"
+        assert records[1]["durationMs"] >= 0
+
+    @mock_aws
+    def test_due_record_is_uploaded_before_next_invocation(self, capture_bucket, runtime_api, monkeypatch):
+        """Test that the runtime uploads a record that is due before asking for the next invocation."""
+
+        class StopLoopException(Exception):
+            pass
+
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", runtime_api.address)
+        monkeypatch.setenv("AWS_REGION", "us-east-1")
+        monkeypatch.setenv("DEBUGGER_CAPTURE_SAMPLE_RATE", "1")
+        monkeypatch.delenv("DEBUGGER_CAPTURE_BUCKET", raising=False)
+        monkeypatch.delenv("DEBUGGER_SESSION_ID", raising=False)
+        monkeypatch.delenv("DEBUGGER_CONNECTION_ID", raising=False)
+        monkeypatch.setattr(lambda_runtime, "resolve_handler", Mock(return_value=lambda event, context: None))
+        monkeypatch.setattr(lambda_runtime, "create_traffic_capture", Mock(return_value=lambda_runtime.TrafficCapture(None, 1.0, flush_interval=0.0)))
+        context = lambda_runtime.LambdaContext("request-1", invoked_function_arn="arn:aws:lambda:us-east-1:123456789012:function:test-function")
+        captures_at_next = []
+
+        def next_invocation(address):
+            captures_at_next.append(self._read_captures(capture_bucket))
+            if len(captures_at_next) == 1:
+                return lambda_runtime.RawJson(b'{"n": 1}'), context
+            raise StopLoopException("Exit loop")
+
+        monkeypatch.setattr(lambda_runtime, "get_next_invocation", Mock(side_effect=next_invocation))
+
+        with pytest.raises(StopLoopException):
+            lambda_runtime.main()
+
+        first, second = captures_at_next
+        assert first == []
+        (records,) = second
+        assert records[0]["requestId"] == "request-1"
+        assert records[0]["response"] is None
+
+    def test_records_are_batched_across_invocations(self):
+        """Test that records are handed over before a freeze only once the oldest one waited the flush interval."""
+        capture = lambda_runtime.TrafficCapture("bucket", 1.0, flush_interval=60)
+        capture._s3_client = Mock()
+
+        capture.add(b'{"n": 1}')
+        capture.before_freeze()
+        capture.add(b'{"n": 2}')
+        capture.before_freeze()
+        capture._s3_client.put_object.assert_not_called()
+
+        capture._buffered_at -= 60
+        capture.before_freeze()
+
+        capture._s3_client.put_object.assert_called_once()
+        assert gzip.decompress(capture._s3_client.put_object.call_args[1]["Body"]) == b'{"n": 1}\n{"n": 2}\n'
+
+    def test_freeze_wait_is_bounded(self):
+        """Test that a slow upload holds the runtime before the freeze only for the timeout."""
+        capture = lambda_runtime.TrafficCapture("bucket", 1.0, flush_bytes=1)
+        release = threading.Event()
+        capture._s3_client = Mock()
+        capture._s3_client.put_object.side_effect = lambda **kwargs: release.wait(5)
+
+        capture.add(b"{}")
+        start = time.perf_counter()
+        capture.before_freeze()
+        elapsed = time.perf_counter() - start
+        release.set()
+
+        assert elapsed < 1
+        assert capture.join(5)
+
+    def test_buffer_is_bounded(self):
+        """Test that adding never waits for slow uploads and records beyond the buffer are dropped."""
+        capture = lambda_runtime.TrafficCapture("bucket", 1.0, flush_bytes=10, max_buffer_bytes=25)
+        started, release = threading.Event(), threading.Event()
+        capture._s3_client = Mock()
+        capture._s3_client.put_object.side_effect = lambda **kwargs: (started.set(), release.wait(5))
+
+        start = time.perf_counter()
+        added = [capture.add(b"x" * 10)]
+        started.wait(5)
+        # The first batch uploads, the second waits and the third stays in the buffer until it is full
+        added += [capture.add(b"x" * 10) for _ in range(5)]
+        elapsed = time.perf_counter() - start
+        release.set()
+        capture.join(5)
+
+        assert elapsed < 1
+        assert added == [True, True, True, True, False, False]
+        assert capture.dropped == 2
+        assert not capture.add(b"x" * (capture.max_record_bytes + 1))
+
+    def test_failed_uploads_are_dropped(self):
+        """Test that a failing upload only drops its batch."""
+        capture = lambda_runtime.TrafficCapture("bucket", 1.0, flush_bytes=1)
+        capture._s3_client = Mock()
+        capture._s3_client.put_object.side_effect = [Exception("AccessDenied"), None]
+
+        capture.add(b"{}")
+        capture.join(5)
+        capture.add(b"{}")
+        capture.join(5)
+
+        assert capture.dropped == 1
+        assert capture._s3_client.put_object.call_count == 2
+
+
+class TestInvocationMetrics:
+    """Test the per-phase metrics of debug invocations."""
+
+    def test_emf_record(self):
+        """Test that phase durations become metrics dimensioned by function and session."""
+        metrics = lambda_runtime.InvocationMetrics("request-1")
+        with metrics.phase("AssumeRole"):
+            pass
+        metrics.timed("RequestWrite", lambda: None)()
+        metrics.durations["DebuggerWait"] = 1500.0
+        metrics.stats.update({"polls": 2, "pushed": True})
+
+        record = metrics.to_emf("my-function", "session-1")
+
+        directive = record["_aws"]["CloudWatchMetrics"][0]
+        assert directive["Namespace"] == "PLLDB"
+        assert directive["Dimensions"] == [["FunctionName", "SessionId"]]
+        assert [metric["Name"] for metric in directive["Metrics"]] == ["AssumeRoleDuration", "RequestWriteDuration", "DebuggerWaitDuration", "TotalDuration", "OverheadDuration"]
+        assert record["FunctionName"] == "my-function"
+        assert record["SessionId"] == "session-1"
+        assert record["DebuggerWaitDuration"] == 1500.0
+        assert record["OverheadDuration"] == pytest.approx(record["TotalDuration"] - 1500.0, abs=0.02)
+        assert record["Polls"] == 2 and record["Pushed"] == 1
+        assert type(record["Pushed"]) is int
+        assert record["Report"].startswith("REPORT RequestId: request-1\tAssumeRole: ")
+
+    def test_counts_are_not_replaced_by_stats(self):
+        """Test that a stat named like a count does not replace the count metric."""
+        metrics = lambda_runtime.InvocationMetrics("request-1")
+        metrics.counts["Hedged"] = 0
+        metrics.counts["Pushed"] = True
+        metrics.stats.update({"hedged": True, "pushed": False, "polls": 1})
+
+        record = metrics.to_emf("my-function", "session-1")
+
+        assert record["Hedged"] == 0 and type(record["Hedged"]) is int
+        assert record["Pushed"] == 1 and type(record["Pushed"]) is int
+        assert record["Polls"] == 1
+
+    def test_phase_is_recorded_on_failure(self):
+        """Test that a failing phase still records its duration."""
+        metrics = lambda_runtime.InvocationMetrics("request-1")
+
+        with pytest.raises(RuntimeError):
+            with metrics.phase("AssumeRole"):
+                raise RuntimeError("AccessDenied")
+
+        assert "AssumeRole" in metrics.durations
+
 
 class TestPollingAndWebSocket:
     """Test polling and WebSocket notification functions."""
@@ -281,6 +1759,120 @@ class TestPollingAndWebSocket:
         assert response is None
         assert error == "Timeout waiting for debugger response"
 
+    def test_poll_for_response_stops_before_deadline(self):
+        """Test that waiting ends ahead of the invocation deadline with a clean error."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"StatusCode": 0}}
+        deadline_ms = int(time.time() * 1000) + lambda_runtime.DEADLINE_MARGIN_MS + 300
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            start = time.time()
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=300, deadline_ms=deadline_ms)
+
+        assert response is None
+        assert error == "Debugger did not respond before the function deadline"
+        assert time.time() * 1000 < deadline_ms - lambda_runtime.DEADLINE_MARGIN_MS + 200
+        assert time.time() - start < 1
+
+    def test_poll_for_response_stops_after_hedging_delay(self):
+        """Test that waiting ends after the hedging delay, leaving the hedging decision to the caller."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"StatusCode": 0}}
+        stats: Dict[str, Any] = {}
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            start = time.time()
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=300, stats=stats, hedge_after_ms=200)
+
+        assert (response, error) == (None, lambda_runtime.HEDGE_TIMEOUT_MESSAGE)
+        assert "hedged" not in stats
+        assert time.time() - start < 1
+
+    def test_poll_for_response_answered_before_hedging_delay(self):
+        """Test that a response within the hedging delay is not hedged."""
+        mock_table = Mock()
+        mock_table.get_item.side_effect = [{"Item": {"StatusCode": 200}}, {"Item": {"StatusCode": 200, "Response": json.dumps({"result": "success"})}}]
+        stats: Dict[str, Any] = {}
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", stats=stats, hedge_after_ms=5000)
+
+        assert (response, error) == ({"result": "success"}, None)
+        assert "hedged" not in stats
+
+    @mock_aws
+    def test_supersede_debugger_request(self, mock_aws_session):
+        """Test that only a request still waiting for the debugger, which has not started streaming, is superseded."""
+        dynamodb = mock_aws_session.resource("dynamodb")
+        table = dynamodb.create_table(
+            TableName="PLLDBDebugger",
+            KeySchema=[{"AttributeName": "RequestId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "RequestId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        table.put_item(Item={"RequestId": "waiting", "StatusCode": 0})
+        table.put_item(Item={"RequestId": "answered", "StatusCode": 200, "Response": "{}"})
+        table.put_item(Item={"RequestId": "streaming", "StatusCode": 0, "Streaming": True})
+
+        assert lambda_runtime.supersede_debugger_request(mock_aws_session, "waiting")
+        assert not lambda_runtime.supersede_debugger_request(mock_aws_session, "answered")
+        assert not lambda_runtime.supersede_debugger_request(mock_aws_session, "streaming")
+        assert table.get_item(Key={"RequestId": "waiting"})["Item"]["Superseded"] is True
+        assert "Superseded" not in table.get_item(Key={"RequestId": "answered"})["Item"]
+
+    def test_get_hedge_after_ms(self, monkeypatch):
+        """Test reading the hedging delay of the function."""
+        monkeypatch.delenv("DEBUGGER_HEDGE_AFTER_MS", raising=False)
+        assert lambda_runtime.get_hedge_after_ms() is None
+        monkeypatch.setenv("DEBUGGER_HEDGE_AFTER_MS", "2500")
+        assert lambda_runtime.get_hedge_after_ms() == 2500
+        monkeypatch.setenv("DEBUGGER_HEDGE_AFTER_MS", "soon")
+        assert lambda_runtime.get_hedge_after_ms() is None
+
+    def test_poll_for_response_reads_status_only_until_ready(self):
+        """Test that only StatusCode and the streaming marker are fetched until the response is ready."""
+        mock_table = Mock()
+        mock_table.get_item.side_effect = [
+            {"Item": {"StatusCode": 0}},
+            {"Item": {"StatusCode": 200}},
+            {"Item": {"StatusCode": 200, "Response": json.dumps({"result": "success"})}},
+        ]
+        stats: Dict[str, Any] = {}
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table), patch("time.sleep"):
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=10, stats=stats)
+
+        assert response == {"result": "success"}
+        assert error is None
+        assert stats["polls"] == 2
+        assert "waitMs" in stats
+
+        status_calls = mock_table.get_item.call_args_list[:2]
+        for status_call in status_calls:
+            assert status_call[1]["ProjectionExpression"] == "StatusCode, Streaming"
+            assert status_call[1]["ConsistentRead"] is True
+        final_call = mock_table.get_item.call_args_list[2]
+        assert final_call[1]["ExpressionAttributeNames"] == {"#resp": "Response"}
+        assert final_call[1]["ConsistentRead"] is True
+
+    def test_poll_for_response_backs_off_with_jitter(self, monkeypatch):
+        """Test that the polling interval grows exponentially up to the configured maximum."""
+        monkeypatch.setenv("DEBUGGER_POLL_INITIAL_INTERVAL_MS", "100")
+        monkeypatch.setenv("DEBUGGER_POLL_MAX_INTERVAL_MS", "400")
+
+        mock_table = Mock()
+        mock_table.get_item.side_effect = [{"Item": {"StatusCode": 0}}] * 5 + [{"Item": {"StatusCode": 200}}, {"Item": {"StatusCode": 200, "Response": "null"}}]
+
+        with (
+            patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table),
+            patch("time.sleep") as mock_sleep,
+            patch("random.uniform", side_effect=lambda low, high: high) as mock_uniform,
+        ):
+            lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=10)
+
+        assert [call[0] for call in mock_uniform.call_args_list] == [(0.05, 0.1), (0.1, 0.2), (0.2, 0.4), (0.2, 0.4), (0.2, 0.4)]
+        assert [call[0][0] for call in mock_sleep.call_args_list] == [0.1, 0.2, 0.4, 0.4, 0.4]
+
     @patch("boto3.Session.client")
     def test_send_debugger_request_success(self, mock_client, monkeypatch):
         """Test successful WebSocket notification."""
@@ -301,57 +1893,167 @@ class TestPollingAndWebSocket:
         message = {"action": "test", "data": "value"}
         lambda_runtime.send_debugger_request(mock_session, "test-connection-id", message)
 
-        # Verify API call
-        mock_api_client.post_to_connection.assert_called_once_with(ConnectionId="test-connection-id", Data=json.dumps(message).encode())
+        # Verify API call
+        mock_api_client.post_to_connection.assert_called_once_with(ConnectionId="test-connection-id", Data=json.dumps(message).encode())
+
+    @patch("boto3.Session.client")
+    def test_send_debugger_request_error(self, mock_client, monkeypatch):
+        """Test WebSocket notification error handling (should not raise)."""
+        monkeypatch.setenv(
+            "DEBUGGER_WEBSOCKET_API_ENDPOINT",
+            "https://test.execute-api.us-east-1.amazonaws.com/prod",
+        )
+
+        # Mock API Gateway Management API client that raises error
+        mock_api_client = Mock()
+        mock_api_client.post_to_connection.side_effect = Exception("Connection error")
+        mock_client.return_value = mock_api_client
+
+        # Create mock session
+        mock_session = Mock(spec=boto3.Session)
+        mock_session.client = mock_client
+
+        # Test notification - should not raise
+        lambda_runtime.send_debugger_request(mock_session, "test-connection-id", {"test": "data"})
+
+        # Verify API was called despite error
+        assert mock_api_client.post_to_connection.called
+
+
+class TestResponseChannel:
+    """Test pushed response delivery against a local stand-in WebSocket API."""
+
+    def test_get_response_channel_url(self, monkeypatch):
+        """Test that the management endpoint is turned into the runtime WebSocket URL."""
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "https://abc.execute-api.us-east-1.amazonaws.com/prod")
+        monkeypatch.setenv("DEBUGGER_RUNTIME_SECRET", "runtime-secret")
+
+        url = lambda_runtime.get_response_channel_url("test-session")
+
+        assert url == "wss://abc.execute-api.us-east-1.amazonaws.com/prod?sessionId=test-session&role=runtime&runtimeSecret=runtime-secret"
+
+    def test_get_response_channel_url_without_secret(self, monkeypatch):
+        """Test that a runtime without the secret of the session does not try to connect."""
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "https://abc.execute-api.us-east-1.amazonaws.com/prod")
+        monkeypatch.delenv("DEBUGGER_RUNTIME_SECRET", raising=False)
+
+        assert lambda_runtime.get_response_channel_url("test-session") is None
+
+    def test_get_response_channel_url_disabled(self, monkeypatch):
+        """Test that pushing can be switched off."""
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "https://abc.execute-api.us-east-1.amazonaws.com/prod")
+        monkeypatch.setenv("DEBUGGER_RESPONSE_PUSH", "0")
+
+        assert lambda_runtime.get_response_channel_url("test-session") is None
+
+    def test_channel_registers_and_is_reused(self, websocket_api):
+        """Test that the runtime registers once and reuses the connection."""
+        channel = lambda_runtime.get_response_channel("test-session")
+
+        assert channel is not None
+        assert channel.connection_id == "runtime-connection-id"
+        assert websocket_api.received == [{"action": "registerRuntime"}]
+        assert websocket_api.request_paths == ["/prod?sessionId=test-session&role=runtime&runtimeSecret=runtime-secret"]
+        assert lambda_runtime.get_response_channel("test-session") is channel
+
+    def test_channel_unavailable_falls_back_to_polling(self, monkeypatch):
+        """Test that an unreachable WebSocket API disables pushing for a while."""
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "http://127.0.0.1:1/prod")
+        monkeypatch.setenv("DEBUGGER_RUNTIME_SECRET", "runtime-secret")
+
+        assert lambda_runtime.get_response_channel("test-session") is None
+        assert lambda_runtime._response_channel_retry_at > time.time()
+
+    def test_poll_for_response_receives_pushed_response(self, websocket_api):
+        """Test that a pushed response is returned without polling DynamoDB."""
+        channel = lambda_runtime.get_response_channel("test-session")
+        mock_table = Mock()
+
+        websocket_api.push({"requestId": "other-request", "statusCode": 200, "response": "{}"})
+        websocket_api.push({"requestId": "test-request-id", "statusCode": 200, "response": json.dumps({"result": "pushed"})})
+        stats: Dict[str, Any] = {}
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=5, stats=stats, channel=channel)
+
+        assert response == {"result": "pushed"}
+        assert error is None
+        assert stats["pushed"] is True
+        assert stats["polls"] == 0
+        mock_table.get_item.assert_not_called()
+
+    def test_poll_for_response_reads_response_stored_before_request(self, websocket_api):
+        """Test that a response which beat the request item is read at once instead of waiting for a push."""
+        channel = lambda_runtime.get_response_channel("test-session")
+        mock_table = Mock()
+        mock_table.get_item.side_effect = [{"Item": {"StatusCode": 200}}, {"Item": {"StatusCode": 200, "Response": json.dumps({"result": "early"})}}]
+        stats: Dict[str, Any] = {}
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            start = time.time()
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=30, stats=stats, channel=channel, poll_first=True)
+
+        assert (response, error) == ({"result": "early"}, None)
+        assert stats["polls"] == 1 and stats["pushed"] is False
+        assert time.time() - start < lambda_runtime.PUSH_FALLBACK_POLL_INTERVAL_SECONDS
+
+    def test_poll_for_response_pushed_error(self, websocket_api):
+        """Test that a pushed error is returned as error."""
+        channel = lambda_runtime.get_response_channel("test-session")
+        websocket_api.push({"requestId": "test-request-id", "statusCode": 500, "response": "", "errorMessage": "Boom"})
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=Mock()):
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=5, channel=channel)
+
+        assert response is None
+        assert error == "Boom"
+
+    def test_poll_for_response_falls_back_when_channel_is_lost(self, websocket_api):
+        """Test that DynamoDB is polled when the connection drops."""
+        channel = lambda_runtime.get_response_channel("test-session")
+        websocket_api.push(None)
+
+        mock_table = Mock()
+        mock_table.get_item.side_effect = [{"Item": {"StatusCode": 200}}, {"Item": {"StatusCode": 200, "Response": json.dumps({"result": "stored"})}}]
+        stats: Dict[str, Any] = {}
 
-    @patch("boto3.Session.client")
-    def test_send_debugger_request_error(self, mock_client, monkeypatch):
-        """Test WebSocket notification error handling (should not raise)."""
-        monkeypatch.setenv(
-            "DEBUGGER_WEBSOCKET_API_ENDPOINT",
-            "https://test.execute-api.us-east-1.amazonaws.com/prod",
-        )
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=5, stats=stats, channel=channel)
 
-        # Mock API Gateway Management API client that raises error
-        mock_api_client = Mock()
-        mock_api_client.post_to_connection.side_effect = Exception("Connection error")
-        mock_client.return_value = mock_api_client
+        assert response == {"result": "stored"}
+        assert stats["pushed"] is False
+        assert stats["polls"] == 1
+        assert not channel.is_usable()
 
-        # Create mock session
-        mock_session = Mock(spec=boto3.Session)
-        mock_session.client = mock_client
+    def test_large_pushed_message(self, websocket_api):
+        """Test that messages using extended payload lengths are received."""
+        channel = lambda_runtime.get_response_channel("test-session")
+        big = {"data": "x" * 70000}
+        websocket_api.push({"requestId": "test-request-id", "statusCode": 200, "response": json.dumps(big)})
 
-        # Test notification - should not raise
-        lambda_runtime.send_debugger_request(mock_session, "test-connection-id", {"test": "data"})
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=Mock()):
+            response, _ = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=5, channel=channel)
 
-        # Verify API was called despite error
-        assert mock_api_client.post_to_connection.called
+        assert response == big
 
 
 class TestNormalHandlerExecution:
     """Test normal Lambda handler execution."""
 
-    @patch("urllib.request.urlopen")
-    def test_run_normal_handler_success(self, mock_urlopen, monkeypatch):
+    def test_run_normal_handler_success(self, runtime_api, monkeypatch):
         """Test successful execution of normal handler."""
         # Setup environment
         monkeypatch.setenv("_HANDLER", "test_handler.handler")
         monkeypatch.setenv("LAMBDA_TASK_ROOT", "/var/task")
         monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "test-function")
 
-        # Mock urlopen for send_response
-        mock_response = Mock()
-        mock_response.__enter__ = Mock(return_value=mock_response)
-        mock_response.__exit__ = Mock(return_value=None)
-        mock_urlopen.return_value = mock_response
-
         # Create a mock handler module
         mock_handler_module = Mock()
         mock_handler_module.handler = Mock(return_value={"statusCode": 200, "body": "Success"})
 
         # Mock __import__
         with patch("builtins.__import__", return_value=mock_handler_module):
-            lambda_runtime.run_normal_handler({"test": "event"}, "test-request-id", "127.0.0.1:9001")
+            lambda_runtime.run_normal_handler({"test": "event"}, "test-request-id", runtime_api.address)
 
         # Verify handler was called
         mock_handler_module.handler.assert_called_once()
@@ -360,26 +2062,284 @@ class TestNormalHandlerExecution:
         assert args[1].aws_request_id == "test-request-id"
 
         # Verify response was sent
-        assert mock_urlopen.called
+        assert json.loads(runtime_api.responses["test-request-id"]) == {"statusCode": 200, "body": "Success"}
 
-    @patch("urllib.request.urlopen")
-    def test_run_normal_handler_no_handler(self, mock_urlopen, monkeypatch):
+    def test_handler_receives_invocation_context(self, runtime_api, monkeypatch):
+        """Test that the handler sees the deadline and invocation headers of the Runtime API."""
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "test-function")
+        deadline_ms = int(time.time() * 1000) + 30000
+        runtime_api.add_invocation(
+            {"test": "event"},
+            "test-request-id",
+            {
+                "Lambda-Runtime-Deadline-Ms": str(deadline_ms),
+                "Lambda-Runtime-Invoked-Function-Arn": "arn:aws:lambda:us-east-1:123456789012:function:test-function:live",
+                "Lambda-Runtime-Trace-Id": "Root=1-abc;Parent=def;Sampled=1",
+                "Lambda-Runtime-Client-Context": json.dumps({"client": {"app_title": "app"}, "custom": {"k": "v"}, "env": {"platform": "ios"}}),
+                "Lambda-Runtime-Cognito-Identity": json.dumps({"cognitoIdentityId": "id-1", "cognitoIdentityPoolId": "pool-1"}),
+            },
+        )
+        captured = []
+        monkeypatch.setattr(lambda_runtime, "_handler", lambda event, context: captured.append(context) or {})
+
+        event, context = lambda_runtime.get_next_invocation(runtime_api.address)
+        lambda_runtime.run_normal_handler(event, context.aws_request_id, runtime_api.address, context)
+
+        context = captured[0]
+        assert context.aws_request_id == "test-request-id"
+        assert 25000 < context.get_remaining_time_in_millis() <= 30000
+        assert context.invoked_function_arn.endswith(":live")
+        assert context.function_name == "test-function"
+        assert context.client_context.client.app_title == "app"
+        assert context.client_context.custom == {"k": "v"}
+        assert context.identity.cognito_identity_id == "id-1"
+        assert context.identity.cognito_identity_pool_id == "pool-1"
+        assert context.to_dict()["deadline_ms"] == deadline_ms
+
+    def test_run_normal_handler_no_handler(self, runtime_api, monkeypatch):
         """Test error when handler is not specified."""
         # No _HANDLER environment variable
         monkeypatch.delenv("_HANDLER", raising=False)
 
-        # Mock urlopen for send_error
-        mock_response = Mock()
-        mock_response.__enter__ = Mock(return_value=mock_response)
-        mock_response.__exit__ = Mock(return_value=None)
-        mock_urlopen.return_value = mock_response
-
-        lambda_runtime.run_normal_handler({}, "test-request-id", "127.0.0.1:9001")
+        lambda_runtime.run_normal_handler({}, "test-request-id", runtime_api.address)
 
         # Verify error was sent
-        args, kwargs = mock_urlopen.call_args
-        request = args[0]
-        assert "/error" in request.get_full_url()
+        assert "test-request-id" in runtime_api.errors
+        assert runtime_api.responses == {}
+
+
+class TestHandlerInit:
+    """Test that the handler is resolved once per sandbox during the init phase."""
+
+    @pytest.fixture
+    def task_root(self, tmp_path, monkeypatch):
+        (tmp_path / "init_test_handler.py").write_text("IMPORTS = []\nIMPORTS.append(1)\n\ndef handler(event, context):\n    return {'echo': event, 'requestId': context.aws_request_id}\n")
+        monkeypatch.setenv("LAMBDA_TASK_ROOT", str(tmp_path))
+        monkeypatch.setenv("_HANDLER", "init_test_handler.handler")
+        monkeypatch.setattr(sys, "path", list(sys.path))
+        yield tmp_path
+        sys.modules.pop("init_test_handler", None)
+
+    def test_handler_is_imported_once(self, task_root):
+        """Test that warm invocations reuse the resolved handler and do not grow sys.path."""
+        sent = []
+        with patch.object(lambda_runtime, "send_response", side_effect=lambda api, request_id, result: sent.append(result)):
+            lambda_runtime.run_normal_handler({"n": 1}, "request-1", "127.0.0.1:9001")
+            path_length = len(sys.path)
+            lambda_runtime.run_normal_handler({"n": 2}, "request-2", "127.0.0.1:9001")
+
+        assert sent == [{"echo": {"n": 1}, "requestId": "request-1"}, {"echo": {"n": 2}, "requestId": "request-2"}]
+        assert len(sys.path) == path_length
+        assert sys.modules["init_test_handler"].IMPORTS == [1]
+
+    def test_init_resolves_handler(self, task_root):
+        """Test that the init phase resolves the handler before the first invocation."""
+        lambda_runtime.init("127.0.0.1:9001", debugging=False)
+
+        assert lambda_runtime._handler is sys.modules["init_test_handler"].handler
+
+    def test_init_error_is_reported(self, monkeypatch):
+        """Test that a handler that cannot be imported is reported as an init error."""
+        monkeypatch.setenv("_HANDLER", "missing_module_for_init_test.handler")
+
+        with patch.object(lambda_runtime, "send_init_error") as mock_send_init_error, pytest.raises(SystemExit):
+            lambda_runtime.init("127.0.0.1:9001", debugging=False)
+
+        args = mock_send_init_error.call_args[0]
+        assert args[0] == "127.0.0.1:9001"
+        assert args[2] == "ModuleNotFoundError"
+
+    def test_init_error_is_tolerated_while_debugging(self, monkeypatch):
+        """Test that forwarding to the debugger does not need the handler in the sandbox."""
+        monkeypatch.setenv("_HANDLER", "missing_module_for_init_test.handler")
+
+        with patch.object(lambda_runtime, "send_init_error") as mock_send_init_error:
+            lambda_runtime.init("127.0.0.1:9001", debugging=True)
+
+        mock_send_init_error.assert_not_called()
+
+    def test_send_init_error(self, runtime_api):
+        """Test that init errors are posted to the init error endpoint."""
+        lambda_runtime.send_init_error(runtime_api.address, "Import failed", "ImportError")
+
+        assert runtime_api.requests[0][:2] == ("POST", "/2018-06-01/runtime/init/error")
+        assert runtime_api.init_errors == [{"errorMessage": "Import failed", "errorType": "ImportError"}]
+
+
+class TestSnapStart:
+    """Test the init phase of SnapStart functions ending in a snapshot."""
+
+    def test_hooks_run_around_restore(self, runtime_api, monkeypatch):
+        """Test that before-snapshot hooks run in reverse order, then the restore is awaited, then after-restore hooks run."""
+        calls = []
+        monkeypatch.setattr(lambda_runtime, "get_lambda_runtime_api", lambda: runtime_api.address)
+        lambda_runtime.register_before_snapshot(calls.append, "before-1")
+        lambda_runtime.register_before_snapshot(calls.append, "before-2")
+        lambda_runtime.register_after_restore(lambda: calls.append(runtime_api.requests[-1][:2]))
+        lambda_runtime.register_after_restore(calls.append, "after-2")
+
+        lambda_runtime.snapshot_and_restore(runtime_api.address)
+
+        assert calls == ["before-2", "before-1", ("GET", "/2018-06-01/runtime/restore/next"), "after-2"]
+
+    def test_function_hooks_are_run(self, runtime_api, monkeypatch):
+        """Test that hooks the function registered with snapshot_restore_py are run like the managed runtime does."""
+        calls = []
+        module = Mock()
+        module.get_before_snapshot.return_value = [(calls.append, ("function-before",), {})]
+        module.get_after_restore.return_value = [(calls.append, ("function-after",), {})]
+        monkeypatch.setitem(sys.modules, "snapshot_restore_py", module)
+        lambda_runtime.register_before_snapshot(calls.append, "runtime-before")
+        lambda_runtime.register_after_restore(calls.append, "runtime-after")
+
+        lambda_runtime.snapshot_and_restore(runtime_api.address)
+
+        assert calls == ["function-before", "runtime-before", "runtime-after", "function-after"]
+
+    def test_failing_before_snapshot_hook_fails_init(self, runtime_api):
+        """Test that a failing before-snapshot hook is reported as an init error and no snapshot is taken."""
+        lambda_runtime.register_before_snapshot(Mock(side_effect=RuntimeError("cannot prepare")))
+
+        with pytest.raises(SystemExit):
+            lambda_runtime.snapshot_and_restore(runtime_api.address)
+
+        assert runtime_api.init_errors == [{"errorMessage": "cannot prepare", "errorType": "RuntimeError"}]
+        assert not any(path.endswith("/restore/next") for _, path, _ in runtime_api.requests)
+
+    def test_failing_after_restore_hook_fails_restore(self, runtime_api):
+        """Test that a failing after-restore hook is reported as a restore error."""
+        lambda_runtime.register_after_restore(Mock(side_effect=RuntimeError("cannot reconnect")))
+
+        with pytest.raises(SystemExit):
+            lambda_runtime.snapshot_and_restore(runtime_api.address)
+
+        assert runtime_api.restore_errors == [{"errorMessage": "cannot reconnect", "errorType": "RuntimeError"}]
+
+    def test_connections_are_renewed_after_restore(self, runtime_api, monkeypatch):
+        """Test that the snapshot holds no connection nor credentials of the debug path and both are renewed on restore."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", runtime_api.address)
+        channel = Mock()
+        monkeypatch.setattr(lambda_runtime, "_response_channel", channel)
+        monkeypatch.setattr(lambda_runtime, "_response_channel_retry_at", time.time() + 60)
+        lambda_runtime._session_cache._session = Mock()
+        lambda_runtime._session_cache._expiration = time.time() + 3600
+        prewarm = Mock()
+        monkeypatch.setattr(lambda_runtime, "prewarm_debugger_connections", prewarm)
+
+        lambda_runtime.release_debugger_connections()
+
+        channel.close.assert_called_once()
+        assert lambda_runtime._response_channel is None
+        assert lambda_runtime._response_channel_retry_at == 0.0
+        assert lambda_runtime._session_cache._session is None
+
+        lambda_runtime.get_runtime_api_client(runtime_api.address).restore_next()
+        lambda_runtime.refresh_debugger_connections("session", "connection")
+
+        prewarm.assert_called_once_with("session", "connection")
+        assert lambda_runtime.get_runtime_api_client(runtime_api.address)._connection is None
+
+
+class TestStreaming:
+    """Test streamed responses of handlers and of the debugger."""
+
+    def test_handler_stream_is_relayed_as_produced(self, runtime_api, monkeypatch):
+        """Test that each chunk reaches the Runtime API before the handler produces the next one."""
+
+        def handler(event, context):
+            yield b"first"
+            # Time to first byte is kept: the first chunk arrived while the handler still runs
+            runtime_api.wait_for_chunks("request-1", 1)
+            yield "second"
+            yield {"n": 1}
+
+        monkeypatch.setattr(lambda_runtime, "get_handler", Mock(return_value=handler))
+
+        assert lambda_runtime.run_normal_handler({}, "request-1", runtime_api.address) == (None, None)
+        stream = runtime_api.streams["request-1"]
+        assert stream["mode"] == "streaming"
+        assert stream["chunks"] == [b"first", b"second", b'{"n": 1}']
+        assert stream["trailers"] == {}
+        assert runtime_api.responses["request-1"] == b'firstsecond{"n": 1}'
+
+    def test_handler_stream_failure_is_reported_in_trailers(self, runtime_api, monkeypatch):
+        """Test that a handler failing mid-stream ends the stream with its error."""
+
+        def handler(event, context):
+            yield "partial"
+            raise ValueError("broken")
+
+        monkeypatch.setattr(lambda_runtime, "get_handler", Mock(return_value=handler))
+
+        assert lambda_runtime.run_normal_handler({}, "request-1", runtime_api.address) == (None, "broken")
+        stream = runtime_api.streams["request-1"]
+        assert stream["chunks"] == [b"partial"]
+        assert stream["trailers"]["Lambda-Runtime-Function-Error-Type"] == "ValueError"
+        assert json.loads(base64.b64decode(stream["trailers"]["Lambda-Runtime-Function-Error-Body"])) == {"errorMessage": "broken", "errorType": "ValueError"}
+
+    def test_stream_is_kept_for_shadow_copies(self, runtime_api, monkeypatch):
+        """Test that a streamed result is joined only when asked to keep it."""
+        monkeypatch.setattr(lambda_runtime, "get_handler", Mock(return_value=lambda event, context: iter(["a", "b"])))
+
+        assert lambda_runtime.run_normal_handler({}, "request-1", runtime_api.address, keep_stream=True) == (b"ab", None)
+        assert runtime_api.streams["request-1"]["chunks"] == [b"a", b"b"]
+
+    def test_pushed_chunks_are_put_in_order(self, websocket_api, runtime_api, monkeypatch):
+        """Test that chunks pushed out of order are sent in order and a chunk never pushed is read from the table."""
+        monkeypatch.setattr(lambda_runtime, "PUSH_FALLBACK_POLL_INTERVAL_SECONDS", 0.2)
+        channel = lambda_runtime.get_response_channel("test-session")
+        mock_table = Mock()
+        mock_table.get_item.side_effect = lambda Key, **kwargs: {"Item": {"Chunk": Binary(b"two")}} if Key["RequestId"] == "test-request-id#chunk#2" else {}
+
+        websocket_api.push({"requestId": "test-request-id", "statusCode": 200, "response": base64.b64encode(zlib.compress(b"one")).decode(), "encoding": "zlib", "chunk": 1})
+        websocket_api.push({"requestId": "test-request-id", "statusCode": 200, "response": base64.b64encode(b"zero").decode(), "chunk": 0})
+        websocket_api.push({"requestId": "test-request-id", "statusCode": 200, "response": "", "streamed": 3})
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=5, channel=channel)
+            assert error is None
+            assert isinstance(response, lambda_runtime.StreamedResponse)
+            assert lambda_runtime.send_streaming_response(runtime_api.address, "test-request-id", response) is None
+
+        assert runtime_api.streams["test-request-id"]["chunks"] == [b"zero", b"one", b"two"]
+
+    def test_streamed_error_ends_the_stream(self, websocket_api, runtime_api):
+        """Test that the error of the debugger is reported after the chunks sent before it."""
+        channel = lambda_runtime.get_response_channel("test-session")
+        websocket_api.push({"requestId": "test-request-id", "statusCode": 200, "response": base64.b64encode(b"zero").decode(), "chunk": 0})
+        websocket_api.push({"requestId": "test-request-id", "statusCode": 500, "response": "", "errorMessage": "Boom", "streamed": 1})
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=Mock()):
+            response, _ = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=5, channel=channel)
+            assert lambda_runtime.send_streaming_response(runtime_api.address, "test-request-id", response) == "Boom"
+
+        stream = runtime_api.streams["test-request-id"]
+        assert stream["chunks"] == [b"zero"]
+        assert stream["trailers"]["Lambda-Runtime-Function-Error-Type"] == "DebuggerStreamError"
+
+    def test_stream_is_read_from_table_without_channel(self, monkeypatch):
+        """Test that a runtime polling DynamoDB reads the chunks once the debugger started streaming."""
+        monkeypatch.setenv("DEBUGGER_POLL_INITIAL_INTERVAL_MS", "1")
+        items = {"test-request-id": {"StatusCode": 0, "Streaming": True}}
+        mock_table = Mock()
+        mock_table.get_item.side_effect = lambda Key, **kwargs: {"Item": items[Key["RequestId"]]} if Key["RequestId"] in items else {}
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=mock_table):
+            response, error = lambda_runtime.poll_for_response(Mock(), "test-request-id", timeout=5)
+            assert error is None
+            items["test-request-id#chunk#0"] = {"Chunk": b"zero"}
+            assert next(response) == b"zero"
+
+            items["test-request-id"] = {"StatusCode": 200, "Streaming": True, "Streamed": Decimal(1)}
+            assert list(response) == []
+
+    def test_stream_stops_at_deadline(self, monkeypatch):
+        """Test that a stream the debugger does not finish fails before the function deadline."""
+        response = lambda_runtime.StreamedResponse(Mock(), "test-request-id", time.time() + 0.05)
+
+        with patch.object(lambda_runtime, "get_debugger_table", return_value=Mock(get_item=Mock(return_value={}))):
+            with pytest.raises(lambda_runtime.DebuggerStreamError, match="deadline"):
+                next(response)
 
 
 class TestMainLoop:
@@ -390,6 +2350,28 @@ class TestMainLoop:
 
         pass
 
+    @pytest.fixture(autouse=True)
+    def resolved_handler(self, monkeypatch):
+        """Resolve a stub handler during the init phase."""
+        handler = Mock(return_value={"statusCode": 200})
+        monkeypatch.setattr(lambda_runtime, "resolve_handler", Mock(return_value=handler))
+        return handler
+
+    @pytest.fixture(autouse=True)
+    def routing_rules(self, monkeypatch):
+        """Run an active session without routing rules, forwarding every invocation."""
+        get_rules = Mock(return_value=None)
+        monkeypatch.setattr(lambda_runtime._session_item_cache, "get_rules", get_rules)
+        monkeypatch.setattr(lambda_runtime._session_item_cache, "get_status", Mock(return_value="ACTIVE"))
+        return get_rules
+
+    @pytest.fixture(autouse=True)
+    def prewarm(self, monkeypatch):
+        """Skip opening connections during init."""
+        prewarm = Mock()
+        monkeypatch.setattr(lambda_runtime, "prewarm_debugger_connections", prewarm)
+        return prewarm
+
     @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
     @patch("plldb.cloudformation.layer.lambda_runtime.run_normal_handler")
     def test_main_normal_mode(self, mock_run_normal, mock_get_next, monkeypatch):
@@ -399,13 +2381,16 @@ class TestMainLoop:
         monkeypatch.delenv("DEBUGGER_CONNECTION_ID", raising=False)
 
         # First call returns event, second call raises to exit loop
-        mock_get_next.side_effect = [({"test": "event"}, "request-1"), self.StopLoopException("Exit loop")]
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
 
         with pytest.raises(self.StopLoopException):
             lambda_runtime.main()
 
         # Verify normal handler was called
-        mock_run_normal.assert_called_once_with({"test": "event"}, "request-1", "127.0.0.1:9001")
+        mock_run_normal.assert_called_once()
+        args = mock_run_normal.call_args[0]
+        assert args[:3] == ({"test": "event"}, "request-1", "127.0.0.1:9001")
+        assert args[3].aws_request_id == "request-1"
 
     @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
     @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
@@ -426,7 +2411,7 @@ class TestMainLoop:
         mock_poll.return_value = ({"result": "success"}, None)
 
         # First call returns event, second raises to exit
-        mock_get_next.side_effect = [({"test": "event"}, "request-1"), self.StopLoopException("Exit loop")]
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
 
         with pytest.raises(self.StopLoopException):
             lambda_runtime.main()
@@ -439,12 +2424,52 @@ class TestMainLoop:
             "test-session",
             "test-connection",
             {"test": "event"},
-            {"aws_request_id": "request-1", "function_name": "test-function", "function_version": "", "invoked_function_arn": "", "memory_limit_in_mb": ""},
+            {
+                "aws_request_id": "request-1",
+                "function_name": "test-function",
+                "function_version": "",
+                "invoked_function_arn": "",
+                "memory_limit_in_mb": "",
+                "deadline_ms": None,
+                "trace_id": None,
+                "client_context": None,
+                "identity": None,
+            },
+            None,
+            None,
+            None,
+            ANY,
         )
+        assert isinstance(mock_create_request.call_args[0][9], lambda_runtime.EnvironmentSnapshot)
         mock_send_debugger_request.assert_called_once()
-        mock_poll.assert_called_once_with(mock_session, "request-1")
+        mock_poll.assert_called_once_with(mock_session, "request-1", stats=ANY, channel=None, deadline_ms=None, hedge_after_ms=None, poll_first=False)
         mock_send_response.assert_called_once_with("127.0.0.1:9001", "request-1", {"result": "success"})
 
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_response_channel")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.poll_for_response")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_response")
+    def test_main_debug_mode_response_arrived_first(
+        self, mock_send_response, mock_poll, mock_send_debugger_request, mock_create_request, mock_get_channel, mock_assume_role, mock_get_next, monkeypatch
+    ):
+        """Test that a response stored before the request item is polled at once rather than waited for on the channel."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        mock_create_request.return_value = False
+        mock_poll.return_value = ({"result": "early"}, None)
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        assert mock_poll.call_args[1]["channel"] is mock_get_channel.return_value
+        assert mock_poll.call_args[1]["poll_first"] is True
+        mock_send_response.assert_called_once_with("127.0.0.1:9001", "request-1", {"result": "early"})
+
     @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
     @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
     @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
@@ -463,7 +2488,7 @@ class TestMainLoop:
         mock_poll.return_value = (None, "Debugger error")
 
         # First call returns event, second raises to exit
-        mock_get_next.side_effect = [({"test": "event"}, "request-1"), self.StopLoopException("Exit loop")]
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
 
         with pytest.raises(self.StopLoopException):
             lambda_runtime.main()
@@ -484,7 +2509,7 @@ class TestMainLoop:
         mock_assume_role.side_effect = Exception("Role assumption failed")
 
         # First call returns event, second raises to exit
-        mock_get_next.side_effect = [({"test": "event"}, "request-1"), self.StopLoopException("Exit loop")]
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
 
         with pytest.raises(self.StopLoopException):
             lambda_runtime.main()
@@ -508,7 +2533,7 @@ class TestMainLoop:
         mock_create_request.side_effect = Exception("DynamoDB error")
 
         # First call returns event, second raises to exit
-        mock_get_next.side_effect = [({"test": "event"}, "request-1"), self.StopLoopException("Exit loop")]
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
 
         with pytest.raises(self.StopLoopException):
             lambda_runtime.main()
@@ -525,7 +2550,11 @@ class TestMainLoop:
         monkeypatch.delenv("DEBUGGER_CONNECTION_ID", raising=False)
 
         # Setup mocks - normal handler throws exception on first call
-        mock_get_next.side_effect = [({"test": "event1"}, "request-1"), ({"test": "event2"}, "request-2"), self.StopLoopException("Exit loop")]
+        mock_get_next.side_effect = [
+            ({"test": "event1"}, lambda_runtime.LambdaContext("request-1")),
+            ({"test": "event2"}, lambda_runtime.LambdaContext("request-2")),
+            self.StopLoopException("Exit loop"),
+        ]
         mock_run_normal.side_effect = [
             Exception("Handler error"),
             None,  # Second call succeeds
@@ -561,7 +2590,7 @@ class TestMainLoop:
         monkeypatch.setattr("plldb.cloudformation.layer.lambda_runtime.send_error", mock_send_error)
 
         # First call returns event, second raises to exit
-        mock_get_next.side_effect = [({"test": "event"}, "request-1"), self.StopLoopException("Exit loop")]
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
 
         with pytest.raises(self.StopLoopException):
             lambda_runtime.main()
@@ -576,3 +2605,313 @@ class TestMainLoop:
         # Verify poll was not called since we errored out earlier
         mock_poll.assert_not_called()
         mock_send_response.assert_not_called()
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.poll_for_response")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_response")
+    def test_main_debug_mode_forwards_deadline(self, mock_send_response, mock_poll, mock_send_debugger_request, mock_create_request, mock_assume_role, mock_get_next, monkeypatch):
+        """Test that the invocation deadline and trace header reach the debugger and bound the wait."""
+        monkeypatch.setenv("_X_AMZN_TRACE_ID", "")
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        mock_poll.return_value = ({"result": "success"}, None)
+        context = lambda_runtime.LambdaContext("request-1", deadline_ms=1700000000000, trace_id="Root=1-abc")
+        mock_get_next.side_effect = [({"test": "event"}, context), self.StopLoopException("Exit loop")]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        message = mock_send_debugger_request.call_args[0][2]
+        assert message["deadlineMs"] == 1700000000000
+        assert message["environmentDelta"]["_X_AMZN_TRACE_ID"] == "Root=1-abc"
+        assert mock_create_request.call_args[0][5]["deadline_ms"] == 1700000000000
+        assert mock_poll.call_args[1]["deadline_ms"] == 1700000000000
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.poll_for_response")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_response")
+    def test_main_debug_mode_emits_metrics(self, mock_send_response, mock_poll, mock_send_debugger_request, mock_create_request, mock_assume_role, mock_get_next, monkeypatch, capsys):
+        """Test that every debug invocation writes one EMF line with all phases."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "test-function")
+        mock_poll.return_value = ({"result": "success"}, None)
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+        assert len(records) == 1
+        assert records[0]["FunctionName"] == "test-function"
+        assert records[0]["SessionId"] == "test-session"
+        assert all(f"{phase}Duration" in records[0] for phase in lambda_runtime.INVOCATION_PHASES if phase not in ("Prewarm", "Hedge"))
+        assert "Hedged" not in records[0]
+        assert records[0]["ColdStart"] == 0
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.run_normal_handler")
+    def test_main_debug_mode_skips_unrouted_invocations(self, mock_run_normal, mock_create_request, mock_assume_role, mock_get_next, routing_rules, monkeypatch, capsys):
+        """Test that invocations not selected by the routing rules run in the sandbox."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "orders-list")
+        routing_rules.return_value = {"functions": ["orders-create"]}
+        context = lambda_runtime.LambdaContext("request-1")
+        mock_get_next.side_effect = [({"test": "event"}, context), self.StopLoopException("Exit loop")]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        mock_run_normal.assert_called_once_with({"test": "event"}, "request-1", "127.0.0.1:9001", context)
+        mock_create_request.assert_not_called()
+        assert '{"_aws"' not in capsys.readouterr().out
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.poll_for_response")
+    @patch("plldb.cloudformation.layer.lambda_runtime.supersede_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.run_normal_handler")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_response")
+    def test_main_debug_mode_hedges_to_handler(
+        self, mock_send_response, mock_run_normal, mock_supersede, mock_poll, mock_send_debugger_request, mock_create_request, mock_assume_role, mock_get_next, monkeypatch, capsys
+    ):
+        """Test that the deployed handler answers when the debugger misses the hedging delay."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        monkeypatch.setenv("DEBUGGER_HEDGE_AFTER_MS", "2000")
+
+        mock_poll.return_value = (None, lambda_runtime.HEDGE_TIMEOUT_MESSAGE)
+        mock_supersede.return_value = True
+        context = lambda_runtime.LambdaContext("request-1")
+        mock_get_next.side_effect = [({"test": "event"}, context), self.StopLoopException("Exit loop")]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        assert mock_poll.call_args[1]["hedge_after_ms"] == 2000
+        mock_supersede.assert_called_once_with(mock_assume_role.return_value, "request-1")
+        mock_run_normal.assert_called_once_with({"test": "event"}, "request-1", "127.0.0.1:9001", context)
+        mock_send_response.assert_not_called()
+        record = next(json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"'))
+        assert record["Hedged"] == 1
+        assert "HedgeDuration" in record
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.poll_for_response")
+    @patch("plldb.cloudformation.layer.lambda_runtime.supersede_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.run_normal_handler")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_response")
+    def test_main_debug_mode_uses_response_racing_the_hedge(
+        self, mock_send_response, mock_run_normal, mock_supersede, mock_poll, mock_send_debugger_request, mock_create_request, mock_assume_role, mock_get_next, monkeypatch, capsys
+    ):
+        """Test that a response stored while superseding the request is returned and not counted as hedged."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        monkeypatch.setenv("DEBUGGER_HEDGE_AFTER_MS", "2000")
+
+        def hedge(*args, stats=None, **kwargs):
+            if stats is None:
+                return {"result": "late"}, None
+            return None, lambda_runtime.HEDGE_TIMEOUT_MESSAGE
+
+        mock_poll.side_effect = hedge
+        mock_supersede.return_value = False
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        mock_run_normal.assert_not_called()
+        mock_send_response.assert_called_once_with("127.0.0.1:9001", "request-1", {"result": "late"})
+        record = next(json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"'))
+        assert record["Hedged"] == 0
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_apigateway_client")
+    @patch("plldb.cloudformation.layer.lambda_runtime.poll_for_response")
+    @patch("plldb.cloudformation.layer.lambda_runtime.run_normal_handler")
+    def test_main_debug_mode_gone_connection_runs_handler(self, mock_run_normal, mock_poll, mock_get_client, mock_create_request, mock_assume_role, mock_get_next, monkeypatch):
+        """Test that a gone debugger connection stops costing latency from the same invocation on."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        monkeypatch.setenv("DEBUGGER_WEBSOCKET_API_ENDPOINT", "https://test.execute-api.us-east-1.amazonaws.com/prod")
+        error = Exception("GoneException")
+        error.response = {"Error": {"Code": "GoneException"}}
+        mock_get_client.return_value.post_to_connection.side_effect = error
+        first = lambda_runtime.LambdaContext("request-1")
+        second = lambda_runtime.LambdaContext("request-2")
+        mock_get_next.side_effect = [({"n": 1}, first), ({"n": 2}, second), self.StopLoopException("Exit loop")]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        mock_poll.assert_not_called()
+        assert mock_run_normal.call_args_list == [call({"n": 1}, "request-1", "127.0.0.1:9001", first), call({"n": 2}, "request-2", "127.0.0.1:9001", second)]
+        assert mock_create_request.call_count == 1
+        assert mock_get_client.return_value.post_to_connection.call_count == 1
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_debugger_request")
+    @patch("plldb.cloudformation.layer.lambda_runtime.poll_for_response")
+    @patch("plldb.cloudformation.layer.lambda_runtime.send_response")
+    def test_main_prewarms_before_first_invocation(self, mock_send_response, mock_poll, mock_send_debugger_request, mock_create_request, mock_assume_role, mock_get_next, prewarm, monkeypatch, capsys):
+        """Test that connections are opened during init and the first invocation reports the cold start."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        prewarm.side_effect = lambda *args: setattr(lambda_runtime, "_prewarm_ms", 120.0)
+        mock_poll.return_value = ({"result": "success"}, None)
+        mock_get_next.side_effect = [
+            ({"n": 1}, lambda_runtime.LambdaContext("request-1")),
+            ({"n": 2}, lambda_runtime.LambdaContext("request-2")),
+            self.StopLoopException("Exit loop"),
+        ]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        prewarm.assert_called_once_with("test-session", "test-connection")
+        records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+        assert [record["ColdStart"] for record in records] == [1, 0]
+        assert records[0]["PrewarmDuration"] == 120.0
+        assert "PrewarmDuration" not in records[1]
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.snapshot_and_restore")
+    def test_main_snapstart(self, mock_snapshot, mock_get_next, prewarm, monkeypatch):
+        """Test that a SnapStart init phase sets up the debug path before the snapshot and renews it after the restore."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("AWS_LAMBDA_INITIALIZATION_TYPE", "snap-start")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        calls = []
+        prewarm.side_effect = lambda *args: calls.append("prewarm")
+        mock_snapshot.side_effect = lambda *args: calls.append("snapshot")
+        mock_get_next.side_effect = self.StopLoopException("Exit loop")
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        assert calls == ["prewarm", "snapshot"]
+        mock_snapshot.assert_called_once_with("127.0.0.1:9001")
+        assert lambda_runtime._before_snapshot_hooks == [(lambda_runtime.release_debugger_connections, (), {})]
+        assert lambda_runtime._after_restore_hooks == [(lambda_runtime.refresh_debugger_connections, ("test-session", "test-connection"), {})]
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.snapshot_and_restore")
+    def test_main_without_snapstart(self, mock_snapshot, mock_get_next, monkeypatch):
+        """Test that on-demand sandboxes do not wait for a restore."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("AWS_LAMBDA_INITIALIZATION_TYPE", "on-demand")
+        mock_get_next.side_effect = self.StopLoopException("Exit loop")
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        mock_snapshot.assert_not_called()
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.run_normal_handler")
+    @patch("plldb.cloudformation.layer.lambda_runtime.capture_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.create_traffic_capture")
+    def test_main_capture_mode(self, mock_create_capture, mock_capture_invocation, mock_run_normal, mock_get_next, monkeypatch):
+        """Test that sampled invocations are captured, and pending captures are handled before every freeze."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.delenv("DEBUGGER_SESSION_ID", raising=False)
+        monkeypatch.delenv("DEBUGGER_CONNECTION_ID", raising=False)
+        capture = mock_create_capture.return_value
+        capture.sample.side_effect = [True, False]
+        calls = []
+        capture.before_freeze.side_effect = lambda: calls.append("freeze")
+        mock_capture_invocation.side_effect = lambda *args: calls.append("capture")
+        mock_run_normal.side_effect = lambda *args, **kwargs: calls.append("handler") or ({}, None)
+        mock_get_next.side_effect = [
+            ({"n": 1}, lambda_runtime.LambdaContext("request-1")),
+            ({"n": 2}, lambda_runtime.LambdaContext("request-2")),
+            self.StopLoopException("Exit loop"),
+        ]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        assert calls == ["freeze", "capture", "freeze", "handler", "freeze"]
+        assert mock_capture_invocation.call_args[0][:3] == (capture, {"n": 1}, "request-1")
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.run_normal_handler")
+    @patch("plldb.cloudformation.layer.lambda_runtime.mirror_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.assume_debugger_role")
+    def test_main_shadow_mode(self, mock_assume_role, mock_mirror, mock_run_normal, mock_get_next, monkeypatch):
+        """Test that in shadow mode the deployed handler answers and the invocation is mirrored afterwards."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        monkeypatch.setenv("DEBUGGER_SESSION_MODE", "shadow")
+        calls = []
+        mock_run_normal.side_effect = lambda *args, **kwargs: calls.append("handler") or ({"statusCode": 200}, None)
+        mock_mirror.side_effect = lambda *args: calls.append("mirror")
+        mock_get_next.side_effect = [({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")]
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        assert calls == ["handler", "mirror"]
+        args = mock_mirror.call_args[0]
+        assert args[:3] == ("test-session", "test-connection", {"test": "event"})
+        assert args[4:] == ({"statusCode": 200}, None)
+        # A streamed result has to be kept for the copy
+        assert mock_run_normal.call_args[1] == {"keep_stream": True}
+        mock_assume_role.assert_not_called()
+
+    @patch("plldb.cloudformation.layer.lambda_runtime.get_next_invocation")
+    @patch("plldb.cloudformation.layer.lambda_runtime.run_normal_handler")
+    @patch("plldb.cloudformation.layer.lambda_runtime.forward_shadow_copy")
+    def test_main_shadow_mode_sends_copy_before_next_invocation(self, mock_forward, mock_run_normal, mock_get_next, monkeypatch):
+        """Test that the copy is sent before the next invocation is requested, which freezes the sandbox."""
+        monkeypatch.setenv("AWS_LAMBDA_RUNTIME_API", "127.0.0.1:9001")
+        monkeypatch.setenv("DEBUGGER_SESSION_ID", "test-session")
+        monkeypatch.setenv("DEBUGGER_CONNECTION_ID", "test-connection")
+        monkeypatch.setenv("DEBUGGER_SESSION_MODE", "shadow")
+        monkeypatch.setattr(lambda_runtime, "_shadow_forwarder", lambda_runtime.ShadowForwarder())
+        calls = []
+        mock_run_normal.return_value = ({"statusCode": 200}, None)
+        mock_forward.side_effect = lambda *args: time.sleep(0.05) or calls.append("sent")
+        events = iter([({"test": "event"}, lambda_runtime.LambdaContext("request-1")), self.StopLoopException("Exit loop")])
+
+        def get_next(runtime_api):
+            calls.append("next")
+            event = next(events)
+            if isinstance(event, Exception):
+                raise event
+            return event
+
+        mock_get_next.side_effect = get_next
+
+        with pytest.raises(self.StopLoopException):
+            lambda_runtime.main()
+
+        assert calls == ["next", "sent", "next"]
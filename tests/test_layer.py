@@ -1,8 +1,12 @@
 import os
+import subprocess
+import sys
 import tempfile
 import zipfile
 from pathlib import Path
 
+import pytest
+
 from plldb.setup import BootstrapManager
 
 
@@ -16,9 +20,12 @@ class TestLambdaLayer:
         assert layer_dir.exists()
         assert (layer_dir / "bootstrap").exists()
         assert (layer_dir / "lambda_runtime.py").exists()
+        assert (layer_dir / "lambda_extension.py").exists()
+        assert (layer_dir / "plldb_wrapper.py").exists()
 
         # Check bootstrap is executable
         assert os.access(layer_dir / "bootstrap", os.X_OK)
+        assert os.access(layer_dir / "plldb-extension", os.X_OK)
 
     def test_package_and_upload_layer(self, mock_aws_session, monkeypatch):
         """Test packaging and uploading the Lambda layer."""
@@ -60,6 +67,13 @@ class TestLambdaLayer:
                 # Check required files are in the bin/ directory
                 assert "bin/bootstrap" in namelist
                 assert "bin/lambda_runtime.py" in namelist
+                assert "bin/lambda_extension.py" in namelist
+                assert "extensions/plldb-extension" in namelist
+                assert "python/plldb_wrapper.py" in namelist
+
+                # Lambda only starts extensions that are executable
+                assert zipf.getinfo("extensions/plldb-extension").external_attr >> 16 & 0o111
+                assert "/opt/bin/lambda_extension.py" in zipf.read("extensions/plldb-extension").decode()
 
                 # Verify bootstrap content
                 bootstrap_content = zipf.read("bin/bootstrap").decode()
@@ -149,3 +163,55 @@ class TestLambdaLayer:
         assert calls["layer"]
         assert calls["template"]
         assert calls["deploy"]
+
+
+class TestDormantMode:
+    """Test that an attached layer costs nothing while no debugger session is configured."""
+
+    layer_dir = Path(__file__).parent.parent / "plldb" / "cloudformation" / "layer"
+
+    def _run_bootstrap(self, env: dict) -> subprocess.CompletedProcess:
+        return subprocess.run(["bash", str(self.layer_dir / "bootstrap"), "echo", "managed runtime"], env=env, capture_output=True, text=True, timeout=30)
+
+    def test_bootstrap_execs_managed_runtime_without_session(self):
+        """Test that the wrapper hands over to the original runtime when no session is set."""
+        env = {key: value for key, value in os.environ.items() if key != "DEBUGGER_SESSION_ID"}
+
+        result = self._run_bootstrap(env)
+
+        assert result.returncode == 0
+        assert result.stdout.strip() == "managed runtime"
+
+    def test_bootstrap_starts_debug_runtime_with_session(self):
+        """Test that the wrapper does not hand over to the original runtime when a session is set."""
+        result = self._run_bootstrap({**os.environ, "DEBUGGER_SESSION_ID": "test-session"})
+
+        assert "managed runtime" not in result.stdout
+
+    def test_bootstrap_starts_runtime_for_capture(self):
+        """Test that the wrapper keeps the layer runtime for traffic capture without a session."""
+        env = {key: value for key, value in os.environ.items() if key != "DEBUGGER_SESSION_ID"}
+
+        result = self._run_bootstrap({**env, "DEBUGGER_CAPTURE_SAMPLE_RATE": "0.1", "DEBUGGER_INTERCEPTION": "extension"})
+
+        assert "managed runtime" not in result.stdout
+
+    @pytest.mark.parametrize("session, interception", [(None, "extension"), ("test-session", None), ("test-session", "runtime")])
+    def test_extension_exits_without_extension_interception(self, session, interception):
+        """Test that the extension exits before registering unless a session uses the extension interception."""
+        env = {key: value for key, value in os.environ.items() if key not in ("DEBUGGER_SESSION_ID", "DEBUGGER_INTERCEPTION", "AWS_LAMBDA_RUNTIME_API")}
+        env.update({key: value for key, value in (("DEBUGGER_SESSION_ID", session), ("DEBUGGER_INTERCEPTION", interception)) if value})
+
+        result = subprocess.run(["bash", str(self.layer_dir / "plldb-extension")], env=env, capture_output=True, text=True, timeout=30)
+
+        assert result.returncode == 0
+        assert result.stdout == result.stderr == ""
+
+    def test_runtime_import_does_not_load_boto3(self):
+        """Test that boto3 is loaded only on the debug path."""
+        code = f"import sys; sys.path.insert(0, {str(self.layer_dir)!r}); import lambda_runtime; print('boto3' in sys.modules)"
+
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60)
+
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.strip() == "False"
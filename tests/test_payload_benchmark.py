@@ -0,0 +1,16 @@
+from benchmarks.payload_benchmark import RUNTIME_PATH, load_runtime, run_benchmark
+
+
+class TestPayloadBenchmark:
+    def test_raw_hops_do_not_copy_the_payload(self, capsys):
+        """Test that events and responses pass through the runtime without being decoded or copied."""
+        runtime = load_runtime(RUNTIME_PATH)
+        size = 256 * 1024
+
+        results = run_benchmark(runtime, size, repeat=1)
+
+        assert set(results) == {"NextInvocation", "Routing", "PayloadOffload", "ResponseRead", "RuntimeResponse"}
+        for hop in ("NextInvocation", "Routing", "ResponseRead", "RuntimeResponse"):
+            assert results[hop]["peakAllocMb"] * 1024 * 1024 < size / 4
+        # The serialized request holds one copy of the event
+        assert results["PayloadOffload"]["peakAllocMb"] * 1024 * 1024 < size * 2
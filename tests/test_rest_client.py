@@ -37,6 +37,42 @@ class TestRestApiClient:
         assert call_args.kwargs["timeout"] == 30
         assert json.loads(call_args.kwargs["data"]) == {"stackName": "test-stack"}
 
+    @patch("requests.post")
+    def test_create_session_with_mode(self, mock_post):
+        """Test that the session mode is sent when given."""
+        mock_post.return_value = Mock(status_code=201, json=Mock(return_value={"sessionId": "test-session-id"}))
+        mock_session = Mock()
+        mock_session.get_credentials.return_value = Mock(access_key="test-key", secret_key="test-secret", token=None)
+        mock_session.region_name = "us-east-1"
+
+        RestApiClient(mock_session).create_session("https://api.example.com", "test-stack", mode="shadow")
+
+        assert json.loads(mock_post.call_args.kwargs["data"]) == {"stackName": "test-stack", "mode": "shadow"}
+
+    @patch("requests.post")
+    def test_create_session_with_snapstart(self, mock_post):
+        """Test that SnapStart is requested only when enabled."""
+        mock_post.return_value = Mock(status_code=201, json=Mock(return_value={"sessionId": "test-session-id"}))
+        mock_session = Mock()
+        mock_session.get_credentials.return_value = Mock(access_key="test-key", secret_key="test-secret", token=None)
+        mock_session.region_name = "us-east-1"
+
+        RestApiClient(mock_session).create_session("https://api.example.com", "test-stack", snapstart=True)
+
+        assert json.loads(mock_post.call_args.kwargs["data"]) == {"stackName": "test-stack", "snapStart": True}
+
+    @patch("requests.post")
+    def test_create_session_with_direct_access(self, mock_post):
+        """Test that the access of the debug runtime is sent when set."""
+        mock_post.return_value = Mock(status_code=201, json=Mock(return_value={"sessionId": "test-session-id"}))
+        mock_session = Mock()
+        mock_session.get_credentials.return_value = Mock(access_key="test-key", secret_key="test-secret", token=None)
+        mock_session.region_name = "us-east-1"
+
+        RestApiClient(mock_session).create_session("https://api.example.com", "test-stack", access="direct")
+
+        assert json.loads(mock_post.call_args.kwargs["data"]) == {"stackName": "test-stack", "access": "direct"}
+
     @patch("requests.post")
     def test_create_session_api_error(self, mock_post):
         """Test API error handling."""
@@ -82,3 +118,33 @@ class TestRestApiClient:
         client = RestApiClient(mock_session)
         with pytest.raises(ValueError, match="No sessionId returned from API"):
             client.create_session("https://api.example.com", "test-stack")
+
+    @patch("requests.put")
+    def test_update_routing_rules(self, mock_put):
+        """Test that routing rules are sent signed to the session routing resource."""
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_put.return_value = mock_response
+
+        # Mock session
+        mock_session = Mock()
+        mock_credentials = Mock()
+        mock_credentials.access_key = "test-key"
+        mock_credentials.secret_key = "test-secret"
+        mock_credentials.token = None
+        mock_session.get_credentials.return_value = mock_credentials
+        mock_session.region_name = "us-east-1"
+
+        # Test
+        client = RestApiClient(mock_session)
+        client.update_routing_rules("https://api.example.com", "session-1", {"sampleRate": 10})
+
+        call_args = mock_put.call_args
+        assert call_args.args[0] == "https://api.example.com/sessions/session-1/routing"
+        assert "Authorization" in call_args.kwargs["headers"]
+        assert json.loads(call_args.kwargs["data"]) == {"routingRules": {"sampleRate": 10}}
+
+        mock_response.status_code = 404
+        mock_response.text = "Session not found"
+        with pytest.raises(ValueError, match="Failed to update routing rules: 404 - Session not found"):
+            client.update_routing_rules("https://api.example.com", "session-1", {})
@@ -34,6 +34,121 @@ class TestRestApiLambda:
         assert item["Status"] == "PENDING"
         assert item["TTL"] > int(time.time())
         assert item["TTL"] <= int(time.time()) + 3600
+        # The runtime secret is stored for the authorizer and not returned with the session ID
+        assert len(item["RuntimeSecret"]) >= 32
+        assert "runtimeSecret" not in body
+
+    def test_create_session_with_compression(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "compression": "zlib"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 201
+        item = dynamodb.Table("PLLDBSessions").get_item(Key={"SessionId": json.loads(response["body"])["sessionId"]})["Item"]
+        assert item["Compression"] == "zlib"
+
+    def test_create_session_unsupported_compression(self, mock_aws_session):
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "compression": "brotli"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 400
+        assert "Unsupported compression" in json.loads(response["body"])["error"]
+
+    def test_create_session_with_mode(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "mode": "shadow"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 201
+        item = dynamodb.Table("PLLDBSessions").get_item(Key={"SessionId": json.loads(response["body"])["sessionId"]})["Item"]
+        assert item["Mode"] == "shadow"
+
+    def test_create_session_with_interception(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "interception": "extension"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 201
+        item = dynamodb.Table("PLLDBSessions").get_item(Key={"SessionId": json.loads(response["body"])["sessionId"]})["Item"]
+        assert item["Interception"] == "extension"
+
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "interception": "proxy"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 400
+        assert "Unsupported interception" in json.loads(response["body"])["error"]
+
+    def test_create_session_with_snapstart(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "snapStart": True})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 201
+        item = dynamodb.Table("PLLDBSessions").get_item(Key={"SessionId": json.loads(response["body"])["sessionId"]})["Item"]
+        assert item["SnapStart"] is True
+
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "snapStart": True, "interception": "extension"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 400
+        assert "requires the runtime interception" in json.loads(response["body"])["error"]
+
+    def test_create_session_with_direct_access(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "access": "direct"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 201
+        item = dynamodb.Table("PLLDBSessions").get_item(Key={"SessionId": json.loads(response["body"])["sessionId"]})["Item"]
+        assert item["Access"] == "direct"
+
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "access": "admin"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 400
+        assert "Unsupported access" in json.loads(response["body"])["error"]
+
+    def test_create_session_unsupported_mode(self, mock_aws_session):
+        event = {"httpMethod": "POST", "path": "/sessions", "body": json.dumps({"stackName": "test-stack", "mode": "replay"})}
+        response = lambda_handler(event, None)
+
+        assert response["statusCode"] == 400
+        assert "Unsupported mode" in json.loads(response["body"])["error"]
 
     def test_create_session_missing_stack_name(self, mock_aws_session):
         # Setup DynamoDB table
@@ -97,3 +212,53 @@ class TestRestApiLambda:
         assert response["statusCode"] == 404
         body = json.loads(response["body"])
         assert body["error"] == "Not Found"
+
+    def test_update_routing_rules(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        table = dynamodb.Table("PLLDBSessions")
+        table.put_item(Item={"SessionId": "session-1", "StackName": "test-stack"})
+        rules = {"functions": ["orders-create"], "sampleRate": 12.5, "predicates": [{"path": "$.httpMethod", "equals": "POST"}]}
+
+        response = lambda_handler({"httpMethod": "PUT", "path": "/sessions/session-1/routing", "body": json.dumps({"routingRules": rules})}, None)
+
+        assert response["statusCode"] == 200
+        stored = table.get_item(Key={"SessionId": "session-1"})["Item"]["RoutingRules"]
+        assert stored["functions"] == ["orders-create"]
+        assert float(stored["sampleRate"]) == 12.5
+        assert stored["predicates"] == [{"path": "$.httpMethod", "equals": "POST"}]
+
+        response = lambda_handler({"httpMethod": "PUT", "path": "/sessions/session-1/routing", "body": json.dumps({"routingRules": {}})}, None)
+
+        assert response["statusCode"] == 200
+        assert "RoutingRules" not in table.get_item(Key={"SessionId": "session-1"})["Item"]
+
+    def test_update_routing_rules_unknown_session(self, mock_aws_session):
+        dynamodb = mock_aws_session.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="PLLDBSessions",
+            KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        response = lambda_handler({"httpMethod": "PUT", "path": "/sessions/missing/routing", "body": json.dumps({"routingRules": {"sampleRate": 10}})}, None)
+
+        assert response["statusCode"] == 404
+
+    def test_update_routing_rules_invalid(self, mock_aws_session):
+        for rules, error in [
+            ({"sampleRate": 150}, "sampleRate must be a percentage between 0 and 100"),
+            ({"functions": "orders-create"}, "functions must be a list of function names"),
+            ({"predicates": [{"path": "httpMethod"}]}, "predicates must be objects with a path starting with $ and an optional equals"),
+            ({"regions": ["us-east-1"]}, "Unknown routing rules: regions"),
+        ]:
+            response = lambda_handler({"httpMethod": "PUT", "path": "/sessions/session-1/routing", "body": json.dumps({"routingRules": rules})}, None)
+
+            assert response["statusCode"] == 400
+            assert json.loads(response["body"])["error"] == error
@@ -0,0 +1,46 @@
+import pytest
+
+from benchmarks.runtime_benchmark import compare_results, percentile, run_benchmark
+
+
+def make_results(throughput: float, p50: float, p99: float) -> dict:
+    return {"version": 1, "modes": {"debug": {"throughput": throughput, "latency": {"Overhead": {"p50": p50, "p99": p99, "mean": p50}}}}}
+
+
+class TestRuntimeBenchmark:
+    def test_run_benchmark_reports_phases(self):
+        """Test that all modes run through the runtime and the debug phases are reported."""
+        results = run_benchmark(["normal", "debug", "debug-builtin"], invocations=5, warmup=1)
+
+        normal = results["modes"]["normal"]
+        assert normal["throughput"] > 0
+        assert set(normal["latency"]) == {"Init", "Invocation"}
+        for mode in ("debug", "debug-builtin"):
+            debug = results["modes"][mode]
+            assert debug["errors"] == 0
+            assert {"Init", "Invocation", "RequestWrite", "Notification", "DebuggerWait", "RuntimeResponse", "Total", "Overhead"} <= set(debug["latency"])
+            assert "Prewarm" not in debug["latency"]
+
+    def test_percentile(self):
+        """Test the nearest-rank percentile."""
+        values = [float(i) for i in range(1, 101)]
+
+        assert percentile(values, 50) == 50.0
+        assert percentile(values, 99) == 99.0
+        assert percentile([3.0], 99) == 3.0
+
+    def test_compare_results_flags_regressions(self):
+        """Test that slower latencies and lower throughput beyond the threshold are regressions."""
+        regressions = compare_results(make_results(100.0, 10.0, 20.0), make_results(70.0, 13.0, 21.0), threshold=0.2)
+
+        assert regressions == ["debug: throughput 100.00/s -> 70.00/s", "debug: Overhead p50 10.000 ms -> 13.000 ms"]
+
+    def test_compare_results_ignores_noise(self):
+        """Test that changes within the threshold or below the absolute minimum are not regressions."""
+        assert compare_results(make_results(100.0, 10.0, 20.0), make_results(90.0, 11.0, 22.0), threshold=0.2) == []
+        assert compare_results(make_results(100.0, 0.1, 0.2), make_results(100.0, 0.3, 0.4), threshold=0.2) == []
+
+    def test_compare_results_rejects_other_versions(self):
+        """Test that results in another format are not compared."""
+        with pytest.raises(ValueError):
+            compare_results({**make_results(100.0, 10.0, 20.0), "version": 0}, make_results(100.0, 10.0, 20.0), threshold=0.2)
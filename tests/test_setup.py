@@ -32,6 +32,10 @@ class TestBootstrapManager:
         assert config["BlockPublicPolicy"] is True
         assert config["RestrictPublicBuckets"] is True
 
+        lifecycle = s3_client.get_bucket_lifecycle_configuration(Bucket="plldb-core-infrastructure-us-east-1-123456789012")
+        assert lifecycle["Rules"][0]["Filter"]["Prefix"] == "payloads/"
+        assert lifecycle["Rules"][0]["Expiration"]["Days"] == 1
+
     def test_setup_idempotent_when_bucket_exists(self, mock_aws_session, monkeypatch):
         manager = BootstrapManager(session=mock_aws_session)
         s3_client = mock_aws_session.client("s3")
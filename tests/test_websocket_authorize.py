@@ -82,6 +82,56 @@ class TestWebSocketAuthorize:
         assert "context" in result
         assert result["context"]["sessionId"] == "test-session-id"
 
+    @patch("boto3.resource")
+    def test_runtime_connection_to_active_session_allows_access(self, mock_boto3_resource):
+        """Test that a runtime may join an ACTIVE session and gets the runtime role in context."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"SessionId": "test-session-id", "Status": "ACTIVE", "RuntimeSecret": "runtime-secret"}}
+        mock_dynamodb = Mock()
+        mock_dynamodb.Table.return_value = mock_table
+        mock_boto3_resource.return_value = mock_dynamodb
+
+        event = {
+            "methodArn": "arn:aws:execute-api:us-east-1:123456789012:abcdef123/*/GET/",
+            "queryStringParameters": {"sessionId": "test-session-id", "role": "runtime", "runtimeSecret": "runtime-secret"},
+        }
+
+        result = lambda_handler(event, None)
+
+        assert result["policyDocument"]["Statement"][0]["Effect"] == "Allow"
+        assert result["context"] == {"sessionId": "test-session-id", "role": "runtime"}
+
+    @patch("boto3.resource")
+    def test_runtime_connection_without_secret_denies_access(self, mock_boto3_resource):
+        """Test that knowing the sessionId is not enough for a runtime to join the session."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"SessionId": "test-session-id", "Status": "ACTIVE", "RuntimeSecret": "runtime-secret"}}
+        mock_dynamodb = Mock()
+        mock_dynamodb.Table.return_value = mock_table
+        mock_boto3_resource.return_value = mock_dynamodb
+
+        for query in ({"sessionId": "test-session-id", "role": "runtime"}, {"sessionId": "test-session-id", "role": "runtime", "runtimeSecret": "guessed"}):
+            event = {"methodArn": "arn:aws:execute-api:us-east-1:123456789012:abcdef123/*/GET/", "queryStringParameters": query}
+
+            result = lambda_handler(event, None)
+
+            assert result["policyDocument"]["Statement"][0]["Effect"] == "Deny"
+
+    @patch("boto3.resource")
+    def test_runtime_connection_to_pending_session_denies_access(self, mock_boto3_resource):
+        """Test that a runtime cannot connect before the debugger has connected."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"SessionId": "test-session-id", "Status": "PENDING"}}
+        mock_dynamodb = Mock()
+        mock_dynamodb.Table.return_value = mock_table
+        mock_boto3_resource.return_value = mock_dynamodb
+
+        event = {"methodArn": "arn:aws:execute-api:us-east-1:123456789012:abcdef123/*/GET/", "queryStringParameters": {"sessionId": "test-session-id", "role": "runtime"}}
+
+        result = lambda_handler(event, None)
+
+        assert result["policyDocument"]["Statement"][0]["Effect"] == "Deny"
+
     @patch("boto3.resource")
     def test_dynamodb_error_denies_access(self, mock_boto3_resource):
         """Test that DynamoDB errors result in denied access."""
@@ -135,6 +135,39 @@ class TestWebSocketClient:
         assert sent_messages[1]["statusCode"] == 200
         assert sent_messages[1]["response"] == "response-2"
 
+    @pytest.mark.asyncio
+    async def test_run_loop_relays_streamed_response(self):
+        """Test that the messages of a streamed response are sent one by one as they are produced."""
+        mock_ws = AsyncMock()
+        request = {"requestId": "req-1", "sessionId": "test-session-id", "connectionId": "conn-1", "lambdaFunctionName": "test-function", "lambdaFunctionVersion": "$LATEST", "event": "{}"}
+        mock_ws.recv.side_effect = [json.dumps(request), websockets.exceptions.ConnectionClosed(None, None)]
+        sent_before_produced = []
+
+        def stream():
+            yield DebuggerResponse(requestId="req-1", statusCode=200, response="Y2h1bms=", chunk=0)
+            sent_before_produced.append(mock_ws.send.call_count)
+            yield DebuggerResponse(requestId="req-1", statusCode=200, response="", streamed=1)
+
+        client = WebSocketClient("wss://example.com/ws", "test-session-id")
+
+        with patch("asyncio.get_event_loop") as mock_loop:
+            mock_loop.return_value.add_signal_handler = Mock()
+            mock_loop.return_value.remove_signal_handler = Mock()
+
+            async def mock_executor(executor, func, *args):
+                return func(*args)
+
+            mock_loop.return_value.run_in_executor = mock_executor
+
+            with patch("plldb.websocket_client.websockets.connect", new_callable=AsyncMock) as mock_connect:
+                mock_connect.return_value = mock_ws
+
+                await client.run_loop(Mock(return_value=stream()))
+
+        sent_messages = [json.loads(call.args[0]) for call in mock_ws.send.call_args_list]
+        assert [(message["chunk"], message["streamed"]) for message in sent_messages] == [(0, None), (None, 1)]
+        assert sent_before_produced == [1]
+
     @pytest.mark.asyncio
     async def test_run_loop_keyboard_interrupt(self):
         """Test loop termination on interrupt."""
@@ -51,6 +51,105 @@ class TestWebSocketConnect:
         assert body["message"] == "Connected"
         assert body["sessionId"] == "test-session-id"
 
+    @patch("boto3.client")
+    @patch("boto3.resource")
+    def test_session_compression_is_passed_to_instrumentation(self, mock_boto3_resource, mock_boto3_client):
+        """Test that the compression negotiated for the session reaches the instrumentation lambda."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"SessionId": "test-session-id", "StackName": "test-stack", "Compression": "zlib"}}
+        mock_boto3_resource.return_value.Table.return_value = mock_table
+        mock_lambda_client = Mock()
+        mock_lambda_client.invoke.return_value = {"StatusCode": 202}
+        mock_boto3_client.return_value = mock_lambda_client
+
+        event = {"requestContext": {"connectionId": "test-connection-id", "authorizer": {"sessionId": "test-session-id"}}}
+        lambda_handler(event, None)
+
+        payload = json.loads(mock_lambda_client.invoke.call_args[1]["Payload"])
+        assert payload["compression"] == "zlib"
+
+    @patch("boto3.client")
+    @patch("boto3.resource")
+    def test_session_mode_is_passed_to_instrumentation(self, mock_boto3_resource, mock_boto3_client):
+        """Test that the mode of the session reaches the instrumentation lambda."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"SessionId": "test-session-id", "StackName": "test-stack", "Mode": "shadow"}}
+        mock_boto3_resource.return_value.Table.return_value = mock_table
+        mock_lambda_client = Mock()
+        mock_lambda_client.invoke.return_value = {"StatusCode": 202}
+        mock_boto3_client.return_value = mock_lambda_client
+
+        event = {"requestContext": {"connectionId": "test-connection-id", "authorizer": {"sessionId": "test-session-id"}}}
+        lambda_handler(event, None)
+
+        payload = json.loads(mock_lambda_client.invoke.call_args[1]["Payload"])
+        assert payload["mode"] == "shadow"
+        assert "compression" not in payload
+        assert "snapStart" not in payload
+
+    @patch("boto3.client")
+    @patch("boto3.resource")
+    def test_session_snapstart_is_passed_to_instrumentation(self, mock_boto3_resource, mock_boto3_client):
+        """Test that SnapStart requested for the session reaches the instrumentation lambda."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"SessionId": "test-session-id", "StackName": "test-stack", "SnapStart": True}}
+        mock_boto3_resource.return_value.Table.return_value = mock_table
+        mock_lambda_client = Mock()
+        mock_lambda_client.invoke.return_value = {"StatusCode": 202}
+        mock_boto3_client.return_value = mock_lambda_client
+
+        event = {"requestContext": {"connectionId": "test-connection-id", "authorizer": {"sessionId": "test-session-id"}}}
+        lambda_handler(event, None)
+
+        payload = json.loads(mock_lambda_client.invoke.call_args[1]["Payload"])
+        assert payload["snapStart"] is True
+
+    @patch("boto3.client")
+    @patch("boto3.resource")
+    def test_session_access_is_passed_to_instrumentation(self, mock_boto3_resource, mock_boto3_client):
+        """Test that the access requested for the session reaches the instrumentation lambda."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"SessionId": "test-session-id", "StackName": "test-stack", "Access": "direct"}}
+        mock_boto3_resource.return_value.Table.return_value = mock_table
+        mock_lambda_client = Mock()
+        mock_lambda_client.invoke.return_value = {"StatusCode": 202}
+        mock_boto3_client.return_value = mock_lambda_client
+
+        event = {"requestContext": {"connectionId": "test-connection-id", "authorizer": {"sessionId": "test-session-id"}}}
+        lambda_handler(event, None)
+
+        payload = json.loads(mock_lambda_client.invoke.call_args[1]["Payload"])
+        assert payload["access"] == "direct"
+
+    @patch("boto3.client")
+    @patch("boto3.resource")
+    def test_session_runtime_secret_is_passed_to_instrumentation(self, mock_boto3_resource, mock_boto3_client):
+        """Test that the runtime secret of the session reaches the instrumentation lambda."""
+        mock_table = Mock()
+        mock_table.get_item.return_value = {"Item": {"SessionId": "test-session-id", "StackName": "test-stack", "RuntimeSecret": "runtime-secret"}}
+        mock_boto3_resource.return_value.Table.return_value = mock_table
+        mock_lambda_client = Mock()
+        mock_lambda_client.invoke.return_value = {"StatusCode": 202}
+        mock_boto3_client.return_value = mock_lambda_client
+
+        event = {"requestContext": {"connectionId": "test-connection-id", "authorizer": {"sessionId": "test-session-id"}}}
+        lambda_handler(event, None)
+
+        payload = json.loads(mock_lambda_client.invoke.call_args[1]["Payload"])
+        assert payload["runtimeSecret"] == "runtime-secret"
+
+    @patch("boto3.client")
+    @patch("boto3.resource")
+    def test_runtime_connection_does_not_touch_session(self, mock_boto3_resource, mock_boto3_client):
+        """Test that a runtime connection neither updates the session nor triggers instrumentation."""
+        event = {"requestContext": {"connectionId": "runtime-connection-id", "authorizer": {"sessionId": "test-session-id", "role": "runtime"}}}
+
+        result = lambda_handler(event, None)
+
+        assert result["statusCode"] == 200
+        mock_boto3_resource.assert_not_called()
+        mock_boto3_client.assert_not_called()
+
     @patch("boto3.resource")
     def test_missing_session_id_returns_403(self, mock_boto3_resource):
         """Test that missing sessionId returns 403 Forbidden."""
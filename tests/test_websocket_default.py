@@ -1,19 +1,24 @@
 import json
+import time
 from unittest.mock import Mock, patch
 
 import pytest
 
-from plldb.cloudformation.lambda_functions.websocket_default import lambda_handler, handle_debugger_response
+from plldb.cloudformation.lambda_functions.websocket_default import RESPONSE_CONDITION, STREAM_CHUNK_TTL_SECONDS, lambda_handler, handle_debugger_response
+
+DEBUGGER_CONTEXT = {"connectionId": "debugger-connection-id", "authorizer": {"sessionId": "session-1", "role": "debugger"}}
+SESSION_ITEM = {"Item": {"SessionId": "session-1", "Status": "ACTIVE", "ConnectionId": "debugger-connection-id"}}
 
 
 class TestWebSocketDefault:
     def test_lambda_handler_with_debugger_response(self):
         """Test handling debugger response message."""
-        event = {"body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "test-response"})}
+        event = {"requestContext": DEBUGGER_CONTEXT, "body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "test-response"})}
 
         with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
             # Mock DynamoDB
             mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
             mock_boto3.resource.return_value.Table.return_value = mock_table
 
             result = lambda_handler(event, None)
@@ -32,11 +37,12 @@ class TestWebSocketDefault:
 
     def test_lambda_handler_with_debugger_response_and_error(self):
         """Test handling debugger response with error message."""
-        event = {"body": json.dumps({"requestId": "test-request-id", "statusCode": 500, "response": "", "errorMessage": "Test error"})}
+        event = {"requestContext": DEBUGGER_CONTEXT, "body": json.dumps({"requestId": "test-request-id", "statusCode": 500, "response": "", "errorMessage": "Test error"})}
 
         with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
             # Mock DynamoDB
             mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
             mock_boto3.resource.return_value.Table.return_value = mock_table
 
             result = lambda_handler(event, None)
@@ -77,11 +83,12 @@ class TestWebSocketDefault:
 
     def test_lambda_handler_dynamodb_error(self):
         """Test handling DynamoDB errors."""
-        event = {"body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "test-response"})}
+        event = {"requestContext": DEBUGGER_CONTEXT, "body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "test-response"})}
 
         with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
             # Mock DynamoDB to raise error
             mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
             mock_table.update_item.side_effect = Exception("DynamoDB error")
             mock_boto3.resource.return_value.Table.return_value = mock_table
 
@@ -98,9 +105,10 @@ class TestWebSocketDefault:
         with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
             # Mock DynamoDB
             mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
             mock_boto3.resource.return_value.Table.return_value = mock_table
 
-            result = handle_debugger_response(body)
+            result = handle_debugger_response(body, "session-1")
 
             assert result["statusCode"] == 200
 
@@ -108,3 +116,204 @@ class TestWebSocketDefault:
             call_args = mock_table.update_item.call_args[1]
             assert call_args["UpdateExpression"] == "SET #resp = :resp, StatusCode = :status"
             assert call_args["ExpressionAttributeNames"]["#resp"] == "Response"
+
+    def test_handle_debugger_response_offloaded(self):
+        """Test that the location of an offloaded response is stored with the request."""
+        body = {"requestId": "test-request-id", "statusCode": 200, "response": "", "responseLocation": "s3://bucket/payloads/s/test-request-id/response.json"}
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+
+            result = handle_debugger_response(body, "session-1")
+
+            assert result["statusCode"] == 200
+            call_args = mock_table.update_item.call_args[1]
+            assert call_args["UpdateExpression"] == "SET #resp = :resp, StatusCode = :status, ResponseLocation = :location"
+            assert call_args["ExpressionAttributeValues"][":location"] == "s3://bucket/payloads/s/test-request-id/response.json"
+
+    def test_lambda_handler_pushes_response_to_runtime(self):
+        """Test that the response is pushed to the runtime connection stored on the request."""
+        event = {
+            "requestContext": {**DEBUGGER_CONTEXT, "domainName": "abc.execute-api.us-east-1.amazonaws.com", "stage": "prod"},
+            "body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "test-response"}),
+        }
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_table.update_item.return_value = {"Attributes": {"RequestId": "test-request-id", "RuntimeConnectionId": "runtime-connection-id"}}
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+            mock_client = mock_boto3.client.return_value
+
+            result = lambda_handler(event, None)
+
+            assert result["statusCode"] == 200
+            assert mock_table.update_item.call_args[1]["ReturnValues"] == "ALL_NEW"
+            mock_boto3.client.assert_called_once_with("apigatewaymanagementapi", endpoint_url="https://abc.execute-api.us-east-1.amazonaws.com/prod")
+            call_args = mock_client.post_to_connection.call_args[1]
+            assert call_args["ConnectionId"] == "runtime-connection-id"
+            assert json.loads(call_args["Data"]) == {"requestId": "test-request-id", "statusCode": 200, "response": "test-response", "errorMessage": None, "responseLocation": None, "encoding": None}
+
+    def test_lambda_handler_push_failure_keeps_stored_response(self):
+        """Test that a failed push does not fail the response handling."""
+        event = {
+            "requestContext": {**DEBUGGER_CONTEXT, "domainName": "abc.execute-api.us-east-1.amazonaws.com", "stage": "prod"},
+            "body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "test-response"}),
+        }
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_table.update_item.return_value = {"Attributes": {"RuntimeConnectionId": "runtime-connection-id"}}
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+            mock_boto3.client.return_value.post_to_connection.side_effect = Exception("GoneException")
+
+            result = lambda_handler(event, None)
+
+            assert result["statusCode"] == 200
+
+    def test_lambda_handler_registers_runtime(self):
+        """Test that a runtime registration is answered with its connection ID."""
+        event = {
+            "requestContext": {"connectionId": "runtime-connection-id", "domainName": "abc.execute-api.us-east-1.amazonaws.com", "stage": "prod"},
+            "body": json.dumps({"action": "registerRuntime"}),
+        }
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            result = lambda_handler(event, None)
+
+            assert result["statusCode"] == 200
+            call_args = mock_boto3.client.return_value.post_to_connection.call_args[1]
+            assert call_args["ConnectionId"] == "runtime-connection-id"
+            assert json.loads(call_args["Data"]) == {"runtimeConnectionId": "runtime-connection-id"}
+
+    def test_handle_debugger_response_superseded(self):
+        """Test that a response arriving after the runtime ran the handler itself is discarded."""
+        body = {"requestId": "test-request-id", "statusCode": 200, "response": "test-response"}
+        error = Exception("The conditional request failed")
+        error.response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_table.update_item.side_effect = error
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+
+            result = handle_debugger_response(body, "session-1", "https://abc.execute-api.us-east-1.amazonaws.com/prod")
+
+            assert result["statusCode"] == 409
+            assert mock_table.update_item.call_args[1]["ConditionExpression"] == RESPONSE_CONDITION
+            mock_boto3.client.return_value.post_to_connection.assert_not_called()
+
+    def test_lambda_handler_relays_chunk(self):
+        """Test that a chunk of a streamed response is stored as its own item and pushed to the runtime."""
+        event = {
+            "requestContext": {**DEBUGGER_CONTEXT, "domainName": "abc.execute-api.us-east-1.amazonaws.com", "stage": "prod"},
+            "body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "Y2h1bms=", "chunk": 2}),
+        }
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_table.update_item.return_value = {"Attributes": {"RequestId": "test-request-id", "SessionId": "session-1", "RuntimeConnectionId": "runtime-connection-id"}}
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+            mock_client = mock_boto3.client.return_value
+
+            result = lambda_handler(event, None)
+
+            assert result["statusCode"] == 200
+            update_args = mock_table.update_item.call_args[1]
+            assert update_args["UpdateExpression"] == "SET Streaming = :streaming"
+            assert update_args["ConditionExpression"] == RESPONSE_CONDITION
+            item = mock_table.put_item.call_args[1]["Item"]
+            assert int(time.time()) < item.pop("TTL") <= int(time.time()) + STREAM_CHUNK_TTL_SECONDS
+            assert item == {"RequestId": "test-request-id#chunk#2", "Chunk": b"chunk", "SessionId": "session-1"}
+            pushed = json.loads(mock_client.post_to_connection.call_args[1]["Data"])
+            assert (pushed["chunk"], pushed["response"]) == (2, "Y2h1bms=")
+            assert "streamed" not in pushed
+
+    def test_chunk_of_superseded_request_is_discarded(self):
+        """Test that chunks arriving after the runtime ran the handler itself are neither stored nor pushed."""
+        body = {"requestId": "test-request-id", "statusCode": 200, "response": "Y2h1bms=", "chunk": 0}
+        error = Exception("The conditional request failed")
+        error.response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_table.update_item.side_effect = error
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+
+            result = lambda_handler({"requestContext": {**DEBUGGER_CONTEXT, "domainName": "abc.execute-api.us-east-1.amazonaws.com", "stage": "prod"}, "body": json.dumps(body)}, None)
+
+            assert result["statusCode"] == 409
+            mock_table.put_item.assert_not_called()
+            mock_boto3.client.return_value.post_to_connection.assert_not_called()
+
+    def test_handle_debugger_response_end_of_stream(self):
+        """Test that the end of a streamed response stores the number of chunks."""
+        body = {"requestId": "test-request-id", "statusCode": 500, "response": "", "errorMessage": "broken", "streamed": 3}
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+
+            result = handle_debugger_response(body, "session-1")
+
+            assert result["statusCode"] == 200
+            call_args = mock_table.update_item.call_args[1]
+            assert call_args["UpdateExpression"] == "SET #resp = :resp, StatusCode = :status, ErrorMessage = :error, Streamed = :streamed"
+            assert call_args["ExpressionAttributeValues"][":streamed"] == 3
+
+    def test_response_from_runtime_connection_is_rejected(self):
+        """Test that a runtime connected to the session cannot answer requests."""
+        event = {
+            "requestContext": {"connectionId": "runtime-connection-id", "authorizer": {"sessionId": "session-1", "role": "runtime"}},
+            "body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "forged"}),
+        }
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+
+            result = lambda_handler(event, None)
+
+            assert result["statusCode"] == 403
+            mock_table.update_item.assert_not_called()
+
+    def test_response_from_other_connection_is_rejected(self):
+        """Test that only the connection stored on the session when the debugger connected may answer."""
+        event = {
+            "requestContext": {"connectionId": "other-connection-id", "authorizer": {"sessionId": "session-1", "role": "debugger"}},
+            "body": json.dumps({"requestId": "test-request-id", "statusCode": 200, "response": "Y2h1bms=", "chunk": 0}),
+        }
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_table.get_item.return_value = SESSION_ITEM
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+
+            result = lambda_handler(event, None)
+
+            assert result["statusCode"] == 403
+            mock_table.get_item.assert_called_once_with(Key={"SessionId": "session-1"})
+            mock_table.update_item.assert_not_called()
+            mock_table.put_item.assert_not_called()
+
+    def test_response_is_stored_only_on_requests_of_the_session(self):
+        """Test that the response is conditioned on the request belonging to the session of the debugger."""
+        body = {"requestId": "test-request-id", "statusCode": 200, "response": "test-response"}
+
+        with patch("plldb.cloudformation.lambda_functions.websocket_default.boto3") as mock_boto3:
+            mock_table = Mock()
+            mock_boto3.resource.return_value.Table.return_value = mock_table
+
+            handle_debugger_response(body, "session-1")
+
+            call_args = mock_table.update_item.call_args[1]
+            assert call_args["ConditionExpression"] == RESPONSE_CONDITION
+            assert call_args["ExpressionAttributeValues"][":session_id"] == "session-1"